@@ -0,0 +1,346 @@
+#!/usr/bin/env python
+# Copyright 2015-2016 Yelp Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Usage: ./api_recorder.py <bundle> [options]
+
+Record and replay the responses paasta gets from Marathon, Mesos and haproxy.
+
+When the ``PAASTA_RECORD_FIXTURES`` environment variable points at a file,
+``marathon_tools.get_marathon_client``, ``mesos_tools.fetch_state`` and
+``smartstack_tools.retrieve_haproxy_csv`` append every response they receive
+to that file (a "fixture bundle", one JSON document per line). Anything that
+looks like a credential is redacted before it hits the disk.
+
+Running this script serves a fixture bundle from local stand-in servers, one
+for every host the bundle was recorded from, replaying each response with the
+latency it was originally recorded with. Point marathon.json, the mesos-cli
+config and ``synapse_haproxy_url_format`` at them to run paasta against a
+faithful copy of a production cluster, offline.
+
+Command line options:
+
+- -H <HOST>, --host <HOST>: Address to listen on
+- -p <PORT>, --port <PORT>: Port to listen on for the first recorded host; the others get the ports after it
+- -s <SPEED>, --speed <SPEED>: Replay latencies this many times faster
+"""
+import argparse
+import io
+import json
+import logging
+import os
+import re
+import threading
+import time
+from BaseHTTPServer import BaseHTTPRequestHandler
+from BaseHTTPServer import HTTPServer
+from SocketServer import ThreadingMixIn
+from urlparse import urlsplit
+from urlparse import urlunsplit
+
+from marathon import MarathonClient
+
+
+RECORD_FIXTURES_ENV = 'PAASTA_RECORD_FIXTURES'
+REDACTED = '<redacted>'
+# Keys whose values are never written to a fixture bundle, wherever they appear in a response body.
+SECRET_KEY_RE = re.compile(r'(pass|secret|token|credential|auth|private_?key)', re.IGNORECASE)
+
+log = logging.getLogger(__name__)
+log.addHandler(logging.NullHandler())
+
+_recorders = {}
+_recorders_lock = threading.Lock()
+
+
+def redact_url(url):
+    """Strips any user:password@ portion from a url."""
+    parts = urlsplit(url)
+    netloc = parts.netloc.rsplit('@', 1)[-1]
+    return urlunsplit((parts.scheme, netloc, parts.path, parts.query, parts.fragment))
+
+
+def redact_secrets(obj):
+    """Returns a copy of a decoded JSON document with the values of secret-looking keys replaced."""
+    if isinstance(obj, dict):
+        return dict(
+            (key, REDACTED if SECRET_KEY_RE.search(key) else redact_secrets(value))
+            for key, value in obj.items()
+        )
+    elif isinstance(obj, list):
+        return [redact_secrets(value) for value in obj]
+    else:
+        return obj
+
+
+def redact_body(body, content_type):
+    if 'json' not in (content_type or ''):
+        return body
+    try:
+        return json.dumps(redact_secrets(json.loads(body)), sort_keys=True)
+    except ValueError:
+        return body
+
+
+class FixtureRecorder(object):
+    """Appends HTTP exchanges to a fixture bundle.
+
+    Like the FileLogWriter, each exchange is written with a single write() on an O_APPEND file, so several
+    paasta processes can record into the same bundle at once."""
+
+    def __init__(self, path):
+        self.path = path
+
+    def record(self, source, method, url, status_code, content_type, body, latency):
+        parts = urlsplit(redact_url(url))
+        exchange = {
+            'source': source,
+            'method': method,
+            'url': urlunsplit(parts),
+            'path': urlunsplit(('', '', parts.path, parts.query, '')),
+            'status_code': status_code,
+            'content_type': content_type,
+            'body': redact_body(body, content_type),
+            'latency': latency,
+            'recorded_at': time.time(),
+        }
+        with io.FileIO(self.path, mode='a') as f:
+            f.write('%s\n' % json.dumps(exchange, sort_keys=True))
+
+    def record_response(self, source, response):
+        """Records a requests.Response object."""
+        self.record(
+            source=source,
+            method=response.request.method,
+            url=response.url,
+            status_code=response.status_code,
+            content_type=response.headers.get('content-type'),
+            body=response.text,
+            latency=response.elapsed.total_seconds(),
+        )
+
+
+def get_fixture_recorder(environ=None):
+    """Returns the FixtureRecorder for the bundle named by PAASTA_RECORD_FIXTURES, or None if recording is off."""
+    path = (os.environ if environ is None else environ).get(RECORD_FIXTURES_ENV)
+    if not path:
+        return None
+    with _recorders_lock:
+        if path not in _recorders:
+            _recorders[path] = FixtureRecorder(path)
+        return _recorders[path]
+
+
+def maybe_record_response(source, response):
+    """Records a requests.Response in the active fixture bundle, if there is one."""
+    recorder = get_fixture_recorder()
+    if recorder is not None:
+        recorder.record_response(source, response)
+
+
+class RecordingMarathonClient(MarathonClient):
+    """A MarathonClient that records every response it gets into a fixture bundle, errors included, against
+    the server that sent it.
+
+    Responses are recorded by a hook on the requests.Session the client sends its requests over, so this has
+    to be mixed in ahead of a client that uses one, like marathon_tools.PaastaMarathonClient."""
+
+    def __init__(self, recorder, *args, **kwargs):
+        super(RecordingMarathonClient, self).__init__(*args, **kwargs)
+        self.recorder = recorder
+        self.session.hooks['response'].append(self.record_response)
+
+    def record_response(self, response, *args, **kwargs):
+        self.recorder.record_response('marathon', response)
+
+
+def load_fixture_bundle(path):
+    """Reads a fixture bundle.
+
+    :returns: A list of recorded exchanges, in the order they were recorded"""
+    with open(path) as f:
+        exchanges = [json.loads(line) for line in f if line.strip()]
+    return sorted(exchanges, key=lambda exchange: exchange['recorded_at'])
+
+
+def get_recorded_host(exchange):
+    """Returns the host:port an exchange was recorded from, or '' if it doesn't say."""
+    return urlsplit(exchange.get('url', '')).netloc
+
+
+def get_recorded_hosts(exchanges):
+    return sorted(set(get_recorded_host(exchange) for exchange in exchanges))
+
+
+class FixtureIndex(object):
+    """Looks up the recorded response for a request to one of the recorded hosts. When the same request was
+    recorded several times, the recordings are handed out in order, and the last one is repeated once they
+    run out."""
+
+    def __init__(self, exchanges):
+        self.exchanges = {}
+        for exchange in exchanges:
+            for key in self._keys(get_recorded_host(exchange), exchange['method'], exchange['path']):
+                self.exchanges.setdefault(key, []).append(exchange)
+        self.served = {}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def _keys(recorded_host, method, path):
+        # Exact match first, then the same path with any query string ignored.
+        bare_path = path.split('?', 1)[0]
+        keys = [(recorded_host, method, path)]
+        if bare_path != path:
+            keys.append((recorded_host, method, bare_path))
+        return keys
+
+    def lookup(self, recorded_host, method, path):
+        with self.lock:
+            for key in self._keys(recorded_host, method, path):
+                if key in self.exchanges:
+                    candidates = self.exchanges[key]
+                    index = self.served.get(key, 0)
+                    self.served[key] = index + 1
+                    return candidates[min(index, len(candidates) - 1)]
+        return None
+
+
+class FixtureReplayHandler(BaseHTTPRequestHandler):
+
+    def replay(self):
+        content_length = int(self.headers.getheader('content-length') or 0)
+        if content_length:
+            self.rfile.read(content_length)
+        exchange = self.server.index.lookup(self.server.recorded_host, self.command, self.path)
+        if exchange is None:
+            log.warning("No recorded response for %s %s", self.command, self.path)
+            self.send_response(404)
+            self.send_header('Content-Type', 'application/json')
+            self.end_headers()
+            self.wfile.write(json.dumps({'message': 'No recorded response for %s' % self.path}))
+            return
+        if self.server.speed:
+            time.sleep(exchange['latency'] / self.server.speed)
+        body = exchange['body'].encode('utf-8')
+        self.send_response(exchange['status_code'])
+        self.send_header('Content-Type', exchange['content_type'] or 'text/plain')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    do_GET = do_POST = do_PUT = do_DELETE = replay
+
+    def log_message(self, format, *args):
+        log.debug(format, *args)
+
+
+class FixtureReplayServer(ThreadingMixIn, HTTPServer):
+    """A local stand-in for one of the Marathon servers, Mesos masters and haproxies a fixture bundle was
+    recorded from, which serves the responses recorded from it.
+
+    :param exchanges: The recorded exchanges, as returned by load_fixture_bundle
+    :param speed: Latencies are divided by this; 0 replays with no latency at all
+    :param recorded_host: The host:port to stand in for; may be left out if the bundle was recorded from one
+    """
+    daemon_threads = True
+
+    def __init__(self, exchanges, host='127.0.0.1', port=0, speed=1.0, recorded_host=None):
+        if recorded_host is None:
+            recorded_hosts = get_recorded_hosts(exchanges)
+            if len(recorded_hosts) > 1:
+                raise ValueError("The exchanges were recorded from %s; pick the one to stand in for" %
+                                 ', '.join(recorded_hosts))
+            recorded_host = recorded_hosts[0] if recorded_hosts else ''
+        HTTPServer.__init__(self, (host, port), FixtureReplayHandler)
+        self.index = FixtureIndex(exchanges)
+        self.recorded_host = recorded_host
+        self.speed = speed
+        self.thread = None
+
+    @property
+    def url(self):
+        return 'http://%s:%d' % self.server_address
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        if self.thread is not None:
+            self.thread.join()
+
+
+def start_fixture_replay_servers(exchanges, host='127.0.0.1', port=0, speed=1.0):
+    """Starts a FixtureReplayServer for every host the exchanges were recorded from, on consecutive ports
+    from port (or on free ones, if port is 0).
+
+    :returns: A dict of {recorded host: its started FixtureReplayServer}
+    """
+    exchanges_by_host = {}
+    for exchange in exchanges:
+        exchanges_by_host.setdefault(get_recorded_host(exchange), []).append(exchange)
+    servers = {}
+    try:
+        for offset, recorded_host in enumerate(sorted(exchanges_by_host)):
+            server = FixtureReplayServer(exchanges_by_host[recorded_host], host=host,
+                                         port=port + offset if port else 0, speed=speed,
+                                         recorded_host=recorded_host)
+            servers[recorded_host] = server.start()
+    except Exception:
+        for server in servers.values():
+            server.stop()
+        raise
+    return servers
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Serves a recorded fixture bundle from local stand-in servers.')
+    parser.add_argument('bundle', help="The fixture bundle to replay")
+    parser.add_argument('-H', '--host', dest="host", default='127.0.0.1',
+                        help="The address to listen on")
+    parser.add_argument('-p', '--port', dest="port", type=int, default=0,
+                        help="The port to listen on for the first recorded host; the others get the ports "
+                             "after it (default: pick free ones)")
+    parser.add_argument('-s', '--speed', dest="speed", type=float, default=1.0,
+                        help="Replay recorded latencies this many times faster. 0 disables latency.")
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        dest="verbose", default=False)
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    if args.verbose:
+        logging.basicConfig(level=logging.DEBUG)
+    else:
+        logging.basicConfig(level=logging.WARNING)
+    servers = start_fixture_replay_servers(load_fixture_bundle(args.bundle), host=args.host, port=args.port,
+                                           speed=args.speed)
+    print "Replaying %s:" % args.bundle
+    for recorded_host, server in sorted(servers.items()):
+        print "  %s on %s" % (recorded_host or 'unknown host', server.url)
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        for server in servers.values():
+            server.stop()
+
+
+if __name__ == "__main__":
+    main()
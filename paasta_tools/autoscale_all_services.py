@@ -16,6 +16,7 @@ import argparse
 
 from paasta_tools.autoscaling_lib import autoscale_services
 from paasta_tools.marathon_tools import DEFAULT_SOA_DIR
+from paasta_tools.utils import configure_timing
 
 
 def parse_args():
@@ -30,6 +31,7 @@ def parse_args():
 def main():
     args = parse_args()
     soa_dir = args.soa_dir
+    configure_timing()
     autoscale_services(soa_dir)
 
 
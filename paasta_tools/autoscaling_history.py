@@ -0,0 +1,156 @@
+# Copyright 2015-2016 Yelp Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+A compact, append-only record of what the autoscaler saw and decided for each marathon instance.
+
+Every time autoscale_marathon_instance makes a decision, it appends one record to the instance's
+history file: when it ran, the utilization the metrics provider reported, the error worked out from
+it, how many instances were running, and how many the decision policy added (negative if it removed
+some). Records are RECORD_SIZE bytes each, so a history file is an array of them: reading one is a
+single read and a single struct unpack into one array per field, and a torn write at the end of the
+file only ever costs the record being written.
+"""
+import array
+import bisect
+import logging
+import os
+import struct
+from collections import namedtuple
+
+from paasta_tools.utils import atomic_file_write
+from paasta_tools.utils import compose_job_id
+
+log = logging.getLogger(__name__)
+
+# timestamp (uint32 unix time), utilization (float32), error (float32), instances (uint16) and decision (int16)
+RECORD_FORMAT = 'IffHh'
+RECORD_STRUCT = struct.Struct('<' + RECORD_FORMAT)
+RECORD_SIZE = RECORD_STRUCT.size
+TIMESTAMP_STRUCT = struct.Struct('<I')
+# The array typecode each field is read into.
+COLUMN_TYPECODES = ('L', 'd', 'd', 'H', 'h')
+# About a year of decisions made every five minutes, or 1.6MB.
+DEFAULT_MAX_RECORDS = 105120
+# How far past max_records a history may grow before its oldest records are dropped, as a fraction of
+# max_records; this keeps appends from rewriting the file every time.
+COMPACTION_SLACK = 0.1
+
+HistoryRecord = namedtuple('HistoryRecord', ['timestamp', 'utilization', 'error', 'instances', 'decision'])
+
+
+class HistoryColumns(namedtuple('HistoryColumns', HistoryRecord._fields)):
+    """The records of a history, as one array per field."""
+
+    def __len__(self):
+        return len(self.timestamp)
+
+    def records(self):
+        return [HistoryRecord(*fields) for fields in zip(*self)]
+
+    def since(self, timestamp):
+        """Returns the columns of the records made at or after timestamp."""
+        start = bisect.bisect_left(self.timestamp, timestamp)
+        return HistoryColumns(*(column[start:] for column in self))
+
+
+def empty_columns():
+    return HistoryColumns(*(array.array(typecode) for typecode in COLUMN_TYPECODES))
+
+
+def decode_records(data):
+    """Decodes packed records into HistoryColumns, ignoring an incomplete record at the end of data."""
+    count = len(data) // RECORD_SIZE
+    if not count:
+        return empty_columns()
+    values = struct.unpack('<' + RECORD_FORMAT * count, data[:count * RECORD_SIZE])
+    fields = len(RECORD_FORMAT)
+    return HistoryColumns(*(array.array(typecode, values[index::fields])
+                            for index, typecode in enumerate(COLUMN_TYPECODES)))
+
+
+def encode_record(record):
+    """Packs a HistoryRecord, clamping instance counts and decisions to the range their fields can hold."""
+    return RECORD_STRUCT.pack(
+        int(record.timestamp),
+        record.utilization,
+        record.error,
+        max(0, min(int(record.instances), 0xffff)),
+        max(-0x8000, min(int(record.decision), 0x7fff)),
+    )
+
+
+def find_first_record_since(f, timestamp):
+    """Returns the index of the first record of a history file made at or after timestamp, binary
+    searching the file so that only a few timestamps are read however long it is."""
+    low, high = 0, os.fstat(f.fileno()).st_size // RECORD_SIZE
+    while low < high:
+        middle = (low + high) // 2
+        f.seek(middle * RECORD_SIZE)
+        if TIMESTAMP_STRUCT.unpack(f.read(TIMESTAMP_STRUCT.size))[0] < timestamp:
+            low = middle + 1
+        else:
+            high = middle
+    return low
+
+
+def get_history_path(service, instance, history_dir):
+    return os.path.join(history_dir, '%s.history' % compose_job_id(service, instance))
+
+
+class AutoscalingHistory(object):
+    """The history file of one instance.
+
+    :param path: Where the history is kept
+    :param max_records: How many of the latest records to keep
+    """
+
+    def __init__(self, path, max_records=DEFAULT_MAX_RECORDS):
+        self.path = path
+        self.max_records = max_records
+
+    def append(self, record):
+        """Adds a HistoryRecord to the end of the history, dropping the oldest records once there are
+        too many."""
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        with open(self.path, 'ab') as f:
+            f.write(encode_record(record))
+            size = f.tell()
+        if size > self.max_records * (1 + COMPACTION_SLACK) * RECORD_SIZE:
+            self.compact()
+
+    def compact(self):
+        """Rewrites the history with only its latest max_records records."""
+        with open(self.path, 'rb') as f:
+            data = f.read()
+        count = len(data) // RECORD_SIZE
+        keep = min(count, self.max_records)
+        with atomic_file_write(self.path) as f:
+            f.write(data[(count - keep) * RECORD_SIZE:count * RECORD_SIZE])
+
+    def read(self, since=None):
+        """Reads the history.
+
+        :param since: Only read the records made at or after this unix time
+        :returns: HistoryColumns, empty if there is no history yet
+        """
+        try:
+            with open(self.path, 'rb') as f:
+                if since is not None:
+                    f.seek(find_first_record_since(f, since) * RECORD_SIZE)
+                return decode_records(f.read())
+        except IOError as e:
+            log.debug("No autoscaling history at %s: %s" % (self.path, e))
+            return empty_columns()
@@ -0,0 +1,180 @@
+# Copyright 2015-2016 Yelp Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Replays the autoscaling history of an instance through decision policies, to see what each would have cost.
+
+The load an instance had at each point of its history is the utilization it reported times the
+number of instances that were running, i.e. how many instances' worth of work there was. A
+simulation starts with as many instances as the history does, and at each point works out the
+utilization that load would have caused on the simulated instances, asks the decision policy what to
+do about it exactly like autoscale_marathon_instance does, and keeps the result until the next point.
+
+Each interval is then scored against the load at its end:
+
+- over-provisioned instance-hours: the instances beyond what the load needed at the setpoint (and
+  beyond min_instances, which are never over-provisioning)
+- SLO-violation minutes: the time the utilization was above slo_utilization
+
+The decisions that were actually made are scored the same way, as the "recorded" baseline.
+"""
+from collections import namedtuple
+
+from paasta_tools.autoscaling_lib import AUTOSCALING_DELAY
+from paasta_tools.autoscaling_lib import DECISION_POLICY_KEY
+from paasta_tools.autoscaling_lib import get_error_from_utilization
+from paasta_tools.autoscaling_lib import get_needed_instances
+from paasta_tools.autoscaling_lib import InMemoryPolicyState
+from paasta_tools.autoscaling_lib import SERVICE_METRICS_PROVIDER_KEY
+
+RECORDED_POLICY = 'recorded'
+DEFAULT_SLO_UTILIZATION = 0.9
+# Gaps in the history longer than this, e.g. while the autoscaler was down, are only counted this long.
+MAX_INTERVAL_S = 2 * AUTOSCALING_DELAY
+
+SimulationResult = namedtuple('SimulationResult', [
+    'policy',
+    'instance_hours',
+    'overprovisioned_instance_hours',
+    'slo_violation_minutes',
+    'scaling_actions',
+])
+
+
+def get_loads(history):
+    """Returns how many instances' worth of work there was at each point of a history."""
+    return [utilization * instances for utilization, instances in zip(history.utilization, history.instances)]
+
+
+def get_increasing_points(history):
+    """Returns the indexes of the points of a history whose timestamps are later than all before them."""
+    points = []
+    for index, timestamp in enumerate(history.timestamp):
+        if not points or timestamp > history.timestamp[points[-1]]:
+            points.append(index)
+    return points
+
+
+class Scorecard(object):
+    """Adds up the cost of running some number of instances against a load over time."""
+
+    def __init__(self, setpoint, min_instances, slo_utilization):
+        self.setpoint = setpoint
+        self.min_instances = min_instances
+        self.slo_utilization = slo_utilization
+        self.instance_hours = 0.0
+        self.overprovisioned_instance_hours = 0.0
+        self.slo_violation_minutes = 0.0
+        self.scaling_actions = 0
+
+    def add_interval(self, instances, load, seconds):
+        seconds = min(seconds, MAX_INTERVAL_S)
+        self.instance_hours += instances * seconds / 3600.0
+        needed = get_needed_instances(load, self.setpoint, self.min_instances)
+        self.overprovisioned_instance_hours += max(0, instances - needed) * seconds / 3600.0
+        if load > self.slo_utilization * instances:
+            self.slo_violation_minutes += seconds / 60.0
+
+    def get_result(self, policy):
+        return SimulationResult(
+            policy=policy,
+            instance_hours=self.instance_hours,
+            overprovisioned_instance_hours=self.overprovisioned_instance_hours,
+            slo_violation_minutes=self.slo_violation_minutes,
+            scaling_actions=self.scaling_actions,
+        )
+
+
+def get_policy_params(autoscaling_params):
+    """Returns the autoscaling params that autoscale_marathon_instance hands to the decision policy."""
+    return dict((key, value) for key, value in autoscaling_params.items()
+                if key not in (SERVICE_METRICS_PROVIDER_KEY, DECISION_POLICY_KEY, 'setpoint'))
+
+
+def simulate_policy(history, policy, decision_policy, min_instances, max_instances, autoscaling_params,
+                    slo_utilization=DEFAULT_SLO_UTILIZATION):
+    """Replays a history through a decision policy.
+
+    :param history: The HistoryColumns to replay
+    :param policy: The name to report the result under
+    :param decision_policy: A decision policy, as returned by get_decision_policy
+    :param min_instances: The fewest instances the simulation may scale to
+    :param max_instances: The most instances the simulation may scale to
+    :param autoscaling_params: The instance's autoscaling params, as returned by get_autoscaling_params
+    :param slo_utilization: The utilization above which the instance is considered to violate its SLO
+    :returns: A SimulationResult
+    """
+    setpoint = autoscaling_params['setpoint']
+    policy_params = get_policy_params(autoscaling_params)
+    policy_state = InMemoryPolicyState()
+    scorecard = Scorecard(setpoint, min_instances, slo_utilization)
+    loads = get_loads(history)
+    points = get_increasing_points(history)
+    if not points:
+        return scorecard.get_result(policy)
+
+    instances = history.instances[points[0]]
+    for index, next_index in zip(points, points[1:]):
+        utilization = loads[index] / max(instances, 1)
+        error = get_error_from_utilization(
+            utilization=utilization,
+            setpoint=setpoint,
+            current_instances=max(instances, 1),
+        )
+        autoscaling_amount = decision_policy(
+            error=error,
+            min_instances=min_instances,
+            max_instances=max_instances,
+            current_instances=instances,
+            zookeeper_path=None,
+            utilization=utilization,
+            setpoint=setpoint,
+            # Policies only look at the history made before current_time.
+            history=history,
+            policy_state=policy_state,
+            current_time=history.timestamp[index],
+            **policy_params
+        )
+        new_instances = max(min_instances, min(max_instances, instances + autoscaling_amount))
+        if new_instances != instances:
+            scorecard.scaling_actions += 1
+        instances = new_instances
+        scorecard.add_interval(instances, loads[next_index], history.timestamp[next_index] - history.timestamp[index])
+    return scorecard.get_result(policy)
+
+
+def score_recorded_decisions(history, min_instances, setpoint, slo_utilization=DEFAULT_SLO_UTILIZATION):
+    """Scores the decisions a history recorded, the same way simulate_policy scores a policy's."""
+    scorecard = Scorecard(setpoint, min_instances, slo_utilization)
+    loads = get_loads(history)
+    points = get_increasing_points(history)
+    for index, next_index in zip(points, points[1:]):
+        if history.decision[index]:
+            scorecard.scaling_actions += 1
+        scorecard.add_interval(history.instances[index] + history.decision[index], loads[next_index],
+                               history.timestamp[next_index] - history.timestamp[index])
+    return scorecard.get_result(RECORDED_POLICY)
+
+
+def simulate(history, decision_policies, min_instances, max_instances, autoscaling_params,
+             slo_utilization=DEFAULT_SLO_UTILIZATION):
+    """Scores the recorded decisions of a history, then every given decision policy on it.
+
+    :param decision_policies: A dict of {name: decision policy}
+    :returns: A list of SimulationResult, the recorded one first and then one per policy by name
+    """
+    results = [score_recorded_decisions(history, min_instances, autoscaling_params['setpoint'], slo_utilization)]
+    for name, decision_policy in sorted(decision_policies.items()):
+        results.append(simulate_policy(history, name, decision_policy, min_instances, max_instances,
+                                       autoscaling_params, slo_utilization))
+    return results
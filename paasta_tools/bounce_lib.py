@@ -16,36 +16,43 @@ import datetime
 import fcntl
 import logging
 import os
-import signal
 import time
 from contextlib import contextmanager
 from contextlib import nested
 
 import marathon_tools
 import mesos_tools
-from kazoo.client import KazooClient
+import requests
+from concurrent.futures import ThreadPoolExecutor
 from kazoo.exceptions import LockTimeout
 from marathon.models import MarathonApp
 
 from paasta_tools.monitoring.replication_utils import \
     get_registered_marathon_tasks
+from paasta_tools.smartstack_tools import HaproxySnapshot
 from paasta_tools.utils import compose_job_id
-from paasta_tools.utils import load_system_paasta_config
+from paasta_tools.utils import Deadline
+from paasta_tools.utils import deadline_timeout
+from paasta_tools.utils import get_zookeeper_session
+from paasta_tools.utils import sleep_within_deadline
+from paasta_tools.utils import timed
 
 
 log = logging.getLogger(__name__)
 log.addHandler(logging.NullHandler())
 logging.getLogger("requests").setLevel(logging.WARNING)
 
-ZK_LOCK_CONNECT_TIMEOUT_S = 10.0  # seconds to wait to connect to zookeeper
 ZK_LOCK_PATH = '/bounce'
 WAIT_CREATE_S = 3
 WAIT_DELETE_S = 5
+WAIT_DELETE_TIMEOUT_S = 60
+# The most haproxies get_happy_tasks will query at once, one per discovery location
+MAX_HAPROXY_QUERY_THREADS = 16
 
 
 class TimeoutException(Exception):
 
-    """An exception type used by time_limit."""
+    """An exception type used by time_limit and wait_for_delete."""
     pass
 
 
@@ -97,70 +104,76 @@ def bounce_lock(name):
 
 
 @contextmanager
-def bounce_lock_zookeeper(name):
+def zookeeper_lock_client(zk=None):
+    """A contextmanager that gives a started KazooClient to take locks with.
+    If zk is given, it is used as is; otherwise this leases the process-wide zookeeper session,
+    so locks taken one after another (or from several threads) while a lease is held share one connection.
+
+    :param zk: An already started KazooClient, or None"""
+    if zk is not None:
+        yield zk
+        return
+    with get_zookeeper_session().lease() as zk:
+        yield zk
+
+
+@contextmanager
+def bounce_lock_zookeeper(name, zk=None):
     """Acquire a bounce lock in zookeeper for the name given. The name should
     generally be the service namespace being bounced.
     This is a contextmanager. Please use it via 'with bounce_lock(name):'.
-    :param name: The lock name to acquire"""
-    zk = KazooClient(hosts=load_system_paasta_config().get_zk_hosts(), timeout=ZK_LOCK_CONNECT_TIMEOUT_S)
-    zk.start()
-    lock = zk.Lock('%s/%s' % (ZK_LOCK_PATH, name))
-    try:
-        lock.acquire(timeout=1)  # timeout=0 throws some other strange exception
-        yield
-    except LockTimeout:
-        raise LockHeldException("Service %s is already being bounced!" % name)
-    else:
-        lock.release()
-    finally:
-        zk.stop()
+    :param name: The lock name to acquire
+    :param zk: A started KazooClient to take the lock with; by default the shared zookeeper session is leased"""
+    with zookeeper_lock_client(zk) as zk:
+        lock = zk.Lock('%s/%s' % (ZK_LOCK_PATH, name))
+        try:
+            with timed('bounce_lib.bounce_lock_acquire'):
+                lock.acquire(timeout=deadline_timeout(1))  # timeout=0 throws some other strange exception
+            yield
+        except LockTimeout:
+            raise LockHeldException("Service %s is already being bounced!" % name)
+        else:
+            lock.release()
 
 
 @contextmanager
-def create_app_lock():
+def create_app_lock(zk=None):
     """Acquire a lock in zookeeper for creating a marathon app. This is
     due to marathon's extreme lack of resilience with creating multiple
     apps at once, so we use this to not do that and only deploy
-    one app at a time."""
-    zk = KazooClient(hosts=load_system_paasta_config().get_zk_hosts(), timeout=ZK_LOCK_CONNECT_TIMEOUT_S)
-    zk.start()
-    lock = zk.Lock('%s/%s' % (ZK_LOCK_PATH, 'create_marathon_app_lock'))
-    try:
-        lock.acquire(timeout=30)  # timeout=0 throws some other strange exception
-        yield
-    except LockTimeout:
-        raise LockHeldException("Failed to acquire lock for creating marathon app!")
-    else:
-        lock.release()
-    finally:
-        zk.stop()
+    one app at a time.
+    :param zk: A started KazooClient to take the lock with; by default the shared zookeeper session is leased"""
+    with zookeeper_lock_client(zk) as zk:
+        lock = zk.Lock('%s/%s' % (ZK_LOCK_PATH, 'create_marathon_app_lock'))
+        try:
+            with timed('bounce_lib.create_app_lock_acquire'):
+                lock.acquire(timeout=deadline_timeout(30))  # timeout=0 throws some other strange exception
+            yield
+        except LockTimeout:
+            raise LockHeldException("Failed to acquire lock for creating marathon app!")
+        else:
+            lock.release()
 
 
-@contextmanager
 def time_limit(minutes):
-    """A contextmanager to raise a TimeoutException whenever a specified
-    number of minutes has passed.
+    """A contextmanager to raise a TimeoutException once a specified
+    number of minutes has passed. This is a utils.Deadline, so the work
+    inside it has to check it (or use it for its socket timeouts), but it
+    is safe to use from any thread.
 
     :param minutes: The number of minutes until an exception is raised"""
-    def signal_handler(signum, frame):
-        raise TimeoutException("Time limit expired")
-    signal.signal(signal.SIGALRM, signal_handler)
-    signal.alarm(minutes * 60)
-    try:
-        yield
-    finally:
-        signal.alarm(0)
+    return Deadline(minutes * 60, error_message="Time limit expired", exception=TimeoutException)
 
 
 def wait_for_create(app_id, client):
     """Wait for the specified app_id to be listed in marathon.
-    Waits WAIT_CREATE_S seconds between calls to list_apps.
+    Waits WAIT_CREATE_S seconds between checks.
 
     :param app_id: The app_id to ensure creation for
     :param client: A MarathonClient object"""
     while marathon_tools.is_app_id_running(app_id, client) is False:
         log.info("Waiting for %s to be created in marathon..", app_id)
-        time.sleep(WAIT_CREATE_S)
+        sleep_within_deadline(WAIT_CREATE_S)
 
 
 def create_marathon_app(app_id, config, client):
@@ -174,30 +187,38 @@ def create_marathon_app(app_id, config, client):
         wait_for_create(app_id, client)
 
 
-def wait_for_delete(app_id, client):
+def wait_for_delete(app_id, client, timeout_s=None):
     """Wait for the specified app_id to not be listed in marathon
     anymore. Waits WAIT_DELETE_S seconds inbetween checks.
 
     :param app_id: The app_id to check for deletion
-    :param client: A MarathonClient object"""
+    :param client: A MarathonClient object
+    :param timeout_s: Raise a TimeoutException if the app is still there after this many seconds"""
+    deadline = None if timeout_s is None else time.time() + timeout_s
     while marathon_tools.is_app_id_running(app_id, client) is True:
+        if deadline is not None and time.time() > deadline:
+            raise TimeoutException("%s was not deleted within %d seconds" % (app_id, timeout_s))
         log.info("Waiting for %s to be deleted from marathon...", app_id)
-        time.sleep(WAIT_DELETE_S)
+        sleep_within_deadline(WAIT_DELETE_S)
 
 
-def delete_marathon_app(app_id, client):
+def delete_marathon_app(app_id, client, zk=None):
     """Delete a new marathon application with a given
     app_id and marathon client object.
 
+    Only starting the deletion is done under the create_app_lock; waiting for marathon to finish
+    is not, so several deletions can be in flight at once. It is safe to call from any thread.
+
     :param app_id: The marathon app id to be deleted
-    :param client: A MarathonClient object"""
-    with nested(create_app_lock(), time_limit(1)):
+    :param client: A MarathonClient object
+    :param zk: A started KazooClient to take the lock with; by default the shared zookeeper session is leased"""
+    with create_app_lock(zk=zk):
         # Scale app to 0 first to work around
         # https://github.com/mesosphere/marathon/issues/725
         client.scale_app(app_id, instances=0, force=True)
-        time.sleep(1)
+        sleep_within_deadline(1)
         client.delete_app(app_id, force=True)
-        wait_for_delete(app_id, client)
+    wait_for_delete(app_id, client, timeout_s=WAIT_DELETE_TIMEOUT_S)
 
 
 def kill_old_ids(old_ids, client):
@@ -215,6 +236,27 @@ def kill_old_ids(old_ids, client):
             continue
 
 
+def get_registered_tasks_in_location(hosts, synapse_port, synapse_haproxy_url_format, service_namespace, tasks):
+    """Returns the tasks that are registered in the haproxy of a location. Asks the synapse hosts in that
+    location in turn, until one of them answers.
+
+    :param hosts: The synapse hosts in the location, in the order they should be tried.
+    """
+    for i, synapse_host in enumerate(hosts):
+        try:
+            return get_registered_marathon_tasks(
+                synapse_host,
+                synapse_port,
+                synapse_haproxy_url_format,
+                service_namespace,
+                tasks,
+            )
+        except requests.exceptions.RequestException as e:
+            if i == len(hosts) - 1:
+                raise
+            log.warning("Couldn't get haproxy state from %s, trying %s instead: %s", synapse_host, hosts[i + 1], e)
+
+
 def get_happy_tasks(app, service, nerve_ns, system_paasta_config, min_task_uptime=None, check_haproxy=False):
     """Given a MarathonApp object, return the subset of tasks which are considered healthy.
     With the default options, this returns tasks where at least one of the defined Marathon healthchecks passes.
@@ -239,15 +281,24 @@ def get_happy_tasks(app, service, nerve_ns, system_paasta_config, min_task_uptim
         discover_location_type = service_namespace_config.get_discover()
         unique_values = mesos_tools.get_mesos_slaves_grouped_by_attribute(discover_location_type)
 
-        for value, hosts in unique_values.iteritems():
-            synapse_host = hosts[0]
-            tasks_in_smartstack.extend(get_registered_marathon_tasks(
-                synapse_host,
-                system_paasta_config.get_synapse_port(),
-                system_paasta_config.get_synapse_haproxy_url_format(),
-                service_namespace,
-                tasks,
-            ))
+        # Each location has its own haproxy to ask, so ask them all at once, going by the caller's snapshot.
+        haproxy_snapshot = HaproxySnapshot.current() or HaproxySnapshot()
+
+        def get_registered_tasks(hosts):
+            with haproxy_snapshot:
+                return get_registered_tasks_in_location(
+                    hosts,
+                    system_paasta_config.get_synapse_port(),
+                    system_paasta_config.get_synapse_haproxy_url_format(),
+                    service_namespace,
+                    tasks,
+                )
+
+        max_workers = max(1, min(len(unique_values), MAX_HAPROXY_QUERY_THREADS))
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = [executor.submit(get_registered_tasks, hosts) for hosts in unique_values.values()]
+            for future in futures:
+                tasks_in_smartstack.extend(future.result())
         tasks = tasks_in_smartstack
 
     for task in tasks:
@@ -0,0 +1,424 @@
+# Copyright 2015-2016 Yelp Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Simulates packing the tasks a cluster should run onto its mesos slaves, to plan the size of its pools.
+
+The tasks of one instance all ask for the same resources and are placed under the same constraints, so
+they are packed together as a TaskGroup. Groups are packed first-fit-decreasing: the biggest tasks
+first, each onto the first hosts, in a fixed order, that have room for it and that its constraints
+allow. Packing a group is a single pass over the hosts it may use that puts as many of its tasks on
+each host as fit. Hosts only ever fill up, so the packer remembers, for each list of hosts and size of
+task, the first host that may still have room and starts the next group of that size there; together
+these keep tens of thousands of tasks down to seconds.
+
+Constraints are those of marathon (https://mesosphere.github.io/marathon/docs/constraints.html):
+LIKE, UNLIKE and CLUSTER decide which hosts a group may use, and GROUP_BY, UNIQUE and MAX_PER how many
+of its tasks may share a value of an attribute.
+"""
+import logging
+import re
+import sys
+from collections import Counter
+from collections import defaultdict
+from collections import namedtuple
+from math import ceil
+
+log = logging.getLogger(__name__)
+
+RESOURCES = ('cpus', 'mem', 'disk')
+# Allows for the rounding errors of adding up fractional cpus.
+EPSILON = 1e-6
+# How many tasks that ask for nothing fit on a host.
+MAX_FIT = sys.maxint
+
+Resources = namedtuple('Resources', RESOURCES)
+
+
+class Host(object):
+    """A mesos slave, and the resources its tasks have not taken yet."""
+
+    __slots__ = ('hostname', 'attributes', 'pool', 'total', 'cpus', 'mem', 'disk', 'task_count')
+
+    def __init__(self, hostname, attributes, total):
+        self.hostname = hostname
+        self.attributes = attributes
+        self.pool = attributes.get('pool', 'default')
+        self.total = total
+        self.cpus, self.mem, self.disk = total
+        self.task_count = 0
+
+    def get_attribute(self, name):
+        return self.hostname if name == 'hostname' else self.attributes.get(name)
+
+    def get_free(self):
+        return Resources(self.cpus, self.mem, self.disk)
+
+    def allocate(self, resources, count=1):
+        self.cpus -= resources.cpus * count
+        self.mem -= resources.mem * count
+        self.disk -= resources.disk * count
+        self.task_count += count
+
+    def how_many_fit(self, resources):
+        """Returns how many tasks asking for resources fit in what is free on the host."""
+        # This is called for every host a group is packed past, so it is written out rather than looped.
+        cpus, mem, disk = resources
+        fit = MAX_FIT
+        if cpus > 0:
+            fit = (self.cpus + EPSILON) / cpus
+        elif self.cpus < -EPSILON:
+            return 0
+        if mem > 0:
+            fit = min(fit, (self.mem + EPSILON) / mem)
+        elif self.mem < -EPSILON:
+            return 0
+        if disk > 0:
+            fit = min(fit, (self.disk + EPSILON) / disk)
+        elif self.disk < -EPSILON:
+            return 0
+        return int(fit) if fit >= 1 else 0
+
+    def clone(self, hostname):
+        """Returns an empty host with the same resources and attributes."""
+        return Host(hostname, self.attributes, self.total)
+
+
+class TaskGroup(object):
+    """The tasks of one instance.
+
+    :param name: What to report the group as, e.g. its job id
+    :param count: How many tasks to place
+    :param resources: The Resources each task asks for
+    :param pool: The pool the group is reported under
+    :param constraints: The marathon constraints of the tasks
+    """
+
+    def __init__(self, name, count, resources, pool, constraints):
+        self.name = name
+        self.count = count
+        self.resources = resources
+        self.pool = pool
+        self.constraints = [list(constraint) for constraint in constraints]
+
+
+def get_hosts_from_mesos_state(mesos_state, framework_prefix='marathon'):
+    """Returns a Host for each active slave of a mesos state, in hostname order, with the resources of the
+    tasks of frameworks other than framework_prefix (e.g. chronos jobs) already taken."""
+    hosts = {}
+    for slave in mesos_state.get('slaves', []):
+        if not slave.get('active', True):
+            continue
+        resources = slave['resources']
+        hosts[slave['id']] = Host(slave['hostname'], slave.get('attributes', {}),
+                                  Resources(*(float(resources.get(resource, 0)) for resource in RESOURCES)))
+    for framework in mesos_state.get('frameworks', []):
+        if framework.get('name', '').startswith(framework_prefix):
+            continue
+        for task in framework.get('tasks', []):
+            host = hosts.get(task['slave_id'])
+            if host is not None:
+                host.allocate(Resources(*(float(task['resources'].get(resource, 0)) for resource in RESOURCES)))
+    return sorted(hosts.values(), key=lambda host: host.hostname)
+
+
+def matches_pattern(value, pattern):
+    return value is not None and re.match('(?:%s)$' % pattern, str(value)) is not None
+
+
+def host_passes_constraint(host, constraint):
+    """Whether a host may run a task of a group with constraint at all. Constraints that limit how many
+    tasks may share a value, like GROUP_BY, let every host pass."""
+    attribute, operator = constraint[0], constraint[1]
+    value = host.get_attribute(attribute)
+    if operator == 'LIKE':
+        return matches_pattern(value, constraint[2])
+    elif operator == 'UNLIKE':
+        return not matches_pattern(value, constraint[2])
+    elif operator == 'CLUSTER':
+        return len(constraint) < 3 or value == constraint[2]
+    return True
+
+
+def get_host_filter_key(constraints):
+    """The constraints that decide which hosts a group may use, as something hashable."""
+    return tuple(tuple(constraint) for constraint in constraints if constraint[1] in ('LIKE', 'UNLIKE', 'CLUSTER'))
+
+
+def get_spread_limits(group, hosts):
+    """Returns how many of a group's tasks may share a value of an attribute, as (attribute, limit) pairs.
+
+    :param hosts: The hosts the group may use, which GROUP_BY without a number of values spreads over
+    """
+    limits = []
+    for constraint in group.constraints:
+        attribute, operator = constraint[0], constraint[1]
+        if operator == 'GROUP_BY':
+            if len(constraint) > 2:
+                values = int(constraint[2])
+            else:
+                values = len(set(host.get_attribute(attribute) for host in hosts))
+            limits.append((attribute, int(ceil(group.count / float(max(values, 1))))))
+        elif operator == 'UNIQUE':
+            limits.append((attribute, 1))
+        elif operator == 'MAX_PER':
+            limits.append((attribute, int(constraint[2])))
+        elif operator not in ('LIKE', 'UNLIKE', 'CLUSTER'):
+            log.warning("Ignoring the %s constraint of %s, which capacity planning does not know" % (
+                operator, group.name))
+    return limits
+
+
+class Placement(object):
+    """How much of a group has been placed so far."""
+
+    def __init__(self, group, hosts):
+        self.group = group
+        self.remaining = group.count
+        self.limits = get_spread_limits(group, hosts)
+        self.placed_per_value = [Counter() for _ in self.limits]
+
+    def place_on(self, hosts, start=0):
+        """Puts as many of the remaining tasks on each of hosts, in order from start, as fit.
+
+        :returns: The index of the first host from start that still has room for one of the tasks, or
+                  len(hosts) if none does
+        """
+        resources = self.group.resources
+        limits = zip(self.limits, self.placed_per_value)
+        first_open = None
+        for index in xrange(start, len(hosts)):
+            if not self.remaining:
+                return index if first_open is None else first_open
+            host = hosts[index]
+            fit = host.how_many_fit(resources)
+            if not fit:
+                continue
+            count = min(self.remaining, fit)
+            for (attribute, limit), placed in limits:
+                count = min(count, limit - placed[host.get_attribute(attribute)])
+            if count > 0:
+                host.allocate(resources, count)
+                for (attribute, _), placed in limits:
+                    placed[host.get_attribute(attribute)] += count
+                self.remaining -= count
+            if first_open is None and fit > count:
+                first_open = index
+        return len(hosts) if first_open is None else first_open
+
+
+def get_average_total(hosts):
+    """Returns the Resources of an average host."""
+    return Resources(*(sum(getattr(host.total, resource) for host in hosts) / float(len(hosts) or 1)
+                       for resource in RESOURCES))
+
+
+def get_group_size(group, average_total):
+    """How big a group's tasks are, for packing the biggest first: their largest share of any resource of
+    an average host."""
+    return max(asked / total if total else 0 for asked, total in zip(group.resources, average_total))
+
+
+def filter_hosts(hosts, key):
+    """Returns the hosts that pass every constraint of a host filter key."""
+    return [host for host in hosts if all(host_passes_constraint(host, constraint) for constraint in key)]
+
+
+class Packer(object):
+    """Packs task groups onto hosts first-fit-decreasing. Packing allocates the resources of the hosts."""
+
+    def __init__(self, hosts):
+        self.hosts = list(hosts)
+        self.eligible_hosts = {}
+        # {(host filter key, resources): the index of the first eligible host that may have room for them}
+        self.first_open = {}
+        self.placements = []
+
+    def get_eligible_hosts(self, group):
+        key = get_host_filter_key(group.constraints)
+        if key not in self.eligible_hosts:
+            self.eligible_hosts[key] = filter_hosts(self.hosts, key)
+        return self.eligible_hosts[key]
+
+    def pack(self, groups):
+        """Packs groups, biggest tasks first.
+
+        :returns: The Placement of each group, in packing order
+        """
+        average_total = get_average_total(self.hosts)
+        groups = sorted(groups, key=lambda group: (-get_group_size(group, average_total), group.name))
+        for group in groups:
+            eligible_hosts = self.get_eligible_hosts(group)
+            placement = Placement(group, eligible_hosts)
+            first_open_key = (get_host_filter_key(group.constraints), group.resources)
+            self.first_open[first_open_key] = placement.place_on(
+                eligible_hosts, start=self.first_open.get(first_open_key, 0))
+            self.placements.append(placement)
+        return self.placements
+
+    def add_hosts(self, hosts):
+        """Adds hosts after the existing ones, and packs what could not be placed yet onto them."""
+        self.hosts.extend(hosts)
+        new_eligible_hosts = {}
+        for key, eligible_hosts in self.eligible_hosts.items():
+            new_eligible_hosts[key] = filter_hosts(hosts, key)
+            eligible_hosts.extend(new_eligible_hosts[key])
+        for placement in self.get_unplaced():
+            placement.place_on(new_eligible_hosts[get_host_filter_key(placement.group.constraints)])
+
+    def get_unplaced(self):
+        return [placement for placement in self.placements if placement.remaining]
+
+
+def get_stranded_resources(hosts, groups):
+    """Adds up the resources left free on hosts that no task of groups fits on anymore, because another of
+    their resources ran out.
+
+    :returns: A tuple of the stranded Resources and the number of hosts they are on
+    """
+    shapes = set(group.resources for group in groups if group.count)
+    stranded = [0.0] * len(RESOURCES)
+    stranded_hosts = 0
+    for host in hosts:
+        free = host.get_free()
+        if not any(free) or any(host.how_many_fit(shape) for shape in shapes):
+            continue
+        stranded_hosts += 1
+        for index, amount in enumerate(free):
+            stranded[index] += max(amount, 0)
+    return Resources(*stranded), stranded_hosts
+
+
+def count_hosts_to_add(packer, pool, pool_hosts, max_new_hosts):
+    """Works out how many more hosts like those of a pool it takes to place the tasks of the pool that a
+    packing could not, by adding empty clones of them to it one at a time.
+
+    :param packer: The Packer that packed the cluster, which the new hosts are added to
+    :param pool: The pool whose unplaced tasks to place
+    :param pool_hosts: The hosts of the pool, which new hosts are cloned from in turn
+    :param max_new_hosts: How many hosts to add at most before giving up
+    :returns: The number of hosts to add, or None if even max_new_hosts would not do
+    """
+    unplaced = [placement for placement in packer.get_unplaced() if placement.group.pool == pool]
+    if not pool_hosts:
+        return None if unplaced else 0
+    added = 0
+    useless = 0
+    remaining = sum(placement.remaining for placement in unplaced)
+    while remaining:
+        # Once a whole round of clones placed nothing, more never will.
+        if added >= max_new_hosts or useless >= len(pool_hosts):
+            return None
+        template = pool_hosts[added % len(pool_hosts)]
+        packer.add_hosts([template.clone('%s-planned-%d' % (template.hostname, added))])
+        added += 1
+        still_remaining = sum(placement.remaining for placement in unplaced)
+        useless = useless + 1 if still_remaining == remaining else 0
+        remaining = still_remaining
+    return added
+
+
+PoolReport = namedtuple('PoolReport', [
+    'pool',
+    'hosts',
+    'hosts_used',
+    'total',
+    'requested',
+    'headroom',
+    'stranded',
+    'stranded_hosts',
+    'unplaced',
+    'hosts_to_add',
+])
+
+
+def sum_resources(resources_list):
+    return Resources(*(sum(values) for values in zip(*resources_list))) if resources_list else \
+        Resources(0.0, 0.0, 0.0)
+
+
+def plan_capacity(hosts, groups, max_new_hosts_factor=2):
+    """Packs groups onto hosts and reports on each pool.
+
+    :param hosts: The Hosts of the cluster, e.g. from get_hosts_from_mesos_state
+    :param groups: The TaskGroups to place
+    :param max_new_hosts_factor: How many times as many hosts as a pool has to try adding to it, at most,
+                                 to place what did not fit
+    :returns: A list of PoolReport, by pool
+    """
+    pool_hosts = defaultdict(list)
+    for host in hosts:
+        pool_hosts[host.pool].append(host)
+    pool_groups = defaultdict(list)
+    for group in groups:
+        pool_groups[group.pool].append(group)
+    packer = Packer(hosts)
+    placements = packer.pack(groups)
+    unplaced = defaultdict(list)
+    for placement in placements:
+        if placement.remaining:
+            unplaced[placement.group.pool].append((placement.group.name, placement.remaining, placement.group.count))
+
+    reports = []
+    for pool in sorted(set(pool_hosts) | set(pool_groups)):
+        members = pool_hosts.get(pool, [])
+        stranded, stranded_hosts = get_stranded_resources(members, pool_groups.get(pool, []))
+        reports.append(PoolReport(
+            pool=pool,
+            hosts=len(members),
+            hosts_used=sum(1 for host in members if host.task_count),
+            total=sum_resources([host.total for host in members]),
+            requested=sum_resources([Resources(*(amount * group.count for amount in group.resources))
+                                     for group in pool_groups.get(pool, [])]),
+            headroom=sum_resources([host.get_free() for host in members]),
+            stranded=stranded,
+            stranded_hosts=stranded_hosts,
+            unplaced=sorted(unplaced.get(pool, [])),
+            hosts_to_add=0,
+        ))
+    # Only the clones added here are packed onto, so this leaves the hosts reported on above alone.
+    for index, report in enumerate(reports):
+        if report.unplaced:
+            reports[index] = report._replace(hosts_to_add=count_hosts_to_add(
+                packer, report.pool, pool_hosts.get(report.pool, []),
+                max(1, report.hosts) * max_new_hosts_factor))
+    return reports
+
+
+def format_resources(resources, total=None):
+    parts = []
+    for resource, unit, amount in zip(RESOURCES, ('', ' MB', ' MB'), resources):
+        part = '%s %.1f%s' % (resource, amount, unit)
+        if total is not None:
+            part += ' (%.1f%%)' % (amount * 100.0 / getattr(total, resource) if getattr(total, resource) else 0)
+        parts.append(part)
+    return ', '.join(parts)
+
+
+def format_pool_report(report):
+    lines = [
+        "Pool %s: %d hosts, %d used by the packing" % (report.pool, report.hosts, report.hosts_used),
+        "  Total:     %s" % format_resources(report.total),
+        "  Requested: %s" % format_resources(report.requested),
+        "  Headroom:  %s" % format_resources(report.headroom, report.total),
+        "  Stranded:  %s on %d hosts" % (format_resources(report.stranded, report.total), report.stranded_hosts),
+    ]
+    if report.unplaced:
+        lines.append("  Could not place:")
+        for name, remaining, count in report.unplaced:
+            lines.append("    %s: %d of %d tasks" % (name, remaining, count))
+        if report.hosts_to_add is None:
+            lines.append("  Adding hosts like those of the pool would not place everything")
+        else:
+            lines.append("  Placing everything needs %d more hosts like those of the pool" % report.hosts_to_add)
+    return lines
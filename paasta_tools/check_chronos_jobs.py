@@ -15,7 +15,6 @@ from paasta_tools import monitoring_tools
 from paasta_tools import utils
 from paasta_tools.chronos_tools import compose_check_name_for_service_instance
 from paasta_tools.chronos_tools import DEFAULT_SOA_DIR
-from paasta_tools.chronos_tools import load_chronos_job_config
 
 
 def parse_args():
@@ -90,24 +89,39 @@ def build_service_job_mapping(client, configured_jobs):
     :param configured_jobs: A list of jobs configured in Paasta, i.e. jobs we
     expect to be able to find
     :returns: A dict of {(service, instance): [(chronos job, lastrunstate)]}
-    where the chronos job is any with a matching (service, instance) in its
-    name and disabled == False
+    where the chronos job is any non-temporary job with a matching (service, instance)
+    in its name, disabled or not
+
+    The job list is fetched from Chronos once, however many jobs are configured.
     """
+    jobs = chronos_tools.filter_non_temporary_chronos_jobs(client.list())
+    jobs_by_service_instance = chronos_tools.index_chronos_jobs(jobs)
     service_job_mapping = {}
     for job in configured_jobs:
-        # find all the jobs belonging to each service
-        matching_jobs = chronos_tools.lookup_chronos_jobs(
-            service=job[0],
-            instance=job[1],
-            client=client,
-            include_disabled=True,
-        )
-        filtered = chronos_tools.filter_non_temporary_chronos_jobs(matching_jobs)
-        with_states = last_run_state_for_jobs(filtered)
-        service_job_mapping[job] = with_states
+        service_job_mapping[job] = last_run_state_for_jobs(jobs_by_service_instance.get(job, []))
     return service_job_mapping
 
 
+def load_chronos_job_configs(service_instances, cluster, soa_dir):
+    """Loads the ChronosJobConfig of each (service, instance), reading each service's files once.
+
+    :returns: A dict of {(service, instance): ChronosJobConfig}"""
+    instances_by_service = {}
+    for service, instance in service_instances:
+        instances_by_service.setdefault(service, []).append(instance)
+    job_configs = {}
+    for service, instances in instances_by_service.items():
+        service_job_configs = chronos_tools.load_chronos_job_configs_for_service(
+            service=service,
+            instances=instances,
+            cluster=cluster,
+            soa_dir=soa_dir,
+        )
+        for instance, job_config in service_job_configs.items():
+            job_configs[(service, instance)] = job_config
+    return job_configs
+
+
 def message_for_status(status, service, instance, cluster):
     if status not in (pysensu_yelp.Status.CRITICAL, pysensu_yelp.Status.OK, pysensu_yelp.Status.UNKNOWN):
         raise ValueError('unknown sensu status: %s' % status)
@@ -179,33 +193,30 @@ def main():
     configured_jobs = chronos_tools.get_chronos_jobs_for_cluster(cluster, soa_dir=soa_dir)
 
     service_job_mapping = build_service_job_mapping(client, configured_jobs)
-    for service_instance, job_state_pairs in service_job_mapping.items():
-        service, instance = service_instance[0], service_instance[1]
-        chronos_job_config = load_chronos_job_config(
-            service=service,
-            instance=instance,
-            cluster=cluster,
-            soa_dir=soa_dir,
-        )
-        sensu_output, sensu_status = sensu_message_status_for_jobs(
-            chronos_job_config=chronos_job_config,
-            service=service,
-            instance=instance,
-            cluster=cluster,
-            job_state_pairs=job_state_pairs
-        )
-        monitoring_overrides = compose_monitoring_overrides_for_service(
-            chronos_job_config=chronos_job_config,
-            soa_dir=soa_dir
-        )
-        send_event(
-            service=service,
-            instance=instance,
-            monitoring_overrides=monitoring_overrides,
-            status_code=sensu_status,
-            message=sensu_output,
-            soa_dir=soa_dir,
-        )
+    job_configs = load_chronos_job_configs(service_job_mapping.keys(), cluster, soa_dir)
+    with monitoring_tools.MonitoringConfigCache(), monitoring_tools.batched_sensu_events(system_paasta_config):
+        for service_instance, job_state_pairs in service_job_mapping.items():
+            service, instance = service_instance[0], service_instance[1]
+            chronos_job_config = job_configs[service_instance]
+            sensu_output, sensu_status = sensu_message_status_for_jobs(
+                chronos_job_config=chronos_job_config,
+                service=service,
+                instance=instance,
+                cluster=cluster,
+                job_state_pairs=job_state_pairs
+            )
+            monitoring_overrides = compose_monitoring_overrides_for_service(
+                chronos_job_config=chronos_job_config,
+                soa_dir=soa_dir
+            )
+            send_event(
+                service=service,
+                instance=instance,
+                monitoring_overrides=monitoring_overrides,
+                status_code=sensu_status,
+                message=sensu_output,
+                soa_dir=soa_dir,
+            )
 
 
 if __name__ == '__main__':
@@ -194,8 +194,10 @@ def check_smartstack_replication_for_instance(
 
 
 def get_healthy_marathon_instances_for_short_app_id(client, app_id):
-    tasks = client.list_tasks()
-    tasks_for_app = [task for task in tasks if task.app_id.startswith('/%s' % app_id)]
+    if isinstance(client, marathon_tools.PaastaMarathonClient):
+        tasks_for_app = client.get_tasks_with_prefix(app_id)
+    else:
+        tasks_for_app = [task for task in client.list_tasks() if task.app_id.startswith('/%s' % app_id)]
 
     one_minute_ago = datetime.now() - timedelta(minutes=1)
 
@@ -395,16 +397,17 @@ def main():
 
     config = marathon_tools.load_marathon_config()
     client = marathon_tools.get_marathon_client(config.get_url(), config.get_username(), config.get_password())
-    for service, instance in service_instances:
-
-        check_service_replication(
-            client=client,
-            service=service,
-            instance=instance,
-            cluster=cluster,
-            soa_dir=soa_dir,
-            system_paasta_config=system_paasta_config,
-        )
+    with monitoring_tools.MonitoringConfigCache(), monitoring_tools.batched_sensu_events(system_paasta_config):
+        for service, instance in service_instances:
+
+            check_service_replication(
+                client=client,
+                service=service,
+                instance=instance,
+                cluster=cluster,
+                soa_dir=soa_dir,
+                system_paasta_config=system_paasta_config,
+            )
 
 
 if __name__ == "__main__":
@@ -17,8 +17,8 @@ import json
 import logging
 import os
 import re
+import threading
 import urlparse
-from time import sleep
 
 import chronos
 import dateutil
@@ -41,6 +41,7 @@ from paasta_tools.utils import load_deployments_json
 from paasta_tools.utils import load_system_paasta_config
 from paasta_tools.utils import PaastaColors
 from paasta_tools.utils import PATH_TO_SYSTEM_PAASTA_CONFIG_DIR
+from paasta_tools.utils import sleep_within_deadline
 from paasta_tools.utils import timeout
 
 
@@ -170,21 +171,39 @@ def read_chronos_jobs_for_service(service, cluster, soa_dir=DEFAULT_SOA_DIR):
 
 
 def load_chronos_job_config(service, instance, cluster, load_deployments=True, soa_dir=DEFAULT_SOA_DIR):
-    service_chronos_jobs = read_chronos_jobs_for_service(service, cluster, soa_dir=soa_dir)
-    if instance not in service_chronos_jobs:
-        raise UnknownChronosJobError('No job named "%s" in config file chronos-%s.yaml' % (instance, cluster))
-    branch_dict = {}
-    if load_deployments:
-        deployments_json = load_deployments_json(service, soa_dir=soa_dir)
-        branch = get_paasta_branch(cluster=cluster, instance=instance)
-        branch_dict = deployments_json.get_branch_dict(service, branch)
-    return ChronosJobConfig(
+    return load_chronos_job_configs_for_service(
         service=service,
+        instances=[instance],
         cluster=cluster,
-        instance=instance,
-        config_dict=service_chronos_jobs[instance],
-        branch_dict=branch_dict,
-    )
+        load_deployments=load_deployments,
+        soa_dir=soa_dir,
+    )[instance]
+
+
+def load_chronos_job_configs_for_service(service, instances, cluster, load_deployments=True, soa_dir=DEFAULT_SOA_DIR):
+    """Like load_chronos_job_config, for several instances of one service, reading the service's
+    chronos-<cluster>.yaml and deployments.json only once.
+
+    :returns: A dictionary of instance name to ChronosJobConfig"""
+    service_chronos_jobs = read_chronos_jobs_for_service(service, cluster, soa_dir=soa_dir)
+    for instance in instances:
+        if instance not in service_chronos_jobs:
+            raise UnknownChronosJobError('No job named "%s" in config file chronos-%s.yaml' % (instance, cluster))
+    deployments_json = load_deployments_json(service, soa_dir=soa_dir) if load_deployments else None
+    job_configs = {}
+    for instance in instances:
+        branch_dict = {}
+        if load_deployments:
+            branch = get_paasta_branch(cluster=cluster, instance=instance)
+            branch_dict = deployments_json.get_branch_dict(service, branch)
+        job_configs[instance] = ChronosJobConfig(
+            service=service,
+            cluster=cluster,
+            instance=instance,
+            config_dict=service_chronos_jobs[instance],
+            branch_dict=branch_dict,
+        )
+    return job_configs
 
 
 class ChronosJobConfig(InstanceConfig):
@@ -230,7 +249,7 @@ class ChronosJobConfig(InstanceConfig):
         if constraints is not None:
             return constraints
         else:
-            constraints = self.get_extra_constraints()
+            constraints = list(self.get_extra_constraints())
             constraints.extend(self.get_deploy_constraints())
             constraints.extend(self.get_pool_constraints())
         assert isinstance(constraints, list)
@@ -654,6 +673,47 @@ def sort_jobs(jobs):
     )
 
 
+class ChronosJobsSnapshot(object):
+    """
+    A context manager that remembers the list of jobs Chronos returns, the first time it is asked, until
+    the outermost with block exits. Inside it, lookup_chronos_jobs (and so get_job_for_service_instance,
+    which resolves the parents of dependent jobs) only lists the jobs once. These can be nested, and
+    used from several threads at once, which all share the snapshot.
+    """
+    counter = 0
+    jobs = None
+    active = False
+    lock = threading.Lock()
+
+    @classmethod
+    def __enter__(cls):
+        with cls.lock:
+            cls.active = True
+            cls.counter = cls.counter + 1
+
+    @classmethod
+    def __exit__(cls, *args, **kwargs):
+        with cls.lock:
+            cls.counter = cls.counter - 1
+            if cls.counter == 0:
+                cls.active = False
+                cls.jobs = None
+
+    @classmethod
+    def list_jobs(cls, client):
+        """Returns client.list(), from the snapshot if we are inside one."""
+        with cls.lock:
+            active = cls.active
+            if active and cls.jobs is not None:
+                return cls.jobs
+        jobs = client.list()
+        if active:
+            with cls.lock:
+                if cls.active and cls.jobs is None:
+                    cls.jobs = jobs
+        return jobs
+
+
 def lookup_chronos_jobs(client, service=None, instance=None, include_disabled=False):
     """Discovers Chronos jobs and filters them with ``filter_chronos_jobs()``.
 
@@ -664,7 +724,7 @@ def lookup_chronos_jobs(client, service=None, instance=None, include_disabled=Fa
     :returns: list of job dicts discovered by ``client`` and filtered by
     ``filter_chronos_jobs()`` using the other parameters
     """
-    jobs = client.list()
+    jobs = ChronosJobsSnapshot.list_jobs(client)
     return filter_chronos_jobs(
         jobs=jobs,
         service=service,
@@ -685,6 +745,23 @@ def filter_non_temporary_chronos_jobs(jobs):
     return [job for job in jobs if not job['name'].startswith(TMP_JOB_IDENTIFIER)]
 
 
+def index_chronos_jobs(jobs):
+    """Groups a list of Chronos jobs by the service and instance their names decompose to, skipping
+    jobs whose names are not paasta job ids. Temporary jobs are filed under the job they were made from.
+
+    :param jobs: a list of chronos jobs, as returned by ``client.list()``
+    :returns: a dict of {(service, instance): [job, ...]}
+    """
+    index = {}
+    for job in jobs:
+        try:
+            service_instance = decompose_job_id(job['name'])
+        except InvalidJobNameError:
+            continue
+        index.setdefault(service_instance, []).append(job)
+    return index
+
+
 def filter_chronos_jobs(jobs, service, instance, include_disabled):
     """Filters a list of Chronos jobs based on several criteria.
 
@@ -727,7 +804,7 @@ def wait_for_job(client, job_name):
             return True
         else:
             print "waiting for job %s to launch. retrying" % (job_name)
-            sleep(0.5)
+            sleep_within_deadline(0.5)
 
 
 def parse_execution_date(execution_date_string):
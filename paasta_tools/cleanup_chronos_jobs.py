@@ -21,9 +21,14 @@ Gets the current job list from chronos, and then a 'valid_job_list'
 via chronos_tools.get_chronos_jobs_for_cluster
 
 If a job is deployed by chronos but not in the expected list, it is deleted.
-Any tasks associated with that job are also deleted.
+Any tasks associated with that job are also deleted. Temporary jobs made by
+chronos_rerun are deleted once their run finished more than a day ago.
+
+The job list is only fetched from chronos once, and up to --concurrency
+deletes are sent to chronos at a time.
 
 - -d <SOA_DIR>, --soa-dir <SOA_DIR>: Specify a SOA config dir to read from
+- -j <N>, --concurrency <N>: Send up to N deletes to chronos at once
 """
 import argparse
 import datetime
@@ -31,17 +36,23 @@ import sys
 
 import dateutil.parser
 import pysensu_yelp
+from concurrent.futures import ThreadPoolExecutor
 
 from paasta_tools import chronos_tools
 from paasta_tools.check_chronos_jobs import send_event
 from paasta_tools.utils import InvalidJobNameError
 
+DEFAULT_DELETE_CONCURRENCY = 10
+TMP_JOB_EXPIRY = datetime.timedelta(days=1)
+
 
 def parse_args():
     parser = argparse.ArgumentParser(description='Cleans up stale chronos jobs.')
     parser.add_argument('-d', '--soa-dir', dest="soa_dir", metavar="SOA_DIR",
                         default=chronos_tools.DEFAULT_SOA_DIR,
                         help="define a different soa config directory")
+    parser.add_argument('-j', '--concurrency', dest="concurrency", type=int, default=DEFAULT_DELETE_CONCURRENCY,
+                        help="How many deletes to send to chronos at once (default %(default)s)")
     args = parser.parse_args()
     return args
 
@@ -67,24 +78,32 @@ def execute_chronos_api_call_for_job(api_call, job):
         return e
 
 
-def cleanup_jobs(client, jobs):
+def execute_chronos_api_calls(api_call, jobs, concurrency):
+    """Calls execute_chronos_api_call_for_job for each job, up to concurrency at a time.
+
+    :returns: A list of (job, response or exception), in the order of jobs"""
+    jobs = list(jobs)
+    if not jobs:
+        return []
+    with ThreadPoolExecutor(max_workers=max(1, concurrency)) as executor:
+        responses = executor.map(lambda job: execute_chronos_api_call_for_job(api_call, job), jobs)
+        return zip(jobs, responses)
+
+
+def cleanup_jobs(client, jobs, concurrency=DEFAULT_DELETE_CONCURRENCY):
     """Maps a list of jobs to cleanup to a list of response objects (or exception objects) from the api"""
-    return [(job, execute_chronos_api_call_for_job(client.delete, job)) for job in jobs]
+    return execute_chronos_api_calls(client.delete, jobs, concurrency)
 
 
-def cleanup_tasks(client, jobs):
+def cleanup_tasks(client, jobs, concurrency=DEFAULT_DELETE_CONCURRENCY):
     """Maps a list of tasks to cleanup to a list of response objects (or exception objects) from the api"""
-    return [(job, execute_chronos_api_call_for_job(client.delete_tasks, job)) for job in jobs]
+    return execute_chronos_api_calls(client.delete_tasks, jobs, concurrency)
 
 
 def format_list_output(title, job_names):
     return '%s\n  %s' % (title, '\n  '.join(job_names))
 
 
-def deployed_job_names(client):
-    return [job['name'] for job in client.list()]
-
-
 def filter_paasta_jobs(jobs):
     """
     Given a list of job name strings, return only those in the format PaaSTA expects.
@@ -110,7 +129,29 @@ def filter_tmp_jobs(job_names):
     return [name for name in job_names if name.startswith(chronos_tools.TMP_JOB_IDENTIFIER)]
 
 
-def filter_expired_tmp_jobs(client, job_names):
+def index_tmp_jobs(jobs):
+    """
+    Indexes the temporary jobs among a list of chronos jobs by the (service, instance)
+    they were made from, along with the time their last run finished.
+
+    :param jobs: a list of chronos jobs, as returned by ``client.list()``
+    :returns: a dict of {(service, instance): [(job, last run datetime or None if it never ran)]}
+    """
+    tmp_jobs = [job for job in jobs if chronos_tools.is_temporary_job(job)]
+    index = {}
+    for service_instance, matching_jobs in chronos_tools.index_chronos_jobs(tmp_jobs).items():
+        index[service_instance] = []
+        for job in matching_jobs:
+            last_run_time, last_run_state = chronos_tools.get_status_last_run(job)
+            if last_run_state == chronos_tools.LastRunState.NotRun:
+                last_run = None
+            else:
+                last_run = dateutil.parser.parse(last_run_time)
+            index[service_instance].append((job, last_run))
+    return index
+
+
+def filter_expired_tmp_jobs(job_names, tmp_jobs_by_service_instance, now=None):
     """
     Given a list of temporary jobs, find those ready to be removed. Their
     suitablity for removal is defined by two things:
@@ -118,22 +159,20 @@ def filter_expired_tmp_jobs(client, job_names):
         - the job has completed (irrespective of whether it was a success or
           failure)
         - the job completed more than 24 hours ago
+
+    :param job_names: the names of the temporary jobs to consider
+    :param tmp_jobs_by_service_instance: the temporary jobs in chronos, as returned by ``index_tmp_jobs``
+    :param now: the time to compare the last runs with; defaults to now
     """
+    if now is None:
+        now = datetime.datetime.now(dateutil.tz.tzutc())
     expired = []
     for job_name in job_names:
-        service, instance = chronos_tools.decompose_job_id(job_name)
-        temporary_jobs = chronos_tools.get_temporary_jobs_for_service_instance(
-            client=client,
-            service=service,
-            instance=instance
-        )
-        for job in temporary_jobs:
-            last_run_time, last_run_state = chronos_tools.get_status_last_run(job)
-            if last_run_state != chronos_tools.LastRunState.NotRun:
-                if ((datetime.datetime.now(dateutil.tz.tzutc()) -
-                     dateutil.parser.parse(last_run_time)) >
-                        datetime.timedelta(days=1)):
-                    expired.append(job_name)
+        service_instance = chronos_tools.decompose_job_id(job_name)
+        for job, last_run in tmp_jobs_by_service_instance.get(service_instance, []):
+            if last_run is not None and now - last_run > TMP_JOB_EXPIRY:
+                expired.append(job_name)
+                break
     return expired
 
 
@@ -145,18 +184,19 @@ def main():
     config = chronos_tools.load_chronos_config()
     client = chronos_tools.get_chronos_client(config)
 
-    running_jobs = set(deployed_job_names(client))
+    jobs = client.list()
+    running_jobs = set(job['name'] for job in jobs)
 
     expected_service_jobs = set([chronos_tools.compose_job_id(*job) for job in
                                  chronos_tools.get_chronos_jobs_for_cluster(soa_dir=args.soa_dir)])
 
     all_tmp_jobs = set(filter_tmp_jobs(filter_paasta_jobs(running_jobs)))
-    expired_tmp_jobs = set(filter_expired_tmp_jobs(client, all_tmp_jobs))
+    expired_tmp_jobs = set(filter_expired_tmp_jobs(all_tmp_jobs, index_tmp_jobs(jobs)))
     valid_tmp_jobs = all_tmp_jobs - expired_tmp_jobs
 
     to_delete = running_jobs - expected_service_jobs - valid_tmp_jobs
 
-    task_responses = cleanup_tasks(client, to_delete)
+    task_responses = cleanup_tasks(client, to_delete, concurrency=args.concurrency)
     task_successes = []
     task_failures = []
     for response in task_responses:
@@ -165,7 +205,7 @@ def main():
         else:
             task_successes.append(response)
 
-    job_responses = cleanup_jobs(client, to_delete)
+    job_responses = cleanup_jobs(client, to_delete, concurrency=args.concurrency)
     job_successes = []
     job_failures = []
     for response in job_responses:
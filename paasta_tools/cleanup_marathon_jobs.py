@@ -21,23 +21,32 @@ Gets the current app list from marathon, and then a 'valid_app_list'
 via utils.get_services_for_cluster
 
 If an app in the marathon app list isn't in the valid_app_list, it's
-deleted.
+deleted. Up to --concurrency apps are deleted at once, all sharing one
+zookeeper session for their locks. Once they are all gone, the sensu checks
+of every instance that was removed are resolved.
 
 Command line options:
 
 - -d <SOA_DIR>, --soa-dir <SOA_DIR>: Specify a SOA config dir to read from
+- -n, --dry-run: Only print a summary of what would be deleted
+- -j <N>, --concurrency <N>: Delete up to N apps at once
 - -v, --verbose: Verbose output
 """
 import argparse
 import logging
 import traceback
+from collections import defaultdict
 
 import pysensu_yelp
+from concurrent.futures import ThreadPoolExecutor
 
 from paasta_tools import bounce_lib
 from paasta_tools import marathon_tools
+from paasta_tools.monitoring_tools import batched_sensu_events
+from paasta_tools.monitoring_tools import MonitoringConfigCache
 from paasta_tools.monitoring_tools import send_event
 from paasta_tools.utils import _log
+from paasta_tools.utils import compose_job_id
 from paasta_tools.utils import DEFAULT_SOA_DIR
 from paasta_tools.utils import get_services_for_cluster
 from paasta_tools.utils import InvalidJobNameError
@@ -46,52 +55,43 @@ from paasta_tools.utils import load_system_paasta_config
 
 log = logging.getLogger(__name__)
 
+DEFAULT_DELETE_CONCURRENCY = 4
+# The checks that are resolved for every instance we delete
+CLEANUP_CHECK_PREFIXES = (
+    'check_marathon_services_replication',
+    'setup_marathon_job',
+    'paasta_bounce_progress',
+)
+
 
 def parse_args():
     parser = argparse.ArgumentParser(description='Cleans up stale marathon jobs.')
     parser.add_argument('-d', '--soa-dir', dest="soa_dir", metavar="SOA_DIR",
                         default=DEFAULT_SOA_DIR,
                         help="define a different soa config directory")
+    parser.add_argument('-n', '--dry-run', action='store_true', dest="dry_run", default=False,
+                        help="Don't delete anything; just print what would be deleted")
+    parser.add_argument('-j', '--concurrency', dest="concurrency", type=int, default=DEFAULT_DELETE_CONCURRENCY,
+                        help="How many apps to delete at once (default %(default)s)")
     parser.add_argument('-v', '--verbose', action='store_true',
                         dest="verbose", default=False)
     args = parser.parse_args()
     return args
 
 
-def delete_app(app_id, client, soa_dir):
+def delete_app(app_id, client, zk=None):
     """Deletes a marathon app safely and logs to notify the user that it
-    happened"""
+    happened. This is safe to call from several threads at once.
+
+    :param zk: A started KazooClient to take the locks with; by default the shared zookeeper session is leased
+    :returns: True if the app was deleted, False if it was skipped because it is being bounced"""
     log.warn("%s appears to be old; attempting to delete" % app_id)
     service, instance, _, __ = marathon_tools.deformat_job_id(app_id)
     cluster = load_system_paasta_config().get_cluster()
     try:
         short_app_id = marathon_tools.compose_job_id(service, instance)
-        with bounce_lib.bounce_lock_zookeeper(short_app_id):
-            bounce_lib.delete_marathon_app(app_id, client)
-        send_event(
-            service=service,
-            check_name='check_marathon_services_replication.%s' % short_app_id,
-            soa_dir=soa_dir,
-            status=pysensu_yelp.Status.OK,
-            overrides={},
-            output="This instance was removed and is no longer running",
-        )
-        send_event(
-            service=service,
-            check_name='setup_marathon_job.%s' % short_app_id,
-            soa_dir=soa_dir,
-            status=pysensu_yelp.Status.OK,
-            overrides={},
-            output="This instance was removed and is no longer running",
-        )
-        send_event(
-            service=service,
-            check_name='paasta_bounce_progress.%s' % short_app_id,
-            soa_dir=soa_dir,
-            status=pysensu_yelp.Status.OK,
-            overrides={},
-            output="This instance was removed and is no longer running",
-        )
+        with bounce_lib.bounce_lock_zookeeper(short_app_id, zk=zk):
+            bounce_lib.delete_marathon_app(app_id, client, zk=zk)
         log_line = "Deleted stale marathon job that looks lost: %s" % app_id
         _log(
             service=service,
@@ -101,8 +101,10 @@ def delete_app(app_id, client, soa_dir):
             instance=instance,
             line=log_line,
         )
-    except IOError:
+        return True
+    except (IOError, bounce_lib.LockHeldException):
         log.debug("%s is being bounced, skipping" % app_id)
+        return False
     except Exception:
         loglines = ['Exception raised during cleanup of service %s:' % service]
         loglines.extend(traceback.format_exc().rstrip().split("\n"))
@@ -118,12 +120,86 @@ def delete_app(app_id, client, soa_dir):
         raise
 
 
-def cleanup_apps(soa_dir):
+def send_cleanup_events(service_instances, soa_dir):
+    """Resolves the sensu checks of service instances that no longer run.
+    An instance that had several apps deleted only gets one event per check.
+
+    :param service_instances: An iterable of (service, instance) tuples"""
+    for service, instance in sorted(set(service_instances)):
+        short_app_id = compose_job_id(service, instance)
+        for check_prefix in CLEANUP_CHECK_PREFIXES:
+            send_event(
+                service=service,
+                check_name='%s.%s' % (check_prefix, short_app_id),
+                soa_dir=soa_dir,
+                status=pysensu_yelp.Status.OK,
+                overrides={},
+                output="This instance was removed and is no longer running",
+            )
+
+
+def get_stale_app_ids(running_app_ids, valid_services):
+    """Returns the app ids that don't belong to any of the valid (service, instance) pairs.
+    App ids that don't look like paasta apps at all are left alone."""
+    valid_services = set(valid_services)
+    stale_app_ids = []
+    for app_id in running_app_ids:
+        log.debug("Checking app id %s", app_id)
+        try:
+            service, instance, _, __ = marathon_tools.deformat_job_id(app_id)
+        except InvalidJobNameError:
+            log.warn("%s doesn't conform to paasta naming conventions? Skipping." % app_id)
+            continue
+        if (service, instance) not in valid_services:
+            stale_app_ids.append(app_id)
+    return stale_app_ids
+
+
+def format_dry_run_summary(stale_app_ids):
+    if not stale_app_ids:
+        return "No stale apps to delete."
+    app_ids_by_service = defaultdict(list)
+    for app_id in stale_app_ids:
+        app_ids_by_service[marathon_tools.deformat_job_id(app_id)[0]].append(app_id)
+    lines = ["Would delete %d stale apps of %d services:" % (len(stale_app_ids), len(app_ids_by_service))]
+    for service, app_ids in sorted(app_ids_by_service.items()):
+        lines.append("  %s:" % service)
+        lines.extend("    %s" % app_id for app_id in sorted(app_ids))
+    return "\n".join(lines)
+
+
+def delete_apps(app_ids, client, concurrency):
+    """Deletes apps, up to concurrency at a time, sharing one zookeeper session for all their locks.
+    Failing to delete one app doesn't stop the others.
+
+    :returns: A tuple of the (service, instance) of every app that was deleted, and the exceptions
+              raised while trying to delete the others"""
+    deleted = []
+    errors = []
+    if not app_ids:
+        return deleted, errors
+    with bounce_lib.zookeeper_lock_client() as zk:
+        with ThreadPoolExecutor(max_workers=max(1, concurrency)) as executor:
+            futures = [(app_id, executor.submit(delete_app, app_id=app_id, client=client, zk=zk))
+                       for app_id in app_ids]
+            for app_id, future in futures:
+                try:
+                    if future.result():
+                        deleted.append(marathon_tools.deformat_job_id(app_id)[:2])
+                except Exception as e:
+                    log.error("Failed to delete %s: %s" % (app_id, e))
+                    errors.append(e)
+    return deleted, errors
+
+
+def cleanup_apps(soa_dir, dry_run=False, concurrency=DEFAULT_DELETE_CONCURRENCY):
     """Clean up old or invalid jobs/apps from marathon. Retrieves
     both a list of apps currently in marathon and a list of valid
     app ids in order to determine what to kill.
 
-    :param soa_dir: The SOA config directory to read from"""
+    :param soa_dir: The SOA config directory to read from
+    :param dry_run: Only print a summary of the apps that would be deleted
+    :param concurrency: How many apps to delete at once"""
     log.info("Loading marathon configuration")
     marathon_config = marathon_tools.load_marathon_config()
     log.info("Connecting to marathon")
@@ -132,20 +208,16 @@ def cleanup_apps(soa_dir):
 
     valid_services = get_services_for_cluster(instance_type='marathon', soa_dir=soa_dir)
     running_app_ids = marathon_tools.list_all_marathon_app_ids(client)
+    stale_app_ids = get_stale_app_ids(running_app_ids, valid_services)
 
-    for app_id in running_app_ids:
-        log.debug("Checking app id %s", app_id)
-        try:
-            service, instance, _, __ = marathon_tools.deformat_job_id(app_id)
-        except InvalidJobNameError:
-            log.warn("%s doesn't conform to paasta naming conventions? Skipping." % app_id)
-            continue
-        if (service, instance) not in valid_services:
-            delete_app(
-                app_id=app_id,
-                client=client,
-                soa_dir=soa_dir,
-            )
+    if dry_run:
+        print format_dry_run_summary(stale_app_ids)
+        return
+
+    deleted, errors = delete_apps(stale_app_ids, client, concurrency)
+    send_cleanup_events(deleted, soa_dir)
+    if errors:
+        raise errors[0]
 
 
 def main():
@@ -156,7 +228,8 @@ def main():
     else:
         logging.basicConfig(level=logging.WARNING)
 
-    cleanup_apps(soa_dir)
+    with MonitoringConfigCache(), batched_sensu_events():
+        cleanup_apps(soa_dir, dry_run=args.dry_run, concurrency=args.concurrency)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+# Copyright 2015-2016 Yelp Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import time
+
+from paasta_tools.autoscaling_history import AutoscalingHistory
+from paasta_tools.autoscaling_history import get_history_path
+from paasta_tools.autoscaling_lib import get_decision_policy
+from paasta_tools.autoscaling_lib import get_decision_policy_names
+from paasta_tools.autoscaling_simulator import DEFAULT_SLO_UTILIZATION
+from paasta_tools.autoscaling_simulator import simulate
+from paasta_tools.cli.utils import figure_out_service_name
+from paasta_tools.cli.utils import lazy_choices_completer
+from paasta_tools.cli.utils import list_instances
+from paasta_tools.cli.utils import list_services
+from paasta_tools.marathon_tools import load_marathon_service_config
+from paasta_tools.utils import compose_job_id
+from paasta_tools.utils import DEFAULT_SOA_DIR
+from paasta_tools.utils import format_table
+from paasta_tools.utils import list_clusters
+from paasta_tools.utils import load_system_paasta_config
+from paasta_tools.utils import PaastaColors
+
+
+def add_subparser(subparsers):
+    autoscale_sim_parser = subparsers.add_parser(
+        'autoscale-sim',
+        help="Replay the autoscaling history of a service instance through decision policies",
+        description=(
+            "'paasta autoscale-sim' replays the utilization the autoscaler recorded for a service instance "
+            "through each decision policy, and reports how many instance-hours each would have "
+            "over-provisioned and for how many minutes the instance would have been above its SLO "
+            "utilization, next to what the decisions that were actually made cost.\n\n"
+            "The history is read from the autoscaling history directory of the cluster's autoscaler, "
+            "so run this there or point --history-file at a copy."
+        ),
+    )
+    autoscale_sim_parser.add_argument(
+        '-s', '--service',
+        help="Service to simulate. Like 'example_service'.",
+    ).completer = lazy_choices_completer(list_services)
+    autoscale_sim_parser.add_argument(
+        '-i', '--instance',
+        help="Instance of the service to simulate. Like 'main'.",
+        required=True,
+    ).completer = lazy_choices_completer(list_instances)
+    autoscale_sim_parser.add_argument(
+        '-c', '--cluster',
+        help="The PaaSTA cluster the service instance runs in. Like 'norcal-prod'.",
+        required=True,
+    ).completer = lazy_choices_completer(list_clusters)
+    autoscale_sim_parser.add_argument(
+        '--history-file',
+        help="The autoscaling history to replay. Defaults to the instance's history in the "
+             "autoscaling_history_dir of the system paasta config.",
+    )
+    autoscale_sim_parser.add_argument(
+        '-p', '--policy',
+        dest='policies',
+        action='append',
+        choices=get_decision_policy_names(),
+        help="A decision policy to simulate; may be given more than once. Defaults to all of them.",
+    )
+    autoscale_sim_parser.add_argument(
+        '--slo-utilization',
+        type=float,
+        default=DEFAULT_SLO_UTILIZATION,
+        help="The utilization above which the instance violates its SLO (default %(default)s)",
+    )
+    autoscale_sim_parser.add_argument(
+        '--days',
+        type=float,
+        help="Only replay the last this many days of history. Defaults to all of it.",
+    )
+    autoscale_sim_parser.add_argument(
+        '-y', '--yelpsoa-config-root',
+        default=DEFAULT_SOA_DIR,
+        required=False,
+        help="Path to root of yelpsoa-configs checkout",
+    )
+    autoscale_sim_parser.set_defaults(command=paasta_autoscale_sim)
+
+
+def format_results(results):
+    rows = [('Policy', 'Instance-hours', 'Over-provisioned instance-hours', 'SLO-violation minutes',
+             'Scaling actions')]
+    for result in results:
+        rows.append((
+            result.policy,
+            '%.1f' % result.instance_hours,
+            '%.1f' % result.overprovisioned_instance_hours,
+            '%.1f' % result.slo_violation_minutes,
+            str(result.scaling_actions),
+        ))
+    return format_table(rows)
+
+
+def paasta_autoscale_sim(args):
+    """Replays the autoscaling history of a service instance and prints what each policy would have cost"""
+    soa_dir = args.yelpsoa_config_root
+    service = figure_out_service_name(args, soa_dir=soa_dir)
+    service_config = load_marathon_service_config(service, args.instance, args.cluster, load_deployments=False,
+                                                  soa_dir=soa_dir)
+    history_file = args.history_file or get_history_path(
+        service, args.instance, load_system_paasta_config().get_autoscaling_history_dir())
+    since = time.time() - args.days * 86400 if args.days is not None else None
+    history = AutoscalingHistory(history_file).read(since=since)
+    if len(history) < 2:
+        print PaastaColors.red("Not enough autoscaling history for %s in %s" % (
+            compose_job_id(service, args.instance), history_file))
+        return 1
+
+    policies = args.policies or get_decision_policy_names()
+    results = simulate(
+        history,
+        dict((name, get_decision_policy(name)) for name in policies),
+        min_instances=service_config.get_min_instances(),
+        max_instances=service_config.get_max_instances(),
+        autoscaling_params=service_config.get_autoscaling_params(),
+        slo_utilization=args.slo_utilization,
+    )
+    print "Replayed %d autoscaling decisions for %s:" % (len(history), compose_job_id(service, args.instance))
+    print "\n".join(format_results(results))
+    return 0
@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+# Copyright 2015-2016 Yelp Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from paasta_tools.cli.cmds.metastatus import figure_out_clusters_to_inspect
+from paasta_tools.cli.utils import execute_paasta_capacity_on_remote_master
+from paasta_tools.cli.utils import lazy_choices_completer
+from paasta_tools.utils import DEFAULT_SOA_DIR
+from paasta_tools.utils import list_clusters
+from paasta_tools.utils import load_system_paasta_config
+from paasta_tools.utils import PaastaColors
+
+
+def add_subparser(subparsers):
+    capacity_parser = subparsers.add_parser(
+        'capacity',
+        help="Simulate packing every service onto a PaaSTA cluster, to plan the size of its pools",
+        description=(
+            "'paasta capacity' packs the tasks every marathon instance of a cluster asks for onto "
+            "its Mesos slaves, biggest first, under their constraints, and reports for each pool the "
+            "headroom left, the resources stranded on hosts nothing fits on anymore, which instances "
+            "could not be placed and how many more hosts placing them would take.\n\n"
+            "--scale and --instances change what is packed, to answer what-if questions.\n\n"
+            "capacity operates by ssh'ing to a Mesos master of a remote cluster, and "
+            "querying the local APIs."
+        ),
+    )
+    clusters_help = (
+        'A comma separated list of clusters to plan. Defaults to all clusters. '
+        'Try: --clusters norcal-prod,nova-prod'
+    )
+    capacity_parser.add_argument(
+        '-c', '--clusters',
+        help=clusters_help,
+    ).completer = lazy_choices_completer(list_clusters)
+    capacity_parser.add_argument(
+        '--scale',
+        type=float,
+        default=1.0,
+        help="Multiply the instance count of every instance by this much (default %(default)s)",
+    )
+    capacity_parser.add_argument(
+        '--instances',
+        dest='instance_counts',
+        metavar='SERVICE.INSTANCE=COUNT',
+        action='append',
+        default=[],
+        help="Pack this many tasks of an instance; may be given more than once",
+    )
+    capacity_parser.add_argument(
+        '-d', '--soa-dir',
+        dest="soa_dir",
+        metavar="SOA_DIR",
+        default=DEFAULT_SOA_DIR,
+        help="define a different soa config directory",
+    )
+    capacity_parser.set_defaults(command=paasta_capacity)
+
+
+def paasta_capacity(args):
+    """Print the capacity plan of PaaSTA clusters"""
+    system_paasta_config = load_system_paasta_config()
+    all_clusters = list_clusters(soa_dir=args.soa_dir)
+    return_code = 0
+    for cluster in figure_out_clusters_to_inspect(args, all_clusters):
+        if cluster not in all_clusters:
+            print PaastaColors.red("Cluster %s doesn't look like a valid cluster?" % cluster)
+            return_code = 1
+            continue
+        print "Cluster: %s" % cluster
+        print execute_paasta_capacity_on_remote_master(cluster, system_paasta_config, scale=args.scale,
+                                                       instance_counts=args.instance_counts)
+        print ""
+    return return_code
@@ -38,6 +38,7 @@ from paasta_tools.cli.utils import guess_instance
 from paasta_tools.cli.utils import lazy_choices_completer
 from paasta_tools.cli.utils import list_instances
 from paasta_tools.cli.utils import list_services
+from paasta_tools.http_client import get_http_client
 from paasta_tools.marathon_tools import CONTAINER_PORT
 from paasta_tools.marathon_tools import get_healthcheck_for_instance
 from paasta_tools.paasta_execute_docker_command import execute_in_container
@@ -53,7 +54,6 @@ from paasta_tools.utils import NoDockerImageError
 from paasta_tools.utils import PaastaColors
 from paasta_tools.utils import PaastaNotConfiguredError
 from paasta_tools.utils import SystemPaastaConfig
-from paasta_tools.utils import Timeout
 from paasta_tools.utils import TimeoutError
 from paasta_tools.utils import validate_service_instance
 
@@ -96,13 +96,11 @@ def perform_http_healthcheck(url, timeout):
     :returns: True if healthcheck succeeds within number of seconds specified by timeout, false otherwise
     """
     try:
-        with Timeout(seconds=timeout):
-            try:
-                res = requests.head(url)
-            except requests.ConnectionError:
-                return (False, "http request failed: connection failed")
-    except TimeoutError:
+        res = get_http_client().head(url, timeout=timeout, endpoint='local_run.healthcheck')
+    except (TimeoutError, requests.Timeout):
         return (False, "http request timed out after %d seconds" % timeout)
+    except requests.ConnectionError:
+        return (False, "http request failed: connection failed")
 
     if 'content-type' in res.headers and ',' in res.headers['content-type']:
         sys.stdout.write(PaastaColors.yellow(
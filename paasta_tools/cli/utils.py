@@ -14,6 +14,7 @@
 import fnmatch
 import logging
 import os
+import pipes
 import pkgutil
 import re
 import sys
@@ -557,6 +558,37 @@ def execute_paasta_metastatus_on_remote_master(cluster, system_paasta_config, ve
     return run_paasta_metastatus(master, verbose)
 
 
+def run_paasta_capacity(master, scale=1.0, instance_counts=()):
+    """Runs paasta_capacity on a master.
+
+    :param scale: What to multiply the instance count of every instance by
+    :param instance_counts: SERVICE.INSTANCE=COUNT strings, one per instance to pack a given count of
+    """
+    flags = ''
+    if scale != 1.0:
+        flags += ' --scale %s' % pipes.quote(str(scale))
+    for instance_count in instance_counts:
+        flags += ' --instances %s' % pipes.quote(instance_count)
+    command = 'ssh -A -n %s sudo paasta_capacity%s' % (master, flags)
+    _, output = _run(command, timeout=120)
+    return output
+
+
+def execute_paasta_capacity_on_remote_master(cluster, system_paasta_config, scale=1.0, instance_counts=()):
+    """Returns a string containing an error message if an error occurred.
+    Otherwise returns the output of run_paasta_capacity().
+    """
+    masters, output = calculate_remote_masters(cluster, system_paasta_config)
+    if masters == []:
+        return 'ERROR: %s' % output
+    master, output = find_connectable_master(masters)
+    if not master:
+        return (
+            'ERROR: could not find connectable master in cluster %s\nOutput: %s' % (cluster, output)
+        )
+    return run_paasta_capacity(master, scale, instance_counts)
+
+
 def run_chronos_rerun(master, service, instancename, **kwargs):
     timeout = 60
     verbose_flags = '-v ' * kwargs['verbose']
@@ -14,7 +14,7 @@
 import re
 import time
 
-import requests
+from paasta_tools.http_client import get_http_client
 
 
 _drain_methods = {}
@@ -137,19 +137,20 @@ class HacheckDrainMethod(DrainMethod):
         }
 
     def post_spool(self, task, status):
-        resp = requests.post(
+        resp = get_http_client().post(
             self.spool_url(task),
             data={
                 'status': status,
                 'expiration': time.time() + self.expiration,
                 'reason': 'Drained by Paasta',
             },
+            endpoint='hacheck.post_spool',
         )
         resp.raise_for_status()
 
     def get_spool(self, task):
         """Query hacheck for the state of a task, and parse the result into a dictionary."""
-        response = requests.get(self.spool_url(task))
+        response = get_http_client().get(self.spool_url(task), endpoint='hacheck.get_spool')
         if response.status_code == 200:
             return {
                 'state': 'up',
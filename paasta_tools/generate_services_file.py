@@ -15,38 +15,60 @@
 """
 A simple script to enumerate all smartstack namespaces and output
 a /etc/services compatible file
+
+Usage: ./generate_services_file.py [output_path]
+
+Without an output path, the file is printed. With one, the file is only
+rewritten when its contents change.
 """
-import os
 import sys
 
 import service_configuration_lib
 
-from paasta_tools.marathon_tools import get_all_namespaces_for_service
+from paasta_tools.marathon_tools import get_all_service_configurations
 from paasta_tools.utils import compose_job_id
 from paasta_tools.utils import DEFAULT_SOA_DIR
+from paasta_tools.utils import write_file_if_changed
 
 
-def get_service_lines_for_service(service):
+def get_service_lines_for_service(service, config=None):
+    """Returns the /etc/services lines of a service.
+
+    :param config: The service's configuration, if it was read already
+    """
     lines = []
-    config = service_configuration_lib.read_service_configuration(service)
+    if config is None:
+        config = service_configuration_lib.read_service_configuration(service)
     port = config.get('port', None)
     description = config.get('description', "No description")
 
     if port is not None:
         lines.append("%s\t%d/tcp\t# %s" % (service, port, description))
 
-    for namespace, config in get_all_namespaces_for_service(service, full_name=False):
-        proxy_port = config.get('proxy_port', None)
+    for namespace, namespace_config in sorted(config.get('smartstack', {}).items()):
+        proxy_port = namespace_config.get('proxy_port', None)
         if proxy_port is not None:
             lines.append("%s\t%d/tcp\t# %s" % (compose_job_id(service, namespace), proxy_port, description))
     return [line.encode('utf-8') for line in lines]
 
 
-def main():
+def generate_services_file(service_configurations):
+    """Returns the contents of the /etc/services file.
+
+    :param service_configurations: The result of marathon_tools.get_all_service_configurations
+    """
     strings = []
-    for service in sorted(os.listdir(DEFAULT_SOA_DIR)):
-        strings.extend(get_service_lines_for_service(service))
-    print "\n".join(strings)
+    for service, config in service_configurations:
+        strings.extend(get_service_lines_for_service(service, config))
+    return "\n".join(strings) + "\n"
+
+
+def main():
+    contents = generate_services_file(get_all_service_configurations(DEFAULT_SOA_DIR))
+    if len(sys.argv) > 1:
+        write_file_if_changed(sys.argv[1], contents)
+    else:
+        sys.stdout.write(contents)
     sys.exit(0)
 
 
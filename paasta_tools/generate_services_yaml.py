@@ -12,18 +12,52 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
-import sys
+"""Usage: ./generate_services_yaml.py [options] <output_path>
+
+Writes the services YAML that maps every smartstack namespace with a proxy_port to its
+address on yocalhost.
+
+The soa-configs are read once, and the same pass can also write the /etc/services file
+(see generate_services_file) and the synapse_srv_namespaces fact (see synapse_srv_namespaces_fact),
+so that one run keeps all three in line. Each file is only rewritten when its contents change,
+since every rewrite makes synapse or puppet reload.
+
+Command line options:
+
+- --services-file <PATH>: Also write the /etc/services file to PATH
+- --synapse-fact-file <PATH>: Also write the synapse_srv_namespaces fact to PATH, e.g. in facter's facts.d
+"""
+import argparse
 
 import yaml
 
+from paasta_tools.generate_services_file import generate_services_file
 from paasta_tools.marathon_tools import get_all_namespaces
-from paasta_tools.utils import atomic_file_write
+from paasta_tools.marathon_tools import get_all_service_configurations
+from paasta_tools.synapse_srv_namespaces_fact import get_synapse_srv_namespaces_fact
+from paasta_tools.utils import DEFAULT_SOA_DIR
+from paasta_tools.utils import write_file_if_changed
 
 YOCALHOST = '169.254.255.254'
 
 
-def generate_configuration():
-    service_data = get_all_namespaces()
+def parse_args():
+    parser = argparse.ArgumentParser(description='Writes the services YAML for smartstack namespaces.')
+    parser.add_argument('output_path', help="Where to write the services YAML")
+    parser.add_argument('--services-file', dest="services_file", default=None,
+                        help="Also write the /etc/services file here")
+    parser.add_argument('--synapse-fact-file', dest="synapse_fact_file", default=None,
+                        help="Also write the synapse_srv_namespaces fact here")
+    return parser.parse_args()
+
+
+def generate_configuration(service_configurations=None):
+    """Returns the services YAML as a dict.
+
+    :param service_configurations: The result of marathon_tools.get_all_service_configurations, to use
+                                   instead of reading the SOA config directory
+    """
+    service_data = get_all_namespaces(service_configurations=service_configurations)
 
     config = {}
     for (name, data) in service_data:
@@ -38,20 +72,28 @@ def generate_configuration():
     return config
 
 
+def format_configuration(configuration):
+    return yaml.dump(configuration,
+                     indent=2,
+                     explicit_start=True,
+                     default_flow_style=False)
+
+
+def generate_outputs(args, service_configurations):
+    """Returns a list of (path, contents) of every file this run writes."""
+    outputs = [(args.output_path, format_configuration(generate_configuration(service_configurations)))]
+    if args.services_file:
+        outputs.append((args.services_file, generate_services_file(service_configurations)))
+    if args.synapse_fact_file:
+        outputs.append((args.synapse_fact_file, get_synapse_srv_namespaces_fact(service_configurations) + "\n"))
+    return outputs
+
+
 def main():
-    if len(sys.argv) != 2:
-        print >>sys.stderr, "Usage: %s <output_path>"
-        sys.exit(1)
-
-    output_path = sys.argv[1]
-    configuration = generate_configuration()
-
-    with atomic_file_write(output_path) as fp:
-        yaml.dump(configuration,
-                  fp,
-                  indent=2,
-                  explicit_start=True,
-                  default_flow_style=False)
+    args = parse_args()
+    service_configurations = get_all_service_configurations(DEFAULT_SOA_DIR)
+    for path, contents in generate_outputs(args, service_configurations):
+        write_file_if_changed(path, contents)
 
 
 if __name__ == '__main__':
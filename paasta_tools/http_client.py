@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+# Copyright 2015-2016 Yelp Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+The HTTP client paasta uses for everything that is not Marathon or Chronos: hacheck, haproxy, the mesos
+master and slaves, and services' own endpoints.
+
+All of these calls go through one process-wide HttpClient (see get_http_client), which keeps a pool of
+keep-alive connections per host, caps how many connections it opens to any one host, retries failed
+connection attempts, applies a default timeout (shortened to fit the current utils.Deadline, if there is
+one) and times every request per endpoint, into the timing sinks (see utils.configure_timing).
+"""
+import threading
+from urlparse import urlsplit
+
+import requests
+import requests_cache
+from requests.adapters import HTTPAdapter
+
+from paasta_tools.utils import deadline_timeout
+from paasta_tools.utils import timed
+
+DEFAULT_TIMEOUT_S = 10
+# Retries only cover failing to connect, so they are safe for POSTs too.
+DEFAULT_RETRIES = 3
+# How many hosts to keep a pool of connections for, and how many connections to keep (and at most open
+# at once) to each of them.
+DEFAULT_POOL_HOSTS = 64
+DEFAULT_POOL_CONNECTIONS_PER_HOST = 16
+
+_http_client = None
+_http_client_lock = threading.Lock()
+
+
+def default_endpoint_name(method, url):
+    """Names an endpoint after the request's method and host, which keeps the number of endpoints timed
+    bounded however many different paths are called."""
+    return '%s %s' % (method.upper(), urlsplit(url).netloc)
+
+
+class HttpClient(object):
+    """A thread-safe HTTP client with per-host keep-alive pools, uniform retries and timeouts,
+    and per-endpoint timings.
+
+    :param timeout: The timeout, in seconds, of requests that do not ask for a different one
+    :param retries: How many times to retry failing to connect to a host
+    :param pool_hosts: How many hosts to keep connection pools for
+    :param pool_connections_per_host: How many connections to keep alive, and at most have open at once,
+                                      to any single host
+    """
+
+    def __init__(self, timeout=DEFAULT_TIMEOUT_S, retries=DEFAULT_RETRIES, pool_hosts=DEFAULT_POOL_HOSTS,
+                 pool_connections_per_host=DEFAULT_POOL_CONNECTIONS_PER_HOST):
+        self.timeout = timeout
+        # Scripts like setup_marathon_job install requests_cache globally; health and drain checks must
+        # never be answered from a cache.
+        with requests_cache.disabled():
+            self.session = requests.Session()
+        for prefix in ('http://', 'https://'):
+            self.session.mount(prefix, HTTPAdapter(
+                pool_connections=pool_hosts,
+                pool_maxsize=pool_connections_per_host,
+                max_retries=retries,
+                pool_block=True,
+            ))
+
+    def request(self, method, url, endpoint=None, timeout=None, **kwargs):
+        """Makes a request, like requests.Session.request.
+
+        :param endpoint: The endpoint tag to time this request under; defaults to its method and host
+        :param timeout: A timeout in seconds to use instead of the client's default
+        :returns: A requests.Response
+        """
+        endpoint = endpoint or default_endpoint_name(method, url)
+        timeout = deadline_timeout(self.timeout if timeout is None else timeout)
+        with timed('http_client.request', endpoint=endpoint):
+            return self.session.request(method, url, timeout=timeout, **kwargs)
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def head(self, url, **kwargs):
+        return self.request('HEAD', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+
+def get_http_client():
+    """Returns the process-wide HttpClient, creating it on first use."""
+    global _http_client
+    with _http_client_lock:
+        if _http_client is None:
+            _http_client = HttpClient()
+        return _http_client
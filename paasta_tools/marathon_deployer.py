@@ -0,0 +1,529 @@
+#!/usr/bin/env python
+# Copyright 2015-2016 Yelp Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Usage: ./marathon_deployer.py [options]
+
+A long-running alternative to deploy_marathon_services, which runs setup_marathon_job for every
+marathon instance of the cluster on a cron whether or not anything changed.
+
+The deployer follows Marathon's event stream (/v2/events) to keep a model of the cluster's apps
+and tasks, and watches the soa-configs of the cluster's marathon instances (see soa_config_watcher).
+It only deploys the instances whose soa-configs changed, whose apps or tasks Marathon told it about,
+or whose bounce is still in progress, so that each step of a bounce happens seconds after the one
+before instead of a cron period later.
+
+Every instance is deployed when the deployer starts, and the instances whose apps changed while
+it was not listening are deployed whenever it reconnects to the event stream. As a safety net,
+every instance is also deployed every --full-deploy-interval.
+
+Command line options:
+
+- -d <SOA_DIR>, --soa-dir <SOA_DIR>: Specify a SOA config dir to read from
+- -j <N>, --concurrency <N>: Deploy up to N instances at once
+- --bounce-interval <S>: Deploy instances with a bounce in progress every S seconds
+- --soa-poll-interval <S>: Look for changed soa-configs every S seconds
+- --full-deploy-interval <S>: Deploy every instance every S seconds
+- -v, --verbose: Verbose output
+"""
+import argparse
+import json
+import logging
+import re
+import threading
+import time
+
+import requests
+import service_configuration_lib
+from concurrent.futures import ThreadPoolExecutor
+
+from paasta_tools import marathon_tools
+from paasta_tools import monitoring_tools
+from paasta_tools import setup_marathon_job
+from paasta_tools.marathon_tools import deformat_job_id
+from paasta_tools.paasta_maintenance import MaintenanceSnapshot
+from paasta_tools.soa_config_watcher import SoaConfigWatcher
+from paasta_tools.utils import compose_job_id
+from paasta_tools.utils import configure_timing
+from paasta_tools.utils import DEFAULT_SOA_DIR
+from paasta_tools.utils import get_zookeeper_session
+from paasta_tools.utils import InvalidJobNameError
+from paasta_tools.utils import load_system_paasta_config
+from paasta_tools.utils import timed
+from paasta_tools.utils import ZookeeperPool
+
+log = logging.getLogger(__name__)
+
+DEFAULT_CONCURRENCY = 5
+DEFAULT_BOUNCE_INTERVAL_S = 10
+DEFAULT_SOA_POLL_INTERVAL_S = 10
+DEFAULT_FULL_DEPLOY_INTERVAL_S = 3600
+# How long to wait after something changes for more changes to come, so that a burst of task
+# updates from a single bounce step turns into a single deploy.
+DEFAULT_DEBOUNCE_S = 1
+# Marathon does not send anything while nothing happens; reconnect if it has been quiet this long, in
+# case the connection died without us noticing.
+EVENT_STREAM_READ_TIMEOUT_S = 300
+# Reads of the event stream wait until this much has arrived, so the tail of an event may wait for the
+# next one, or for the read timeout on a quiet cluster; resyncing on reconnect catches up on it then.
+EVENT_STREAM_CHUNK_SIZE_B = 1024
+EVENT_STREAM_MAX_BACKOFF_S = 60
+
+MARATHON_EVENT_TYPES = (
+    'status_update_event',
+    'health_status_changed_event',
+    'failed_health_check_event',
+    'deployment_info',
+    'deployment_success',
+    'deployment_failed',
+    'deployment_step_success',
+    'deployment_step_failure',
+    'api_post_event',
+    'app_terminated_event',
+)
+# Task states after which Marathon forgets a task.
+TERMINAL_TASK_STATES = frozenset([
+    'TASK_FINISHED',
+    'TASK_FAILED',
+    'TASK_KILLED',
+    'TASK_LOST',
+    'TASK_ERROR',
+    'TASK_DROPPED',
+    'TASK_GONE',
+])
+# Server-sent events may end their lines with any of these.
+LINE_BREAK_RE = re.compile(r'\r\n|\r|\n')
+
+
+def iter_stream_lines(chunks):
+    """Splits a stream of bytes into lines, which server-sent events may end with CRLF, LF or CR.
+    (requests' iter_lines takes the LF of a CRLF split across two chunks for an empty line.)
+
+    :param chunks: An iterable of the stream's bytes, in chunks of any size
+    :returns: A generator of the stream's complete lines, without their line endings
+    """
+    # The pieces of the line being received, which are only joined once it ends, so that a long line
+    # costs time in proportion to its length, however many chunks it comes in.
+    pending = []
+    after_cr = False
+    for chunk in chunks:
+        # A chunk that starts with LF after one that ended with CR finishes that CRLF.
+        if after_cr and chunk.startswith('\n'):
+            chunk = chunk[1:]
+        if not chunk:
+            continue
+        after_cr = chunk.endswith('\r')
+        lines = LINE_BREAK_RE.split(chunk)
+        if len(lines) == 1:
+            pending.append(chunk)
+            continue
+        pending.append(lines[0])
+        yield ''.join(pending)
+        for line in lines[1:-1]:
+            yield line
+        pending = [lines[-1]]
+
+
+def parse_event_stream(lines):
+    """Parses the lines of a server-sent event stream.
+
+    :param lines: An iterable of the stream's lines, without their line endings
+    :returns: A generator of (event type, decoded JSON data) for every event in the stream
+    """
+    event_type = None
+    data = []
+    for line in lines:
+        if not line:
+            if data:
+                try:
+                    yield event_type or 'message', json.loads('\n'.join(data))
+                except ValueError:
+                    log.warning("Ignoring %s event whose data is not JSON" % event_type)
+            event_type = None
+            data = []
+        elif line.startswith(':'):
+            continue
+        else:
+            field, _, value = line.partition(':')
+            if value.startswith(' '):
+                value = value[1:]
+            if field == 'event':
+                event_type = value
+            elif field == 'data':
+                data.append(value)
+
+
+def subscribe_to_marathon_events(client, event_types=MARATHON_EVENT_TYPES, read_timeout=EVENT_STREAM_READ_TIMEOUT_S):
+    """Subscribes to Marathon's event stream, trying each of the client's servers in turn.
+
+    :param client: A MarathonClient, whose servers and credentials are used
+    :param event_types: The types of event to ask Marathon for
+    :param read_timeout: Give up on the stream if Marathon is silent for this many seconds
+    :returns: The streaming requests.Response; read it with read_marathon_events
+    :raises: requests.exceptions.RequestException if no server could be reached
+    """
+    response = None
+    for server in client.servers:
+        url = server.rstrip('/') + '/v2/events'
+        try:
+            # Not over the client's session: it is shared with the deploys, and this request never ends.
+            response = requests.get(
+                url,
+                params={'event_type': list(event_types)},
+                headers={'Accept': 'text/event-stream'},
+                auth=client.auth,
+                timeout=(client.timeout, read_timeout),
+                stream=True,
+            )
+            response.raise_for_status()
+            break
+        except requests.exceptions.RequestException as e:
+            log.error('Error while subscribing to %s: %s', url, e)
+            response = None
+    if response is None:
+        raise requests.exceptions.ConnectionError('No remaining Marathon servers to subscribe to')
+    return response
+
+
+def read_marathon_events(response):
+    """Returns a generator of (event type, data) for the events of a subscription, which ends
+    (and closes the response) when the stream does."""
+    try:
+        chunks = response.iter_content(chunk_size=EVENT_STREAM_CHUNK_SIZE_B)
+        lines = (line.decode('utf-8') for line in iter_stream_lines(chunks))
+        for event in parse_event_stream(lines):
+            yield event
+    finally:
+        response.close()
+
+
+def app_id_to_service_instance(app_id):
+    """Returns the (service, instance) an app id belongs to, or None if it isn't a paasta app."""
+    try:
+        service, instance, _, __ = deformat_job_id(app_id.lstrip('/'))
+    except InvalidJobNameError:
+        return None
+    return service, instance
+
+
+def get_deployment_app_ids(plan):
+    """Returns the ids of the apps a deployment plan acts on."""
+    steps = plan.get('steps', [])
+    return set(action['app'] for step in steps for action in step.get('actions', []) if 'app' in action)
+
+
+class MarathonModel(object):
+    """What the deployer knows about the apps and tasks in Marathon, kept up to date from the event stream.
+
+    ``apps`` maps every app id to a dict of its 'instances' (None until we learn it) and its 'tasks',
+    which maps each task id to a dict of its 'state' and whether it is 'healthy' (None if the app has
+    no health checks, or they have not run yet)."""
+
+    def __init__(self):
+        self.apps = {}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def app_from_marathon(app):
+        tasks = {}
+        for task in app.tasks or []:
+            results = task.health_check_results or []
+            tasks[task.id] = {
+                'state': 'TASK_RUNNING' if task.started_at else 'TASK_STAGING',
+                'healthy': all(result.alive for result in results) if results else None,
+            }
+        return {'instances': app.instances, 'tasks': tasks}
+
+    def load(self, apps):
+        """Replaces the model with the apps Marathon lists.
+
+        :param apps: A list of MarathonApps, listed with embed_tasks
+        :returns: The ids of the apps that are new, gone, or differ from what the model had
+        """
+        new_apps = dict(('/' + app.id.lstrip('/'), self.app_from_marathon(app)) for app in apps)
+        with self.lock:
+            old_apps = self.apps
+            self.apps = new_apps
+        return set(app_id for app_id in set(old_apps) | set(new_apps)
+                   if old_apps.get(app_id) != new_apps.get(app_id))
+
+    def get_or_create_app(self, app_id):
+        return self.apps.setdefault(app_id, {'instances': None, 'tasks': {}})
+
+    def apply_event(self, event_type, data):
+        """Updates the model with an event from the event stream.
+
+        :returns: The ids of the apps the event is about
+        """
+        with self.lock:
+            if event_type == 'status_update_event':
+                app_id = data['appId']
+                tasks = self.get_or_create_app(app_id)['tasks']
+                if data['taskStatus'] in TERMINAL_TASK_STATES:
+                    tasks.pop(data['taskId'], None)
+                else:
+                    task = tasks.setdefault(data['taskId'], {'healthy': None})
+                    task['state'] = data['taskStatus']
+                return set([app_id])
+            elif event_type == 'health_status_changed_event':
+                app_id = data['appId']
+                task_id = data.get('taskId', data.get('instanceId'))
+                task = self.get_or_create_app(app_id)['tasks'].get(task_id)
+                if task is not None:
+                    task['healthy'] = data['alive']
+                return set([app_id])
+            elif event_type == 'failed_health_check_event':
+                return set([data['appId']])
+            elif event_type == 'api_post_event':
+                app_definition = data.get('appDefinition') or {}
+                if 'id' not in app_definition:
+                    return set()
+                app_id = app_definition['id']
+                if app_definition.get('instances') is not None:
+                    self.get_or_create_app(app_id)['instances'] = app_definition['instances']
+                return set([app_id])
+            elif event_type == 'app_terminated_event':
+                self.apps.pop(data['appId'], None)
+                return set([data['appId']])
+            elif event_type.startswith('deployment_'):
+                plan = data.get('plan', {})
+                app_ids = get_deployment_app_ids(plan)
+                if event_type == 'deployment_success':
+                    for app in plan.get('target', {}).get('apps', []):
+                        if app['id'] in app_ids and app['id'] in self.apps:
+                            self.apps[app['id']]['instances'] = app.get('instances')
+                return app_ids
+        return set()
+
+    def get_apps_by_service_instance(self):
+        """Returns a dict of {(service, instance): [the instance's apps]}, leaving out non-paasta apps."""
+        apps_by_service_instance = {}
+        with self.lock:
+            for app_id, app in self.apps.items():
+                service_instance = app_id_to_service_instance(app_id)
+                if service_instance is not None:
+                    apps_by_service_instance.setdefault(service_instance, []).append(app)
+        return apps_by_service_instance
+
+    def get_service_instances_with_bounce_in_progress(self):
+        """Returns the (service, instance) whose apps still have to settle: there is more than one of them,
+        or the one app's tasks are not all running and healthy, or there are not as many as it asks for."""
+        return set(service_instance for service_instance, apps in self.get_apps_by_service_instance().items()
+                   if is_bounce_in_progress(apps))
+
+
+def is_bounce_in_progress(apps):
+    if len(apps) != 1:
+        return len(apps) > 1
+    tasks = apps[0]['tasks'].values()
+    running = [task for task in tasks if task['state'] == 'TASK_RUNNING']
+    instances = apps[0]['instances']
+    return len(running) != len(tasks) or (instances is not None and len(running) != instances) or \
+        any(task['healthy'] is False for task in running)
+
+
+def deploy_marathon_instance(service, instance, client, marathon_config, soa_dir):
+    with timed('marathon_deployer.deploy', service=service, instance=instance):
+        try:
+            return setup_marathon_job.deploy_marathon_service(service, instance, client, soa_dir, marathon_config)
+        except Exception:
+            log.exception("Failed to deploy %s" % compose_job_id(service, instance))
+            return 1
+
+
+def deploy_marathon_instances(service_instances, client, marathon_config, soa_dir, concurrency=DEFAULT_CONCURRENCY):
+    """Deploys the given marathon instances with setup_marathon_job, up to concurrency at a time.
+
+    :returns: A dict of {(service, instance): 0 if the deploy went fine, 1 otherwise}
+    """
+    service_instances = sorted(service_instances)
+    if not service_instances:
+        return {}
+    system_paasta_config = load_system_paasta_config()
+    with monitoring_tools.MonitoringConfigCache(), \
+            monitoring_tools.batched_sensu_events(system_paasta_config), MaintenanceSnapshot():
+        # Each batch starts from what Marathon has now, not from what the previous one saw.
+        client.invalidate_snapshot()
+        with ThreadPoolExecutor(max_workers=max(1, concurrency)) as executor:
+            results = executor.map(
+                lambda service_instance: deploy_marathon_instance(service_instance[0], service_instance[1], client,
+                                                                  marathon_config, soa_dir),
+                service_instances)
+            return dict(zip(service_instances, results))
+
+
+class MarathonDeployer(object):
+    """Deploys the marathon instances whose soa-configs, apps or tasks changed, or whose bounce is in
+    progress, with setup_marathon_job.
+
+    Changes are collected into a set of dirty instances by mark_dirty, from the event stream
+    (see follow_events) and from polling; run_once deploys the instances that are dirty."""
+
+    def __init__(self, client, marathon_config, cluster, soa_dir=DEFAULT_SOA_DIR, concurrency=DEFAULT_CONCURRENCY,
+                 bounce_interval=DEFAULT_BOUNCE_INTERVAL_S, soa_poll_interval=DEFAULT_SOA_POLL_INTERVAL_S,
+                 full_deploy_interval=DEFAULT_FULL_DEPLOY_INTERVAL_S, debounce=DEFAULT_DEBOUNCE_S):
+        self.client = client
+        self.marathon_config = marathon_config
+        self.cluster = cluster
+        self.soa_dir = soa_dir
+        self.concurrency = concurrency
+        self.bounce_interval = bounce_interval
+        self.soa_poll_interval = soa_poll_interval
+        self.full_deploy_interval = full_deploy_interval
+        self.debounce = debounce
+        self.model = MarathonModel()
+        self.soa_config_watcher = SoaConfigWatcher(cluster, soa_dir, instance_types=('marathon',))
+        self.dirty = set()
+        self.dirty_condition = threading.Condition()
+        self.next_soa_poll = 0
+        self.next_bounce_check = 0
+        self.next_full_deploy = 0
+
+    def mark_dirty(self, service_instances):
+        """Queues the given (service, instance) to be deployed, leaving out those that aren't
+        marathon instances of this cluster."""
+        service_instances = set(service_instances) & self.soa_config_watcher.get_service_instances('marathon')
+        if service_instances:
+            with self.dirty_condition:
+                self.dirty.update(service_instances)
+                self.dirty_condition.notify()
+
+    def mark_apps_dirty(self, app_ids):
+        self.mark_dirty(app_id_to_service_instance(app_id) for app_id in app_ids)
+
+    def take_dirty(self):
+        with self.dirty_condition:
+            dirty = self.dirty
+            self.dirty = set()
+        return dirty
+
+    def resync(self):
+        """Reloads the model from Marathon and marks the instances whose apps changed since as dirty."""
+        self.mark_apps_dirty(self.model.load(self.client.list_apps(embed_tasks=True)))
+
+    def follow_events(self, stop_event):
+        """Keeps the model up to date from the event stream until stop_event is set, reconnecting
+        (and resyncing) whenever the stream ends."""
+        backoff = 1
+        while not stop_event.is_set():
+            try:
+                # Subscribe before listing the apps, so that nothing happens in between unnoticed.
+                response = subscribe_to_marathon_events(self.client)
+                self.resync()
+                backoff = 1
+                for event_type, data in read_marathon_events(response):
+                    self.mark_apps_dirty(self.model.apply_event(event_type, data))
+                    if stop_event.is_set():
+                        break
+            except Exception as e:
+                log.error("Lost the Marathon event stream: %s" % e)
+                stop_event.wait(backoff)
+                backoff = min(backoff * 2, EVENT_STREAM_MAX_BACKOFF_S)
+
+    def check_timers(self, now):
+        """Marks the instances whose soa-configs changed, whose bounce is in progress, or all of them,
+        as dirty when it is time to look for them."""
+        if now >= self.next_soa_poll:
+            self.next_soa_poll = now + self.soa_poll_interval
+            self.mark_dirty(self.soa_config_watcher.poll()['marathon'])
+        if now >= self.next_full_deploy:
+            self.next_full_deploy = now + self.full_deploy_interval
+            self.mark_dirty(self.soa_config_watcher.get_service_instances('marathon'))
+        if now >= self.next_bounce_check:
+            self.next_bounce_check = now + self.bounce_interval
+            self.mark_dirty(self.model.get_service_instances_with_bounce_in_progress())
+
+    def get_next_deadline(self):
+        return min(self.next_soa_poll, self.next_bounce_check, self.next_full_deploy)
+
+    def deploy(self, service_instances):
+        return deploy_marathon_instances(service_instances, self.client, self.marathon_config, self.soa_dir,
+                                         concurrency=self.concurrency)
+
+    def run_once(self, now=None):
+        """Deploys the instances that are dirty, after checking the timers.
+
+        :returns: The results of deploy
+        """
+        self.check_timers(time.time() if now is None else now)
+        return self.deploy(self.take_dirty())
+
+    def run(self, stop_event=None):
+        """Deploys dirty instances as they come, until stop_event is set."""
+        stop_event = stop_event or threading.Event()
+        # The first poll finds every instance, so that the event stream knows which apps to care about.
+        self.check_timers(time.time())
+        events_thread = threading.Thread(target=self.follow_events, args=(stop_event,))
+        events_thread.daemon = True
+        events_thread.start()
+        # Every deploy takes bounce locks and reads zookeeper; keep their sessions open for all of them instead
+        # of connecting again for every batch.
+        with get_zookeeper_session().lease(), ZookeeperPool():
+            while not stop_event.is_set():
+                with self.dirty_condition:
+                    if not self.dirty:
+                        self.dirty_condition.wait(max(0, self.get_next_deadline() - time.time()))
+                stop_event.wait(self.debounce)
+                results = self.run_once()
+                if results:
+                    log.info("Deployed %d instances, %d failed" % (len(results), sum(results.values())))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Deploys marathon instances as their configs, apps and tasks change.')
+    parser.add_argument('-d', '--soa-dir', dest="soa_dir", metavar="SOA_DIR", default=DEFAULT_SOA_DIR,
+                        help="define a different soa config directory")
+    parser.add_argument('-j', '--concurrency', dest="concurrency", type=int, default=DEFAULT_CONCURRENCY,
+                        help="How many instances to deploy at once (default %(default)s)")
+    parser.add_argument('--bounce-interval', dest="bounce_interval", type=float, default=DEFAULT_BOUNCE_INTERVAL_S,
+                        help="Deploy instances with a bounce in progress this often, in seconds (default %(default)s)")
+    parser.add_argument('--soa-poll-interval', dest="soa_poll_interval", type=float,
+                        default=DEFAULT_SOA_POLL_INTERVAL_S,
+                        help="Look for changed soa-configs this often, in seconds (default %(default)s)")
+    parser.add_argument('--full-deploy-interval', dest="full_deploy_interval", type=float,
+                        default=DEFAULT_FULL_DEPLOY_INTERVAL_S,
+                        help="Deploy every instance this often, in seconds (default %(default)s)")
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        dest="verbose", default=False)
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    if args.verbose:
+        logging.basicConfig(level=logging.DEBUG)
+    else:
+        logging.basicConfig(level=logging.WARNING)
+
+    # soa-configs change under a long-running process; always read them from disk.
+    service_configuration_lib.disable_yaml_cache()
+    system_paasta_config = load_system_paasta_config()
+    configure_timing(system_paasta_config)
+    marathon_config = setup_marathon_job.get_main_marathon_config()
+    client = marathon_tools.get_marathon_client(marathon_config.get_url(), marathon_config.get_username(),
+                                                marathon_config.get_password())
+    deployer = MarathonDeployer(
+        client=client,
+        marathon_config=marathon_config,
+        cluster=system_paasta_config.get_cluster(),
+        soa_dir=args.soa_dir,
+        concurrency=args.concurrency,
+        bounce_interval=args.bounce_interval,
+        soa_poll_interval=args.soa_poll_interval,
+        full_deploy_interval=args.full_deploy_interval,
+    )
+    deployer.run()
+
+
+if __name__ == "__main__":
+    main()
@@ -21,21 +21,29 @@ import logging
 import os
 import re
 import socket
+import threading
+from bisect import bisect_left
 from math import ceil
-from time import sleep
 
+import requests
+import requests_cache
 import service_configuration_lib
 from kazoo.exceptions import NoNodeError
 from marathon import MarathonClient
 from marathon import MarathonHttpError
 from marathon import NotFoundError
+from marathon.exceptions import InternalServerError
+from marathon.exceptions import MarathonError
+from marathon.models import MarathonTask
 
+from paasta_tools.api_recorder import get_fixture_recorder
+from paasta_tools.api_recorder import RecordingMarathonClient
 from paasta_tools.mesos_tools import get_local_slave_state
 from paasta_tools.mesos_tools import get_mesos_network_for_net
 from paasta_tools.mesos_tools import get_mesos_slaves_grouped_by_attribute
 from paasta_tools.utils import compose_job_id
+from paasta_tools.utils import deadline_timeout
 from paasta_tools.utils import decompose_job_id
-from paasta_tools.utils import deep_merge_dictionaries
 from paasta_tools.utils import DEFAULT_SOA_DIR
 from paasta_tools.utils import deploy_blacklist_to_constraints
 from paasta_tools.utils import deploy_whitelist_to_constraints
@@ -46,12 +54,14 @@ from paasta_tools.utils import get_paasta_branch
 from paasta_tools.utils import get_service_instance_list
 from paasta_tools.utils import InstanceConfig
 from paasta_tools.utils import InvalidInstanceConfig
+from paasta_tools.utils import LayeredConfig
 from paasta_tools.utils import load_deployments_json
 from paasta_tools.utils import load_system_paasta_config
 from paasta_tools.utils import NoConfigurationForServiceError
 from paasta_tools.utils import PaastaColors
 from paasta_tools.utils import PaastaNotConfiguredError
 from paasta_tools.utils import PATH_TO_SYSTEM_PAASTA_CONFIG_DIR
+from paasta_tools.utils import sleep_within_deadline
 from paasta_tools.utils import timeout
 from paasta_tools.utils import ZookeeperPool
 
@@ -151,7 +161,7 @@ def load_marathon_service_config(service, instance, cluster, load_deployments=Tr
             "%s not found in config file %s/%s/%s.yaml." % (instance, soa_dir, service, marathon_conf_file)
         )
 
-    general_config = deep_merge_dictionaries(overrides=instance_configs[instance], defaults=general_config)
+    general_config = LayeredConfig(instance_configs[instance], general_config)
 
     branch_dict = {}
     if load_deployments:
@@ -248,7 +258,7 @@ class MarathonServiceConfig(InstanceConfig):
             'decision_policy': 'pid',
             'setpoint': 0.8,
         }
-        return deep_merge_dictionaries(overrides=self.config_dict.get('autoscaling', {}), defaults=default_params)
+        return LayeredConfig(self.config_dict.get('autoscaling', {}), default_params).materialize()
 
     def limit_instance_count(self, instances):
         """
@@ -317,7 +327,7 @@ class MarathonServiceConfig(InstanceConfig):
         if constraints is not None:
             return constraints
         else:
-            constraints = self.get_extra_constraints()
+            constraints = list(self.get_extra_constraints())
             constraints.extend(self.get_routing_constraints(service_namespace_config))
             constraints.extend(self.get_deploy_constraints())
             constraints.extend(self.get_pool_constraints())
@@ -584,8 +594,16 @@ def load_service_namespace_config(service, namespace, soa_dir=DEFAULT_SOA_DIR):
 
     service_config = service_configuration_lib.read_service_configuration(service, soa_dir)
     smartstack_config = service_config.get('smartstack', {})
-    namespace_config_from_file = smartstack_config.get(namespace, {})
+    return parse_service_namespace_config(smartstack_config.get(namespace, {}))
 
+
+def parse_service_namespace_config(namespace_config_from_file):
+    """Builds the ServiceNamespaceConfig of a namespace from its section of the smartstack config,
+    as load_service_namespace_config describes.
+
+    :param namespace_config_from_file: The namespace's dict from the service's smartstack config
+    :returns: A ServiceNamespaceConfig
+    """
     service_namespace_config = ServiceNamespaceConfig()
     # We can't really use .get, as we don't want the key to be in the returned
     # dict at all if it doesn't exist in the config file.
@@ -674,15 +692,128 @@ class InvalidMarathonHealthcheckMode(Exception):
     pass
 
 
+class AppIdPrefixIndex(object):
+    """A list of Marathon objects sorted by app id, so that everything under an app id prefix
+    (e.g. all the apps for one service.instance) can be found with a binary search.
+    Leading slashes are ignored, on the app ids and on the prefixes."""
+
+    def __init__(self, items, get_app_id):
+        self.items = sorted(items, key=lambda item: get_app_id(item).lstrip('/'))
+        self.app_ids = [get_app_id(item).lstrip('/') for item in self.items]
+
+    def with_prefix(self, prefix):
+        prefix = prefix.lstrip('/')
+        start = end = bisect_left(self.app_ids, prefix)
+        while end < len(self.app_ids) and self.app_ids[end].startswith(prefix):
+            end += 1
+        return self.items[start:end]
+
+    def __len__(self):
+        return len(self.items)
+
+
+class PaastaMarathonClient(MarathonClient):
+    """A MarathonClient that keeps its connections to Marathon alive between requests, and keeps a
+    snapshot of the cluster's apps and tasks for the length of a run.
+
+    Most of our scripts look at the same cluster-wide lists of apps and tasks once for every instance they
+    deal with. The first call to get_apps_with_prefix or get_tasks_with_prefix fetches the whole list and
+    indexes it by app id; the rest of the run is served from that snapshot. Any write to Marathon throws the
+    snapshot away so that the next read sees the change. When you need the live state of a single app
+    (e.g. while waiting for it to come up), use get_app or list_tasks(app_id), which only ask Marathon
+    about that app."""
+
+    def __init__(self, *args, **kwargs):
+        super(PaastaMarathonClient, self).__init__(*args, **kwargs)
+        # setup_marathon_job installs requests_cache for everything else it talks to. Our reads are cached by
+        # the snapshot instead, and targeted reads are used for polling, so they must never be served stale.
+        with requests_cache.disabled():
+            self.session = requests.Session()
+        self.snapshot_lock = threading.RLock()
+        self.invalidate_snapshot()
+
+    def _do_request(self, method, path, params=None, data=None):
+        """The same as MarathonClient._do_request, but over our keep-alive session."""
+        headers = {'Content-Type': 'application/json', 'Accept': 'application/json'}
+        response = None
+        try:
+            for server in self.servers:
+                url = ''.join([server.rstrip('/'), path])
+                try:
+                    response = self.session.request(method, url, params=params, data=data, headers=headers,
+                                                    auth=self.auth, timeout=deadline_timeout(self.timeout))
+                    break
+                except requests.exceptions.RequestException as e:
+                    log.error('Error while calling %s: %s', url, e)
+        finally:
+            if method != 'GET':
+                self.invalidate_snapshot()
+
+        if response is None:
+            raise MarathonError('No remaining Marathon servers to try')
+        if response.status_code >= 400:
+            log.error('Got HTTP %d: %s', response.status_code, response.text)
+            if response.status_code >= 500:
+                raise InternalServerError(response)
+            elif response.status_code == 404:
+                raise NotFoundError(response)
+            else:
+                raise MarathonHttpError(response)
+        return response
+
+    def invalidate_snapshot(self):
+        """Forget the snapshot of apps and tasks, so that it is fetched again the next time it is needed."""
+        with self.snapshot_lock:
+            self.app_snapshot = None
+            self.task_snapshot = None
+
+    def get_apps_with_prefix(self, prefix):
+        """Returns the apps in this run's snapshot whose id starts with prefix.
+        Apps are listed with embed_failures, so they carry their tasks and last task failure."""
+        with self.snapshot_lock:
+            if self.app_snapshot is None:
+                self.app_snapshot = AppIdPrefixIndex(self.list_apps(embed_failures=True), lambda app: app.id)
+            return self.app_snapshot.with_prefix(prefix)
+
+    def get_tasks_with_prefix(self, prefix):
+        """Returns the tasks in this run's snapshot whose app id starts with prefix."""
+        with self.snapshot_lock:
+            if self.task_snapshot is None:
+                self.task_snapshot = AppIdPrefixIndex(self.list_tasks(), lambda task: task.app_id)
+            return self.task_snapshot.with_prefix(prefix)
+
+    def list_tasks(self, app_id=None, **kwargs):
+        """Like MarathonClient.list_tasks, but when given an app_id only that app's tasks are fetched,
+        instead of every task in the cluster. Raises a NotFoundError if there is no such app."""
+        if app_id is None:
+            return super(PaastaMarathonClient, self).list_tasks(**kwargs)
+        response = self._do_request('GET', '/v2/apps/%s/tasks' % app_id.lstrip('/'))
+        tasks = self._parse_response(response, MarathonTask, is_list=True, resource_name='tasks')
+        for task in tasks:
+            if task.app_id is None:
+                task.app_id = app_id
+        for key, value in kwargs.items():
+            tasks = [task for task in tasks if getattr(task, key) == value]
+        return tasks
+
+
+class RecordingPaastaMarathonClient(RecordingMarathonClient, PaastaMarathonClient):
+    pass
+
+
 def get_marathon_client(url, user, passwd):
-    """Get a new marathon client connection in the form of a MarathonClient object.
+    """Get a new marathon client connection in the form of a PaastaMarathonClient object.
 
     :param url: The url to connect to marathon at
     :param user: The username to connect with
     :param passwd: The password to connect with
-    :returns: A new marathon.MarathonClient object"""
+    :returns: A new PaastaMarathonClient object"""
     log.info("Connecting to Marathon server at: %s", url)
-    return MarathonClient(url, user, passwd, timeout=30)
+    recorder = get_fixture_recorder()
+    if recorder is not None:
+        log.info("Recording Marathon responses to %s", recorder.path)
+        return RecordingPaastaMarathonClient(recorder, url, user, passwd, timeout=30)
+    return PaastaMarathonClient(url, user, passwd, timeout=30)
 
 
 def format_job_id(service, instance, git_hash=None, config_hash=None):
@@ -765,16 +896,31 @@ def get_all_namespaces_for_service(service, soa_dir=DEFAULT_SOA_DIR, full_name=T
     return namespace_list
 
 
-def get_all_namespaces(soa_dir=DEFAULT_SOA_DIR):
+def get_all_service_configurations(soa_dir=DEFAULT_SOA_DIR):
+    """Reads the configuration of every service in the SOA config directory, once each, so that
+    everything that describes all services can be built from a single pass over it.
+
+    :param soa_dir: The SOA config directory to read from
+    :returns: A list of tuples of the form (service, service_config), sorted by service"""
+    rootdir = os.path.abspath(soa_dir)
+    return [(service, service_configuration_lib.read_service_configuration(service, soa_dir))
+            for service in sorted(os.listdir(rootdir))]
+
+
+def get_all_namespaces(soa_dir=DEFAULT_SOA_DIR, service_configurations=None):
     """Get all the smartstack namespaces across all services.
     This is mostly so synapse can get everything it needs in one call.
 
     :param soa_dir: The SOA config directory to read from
+    :param service_configurations: The result of get_all_service_configurations, to use instead of
+                                   reading the SOA config directory again
     :returns: A list of tuples of the form (service.namespace, namespace_config)"""
-    rootdir = os.path.abspath(soa_dir)
+    if service_configurations is None:
+        service_configurations = get_all_service_configurations(soa_dir)
     namespace_list = []
-    for srv_dir in os.listdir(rootdir):
-        namespace_list.extend(get_all_namespaces_for_service(srv_dir, soa_dir))
+    for service, service_config in service_configurations:
+        for namespace, namespace_config in service_config.get('smartstack', {}).items():
+            namespace_list.append((compose_job_id(service, namespace), namespace_config))
     return namespace_list
 
 
@@ -799,6 +945,133 @@ def marathon_services_running_here():
     return srv_list
 
 
+def get_soa_config_paths_for_nerve(service, cluster, soa_dir):
+    """The files that get_marathon_services_running_here_for_nerve reads for a service,
+    named the way service_configuration_lib names them."""
+    service_dir = os.path.join(os.path.abspath(soa_dir), service)
+    return [
+        os.path.join(service_dir, 'service.yaml'),
+        os.path.join(service_dir, 'smartstack.yaml'),
+        os.path.join(service_dir, 'marathon-%s.yaml' % cluster),
+    ]
+
+
+def get_mtime(path):
+    """Returns the mtime of a file, or None if it does not exist."""
+    try:
+        return os.stat(path).st_mtime
+    except OSError:
+        return None
+
+
+class MarathonNerveCache(object):
+    """
+    Remembers, for the life of the process, which nerve entry each marathon instance running here maps
+    to, along with the mtimes of the soa-configs the entries were read from. Callers that ask again and
+    again, like nerve's configuration loop, then only re-read the soa-configs of the services whose files
+    changed, and get the previous answer back outright when neither the set of tasks running here nor
+    any of those files changed.
+
+    A service whose marathon config does not exist is not remembered: it is about to be cleaned up.
+    """
+    lock = threading.Lock()
+    # {(cluster, soa_dir, service): (mtimes, {instance: (nerve_name, ServiceNamespaceConfig) or None})}
+    entries_by_service = {}
+    last_fingerprint = None
+    last_nerve_list = None
+
+    @classmethod
+    def clear(cls):
+        with cls.lock:
+            cls.entries_by_service = {}
+            cls.last_fingerprint = None
+            cls.last_nerve_list = None
+
+    @classmethod
+    def get_nerve_list(cls, marathon_services, cluster, soa_dir):
+        """Returns what get_marathon_services_running_here_for_nerve returns for these marathon services.
+
+        :param marathon_services: A list of (service, instance, port), as marathon_services_running_here returns
+        """
+        mtimes_by_service = dict(
+            (name, tuple(get_mtime(path) for path in get_soa_config_paths_for_nerve(name, cluster, soa_dir)))
+            for name in set(name for name, _, __ in marathon_services)
+        )
+        fingerprint = (cluster, soa_dir, tuple(sorted(marathon_services)), tuple(sorted(mtimes_by_service.items())))
+        with cls.lock:
+            if fingerprint == cls.last_fingerprint:
+                return [(entry_name, ServiceNamespaceConfig(entry_dict))
+                        for entry_name, entry_dict in cls.last_nerve_list]
+
+        nerve_list = []
+        cacheable = True
+        for name, instance, port in marathon_services:
+            mtimes = mtimes_by_service[name]
+            entries = cls.get_entries(name, mtimes, cluster, soa_dir)
+            if instance in entries:
+                entry = entries[instance]
+            else:
+                # service_configuration_lib remembers what it read for the life of the process too, and never
+                # looks at mtimes, so make it read the files again.
+                service_configuration_lib.disable_yaml_cache()
+                try:
+                    entry = read_nerve_entry(name, instance, cluster, soa_dir)
+                finally:
+                    service_configuration_lib.enable_yaml_cache()
+                with cls.lock:
+                    entries[instance] = entry
+            # The marathon config is the last file; without it, nothing was remembered.
+            cacheable = cacheable and mtimes[-1] is not None
+            if entry is None:
+                continue
+            nerve_name, nerve_dict = entry
+            nerve_dict = ServiceNamespaceConfig(nerve_dict)
+            nerve_dict['port'] = port
+            nerve_list.append((nerve_name, nerve_dict))
+
+        with cls.lock:
+            if cacheable:
+                cls.last_fingerprint = fingerprint
+                cls.last_nerve_list = [(entry_name, ServiceNamespaceConfig(entry_dict))
+                                       for entry_name, entry_dict in nerve_list]
+            else:
+                cls.last_fingerprint = None
+                cls.last_nerve_list = None
+        return nerve_list
+
+    @classmethod
+    def get_entries(cls, service, mtimes, cluster, soa_dir):
+        """Returns the remembered entries of a service's instances, forgetting them first if any of its
+        soa-configs changed. If the service can't be remembered, the returned dict is a throwaway one."""
+        key = (cluster, soa_dir, service)
+        with cls.lock:
+            remembered = cls.entries_by_service.get(key)
+            if remembered is not None and remembered[0] == mtimes:
+                return remembered[1]
+            cls.entries_by_service.pop(key, None)
+        entries = {}
+        if mtimes[-1] is not None:
+            with cls.lock:
+                entries = cls.entries_by_service.setdefault(key, (mtimes, entries))[1]
+        return entries
+
+
+def read_nerve_entry(service, instance, cluster, soa_dir):
+    """Reads the nerve namespace a marathon instance is announced in.
+
+    :returns: A tuple of the nerve name and ServiceNamespaceConfig of the namespace, without a port,
+              or None if the instance is not in smartstack or its config is gone
+    """
+    try:
+        namespace = read_namespace_for_service_instance(service, instance, cluster, soa_dir)
+        nerve_dict = load_service_namespace_config(service, namespace, soa_dir)
+    except KeyError:
+        return None  # SOA configs got deleted for this app, it'll get cleaned up
+    if not nerve_dict.is_in_smartstack():
+        return None
+    return (compose_job_id(service, namespace), nerve_dict)
+
+
 def get_marathon_services_running_here_for_nerve(cluster, soa_dir):
     if not cluster:
         try:
@@ -811,19 +1084,8 @@ def get_marathon_services_running_here_for_nerve(cluster, soa_dir):
             return []
     # When a cluster is defined in mesos, let's iterate through marathon services
     marathon_services = marathon_services_running_here()
-    nerve_list = []
-    for name, instance, port in marathon_services:
-        try:
-            namespace = read_namespace_for_service_instance(name, instance, cluster, soa_dir)
-            nerve_dict = load_service_namespace_config(name, namespace, soa_dir)
-            if not nerve_dict.is_in_smartstack():
-                continue
-            nerve_dict['port'] = port
-            nerve_name = compose_job_id(name, namespace)
-            nerve_list.append((nerve_name, nerve_dict))
-        except KeyError:
-            continue  # SOA configs got deleted for this app, it'll get cleaned up
-    return nerve_list
+    # Only the services whose soa-configs changed since the last call are read again.
+    return MarathonNerveCache.get_nerve_list(marathon_services, cluster, soa_dir)
 
 
 def get_classic_services_that_run_here():
@@ -858,9 +1120,15 @@ def _namespaced_get_classic_service_information_for_nerve(name, namespace, soa_d
 def get_classic_services_running_here_for_nerve(soa_dir):
     classic_services = []
     for name in get_classic_services_that_run_here():
-        for namespace in get_all_namespaces_for_service(name, soa_dir, full_name=False):
-            classic_services.append(_namespaced_get_classic_service_information_for_nerve(
-                name, namespace[0], soa_dir))
+        namespaces = get_all_namespaces_for_service(name, soa_dir, full_name=False)
+        if not namespaces:
+            continue
+        # Every namespace is announced on the service's port, and was read with the service's config already.
+        port = service_configuration_lib.read_port(os.path.join(soa_dir, name, 'port'))
+        for namespace, namespace_config in namespaces:
+            nerve_dict = parse_service_namespace_config(namespace_config)
+            nerve_dict['port'] = port
+            classic_services.append((compose_job_id(name, namespace), nerve_dict))
     return classic_services
 
 
@@ -901,14 +1169,16 @@ def list_all_marathon_app_ids(client):
 
 
 def is_app_id_running(app_id, client):
-    """Returns a boolean indicating if the app is in the current list
-    of marathon apps
+    """Returns a boolean indicating if the app currently exists in marathon.
+    Only asks marathon about this one app, so it is cheap enough to poll.
 
     :param app_id: The app_id to look for
     :param client: A MarathonClient object"""
-
-    all_app_ids = list_all_marathon_app_ids(client)
-    return app_id.lstrip('/') in all_app_ids
+    try:
+        client.get_app(app_id.lstrip('/'))
+    except NotFoundError:
+        return False
+    return True
 
 
 def app_has_tasks(client, app_id, expected_tasks, exact_matches_only=False):
@@ -958,7 +1228,7 @@ def wait_for_app_to_launch_tasks(client, app_id, expected_tasks, exact_matches_o
             return
         else:
             print "waiting for app %s to have %d tasks. retrying" % (app_id, expected_tasks)
-            sleep(0.5)
+            sleep_within_deadline(0.5)
 
 
 def create_complete_config(service, instance, soa_dir=DEFAULT_SOA_DIR):
@@ -1007,6 +1277,8 @@ def get_matching_apps(servicename, instance, client, embed_failures=False):
     apps running but you don't know the full instance id"""
     jobid = format_job_id(servicename, instance)
     expected_prefix = "/%s%s" % (jobid, MESOS_TASK_SPACER)
+    if isinstance(client, PaastaMarathonClient):
+        return client.get_apps_with_prefix(expected_prefix)
     return [app for app in client.list_apps(embed_failures=embed_failures) if app.id.startswith(expected_prefix)]
 
 
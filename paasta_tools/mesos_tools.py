@@ -12,6 +12,7 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 import datetime
+import itertools
 import json
 import logging
 import os
@@ -21,11 +22,16 @@ from urlparse import urlparse
 
 import humanize
 import requests
-from kazoo.client import KazooClient
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
 from mesos.cli import util
 from mesos.cli.exceptions import SlaveDoesNotExist
 
+from paasta_tools.api_recorder import maybe_record_response
+from paasta_tools.http_client import get_http_client
+from paasta_tools.utils import deadline_timeout
 from paasta_tools.utils import format_table
+from paasta_tools.utils import get_zookeeper_session
 from paasta_tools.utils import PaastaColors
 from paasta_tools.utils import timeout
 from paasta_tools.utils import TimeoutError
@@ -89,7 +95,9 @@ import mesos.cli.cluster  # noqa
 # monkey patch MesosMaster.state to use a larger ttl
 @util.CachedProperty(ttl=60)
 def fetch_state(self):
-    return master.CURRENT.fetch("/master/state.json").json()
+    response = master.CURRENT.fetch("/master/state.json")
+    maybe_record_response('mesos', response)
+    return response.json()
 master.MesosMaster.state = fetch_state
 
 # Works around a mesos-cli bug ('MesosSlave' object has no attribute 'id' - PAASTA-4119).
@@ -211,11 +219,28 @@ def get_first_status_timestamp(task):
         return "Unknown"
 
 
-@timeout()
+# mesos.cli asks the slave of a task for its usage and files without a timeout we could set, so those reads
+# run in this pool, and are given up on (though not interrupted) once they take too long.
+TASK_USAGE_TIMEOUT_S = 10
+slave_read_executor = ThreadPoolExecutor(max_workers=8)
+
+
+def read_from_slave(read, seconds=None):
+    """Returns what read() returns, waiting for it no longer than seconds or the current deadline,
+    whichever comes first.
+
+    :raises TimeoutError: if read() has not returned in time
+    """
+    future = slave_read_executor.submit(read)
+    try:
+        return future.result(timeout=deadline_timeout(seconds))
+    except FutureTimeoutError:
+        raise TimeoutError("Reading from a mesos slave timed out")
+
+
 def get_mem_usage(task):
     try:
-        task_mem_limit = task.mem_limit
-        task_rss = task.rss
+        task_mem_limit, task_rss = read_from_slave(lambda: (task.mem_limit, task.rss), TASK_USAGE_TIMEOUT_S)
         if task_mem_limit == 0:
             return "Undef"
         mem_percent = task_rss / task_mem_limit * 100
@@ -230,7 +255,6 @@ def get_mem_usage(task):
         return "Timed Out"
 
 
-@timeout()
 def get_cpu_usage(task):
     """Calculates a metric of used_cpu/allocated_cpu
     To do this, we take the total number of cpu-seconds the task has consumed,
@@ -248,9 +272,10 @@ def get_cpu_usage(task):
         # The CPU shares has an additional .1 allocated to it for executor overhead.
         # We subtract this to the true number
         # (https://github.com/apache/mesos/blob/dc7c4b6d0bcf778cc0cad57bb108564be734143a/src/slave/constants.hpp#L100)
-        cpu_shares = task.cpu_limit - .1
+        cpu_limit, stats = read_from_slave(lambda: (task.cpu_limit, task.stats), TASK_USAGE_TIMEOUT_S)
+        cpu_shares = cpu_limit - .1
         allocated_seconds = duration_seconds * cpu_shares
-        used_seconds = task.stats.get('cpus_system_time_secs', 0.0) + task.stats.get('cpus_user_time_secs', 0.0)
+        used_seconds = stats.get('cpus_system_time_secs', 0.0) + stats.get('cpus_user_time_secs', 0.0)
         if allocated_seconds == 0:
             return "Undef"
         percent = round(100 * (used_seconds / allocated_seconds), 1)
@@ -297,7 +322,8 @@ def format_stdstreams_tail_for_task(task, get_short_task_id, nlines=10):
     error_message = PaastaColors.red("      couldn't read stdout/stderr for %s (%s)")
     output = []
     try:
-        fobjs = list(mesos.cli.cluster.files(lambda x: x, flist=['stdout', 'stderr'], fltr=task['id']))
+        fobjs = read_from_slave(
+            lambda: list(mesos.cli.cluster.files(lambda x: x, flist=['stdout', 'stderr'], fltr=task['id'])))
         fobjs.sort(key=lambda fobj: fobj.path, reverse=True)
         if not fobjs:
             output.append(PaastaColors.blue("      no stdout/stderrr for %s" % get_short_task_id(task['id'])))
@@ -306,13 +332,7 @@ def format_stdstreams_tail_for_task(task, get_short_task_id, nlines=10):
             output.append(PaastaColors.blue("      %s tail for %s" % (fobj.path, get_short_task_id(task['id']))))
             # read nlines, starting from EOF
             # mesos.cli is smart and can efficiently read a file backwards
-            reversed_file = reversed(fobj)
-            tail = []
-            for _ in xrange(nlines):
-                line = next(reversed_file, None)
-                if line is None:
-                    break
-                tail.append(line)
+            tail = read_from_slave(lambda: list(itertools.islice(reversed(fobj), nlines)))
             # reverse the tail, so that EOF is at the bottom again
             if tail:
                 output.extend(tail[::-1])
@@ -448,10 +468,10 @@ def get_local_slave_state():
     hostname = socket.getfqdn()
     stats_uri = 'http://%s:%s/state' % (hostname, MESOS_SLAVE_PORT)
     try:
-        response = requests.get(stats_uri, timeout=10)
+        response = get_http_client().get(stats_uri, endpoint='mesos_slave.state')
         if response.status_code == 404:
             fallback_stats_uri = 'http://%s:%s/state.json' % (hostname, MESOS_SLAVE_PORT)
-            response = requests.get(fallback_stats_uri, timeout=10)
+            response = get_http_client().get(fallback_stats_uri, endpoint='mesos_slave.state')
     except requests.ConnectionError as e:
         raise MesosSlaveConnectionError(
             'Could not connect to the mesos slave to see which services are running\n'
@@ -492,11 +512,9 @@ def get_number_of_mesos_masters(zk_config):
     Masters register themselves in zookeeper by creating ``info_`` entries.
     We count these entries to get the number of masters.
     """
-    zk = KazooClient(hosts=zk_config['hosts'], read_only=True)
-    zk.start()
-    root_entries = zk.get_children(zk_config['path'])
+    with get_zookeeper_session(zk_config['hosts'], read_only=True).lease() as zk:
+        root_entries = zk.get_children(zk_config['path'])
     result = [info for info in root_entries if info.startswith('json.info_') or info.startswith('info_')]
-    zk.stop()
     return len(result)
 
 
@@ -23,16 +23,36 @@ Everything in here is private, and you shouldn't worry about it.
 import json
 import logging
 import os
+import re
+import socket
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
 
 import pysensu_yelp
 import service_configuration_lib
+from concurrent.futures import ThreadPoolExecutor
 
+from paasta_tools.utils import atomic_file_write
 from paasta_tools.utils import DEFAULT_SOA_DIR
 from paasta_tools.utils import load_system_paasta_config
 
 
 log = logging.getLogger(__name__)
 
+# Send pending events once this many have been collected, or the oldest has waited this long.
+SENSU_EVENT_BATCH_SIZE = 500
+SENSU_EVENT_MAX_DELAY_S = 10
+# Unchanged OK events are still resent this often.
+SENSU_EVENT_CACHE_MAX_AGE_S = 60 * 60
+SENSU_SOCKET_TIMEOUT_S = 10
+# How many connections to the sensu client a batch is sent over at once.
+SENSU_SEND_CONCURRENCY = 8
+
+_sensu_event_batcher = None
+_sensu_event_batcher_lock = threading.Lock()
+
 
 def get_team(overrides, service, soa_dir=DEFAULT_SOA_DIR):
     return __get_monitoring_config_value('team', overrides, service, soa_dir)
@@ -83,12 +103,82 @@ def get_project(overrides, service, soa_dir=DEFAULT_SOA_DIR):
 
 
 def __get_monitoring_config_value(key, overrides, service, soa_dir=DEFAULT_SOA_DIR):
-    general_config = service_configuration_lib.read_service_configuration(service, soa_dir=soa_dir)
-    monitor_config = read_monitoring_config(service, soa_dir=soa_dir)
-    service_default = general_config.get(key, monitoring_defaults(key))
-    service_default = general_config.get('monitoring', {key: service_default}).get(key, service_default)
-    service_default = monitor_config.get(key, service_default)
-    return overrides.get(key, service_default)
+    return load_monitoring_config(service, soa_dir=soa_dir).get(key, overrides)
+
+
+class MonitoringConfig(object):
+    """The monitoring settings of a service, resolved from its service.yaml and monitoring.yaml.
+
+    :param service: The service name
+    :param general_config: The service's general configuration (service.yaml)
+    :param monitor_config: The service's monitoring.yaml
+    """
+
+    def __init__(self, service, general_config, monitor_config):
+        self.service = service
+        self.general_config = general_config
+        self.monitor_config = monitor_config
+
+    def get(self, key, overrides=None):
+        """Returns a monitoring setting, from the most specific place it is set: the overrides (usually
+        an instance's monitoring dictionary), monitoring.yaml, the 'monitoring' section of service.yaml,
+        a top level key of service.yaml, and finally monitoring_defaults."""
+        if overrides and key in overrides:
+            return overrides[key]
+        if key in self.monitor_config:
+            return self.monitor_config[key]
+        service_default = self.general_config.get(key, monitoring_defaults(key))
+        return self.general_config.get('monitoring', {}).get(key, service_default)
+
+
+class MonitoringConfigCache(object):
+    """
+    A context manager that remembers each service's MonitoringConfig, the first time it is loaded, until
+    the outermost with block exits. Inside it, load_monitoring_config reads a service's service.yaml and
+    monitoring.yaml at most once, however many checks are sent about it. These can be
+    nested, and used from several threads at once, which all share the cache.
+    """
+    counter = 0
+    configs = None
+    lock = threading.Lock()
+
+    @classmethod
+    def __enter__(cls):
+        with cls.lock:
+            if cls.configs is None:
+                cls.configs = {}
+            cls.counter = cls.counter + 1
+
+    @classmethod
+    def __exit__(cls, *args, **kwargs):
+        with cls.lock:
+            cls.counter = cls.counter - 1
+            if cls.counter == 0:
+                cls.configs = None
+
+    @classmethod
+    def get(cls, service, soa_dir):
+        """Returns the MonitoringConfig of a service, from the cache if we are inside one."""
+        key = (service, soa_dir)
+        with cls.lock:
+            cache = cls.configs
+            if cache is not None and key in cache:
+                return cache[key]
+        config = MonitoringConfig(
+            service=service,
+            general_config=service_configuration_lib.read_service_configuration(service, soa_dir=soa_dir),
+            monitor_config=read_monitoring_config(service, soa_dir=soa_dir),
+        )
+        if cache is not None:
+            with cls.lock:
+                config = cache.setdefault(key, config)
+        return config
+
+
+def load_monitoring_config(service, soa_dir=DEFAULT_SOA_DIR):
+    """Returns the MonitoringConfig of a service. Inside a MonitoringConfigCache, the service's
+    files are only read the first time it is asked about."""
+    return MonitoringConfigCache.get(service, soa_dir)
 
 
 def monitoring_defaults(key):
@@ -115,11 +205,12 @@ def get_team_email_address(service, overrides=None, soa_dir=DEFAULT_SOA_DIR):
     leave `notification_email` absent and just let Sensu do its thing."""
     if overrides is None:
         overrides = {}
-    email_address = __get_monitoring_config_value(
-        'notification_email', overrides=overrides, service=service, soa_dir=soa_dir)
-    if not email_address:
-        team = get_team(overrides=overrides, service=service)
-        email_address = get_sensu_team_data(team).get('notification_email', None)
+    with MonitoringConfigCache():
+        email_address = __get_monitoring_config_value(
+            'notification_email', overrides=overrides, service=service, soa_dir=soa_dir)
+        if not email_address:
+            team = get_team(overrides=overrides, service=service, soa_dir=soa_dir)
+            email_address = get_sensu_team_data(team).get('notification_email', None)
     return email_address
 
 
@@ -159,31 +250,280 @@ def send_event(service, check_name, overrides, status, output, soa_dir, ttl=None
     :param soa_dir: The service directory to read monitoring information from
     """
     # This function assumes the input is a string like "mumble.main"
-    team = get_team(overrides, service, soa_dir)
-    if not team:
-        return
-    runbook = overrides.get('runbook', 'http://y/paasta-troubleshooting')
-    system_paasta_config = load_system_paasta_config()
-    result_dict = {
-        'tip': get_tip(overrides, service, soa_dir),
-        'notification_email': get_notification_email(overrides, service, soa_dir),
-        'irc_channels': get_irc_channels(overrides, service, soa_dir),
-        'ticket': get_ticket(overrides, service, soa_dir),
-        'project': get_project(overrides, service, soa_dir),
-        'page': get_page(overrides, service, soa_dir),
-        'alert_after': overrides.get('alert_after', '5m'),
-        'check_every': overrides.get('check_every', '1m'),
-        'realert_every': -1,
-        'source': 'paasta-%s' % system_paasta_config.get_cluster(),
-        'ttl': ttl,
-    }
+    with MonitoringConfigCache():
+        team = get_team(overrides, service, soa_dir)
+        if not team:
+            return
+        runbook = overrides.get('runbook', 'http://y/paasta-troubleshooting')
+        system_paasta_config = load_system_paasta_config()
+        result_dict = {
+            'tip': get_tip(overrides, service, soa_dir),
+            'notification_email': get_notification_email(overrides, service, soa_dir),
+            'irc_channels': get_irc_channels(overrides, service, soa_dir),
+            'ticket': get_ticket(overrides, service, soa_dir),
+            'project': get_project(overrides, service, soa_dir),
+            'page': get_page(overrides, service, soa_dir),
+            'alert_after': overrides.get('alert_after', '5m'),
+            'check_every': overrides.get('check_every', '1m'),
+            'realert_every': -1,
+            'source': 'paasta-%s' % system_paasta_config.get_cluster(),
+            'ttl': ttl,
+        }
 
     sensu_host = system_paasta_config.get_sensu_host()
     sensu_port = system_paasta_config.get_sensu_port()
 
     if sensu_host is not None:
-        pysensu_yelp.send_event(check_name, runbook, status, output, team, sensu_host=sensu_host, sensu_port=sensu_port,
-                                **result_dict)
+        batcher = get_sensu_event_batcher()
+        if batcher is not None:
+            batcher.add(format_sensu_event(check_name, runbook, status, output, team, **result_dict))
+        else:
+            pysensu_yelp.send_event(check_name, runbook, status, output, team, sensu_host=sensu_host,
+                                    sensu_port=sensu_port, **result_dict)
+
+
+def format_sensu_event(name, runbook, status, output, team, page=False, tip=None, notification_email=None,
+                       check_every='5m', realert_every=1, alert_after='0s', dependencies=[], irc_channels=None,
+                       ticket=False, project=None, source=None, ttl=None):
+    """Builds the check result pysensu_yelp.send_event would send for these arguments, and validates
+    them the same way, without sending anything.
+
+    :returns: The check result, as a dictionary"""
+    if not (name and team):
+        raise ValueError("Name and team must be present")
+    if not re.match(r'^[\w\.-]+$', name):
+        raise ValueError("Name cannot contain special characters")
+    event = {
+        'name': name,
+        'status': status,
+        'output': output,
+        'handler': 'default',
+        'team': team,
+        'runbook': runbook or 'Please set a runbook!',
+        'tip': tip,
+        'notification_email': notification_email,
+        'interval': pysensu_yelp.human_to_seconds(check_every),
+        'page': page,
+        'realert_every': int(realert_every),
+        'dependencies': dependencies,
+        'alert_after': pysensu_yelp.human_to_seconds(alert_after),
+        'ticket': ticket,
+        'project': project,
+        'source': source,
+        'ttl': pysensu_yelp.human_to_seconds(ttl),
+    }
+    if irc_channels:
+        event['irc_channels'] = irc_channels
+    return event
+
+
+class SensuEventCache(object):
+    """Remembers the status and time of the last event sent for each check, across runs.
+
+    Only OK events that say nothing new are ever skipped: Sensu resolves a check on its first OK, so
+    repeating it changes nothing. Failing events are always sent, since Sensu counts their occurrences
+    to decide when to alert, and so are events with a ttl, which are keepalives. An unchanged OK is still
+    resent every max_age_s in case Sensu lost track of the check.
+
+    :param path: The file to keep the cache in, or None to only remember events for the life of the process
+    """
+
+    def __init__(self, path=None, max_age_s=SENSU_EVENT_CACHE_MAX_AGE_S):
+        self.path = path
+        self.max_age_s = max_age_s
+        self.last_sent = self._load()
+        self.lock = threading.Lock()
+
+    def _load(self):
+        if self.path is None:
+            return {}
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+    @staticmethod
+    def key(event):
+        return '%s:%s' % (event['source'], event['name'])
+
+    def is_redundant(self, event, now):
+        if event['status'] != pysensu_yelp.Status.OK or event['ttl'] is not None:
+            return False
+        with self.lock:
+            last = self.last_sent.get(self.key(event))
+        return last is not None and last[0] == pysensu_yelp.Status.OK and now - last[1] < self.max_age_s
+
+    def record(self, event, now):
+        with self.lock:
+            self.last_sent[self.key(event)] = [event['status'], now]
+
+    def save(self):
+        """Writes the cache back to its file, merged with whatever other runs wrote there meanwhile."""
+        if self.path is None:
+            return
+        with self.lock:
+            last_sent = self._load()
+            last_sent.update(self.last_sent)
+            try:
+                with atomic_file_write(self.path) as f:
+                    json.dump(last_sent, f)
+            except (IOError, OSError) as e:
+                log.warning("Could not save the sensu event cache to %s: %s" % (self.path, e))
+
+
+class SensuEventBatcher(object):
+    """Collects Sensu events and sends them to the local Sensu client in batches.
+
+    Events are buffered until batch_size of them are pending or the oldest has waited max_delay_s, and then
+    sent by whichever thread added the last one. The sensu client reads everything sent on a connection as
+    one JSON document, so like pysensu_yelp.send_event every event gets a connection of its own; a batch
+    is sent over up to SENSU_SEND_CONCURRENCY of them at once, with the events of each check sent one after
+    another, in order. Only events the client answered "ok" to are recorded in the cache. Threads adding
+    events wait while a full batch is being sent, so no more than batch_size events are ever held in
+    memory. Events the cache says are redundant are dropped instead of buffered.
+
+    The buffer lock is only ever taken before the send lock, never while holding it: the threads sending a
+    batch count what they sent under a lock of their own, so a thread waiting with the buffer lock for the
+    send lock cannot keep the batch it waits on from finishing.
+    """
+
+    def __init__(self, sensu_host, sensu_port, cache=None, batch_size=SENSU_EVENT_BATCH_SIZE,
+                 max_delay_s=SENSU_EVENT_MAX_DELAY_S):
+        self.sensu_host = sensu_host
+        self.sensu_port = sensu_port
+        self.cache = cache if cache is not None else SensuEventCache()
+        self.batch_size = batch_size
+        self.max_delay_s = max_delay_s
+        self.pending = []
+        self.oldest_pending_at = None
+        self.skipped = 0
+        self.sent = 0
+        self.failed = 0
+        self.lock = threading.Lock()
+        self.send_lock = threading.Lock()
+        self.counts_lock = threading.Lock()
+
+    def add(self, event):
+        now = time.time()
+        with self.lock:
+            if self.cache.is_redundant(event, now):
+                self.skipped += 1
+                return
+            if not self.pending:
+                self.oldest_pending_at = now
+            self.pending.append(event)
+            if len(self.pending) < self.batch_size and now - self.oldest_pending_at < self.max_delay_s:
+                return
+            # Take the send lock before letting go of the buffer, so batches go out in order.
+            self.send_lock.acquire()
+            events = self._take_pending()
+        try:
+            self._send(events)
+        finally:
+            self.send_lock.release()
+
+    def flush(self):
+        with self.lock:
+            self.send_lock.acquire()
+            events = self._take_pending()
+        try:
+            self._send(events)
+        finally:
+            self.send_lock.release()
+
+    def close(self):
+        """Flushes any pending events and saves the cache."""
+        self.flush()
+        self.cache.save()
+
+    def _take_pending(self):
+        events, self.pending = self.pending, []
+        self.oldest_pending_at = None
+        return events
+
+    def _send_one(self, event):
+        """Sends an event on a connection of its own.
+
+        :returns: Whether the sensu client answered that it accepted the event
+        """
+        sock = socket.create_connection((self.sensu_host, self.sensu_port), timeout=SENSU_SOCKET_TIMEOUT_S)
+        try:
+            sock.sendall('%s\n' % json.dumps(event))
+            reply = ''
+            while reply.strip() not in ('ok', 'invalid'):
+                data = sock.recv(64)
+                if not data:
+                    break
+                reply += data
+        finally:
+            sock.close()
+        return reply.strip() == 'ok'
+
+    def _send_check_events(self, events):
+        """Sends the events of one check in order, and records the ones the sensu client accepted."""
+        for event in events:
+            try:
+                accepted = self._send_one(event)
+            except socket.error as e:
+                log.error("Could not send the %s event to sensu at %s:%s: %s" % (
+                    SensuEventCache.key(event), self.sensu_host, self.sensu_port, e))
+                accepted = False
+            else:
+                if not accepted:
+                    log.error("Sensu at %s:%s rejected the %s event" % (
+                        self.sensu_host, self.sensu_port, SensuEventCache.key(event)))
+            with self.counts_lock:
+                if accepted:
+                    self.sent += 1
+                else:
+                    self.failed += 1
+            if accepted:
+                self.cache.record(event, time.time())
+
+    def _send(self, events):
+        if not events:
+            return
+        events_by_check = OrderedDict()
+        for event in events:
+            events_by_check.setdefault(SensuEventCache.key(event), []).append(event)
+        with ThreadPoolExecutor(max_workers=min(len(events_by_check), SENSU_SEND_CONCURRENCY)) as executor:
+            for future in [executor.submit(self._send_check_events, check_events)
+                           for check_events in events_by_check.values()]:
+                future.result()
+
+
+def get_sensu_event_batcher():
+    """Returns the SensuEventBatcher of the batched_sensu_events block this process is in, or None."""
+    return _sensu_event_batcher
+
+
+@contextmanager
+def batched_sensu_events(system_paasta_config=None):
+    """A contextmanager that batches every event send_event sends, from any thread, until the block exits.
+    Nested blocks share the outermost one's batcher.
+
+    :param system_paasta_config: The SystemPaastaConfig to read the sensu host, port and event cache path from
+    """
+    global _sensu_event_batcher
+    if system_paasta_config is None:
+        system_paasta_config = load_system_paasta_config()
+    with _sensu_event_batcher_lock:
+        outermost = _sensu_event_batcher is None and system_paasta_config.get_sensu_host() is not None
+        if outermost:
+            _sensu_event_batcher = SensuEventBatcher(
+                sensu_host=system_paasta_config.get_sensu_host(),
+                sensu_port=system_paasta_config.get_sensu_port(),
+                cache=SensuEventCache(system_paasta_config.get_sensu_event_cache_path()),
+            )
+        batcher = _sensu_event_batcher
+    try:
+        yield batcher
+    finally:
+        if outermost:
+            with _sensu_event_batcher_lock:
+                _sensu_event_batcher = None
+            batcher.close()
 
 
 def read_monitoring_config(service, soa_dir=DEFAULT_SOA_DIR):
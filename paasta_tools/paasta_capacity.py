@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+# Copyright 2015-2016 Yelp Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Usage: ./paasta_capacity.py [options]
+
+Simulates packing every marathon instance of the cluster onto its mesos slaves, as first-fit-decreasing,
+and reports for each pool the headroom left, the resources stranded on hosts that nothing fits on
+anymore, which instances could not be placed and how many more hosts placing them would take.
+
+The instances are packed as their soa-configs ask for them, not as they happen to run right now, so
+this also answers what-if questions: --scale multiplies every instance count, and --instances sets the
+count of one instance.
+
+Command line options:
+
+- -d <SOA_DIR>, --soa-dir <SOA_DIR>: Specify a SOA config dir to read from
+- --scale <FACTOR>: Multiply the instance count of every instance by FACTOR
+- --instances <SERVICE.INSTANCE=COUNT>: Pack COUNT tasks of SERVICE.INSTANCE; may be given more than once
+- -v, --verbose: Verbose output
+"""
+import argparse
+import logging
+import sys
+from math import ceil
+
+from paasta_tools.capacity_planning import format_pool_report
+from paasta_tools.capacity_planning import get_hosts_from_mesos_state
+from paasta_tools.capacity_planning import plan_capacity
+from paasta_tools.capacity_planning import Resources
+from paasta_tools.capacity_planning import TaskGroup
+from paasta_tools.marathon_tools import load_marathon_service_config
+from paasta_tools.marathon_tools import load_service_namespace_config
+from paasta_tools.mesos_tools import get_mesos_state_from_leader
+from paasta_tools.mesos_tools import MasterNotAvailableException
+from paasta_tools.mesos_tools import NoSlavesAvailable
+from paasta_tools.utils import compose_job_id
+from paasta_tools.utils import decompose_job_id
+from paasta_tools.utils import DEFAULT_SOA_DIR
+from paasta_tools.utils import get_services_for_cluster
+from paasta_tools.utils import InvalidJobNameError
+from paasta_tools.utils import load_system_paasta_config
+from paasta_tools.utils import NoDeploymentsAvailable
+from paasta_tools.utils import PaastaColors
+
+log = logging.getLogger(__name__)
+
+
+def instance_count(value):
+    """Parses SERVICE.INSTANCE=COUNT into ((service, instance), count)."""
+    try:
+        job_id, count = value.rsplit('=', 1)
+        service, instance, _, __ = decompose_job_id(job_id)
+        count = int(count)
+    except (ValueError, InvalidJobNameError):
+        raise argparse.ArgumentTypeError("%r is not like SERVICE.INSTANCE=COUNT" % value)
+    if count < 0:
+        raise argparse.ArgumentTypeError("%r asks for a negative number of instances" % value)
+    return (service, instance), count
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Simulates packing the marathon instances of the cluster onto its slaves, per pool.',
+    )
+    parser.add_argument('-d', '--soa-dir', dest="soa_dir", metavar="SOA_DIR", default=DEFAULT_SOA_DIR,
+                        help="define a different soa config directory")
+    parser.add_argument('--scale', type=float, default=1.0,
+                        help="Multiply the instance count of every instance by this much (default %(default)s)")
+    parser.add_argument('--instances', dest='instance_counts', metavar='SERVICE.INSTANCE=COUNT',
+                        type=instance_count, action='append', default=[],
+                        help="Pack this many tasks of an instance; may be given more than once")
+    parser.add_argument('-v', '--verbose', action='store_true', dest="verbose", default=False)
+    return parser.parse_args()
+
+
+def get_constraints(service_config, soa_dir):
+    """Returns the constraints an instance would be deployed with. Without any slaves to discover
+    its routing constraints from, it gets the rest of them."""
+    service_namespace_config = load_service_namespace_config(
+        service_config.get_service(), service_config.get_nerve_namespace(), soa_dir=soa_dir)
+    try:
+        return service_config.get_calculated_constraints(service_namespace_config)
+    except NoSlavesAvailable:
+        constraints = service_config.get_constraints()
+        if constraints is None:
+            constraints = service_config.get_deploy_constraints() + service_config.get_pool_constraints()
+        return constraints
+
+
+def get_task_group(service_config, instances, soa_dir):
+    return TaskGroup(
+        name=compose_job_id(service_config.get_service(), service_config.get_instance()),
+        count=instances,
+        resources=Resources(
+            cpus=float(service_config.get_cpus()),
+            mem=float(service_config.get_mem()),
+            disk=float(service_config.get_disk()),
+        ),
+        pool=service_config.get_pool(),
+        constraints=get_constraints(service_config, soa_dir),
+    )
+
+
+def get_task_groups(cluster, soa_dir, scale=1.0, instance_counts=None):
+    """Returns a TaskGroup for every marathon instance of a cluster.
+
+    :param scale: What to multiply the instance count of every instance by, rounding up
+    :param instance_counts: A dict of {(service, instance): count} to use instead of what the
+                            soa-configs ask for
+    """
+    instance_counts = instance_counts or {}
+    groups = []
+    seen = set()
+    for service, instance in sorted(get_services_for_cluster(cluster=cluster, instance_type='marathon',
+                                                             soa_dir=soa_dir)):
+        try:
+            service_config = load_marathon_service_config(service, instance, cluster, load_deployments=True,
+                                                          soa_dir=soa_dir)
+        except NoDeploymentsAvailable:
+            log.debug("Skipping %s, which has no deployments" % compose_job_id(service, instance))
+            continue
+        seen.add((service, instance))
+        if (service, instance) in instance_counts:
+            instances = instance_counts[(service, instance)]
+        else:
+            instances = int(ceil(service_config.get_instances() * scale))
+        groups.append(get_task_group(service_config, instances, soa_dir))
+    for service, instance in sorted(set(instance_counts) - seen):
+        log.warning("%s is not a deployed marathon instance of %s, so its count is ignored" % (
+            compose_job_id(service, instance), cluster))
+    return groups
+
+
+def main():
+    args = parse_args()
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.WARNING)
+    cluster = load_system_paasta_config().get_cluster()
+    try:
+        mesos_state = get_mesos_state_from_leader()
+    except MasterNotAvailableException as e:
+        print PaastaColors.red("CRITICAL:  %s" % e.message)
+        sys.exit(2)
+    hosts = get_hosts_from_mesos_state(mesos_state)
+    groups = get_task_groups(cluster, args.soa_dir, scale=args.scale, instance_counts=dict(args.instance_counts))
+    print "Packed %d tasks of %d instances onto %d hosts:" % (
+        sum(group.count for group in groups), len(groups), len(hosts))
+    for report in plan_capacity(hosts, groups):
+        print "\n".join(format_pool_report(report))
+    sys.exit(0)
+
+
+if __name__ == "__main__":
+    main()
@@ -15,18 +15,25 @@
 import argparse
 import datetime
 import json
+import logging
+import threading
 from socket import getfqdn
 from socket import gethostbyname
 
+from concurrent.futures import ThreadPoolExecutor
 from dateutil import tz
 from pytimeparse import timeparse
-from requests import Request
-from requests import Session
 from requests.exceptions import HTTPError
 
+from paasta_tools.http_client import get_http_client
 from paasta_tools.mesos_tools import get_mesos_leader
 from paasta_tools.mesos_tools import MESOS_MASTER_PORT
 
+log = logging.getLogger(__name__)
+
+# How many hostnames get_machine_ids resolves at once.
+RESOLVE_CONCURRENCY = 20
+
 
 def parse_args():
     """Parses the command line arguments passed to this script"""
@@ -67,14 +74,14 @@ def base_api():
     def execute_request(method, endpoint, **kwargs):
         url = "http://%s:%d%s" % (leader, MESOS_MASTER_PORT, endpoint)
         timeout = 15
-        s = Session()
-        s.auth = load_credentials()
-        req = Request(method, url, **kwargs)
-        prepared = s.prepare_request(req)
         try:
-            resp = s.send(
-                prepared,
+            resp = get_http_client().request(
+                method,
+                url,
+                auth=load_credentials(),
                 timeout=timeout,
+                endpoint='mesos_master.maintenance',
+                **kwargs
             )
             resp.raise_for_status()
             return resp
@@ -135,6 +142,106 @@ def get_maintenance_status():
     return client_fn(method="GET", endpoint="/status")
 
 
+class MaintenanceIndex(object):
+    """The hosts listed in one answer from the /master/maintenance/schedule/status API endpoint,
+    indexed by state so that asking about a host is a set lookup.
+
+    :param status: The decoded JSON of the maintenance status
+    """
+
+    def __init__(self, status):
+        status = status or {}
+        self.hosts_by_state = dict(
+            (state, frozenset(machine['id']['hostname'] for machine in status.get(state, [])))
+            for state in ('draining_machines', 'down_machines')
+        )
+
+    def get_hosts_with_state(self, state):
+        return self.hosts_by_state.get(state, frozenset())
+
+    def is_draining(self, hostname):
+        return hostname in self.hosts_by_state['draining_machines']
+
+    def is_down(self, hostname):
+        return hostname in self.hosts_by_state['down_machines']
+
+    def is_under_maintenance(self, hostname):
+        """Tells whether a host is draining or down, i.e. whether tasks placed on it are going to be lost."""
+        return self.is_draining(hostname) or self.is_down(hostname)
+
+    def get_hosts_under_maintenance(self):
+        return self.hosts_by_state['draining_machines'] | self.hosts_by_state['down_machines']
+
+
+def load_maintenance_index():
+    """Fetches the maintenance status from the mesos master.
+
+    :returns: a MaintenanceIndex
+    """
+    return MaintenanceIndex(get_maintenance_status().json())
+
+
+class MaintenanceSnapshot(object):
+    """
+    A context manager that remembers the maintenance status of the cluster, the first time it is asked,
+    until the outermost with block exits, so that a run looking up many hosts asks the mesos master once.
+    These can be nested, and used from several threads at once, which all share the snapshot.
+    """
+    counter = 0
+    index = None
+    active = False
+    lock = threading.Lock()
+
+    @classmethod
+    def __enter__(cls):
+        with cls.lock:
+            cls.active = True
+            cls.counter = cls.counter + 1
+
+    @classmethod
+    def __exit__(cls, *args, **kwargs):
+        with cls.lock:
+            cls.counter = cls.counter - 1
+            if cls.counter == 0:
+                cls.active = False
+                cls.index = None
+
+    @classmethod
+    def get_index(cls):
+        """Returns the MaintenanceIndex, from the snapshot if we are inside one."""
+        with cls.lock:
+            active = cls.active
+            if active and cls.index is not None:
+                return cls.index
+        index = load_maintenance_index()
+        if active:
+            with cls.lock:
+                if cls.active and cls.index is None:
+                    cls.index = index
+        return index
+
+    @classmethod
+    def get_active_index(cls):
+        """Returns the MaintenanceIndex of the snapshot we are inside, or None outside of one.
+
+        This is what deploys use: they only look at maintenance when their run asked for it by
+        entering a snapshot, and they must not fail because the mesos master could not tell us
+        about maintenance, so a failed fetch is logged and remembered as an empty index.
+        """
+        with cls.lock:
+            if not cls.active:
+                return None
+        try:
+            return cls.get_index()
+        except Exception as e:
+            log.warning("Could not fetch the maintenance status, assuming no host is under maintenance: %s" % e)
+            index = MaintenanceIndex({})
+            with cls.lock:
+                if cls.active and cls.index is None:
+                    cls.index = index
+            return index
+
+
 def get_hosts_with_state(state):
     """Helper function to check the maintenance status and return all hosts
     listed as being in a current state
@@ -142,10 +249,7 @@ def get_hosts_with_state(state):
     :param state: State we are interested in ('down_machines' or 'draining_machines')
     :returns: A list of hostnames in the specified state or an empty list if no machines
     """
-    status = get_maintenance_status()
-    if not status or state not in status:
-        return []
-    return [machine['id']['hostname'] for machine in status[state]]
+    return list(MaintenanceSnapshot.get_index().get_hosts_with_state(state))
 
 
 def get_draining_hosts():
@@ -164,22 +268,22 @@ def get_down_hosts():
     return get_hosts_with_state(state='down_machines')
 
 
-def is_host_draining(hostname=getfqdn()):
+def is_host_draining(hostname=None):
     """Checks if the specified hostname is marked as draining
 
     :param hostname: Hostname we want to check if draining (defaults to current host)
     :returns: a boolean representing whether or not the specified hostname is draining
     """
-    return hostname in get_draining_hosts()
+    return MaintenanceSnapshot.get_index().is_draining(hostname or getfqdn())
 
 
-def is_host_down(hostname=getfqdn()):
+def is_host_down(hostname=None):
     """Checks if the specified hostname is marked as down
 
     :param hostname: Hostname we want to check if down (defaults to current host)
     :returns: a boolean representing whether or not the specified hostname is down
     """
-    return hostname in get_down_hosts()
+    return MaintenanceSnapshot.get_index().is_down(hostname or getfqdn())
 
 
 def parse_timedelta(value):
@@ -238,25 +342,32 @@ def build_start_maintenance_payload(hostnames):
     return get_machine_ids(hostnames)
 
 
+def get_machine_id(hostname):
+    """Helper function to convert a hostname into a hostname/ip pair.
+    :param hostname: a hostname, or "hostname|ipaddress" to avoid querying DNS for the IP
+    :returns: a dictionary with the hostname and ip of the machine
+    """
+    machine_id = dict()
+    if '|' in hostname:
+        (host, ip) = hostname.split('|')
+        machine_id['hostname'] = host
+        machine_id['ip'] = ip
+    else:
+        machine_id['hostname'] = hostname
+        machine_id['ip'] = gethostbyname(hostname)
+    return machine_id
+
+
 def get_machine_ids(hostnames):
     """Helper function to convert a list of hostnames into a JSON list of hostname/ip pairs.
+    Up to RESOLVE_CONCURRENCY hostnames are resolved at once.
     :param hostnames: a list of hostnames
     :returns: a dictionary representing the list of machines to bring up/down for maintenance
     """
-    machine_ids = []
-    for hostname in hostnames:
-        machine_id = dict()
-        # This is to allow specifying a hostname as "hostname|ipaddress"
-        # to avoid querying DNS for the IP.
-        if '|' in hostname:
-            (host, ip) = hostname.split('|')
-            machine_id['hostname'] = host
-            machine_id['ip'] = ip
-        else:
-            machine_id['hostname'] = hostname
-            machine_id['ip'] = gethostbyname(hostname)
-        machine_ids.append(machine_id)
-    return machine_ids
+    if len(hostnames) <= 1:
+        return [get_machine_id(hostname) for hostname in hostnames]
+    with ThreadPoolExecutor(max_workers=min(RESOLVE_CONCURRENCY, len(hostnames))) as executor:
+        return list(executor.map(get_machine_id, hostnames))
 
 
 def build_maintenance_schedule_payload(hostnames, start, duration, drain=True):
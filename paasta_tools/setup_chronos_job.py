@@ -14,6 +14,7 @@
 # limitations under the License.
 """
 Usage: ./setup_chronos_job.py <service.instance> [options]
+       ./setup_chronos_job.py --all [options]
 
 Deploy a service instance to Chronos from a configuration file.
 Reads from the soa_dir /nail/etc/services by default.
@@ -33,43 +34,63 @@ if something went wrong, it'll alert the team responsible for the service
 (as defined in that service's monitoring.yaml), and it'll send resolves
 when the deployment goes alright.
 
+With --all, every chronos job in the cluster is reconciled in a single pass instead:
+the desired config of every job is built, the job list is fetched from Chronos once, and
+only the jobs whose config hash changed are created, updated or disabled, up to
+--concurrency at a time. A summary of what changed and how long each step took is printed.
+
 Command line options:
 
+- -a, --all: Reconcile every chronos job in the cluster
+- -j <N>, --concurrency <N>: With --all, apply up to N changes at once
 - -d <SOA_DIR>, --soa-dir <SOA_DIR>: Specify a SOA config dir to read from
 - -v, --verbose: Verbose output
 """
 import argparse
 import logging
 import sys
+import time
+from contextlib import contextmanager
 
 import pysensu_yelp
+from concurrent.futures import ThreadPoolExecutor
 
 from paasta_tools import chronos_tools
 from paasta_tools import monitoring_tools
 from paasta_tools.utils import _log
 from paasta_tools.utils import compose_job_id
+from paasta_tools.utils import configure_timing
 from paasta_tools.utils import decompose_job_id
 from paasta_tools.utils import InvalidJobNameError
 from paasta_tools.utils import load_system_paasta_config
 from paasta_tools.utils import NoDeploymentsAvailable
 from paasta_tools.utils import NoDockerImageError
 from paasta_tools.utils import SPACER
+from paasta_tools.utils import timed
 
 
 log = logging.getLogger(__name__)
 
+DEFAULT_RECONCILE_CONCURRENCY = 5
+
 
 def parse_args():
     parser = argparse.ArgumentParser(description='Creates chronos jobs.')
-    parser.add_argument('service_instance',
+    parser.add_argument('service_instance', nargs='?',
                         help="The chronos instance of the service to create or update",
                         metavar=compose_job_id("SERVICE", "INSTANCE"))
+    parser.add_argument('-a', '--all', action='store_true', dest="all", default=False,
+                        help="Reconcile every chronos job in the cluster in one pass")
+    parser.add_argument('-j', '--concurrency', dest="concurrency", type=int, default=DEFAULT_RECONCILE_CONCURRENCY,
+                        help="With --all, how many jobs to create or update at once (default %(default)s)")
     parser.add_argument('-d', '--soa-dir', dest="soa_dir", metavar="SOA_DIR",
                         default=chronos_tools.DEFAULT_SOA_DIR,
                         help="define a different soa config directory")
     parser.add_argument('-v', '--verbose', action='store_true',
                         dest="verbose", default=False)
     args = parser.parse_args()
+    if not args.all and args.service_instance is None:
+        parser.error("Specify a service instance, or --all")
     return args
 
 
@@ -122,7 +143,8 @@ def bounce_chronos_job(
         log_line = 'Job to update: %s' % job_to_update
         _log(service=service, instance=instance, component='deploy',
              cluster=cluster, level='debug', line=log_line)
-        chronos_tools.update_job(client=client, job=job_to_update)
+        with timed('setup_chronos_job.update_job', service=service, instance=instance):
+            chronos_tools.update_job(client=client, job=job_to_update)
         log_line = 'Updated Chronos job: %s' % job_to_update['name']
         _log(service=service, instance=instance, component='deploy',
              cluster=cluster, level='event', line=log_line)
@@ -132,12 +154,13 @@ def bounce_chronos_job(
 
 def setup_job(service, instance, complete_job_config, client, cluster):
     # There should only ever be *one* job for a given service_instance
-    all_existing_jobs = chronos_tools.lookup_chronos_jobs(
-        service=service,
-        instance=instance,
-        client=client,
-        include_disabled=True,
-    )
+    with timed('setup_chronos_job.lookup_chronos_jobs', service=service, instance=instance):
+        all_existing_jobs = chronos_tools.lookup_chronos_jobs(
+            service=service,
+            instance=instance,
+            client=client,
+            include_disabled=True,
+        )
 
     job_to_update = None
     if len(all_existing_jobs) > 0:
@@ -156,46 +179,39 @@ def setup_job(service, instance, complete_job_config, client, cluster):
     )
 
 
-def main():
-    args = parse_args()
-    soa_dir = args.soa_dir
-    if args.verbose:
-        logging.basicConfig(level=logging.DEBUG)
-    else:
-        logging.basicConfig(level=logging.WARNING)
-
-    try:
-        service, instance, _, __ = decompose_job_id(args.service_instance, spacer=chronos_tools.INTERNAL_SPACER)
-    except InvalidJobNameError:
-        log.error("Invalid service instance '%s' specified. Format is service%sinstance."
-                  % (args.service_instance, SPACER))
-        sys.exit(1)
-
-    client = chronos_tools.get_chronos_client(chronos_tools.load_chronos_config())
-    cluster = load_system_paasta_config().get_cluster()
+def load_complete_job_config(service, instance, cluster, soa_dir):
+    """Builds the job dict to send to Chronos for a service instance.
 
+    :returns: A tuple of the complete job config, or None if it could not be built, and
+              the error to tell the service's team about, or None if there is nothing to tell"""
+    job_id = compose_job_id(service, instance)
     try:
-        complete_job_config = chronos_tools.create_complete_config(
-            service=service,
-            job_name=instance,
-            soa_dir=soa_dir,
-        )
+        with timed('setup_chronos_job.create_complete_config', service=service, instance=instance):
+            complete_job_config = chronos_tools.create_complete_config(
+                service=service,
+                job_name=instance,
+                soa_dir=soa_dir,
+            )
+        return complete_job_config, None
     except (NoDeploymentsAvailable, NoDockerImageError):
-        error_msg = "No deployment found for %s in cluster %s. Has Jenkins run for it?" % (
-            args.service_instance, cluster)
-        send_event(
-            service=service,
-            instance=instance,
-            soa_dir=soa_dir,
-            status=pysensu_yelp.Status.CRITICAL,
-            output=error_msg,
-        )
-        log.error(error_msg)
-        sys.exit(0)
+        return None, "No deployment found for %s in cluster %s. Has Jenkins run for it?" % (job_id, cluster)
     except chronos_tools.UnknownChronosJobError as e:
-        error_msg = (
-            "Could not read chronos configuration file for %s in cluster %s\n" % (args.service_instance, cluster) +
+        return None, (
+            "Could not read chronos configuration file for %s in cluster %s\n" % (job_id, cluster) +
             "Error was: %s" % str(e))
+    except chronos_tools.InvalidParentError:
+        log.warn("Skipping %s.%s: Parent job could not be found" % (service, instance))
+        return None, None
+
+
+def deploy_chronos_job(service, instance, client, cluster, soa_dir):
+    """Creates or updates the chronos job of a service instance, and tells the service's team how it went.
+
+    :returns: 0 if the job is set up (or there is nothing to set up yet), 1 otherwise"""
+    complete_job_config, error_msg = load_complete_job_config(service, instance, cluster, soa_dir)
+    if complete_job_config is None:
+        if error_msg is None:
+            return 0
         send_event(
             service=service,
             instance=instance,
@@ -204,10 +220,7 @@ def main():
             output=error_msg,
         )
         log.error(error_msg)
-        sys.exit(0)
-    except chronos_tools.InvalidParentError:
-        log.warn("Skipping %s.%s: Parent job could not be found" % (service, instance))
-        sys.exit(0)
+        return 1
 
     status, output = setup_job(
         service=service,
@@ -217,13 +230,179 @@ def main():
         client=client,
     )
     sensu_status = pysensu_yelp.Status.CRITICAL if status else pysensu_yelp.Status.OK
-    send_event(
-        service=service,
-        instance=instance,
-        soa_dir=soa_dir,
-        status=sensu_status,
-        output=output,
-    )
+    with timed('setup_chronos_job.send_event', service=service, instance=instance):
+        send_event(
+            service=service,
+            instance=instance,
+            soa_dir=soa_dir,
+            status=sensu_status,
+            output=output,
+        )
+    return 1 if status else 0
+
+
+def plan_job_changes(desired_jobs, existing_jobs):
+    """Works out what has to change in Chronos, comparing the config hash paasta stores in
+    the description field of each job.
+
+    :param desired_jobs: A dict of {(service, instance): complete job config}
+    :param existing_jobs: The jobs in Chronos, as returned by ``client.list()``
+    :returns: A tuple of a list of (action, service, instance, complete job config) for every job
+              that has to change, where action is one of 'create', 'update' or 'disable', and a list
+              of the (service, instance) of the jobs that are already up to date
+    """
+    existing_by_service_instance = chronos_tools.index_chronos_jobs(
+        chronos_tools.filter_non_temporary_chronos_jobs(existing_jobs))
+    changes = []
+    unchanged = []
+    for (service, instance), job in sorted(desired_jobs.items()):
+        existing = existing_by_service_instance.get((service, instance))
+        if not existing:
+            action = 'create'
+        elif existing[0]['description'] == job['description']:
+            unchanged.append((service, instance))
+            continue
+        elif job['disabled'] and not existing[0]['disabled']:
+            action = 'disable'
+        else:
+            action = 'update'
+        changes.append((action, service, instance, job))
+    return changes, unchanged
+
+
+def apply_job_changes(changes, client, cluster, concurrency):
+    """Applies the changes from plan_job_changes, up to concurrency at a time. Failing to apply one
+    change doesn't stop the others.
+
+    :returns: A dict of {(service, instance): (status, output)}, like bounce_chronos_job returns"""
+    results = {}
+    if not changes:
+        return results
+    with ThreadPoolExecutor(max_workers=max(1, concurrency)) as executor:
+        futures = [((service, instance), executor.submit(
+            bounce_chronos_job,
+            service=service,
+            instance=instance,
+            cluster=cluster,
+            job_to_update=job,
+            client=client,
+        )) for action, service, instance, job in changes]
+        for service_instance, future in futures:
+            try:
+                results[service_instance] = future.result()
+            except Exception as e:
+                log.error("Failed to update %s: %s" % (compose_job_id(*service_instance), e))
+                results[service_instance] = (1, "Failed to update the chronos job: %s" % e)
+    return results
+
+
+@contextmanager
+def reconcile_step(timings, step):
+    """Records how long a step of reconcile_jobs took, both in timings and as a timer metric."""
+    start = time.time()
+    with timed('setup_chronos_job.reconcile', step=step):
+        yield
+    timings.append((step, time.time() - start))
+
+
+def reconcile_jobs(client, cluster, soa_dir, concurrency=DEFAULT_RECONCILE_CONCURRENCY):
+    """Brings every chronos job of the cluster in line with soa-configs, listing the jobs in Chronos once.
+
+    :returns: A dict with the applied 'changes' (see plan_job_changes), the 'unchanged' jobs, the
+              (status, output) of every job by (service, instance) in 'results', and the 'timings'
+              of each step as a list of (step, seconds)"""
+    timings = []
+    results = {}
+    # The snapshot also serves the lookups create_complete_config makes for the parents of dependent jobs.
+    with chronos_tools.ChronosJobsSnapshot():
+        with reconcile_step(timings, 'list'):
+            existing_jobs = chronos_tools.ChronosJobsSnapshot.list_jobs(client)
+        with reconcile_step(timings, 'build'):
+            desired_jobs = {}
+            for service, instance in chronos_tools.get_chronos_jobs_for_cluster(cluster, soa_dir=soa_dir):
+                complete_job_config, error_msg = load_complete_job_config(service, instance, cluster, soa_dir)
+                if complete_job_config is not None:
+                    desired_jobs[(service, instance)] = complete_job_config
+                elif error_msg is not None:
+                    log.error(error_msg)
+                    results[(service, instance)] = (1, error_msg)
+    with reconcile_step(timings, 'diff'):
+        changes, unchanged = plan_job_changes(desired_jobs, existing_jobs)
+    with reconcile_step(timings, 'apply'):
+        results.update(apply_job_changes(changes, client, cluster, concurrency))
+    for service_instance in unchanged:
+        results[service_instance] = (0, "All chronos bouncing tasks finished.")
+    return {
+        'changes': changes,
+        'unchanged': unchanged,
+        'results': results,
+        'timings': timings,
+    }
+
+
+def format_reconcile_summary(reconciled):
+    """Describes the outcome of reconcile_jobs for humans."""
+    failed = sorted(service_instance for service_instance, (status, output) in reconciled['results'].items()
+                    if status)
+    counts = dict((action, 0) for action in ('create', 'update', 'disable'))
+    for action, service, instance, job in reconciled['changes']:
+        counts[action] += 1
+    lines = ["%d created, %d updated, %d disabled, %d unchanged, %d failed" % (
+        counts['create'], counts['update'], counts['disable'], len(reconciled['unchanged']), len(failed))]
+    for action, service, instance, job in reconciled['changes']:
+        lines.append("  %s %s" % (action, compose_job_id(service, instance)))
+    for service, instance in failed:
+        lines.append("  failed %s" % compose_job_id(service, instance))
+    lines.append("Timings: %s" % ", ".join("%s %.2fs" % timing for timing in reconciled['timings']))
+    return "\n".join(lines)
+
+
+def reconcile_main(args):
+    system_paasta_config = load_system_paasta_config()
+    configure_timing(system_paasta_config)
+    client = chronos_tools.get_chronos_client(chronos_tools.load_chronos_config())
+    cluster = system_paasta_config.get_cluster()
+
+    reconciled = reconcile_jobs(client, cluster, args.soa_dir, concurrency=args.concurrency)
+    with monitoring_tools.MonitoringConfigCache(), monitoring_tools.batched_sensu_events(system_paasta_config):
+        with timed('setup_chronos_job.send_event'):
+            for (service, instance), (status, output) in sorted(reconciled['results'].items()):
+                send_event(
+                    service=service,
+                    instance=instance,
+                    soa_dir=args.soa_dir,
+                    status=pysensu_yelp.Status.CRITICAL if status else pysensu_yelp.Status.OK,
+                    output=output,
+                )
+    print format_reconcile_summary(reconciled)
+    # Like a single run, we exit 0 because every failure was sent to the right team.
+    sys.exit(0)
+
+
+def main():
+    args = parse_args()
+    soa_dir = args.soa_dir
+    if args.verbose:
+        logging.basicConfig(level=logging.DEBUG)
+    else:
+        logging.basicConfig(level=logging.WARNING)
+
+    if args.all:
+        reconcile_main(args)
+
+    try:
+        service, instance, _, __ = decompose_job_id(args.service_instance, spacer=chronos_tools.INTERNAL_SPACER)
+    except InvalidJobNameError:
+        log.error("Invalid service instance '%s' specified. Format is service%sinstance."
+                  % (args.service_instance, SPACER))
+        sys.exit(1)
+
+    system_paasta_config = load_system_paasta_config()
+    configure_timing(system_paasta_config)
+    client = chronos_tools.get_chronos_client(chronos_tools.load_chronos_config())
+    cluster = system_paasta_config.get_cluster()
+
+    deploy_chronos_job(service, instance, client, cluster, soa_dir)
     # We exit 0 because the script finished ok and the event was sent to the right team.
     sys.exit(0)
 
@@ -53,9 +53,17 @@ from paasta_tools import bounce_lib
 from paasta_tools import drain_lib
 from paasta_tools import marathon_tools
 from paasta_tools import monitoring_tools
+from paasta_tools.capacity_planning import Host
+from paasta_tools.capacity_planning import host_passes_constraint
+from paasta_tools.capacity_planning import Resources
+from paasta_tools.capacity_planning import RESOURCES
 from paasta_tools.marathon_tools import kill_given_tasks
+from paasta_tools.mesos_tools import get_mesos_state_from_leader
+from paasta_tools.paasta_maintenance import MaintenanceSnapshot
+from paasta_tools.smartstack_tools import HaproxySnapshot
 from paasta_tools.utils import _log
 from paasta_tools.utils import compose_job_id
+from paasta_tools.utils import configure_timing
 from paasta_tools.utils import decompose_job_id
 from paasta_tools.utils import InvalidInstanceConfig
 from paasta_tools.utils import InvalidJobNameError
@@ -64,6 +72,8 @@ from paasta_tools.utils import NoConfigurationForServiceError
 from paasta_tools.utils import NoDeploymentsAvailable
 from paasta_tools.utils import NoDockerImageError
 from paasta_tools.utils import SPACER
+from paasta_tools.utils import timed
+from paasta_tools.utils import timing_tags
 
 # Marathon REST API:
 # https://github.com/mesosphere/marathon/blob/master/REST.md#post-v2apps
@@ -225,7 +235,7 @@ def do_bounce(
         log_bounce_action(
             line='%s bounce creating new app with app_id %s' % (bounce_method, marathon_jobid),
         )
-        with requests_cache.disabled():
+        with requests_cache.disabled(), timed('setup_marathon_job.create_marathon_app'):
             bounce_lib.create_marathon_app(marathon_jobid, config, client)
     if len(actions['tasks_to_drain']) > 0:
         tasks_to_drain_by_app_id = defaultdict(set)
@@ -236,21 +246,24 @@ def do_bounce(
                 line='%s bounce draining %d old tasks with app_id %s' %
                 (bounce_method, len(tasks), app_id),
             )
-        for task in actions['tasks_to_drain']:
-            all_draining_tasks.add(task)
-            drain_method.drain(task)
+        with timed('setup_marathon_job.drain'):
+            for task in actions['tasks_to_drain']:
+                all_draining_tasks.add(task)
+                drain_method.drain(task)
     for app, tasks in old_app_draining_tasks.items():
         for task in tasks:
             all_draining_tasks.add(task)
 
     tasks_to_kill = set()
 
-    for task in all_draining_tasks:
-        if drain_method.is_safe_to_kill(task):
-            tasks_to_kill.add(task)
-            log_bounce_action(line='%s bounce killing drained task %s' % (bounce_method, task.id))
+    with timed('setup_marathon_job.is_safe_to_kill'):
+        for task in all_draining_tasks:
+            if drain_method.is_safe_to_kill(task):
+                tasks_to_kill.add(task)
+                log_bounce_action(line='%s bounce killing drained task %s' % (bounce_method, task.id))
 
-    kill_given_tasks(client=client, task_ids=[task.id for task in tasks_to_kill], scale=True)
+    with timed('setup_marathon_job.kill_given_tasks'):
+        kill_given_tasks(client=client, task_ids=[task.id for task in tasks_to_kill], scale=True)
 
     apps_to_kill = []
     for app in old_app_live_happy_tasks.keys():
@@ -270,7 +283,7 @@ def do_bounce(
                 ', '.join(apps_to_kill)
             ),
         )
-        with requests_cache.disabled():
+        with requests_cache.disabled(), timed('setup_marathon_job.kill_old_ids'):
             bounce_lib.kill_old_ids(apps_to_kill, client)
 
     all_old_tasks = set.union(set(), *old_app_live_happy_tasks.values())
@@ -302,15 +315,18 @@ def get_old_happy_unhappy_draining_tasks_for_app(app, drain_method, service, ner
         'draining': set(),
     }
 
-    happy_tasks = bounce_lib.get_happy_tasks(app, service, nerve_ns, system_paasta_config, **bounce_health_params)
-    for task in app.tasks:
-        if drain_method.is_draining(task):
-            state = 'draining'
-        elif task in happy_tasks:
-            state = 'happy'
-        else:
-            state = 'unhappy'
-        tasks_by_state[state].add(task)
+    with timed('setup_marathon_job.get_happy_tasks'):
+        happy_tasks = bounce_lib.get_happy_tasks(app, service, nerve_ns, system_paasta_config,
+                                                 **bounce_health_params)
+    with timed('setup_marathon_job.is_draining'):
+        for task in app.tasks:
+            if drain_method.is_draining(task):
+                state = 'draining'
+            elif task in happy_tasks:
+                state = 'happy'
+            else:
+                state = 'unhappy'
+            tasks_by_state[state].add(task)
 
     return tasks_by_state
 
@@ -339,6 +355,111 @@ def get_old_happy_unhappy_draining_tasks(other_apps, drain_method, service, nerv
     return old_app_live_happy_tasks, old_app_live_unhappy_tasks, old_app_draining_tasks
 
 
+def get_tasks_under_maintenance(tasks, happy_tasks, drain_method, maintenance_index):
+    """Picks out the tasks that run on hosts which are draining or down for maintenance, split like
+    get_old_happy_unhappy_draining_tasks_for_app splits tasks. Those tasks are going away with their
+    host, so deploy_service handles the ones of the new app like the tasks of an old app.
+
+    :param tasks: The tasks to look at
+    :param happy_tasks: The ones of those tasks that are happy
+    :param maintenance_index: A paasta_maintenance.MaintenanceIndex
+    """
+    tasks_by_state = {
+        'happy': set(),
+        'unhappy': set(),
+        'draining': set(),
+    }
+    for task in tasks:
+        if not maintenance_index.is_under_maintenance(task.host):
+            continue
+        if drain_method.is_draining(task):
+            state = 'draining'
+        elif task in happy_tasks:
+            state = 'happy'
+        else:
+            state = 'unhappy'
+        tasks_by_state[state].add(task)
+    return tasks_by_state
+
+
+def has_room_off_maintenance(config, maintenance_index):
+    """Tells whether a task of an app fits in what is free on some active mesos slave that is not under
+    maintenance and that the app's constraints allow.
+
+    Marathon places tasks by the app's constraints alone, and those can't follow maintenance without
+    bouncing every app, so when no such slave exists a replacement for a task on a host under maintenance
+    would land back on one of them, only to be replaced again on the next run.
+
+    :param config: The complete configuration dict to send to marathon
+    :param maintenance_index: A paasta_maintenance.MaintenanceIndex
+    """
+    task_resources = Resources(*(float(config.get(resource, 0)) for resource in RESOURCES))
+    constraints = config.get('constraints') or []
+    for slave in get_mesos_state_from_leader()['slaves']:
+        if not slave.get('active', True) or maintenance_index.is_under_maintenance(slave['hostname']):
+            continue
+        used = slave.get('used_resources', {})
+        host = Host(slave['hostname'], slave.get('attributes', {}), Resources(*(
+            float(slave['resources'].get(resource, 0)) - float(used.get(resource, 0)) for resource in RESOURCES
+        )))
+        if host.how_many_fit(task_resources) and all(host_passes_constraint(host, constraint)
+                                                     for constraint in constraints):
+            return True
+    return False
+
+
+def get_maintenance_index_for_deploy(new_app_list, config):
+    """Returns the MaintenanceIndex deploy_service should replace the tasks of the new app by: the one of the
+    active MaintenanceSnapshot, or None outside of one. It is None too while some of those tasks run on hosts
+    under maintenance but has_room_off_maintenance says their replacements could only go back there; they
+    are then left alone until a host has room for them. If the mesos master can't be asked about that, they
+    are replaced anyway.
+
+    :param new_app_list: The running apps whose id is the desired one
+    :param config: The complete configuration dict to send to marathon
+    """
+    maintenance_index = MaintenanceSnapshot.get_active_index()
+    if maintenance_index is None or not new_app_list:
+        return maintenance_index
+    if not any(maintenance_index.is_under_maintenance(task.host) for task in new_app_list[0].tasks):
+        return maintenance_index
+    try:
+        with timed('setup_marathon_job.has_room_off_maintenance'):
+            has_room = has_room_off_maintenance(config, maintenance_index)
+    except Exception as e:
+        log.warning("Could not tell whether %s has room off the hosts under maintenance, replacing its tasks "
+                    "there anyway: %s" % (config['id'], e))
+        return maintenance_index
+    if not has_room:
+        log.info("Leaving the tasks of %s on hosts under maintenance alone, as every other host it may use is "
+                 "full" % config['id'])
+        return None
+    return maintenance_index
+
+
+def is_converged(new_app_list, other_apps, config, maintenance_index=None):
+    """Tells whether an instance is in the steady state, where the only app running is the desired one and
+    it is already scaled to the desired number of instances, and none of its tasks run on a host under
+    maintenance. This only looks at the apps Marathon lists and the given maintenance index, so it costs
+    no I/O.
+
+    :param new_app_list: The running apps whose id is the desired one
+    :param other_apps: The other running apps of the instance
+    :param config: The complete configuration dict to send to marathon
+    :param maintenance_index: The MaintenanceIndex from get_maintenance_index_for_deploy, or None to not
+                              look at maintenance
+    """
+    if not (
+        len(new_app_list) == 1 and
+        not other_apps and
+        new_app_list[0].instances == config['instances']
+    ):
+        return False
+    if maintenance_index is None:
+        return True
+    return not any(maintenance_index.is_under_maintenance(task.host) for task in new_app_list[0].tasks)
+
+
 def deploy_service(
     service,
     instance,
@@ -380,18 +501,33 @@ def deploy_service(
 
     system_paasta_config = load_system_paasta_config()
     cluster = system_paasta_config.get_cluster()
-    existing_apps = marathon_tools.get_matching_apps(service, instance, client, embed_failures=True)
+    with timed('setup_marathon_job.get_matching_apps'):
+        existing_apps = marathon_tools.get_matching_apps(service, instance, client, embed_failures=True)
     new_app_list = [a for a in existing_apps if a.id == '/%s' % config['id']]
     other_apps = [a for a in existing_apps if a.id != '/%s' % config['id']]
     serviceinstance = "%s.%s" % (service, instance)
 
+    maintenance_index = get_maintenance_index_for_deploy(new_app_list, config)
+    if is_converged(new_app_list, other_apps, config, maintenance_index):
+        # Nothing to bounce, scale, drain or undrain, so skip asking haproxy, hacheck and zookeeper about it.
+        log.debug("%s is already running as %s with %d instances", serviceinstance, marathon_jobid,
+                  config['instances'])
+        send_sensu_bounce_keepalive(
+            service=service,
+            instance=instance,
+            cluster=cluster,
+            soa_dir=soa_dir,
+        )
+        return (0, 'Service deployed.')
+
     if new_app_list:
         new_app = new_app_list[0]
         if len(new_app_list) != 1:
             raise ValueError("Only expected one app per ID; found %d" % len(new_app_list))
         new_app_running = True
-        happy_new_tasks = bounce_lib.get_happy_tasks(new_app, service, nerve_ns, system_paasta_config,
-                                                     **bounce_health_params)
+        with timed('setup_marathon_job.get_happy_tasks'):
+            happy_new_tasks = bounce_lib.get_happy_tasks(new_app, service, nerve_ns, system_paasta_config,
+                                                         **bounce_health_params)
     else:
         new_app_running = False
         happy_new_tasks = []
@@ -449,16 +585,40 @@ def deploy_service(
             tasks_to_move_happy = min(len(scaling_app_happy_tasks), num_tasks_to_scale)
             old_app_live_happy_tasks[new_app.id] = set(scaling_app_happy_tasks[:tasks_to_move_happy])
             happy_new_tasks = scaling_app_happy_tasks[tasks_to_move_happy:]
+
+        # Tasks of the new app on hosts under maintenance don't count towards its capacity, so the bounce
+        # keeps enough old tasks around and replaces them like old ones.
+        if maintenance_index is not None:
+            already_old_tasks = set.union(
+                old_app_live_happy_tasks.get(new_app.id, set()),
+                old_app_live_unhappy_tasks.get(new_app.id, set()),
+                old_app_draining_tasks.get(new_app.id, set()),
+            )
+            with timed('setup_marathon_job.get_tasks_under_maintenance'):
+                maintenance_tasks = get_tasks_under_maintenance(
+                    [task for task in new_app.tasks if task not in already_old_tasks],
+                    happy_new_tasks,
+                    drain_method,
+                    maintenance_index,
+                )
+            if any(maintenance_tasks.values()):
+                old_app_live_happy_tasks.setdefault(new_app.id, set()).update(maintenance_tasks['happy'])
+                old_app_live_unhappy_tasks.setdefault(new_app.id, set()).update(maintenance_tasks['unhappy'])
+                old_app_draining_tasks.setdefault(new_app.id, set()).update(maintenance_tasks['draining'])
+                protected_draining_tasks.update(maintenance_tasks['draining'])
+                happy_new_tasks = [task for task in happy_new_tasks if task not in maintenance_tasks['happy']]
         # If any tasks on the new app happen to be draining (e.g. someone reverts to an older version with
         # `paasta mark-for-deployment`), then we should undrain them.
-        for task in new_app.tasks:
-            if task not in protected_draining_tasks:
-                drain_method.stop_draining(task)
+        with timed('setup_marathon_job.stop_draining'):
+            for task in new_app.tasks:
+                if task not in protected_draining_tasks:
+                    drain_method.stop_draining(task)
 
     # Re-drain any already draining tasks on old apps
-    for tasks in old_app_draining_tasks.values():
-        for task in tasks:
-            drain_method.drain(task)
+    with timed('setup_marathon_job.drain'):
+        for tasks in old_app_draining_tasks.values():
+            for task in tasks:
+                drain_method.drain(task)
 
     # log all uncaught exceptions and raise them again
     try:
@@ -471,7 +631,7 @@ def deploy_service(
             return (1, errormsg)
 
         try:
-            with bounce_lib.bounce_lock_zookeeper(short_id):
+            with bounce_lib.bounce_lock_zookeeper(short_id), timed('setup_marathon_job.do_bounce'):
                 do_bounce(
                     bounce_func=bounce_func,
                     drain_method=drain_method,
@@ -519,7 +679,8 @@ def setup_service(service, instance, client, marathon_config,
 
     log.info("Setting up instance %s for service %s", instance, service)
     try:
-        marathon_app_dict = service_marathon_config.format_marathon_app_dict()
+        with timed('setup_marathon_job.format_marathon_app_dict'):
+            marathon_app_dict = service_marathon_config.format_marathon_app_dict()
     except NoDockerImageError:
         error_msg = (
             "Docker image for {0}.{1} not in deployments.json. Exiting. Has Jenkins deployed it?\n"
@@ -571,21 +732,28 @@ def main():
 
     # Setting up transparent cache for http API calls
     requests_cache.install_cache("setup_marathon_jobs", backend="memory")
+    system_paasta_config = load_system_paasta_config()
+    configure_timing(system_paasta_config)
 
     marathon_config = get_main_marathon_config()
     client = marathon_tools.get_marathon_client(marathon_config.get_url(), marathon_config.get_username(),
                                                 marathon_config.get_password())
 
     num_failed_deployments = 0
-    for service_instance in args.service_instance_list:
-        try:
-            service, instance, _, __ = decompose_job_id(service_instance)
-        except InvalidJobNameError:
-            log.error("Invalid service instance specified. Format is service%sinstance." % SPACER)
-            num_failed_deployments = num_failed_deployments + 1
-        else:
-            if deploy_marathon_service(service, instance, client, soa_dir, marathon_config):
+    # The maintenance snapshot lets deploy_service replace tasks on hosts that are draining or down, asking the
+    # mesos master once.
+    with monitoring_tools.MonitoringConfigCache(), monitoring_tools.batched_sensu_events(system_paasta_config), \
+            MaintenanceSnapshot():
+        for service_instance in args.service_instance_list:
+            try:
+                service, instance, _, __ = decompose_job_id(service_instance)
+            except InvalidJobNameError:
+                log.error("Invalid service instance specified. Format is service%sinstance." % SPACER)
                 num_failed_deployments = num_failed_deployments + 1
+            else:
+                with timing_tags(service=service, instance=instance), timed('setup_marathon_job.total'):
+                    if deploy_marathon_service(service, instance, client, soa_dir, marathon_config):
+                        num_failed_deployments = num_failed_deployments + 1
 
     log.debug("%d out of %d service.instances failed to deploy." %
               (num_failed_deployments, len(args.service_instance_list)))
@@ -595,12 +763,13 @@ def main():
 
 def deploy_marathon_service(service, instance, client, soa_dir, marathon_config):
     try:
-        service_instance_config = marathon_tools.load_marathon_service_config(
-            service,
-            instance,
-            load_system_paasta_config().get_cluster(),
-            soa_dir=soa_dir,
-        )
+        with timed('setup_marathon_job.load_marathon_service_config'):
+            service_instance_config = marathon_tools.load_marathon_service_config(
+                service,
+                instance,
+                load_system_paasta_config().get_cluster(),
+                soa_dir=soa_dir,
+            )
     except NoDeploymentsAvailable:
         log.debug("No deployments found for %s.%s in cluster %s. Skipping." %
                   (service, instance, load_system_paasta_config().get_cluster()))
@@ -612,10 +781,13 @@ def deploy_marathon_service(service, instance, client, soa_dir, marathon_config)
         return 1
 
     try:
-        status, output = setup_service(service, instance, client, marathon_config,
-                                       service_instance_config, soa_dir)
+        # Every app's tasks are checked against the same haproxies; only ask each of them once per deploy.
+        with HaproxySnapshot():
+            status, output = setup_service(service, instance, client, marathon_config,
+                                           service_instance_config, soa_dir)
         sensu_status = pysensu_yelp.Status.CRITICAL if status else pysensu_yelp.Status.OK
-        send_event(service, instance, soa_dir, sensu_status, output)
+        with timed('setup_marathon_job.send_event'):
+            send_event(service, instance, soa_dir, sensu_status, output)
         return 0
     except (KeyError, TypeError, AttributeError, InvalidInstanceConfig):
         error_str = traceback.format_exc()
@@ -12,8 +12,14 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 import csv
+import threading
+import time
 
-import requests
+from paasta_tools.api_recorder import maybe_record_response
+from paasta_tools.http_client import get_http_client
+
+# How long a HaproxySnapshot goes by what a haproxy told it, however long the deploy using it takes.
+HAPROXY_SNAPSHOT_MAX_AGE_S = 10
 
 
 def retrieve_haproxy_csv(synapse_host, synapse_port, synapse_haproxy_url_format):
@@ -25,15 +31,9 @@ def retrieve_haproxy_csv(synapse_host, synapse_port, synapse_haproxy_url_format)
     """
     synapse_uri = synapse_haproxy_url_format.format(host=synapse_host, port=synapse_port)
 
-    # timeout after 1 second and retry 3 times
-    haproxy_request = requests.Session()
-    haproxy_request.mount(
-        'http://',
-        requests.adapters.HTTPAdapter(max_retries=3))
-    haproxy_request.mount(
-        'https://',
-        requests.adapters.HTTPAdapter(max_retries=3))
-    haproxy_response = haproxy_request.get(synapse_uri, timeout=1)
+    # timeout after 1 second; the shared client retries connecting 3 times
+    haproxy_response = get_http_client().get(synapse_uri, timeout=1, endpoint='haproxy.csv')
+    maybe_record_response('haproxy', haproxy_response)
     haproxy_data = haproxy_response.text
     reader = csv.DictReader(haproxy_data.splitlines())
     return reader
@@ -58,18 +58,12 @@ def get_backends(service, synapse_host, synapse_port, synapse_haproxy_url_format
                                  synapse_haproxy_url_format=synapse_haproxy_url_format)
 
 
-def get_multiple_backends(services, synapse_host, synapse_port, synapse_haproxy_url_format):
-    """Fetches the CSV from haproxy and returns a list of backends,
+def get_all_backends(synapse_host, synapse_port, synapse_haproxy_url_format):
+    """Fetches the CSV from haproxy and returns a list of the backends of every service,
     regardless of their state.
 
-    :param services: If None, return backends for all services, otherwise only return backends for these particular
-                     services.
-    :param synapse_host_port: A string in host:port format that this check
-                              should contact for replication information.
-    :returns backends: A list of dicts representing the backends of all
-                       services or the requested service
+    :returns backends: A list of dicts representing the backends of all services
     """
-
     reader = retrieve_haproxy_csv(synapse_host, synapse_port, synapse_haproxy_url_format=synapse_haproxy_url_format)
     backends = []
 
@@ -80,11 +74,81 @@ def get_multiple_backends(services, synapse_host, synapse_port, synapse_haproxy_
         # and there's a trailing comma on every line:
         line.pop('')
 
-        # Look for the service in question and ignore the fictional
-        # FRONTEND/BACKEND hosts, use starts_with so that hosts that are UP
-        # with 1/X healthchecks to go before going down get counted as UP:
-        ha_slave, ha_service = line['svname'], line['pxname']
-        if (services is None or ha_service in services) and ha_slave not in ('FRONTEND', 'BACKEND'):
+        # Ignore the fictional FRONTEND/BACKEND hosts
+        if line['svname'] not in ('FRONTEND', 'BACKEND'):
             backends.append(line)
 
     return backends
+
+
+class HaproxySnapshot(object):
+    """
+    A context manager that remembers the backends reported by each synapse host's haproxy, the first time
+    it is asked, for up to max_age_s seconds. Inside it, get_multiple_backends talks to each haproxy at most
+    once that often, no matter how many services or apps it is asked about.
+
+    A snapshot only applies to the thread that entered it, so deploys running side by side never judge their
+    tasks by each other's answers. Nested snapshots go by the outermost one of their thread. To carry a
+    snapshot into a worker pool, enter the same HaproxySnapshot object in the worker.
+
+    :param max_age_s: How long to go by an answer from a haproxy
+    """
+    local = threading.local()
+
+    def __init__(self, max_age_s=HAPROXY_SNAPSHOT_MAX_AGE_S):
+        self.max_age_s = max_age_s
+        # {(synapse_host, synapse_port, synapse_haproxy_url_format): (fetched at, backends)}
+        self.backends_by_host = {}
+        self.lock = threading.Lock()
+
+    @classmethod
+    def get_active_snapshots(cls):
+        if not hasattr(cls.local, 'snapshots'):
+            cls.local.snapshots = []
+        return cls.local.snapshots
+
+    @classmethod
+    def current(cls):
+        """Returns the outermost snapshot this thread is inside, or None."""
+        snapshots = cls.get_active_snapshots()
+        return snapshots[0] if snapshots else None
+
+    def __enter__(self):
+        self.get_active_snapshots().append(self)
+        return self
+
+    def __exit__(self, *args, **kwargs):
+        self.get_active_snapshots().remove(self)
+
+    def get_all_backends(self, synapse_host, synapse_port, synapse_haproxy_url_format):
+        """Returns every backend on a synapse host, from the snapshot unless its answer is too old."""
+        key = (synapse_host, synapse_port, synapse_haproxy_url_format)
+        with self.lock:
+            fetched_at, backends = self.backends_by_host.get(key, (None, None))
+        if fetched_at is not None and time.time() - fetched_at < self.max_age_s:
+            return backends
+        fetched_at = time.time()
+        backends = get_all_backends(synapse_host, synapse_port, synapse_haproxy_url_format)
+        with self.lock:
+            if self.backends_by_host.get(key, (0, None))[0] < fetched_at:
+                self.backends_by_host[key] = (fetched_at, backends)
+        return backends
+
+
+def get_multiple_backends(services, synapse_host, synapse_port, synapse_haproxy_url_format):
+    """Fetches the CSV from haproxy and returns a list of backends,
+    regardless of their state.
+
+    :param services: If None, return backends for all services, otherwise only return backends for these particular
+                     services.
+    :param synapse_host_port: A string in host:port format that this check
+                              should contact for replication information.
+    :returns backends: A list of dicts representing the backends of all
+                       services or the requested service
+    """
+    snapshot = HaproxySnapshot.current()
+    if snapshot is not None:
+        backends = snapshot.get_all_backends(synapse_host, synapse_port, synapse_haproxy_url_format)
+    else:
+        backends = get_all_backends(synapse_host, synapse_port, synapse_haproxy_url_format)
+    return [backend for backend in backends if services is None or backend['pxname'] in services]
@@ -0,0 +1,196 @@
+#!/usr/bin/env python
+# Copyright 2015-2016 Yelp Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Usage: ./soa_config_deployer.py [options]
+
+Deploys the marathon and chronos instances of this cluster as soon as their soa-configs change, e.g.
+when generate_deployments_for_service writes a new deployments.json after mark-for-deployment,
+instead of at the next deploy_marathon_services or paasta_deploy_chronos_jobs sweep. Only the
+instances the changed files configure are deployed (see soa_config_watcher); the sweeps keep running
+to catch anything else.
+
+Changes are found with inotify when pyinotify is installed, and by polling otherwise. Changes that come
+in a burst, like a soa-configs sync touching many files, are deployed together once the burst is over.
+
+marathon_deployer already deploys marathon instances whose soa-configs change; where it runs, run this
+with --instance-type chronos.
+
+Command line options:
+
+- -d <SOA_DIR>, --soa-dir <SOA_DIR>: Specify a SOA config dir to read from
+- -t <TYPE>, --instance-type <TYPE>: Only deploy instances of TYPE (marathon or chronos); may be repeated
+- -j <N>, --concurrency <N>: Deploy up to N marathon instances at once
+- --quiet-period <S>: Deploy a burst of changes once none came for S seconds
+- --max-delay <S>: Deploy a burst of changes at most S seconds after it began
+- -v, --verbose: Verbose output
+"""
+import argparse
+import logging
+import time
+from functools import partial
+
+import service_configuration_lib
+
+from paasta_tools import chronos_tools
+from paasta_tools import marathon_tools
+from paasta_tools import monitoring_tools
+from paasta_tools import setup_chronos_job
+from paasta_tools import setup_marathon_job
+from paasta_tools.marathon_deployer import DEFAULT_CONCURRENCY
+from paasta_tools.marathon_deployer import deploy_marathon_instances
+from paasta_tools.soa_config_watcher import Debouncer
+from paasta_tools.soa_config_watcher import INSTANCE_TYPES
+from paasta_tools.soa_config_watcher import SoaConfigWatcher
+from paasta_tools.utils import compose_job_id
+from paasta_tools.utils import configure_timing
+from paasta_tools.utils import DEFAULT_SOA_DIR
+from paasta_tools.utils import load_system_paasta_config
+from paasta_tools.utils import timed
+
+log = logging.getLogger(__name__)
+
+DEFAULT_QUIET_PERIOD_S = 2
+DEFAULT_MAX_DELAY_S = 30
+# How long to wait for changes when nothing is pending.
+IDLE_POLL_INTERVAL_S = 5
+
+
+def deploy_chronos_instances(service_instances, client, cluster, soa_dir):
+    """Sets up the chronos jobs of the given instances with setup_chronos_job, one after the other.
+
+    :returns: A dict of {(service, instance): 0 if the deploy went fine, 1 otherwise}
+    """
+    results = {}
+    if not service_instances:
+        return results
+    system_paasta_config = load_system_paasta_config()
+    # The snapshot also serves the lookups create_complete_config makes for the parents of dependent jobs.
+    with monitoring_tools.MonitoringConfigCache(), monitoring_tools.batched_sensu_events(system_paasta_config), \
+            chronos_tools.ChronosJobsSnapshot():
+        for service, instance in sorted(service_instances):
+            with timed('soa_config_deployer.deploy_chronos_job', service=service, instance=instance):
+                try:
+                    results[(service, instance)] = setup_chronos_job.deploy_chronos_job(
+                        service, instance, client, cluster, soa_dir)
+                except Exception:
+                    log.exception("Failed to deploy %s" % compose_job_id(service, instance))
+                    results[(service, instance)] = 1
+    return results
+
+
+class SoaConfigDeployer(object):
+    """Deploys the instances a SoaConfigWatcher reports, a burst at a time.
+
+    :param watcher: A SoaConfigWatcher
+    :param deploy_functions: A dict of {instance_type: function}, where each function takes a set of
+                             (service, instance) of that type, deploys them and returns a dict of
+                             {(service, instance): 0 or 1}, like deploy_marathon_instances
+    :param debouncer: The Debouncer to gather bursts of changes with
+    """
+
+    def __init__(self, watcher, deploy_functions, debouncer):
+        self.watcher = watcher
+        self.deploy_functions = deploy_functions
+        self.debouncer = debouncer
+
+    def start(self):
+        """Starts watching. Every instance is reported on the first poll; the sweeps take care of those."""
+        self.watcher.poll()
+
+    def get_poll_timeout(self, now):
+        ready_time = self.debouncer.get_ready_time()
+        return IDLE_POLL_INTERVAL_S if ready_time is None else max(0, ready_time - now)
+
+    def run_once(self, now=None):
+        """Waits for changes until the pending burst is ready, then deploys it if it is.
+
+        :param now: The time once the wait is over; defaults to the current time
+        :returns: A dict of {instance_type: results of its deploy function}, for the types with changes
+        """
+        changes = self.watcher.poll(timeout=self.get_poll_timeout(time.time()))
+        now = time.time() if now is None else now
+        self.debouncer.add(((instance_type, service, instance)
+                            for instance_type, service_instances in changes.items()
+                            for service, instance in service_instances), now)
+        batch = self.debouncer.take(now)
+        results = {}
+        for instance_type, deploy in sorted(self.deploy_functions.items()):
+            service_instances = set((service, instance) for batch_type, service, instance in batch
+                                    if batch_type == instance_type)
+            if service_instances:
+                results[instance_type] = deploy(service_instances)
+                log.info("Deployed %d %s instances, %d failed" % (
+                    len(service_instances), instance_type, sum(results[instance_type].values())))
+        return results
+
+    def run(self):
+        self.start()
+        while True:
+            self.run_once()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Deploys instances as soon as their soa-configs change.')
+    parser.add_argument('-d', '--soa-dir', dest="soa_dir", metavar="SOA_DIR", default=DEFAULT_SOA_DIR,
+                        help="define a different soa config directory")
+    parser.add_argument('-t', '--instance-type', dest="instance_types", action='append', choices=INSTANCE_TYPES,
+                        help="Only deploy instances of this type; may be given more than once (default: all types)")
+    parser.add_argument('-j', '--concurrency', dest="concurrency", type=int, default=DEFAULT_CONCURRENCY,
+                        help="How many marathon instances to deploy at once (default %(default)s)")
+    parser.add_argument('--quiet-period', dest="quiet_period", type=float, default=DEFAULT_QUIET_PERIOD_S,
+                        help="Deploy a burst of changes once none came for this many seconds (default %(default)s)")
+    parser.add_argument('--max-delay', dest="max_delay", type=float, default=DEFAULT_MAX_DELAY_S,
+                        help="Deploy a burst of changes at most this many seconds after it began "
+                             "(default %(default)s)")
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        dest="verbose", default=False)
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    if args.verbose:
+        logging.basicConfig(level=logging.DEBUG)
+    else:
+        logging.basicConfig(level=logging.WARNING)
+
+    # soa-configs change under a long-running process; always read them from disk.
+    service_configuration_lib.disable_yaml_cache()
+    system_paasta_config = load_system_paasta_config()
+    configure_timing(system_paasta_config)
+    cluster = system_paasta_config.get_cluster()
+    instance_types = args.instance_types or INSTANCE_TYPES
+
+    deploy_functions = {}
+    if 'marathon' in instance_types:
+        marathon_config = setup_marathon_job.get_main_marathon_config()
+        marathon_client = marathon_tools.get_marathon_client(marathon_config.get_url(), marathon_config.get_username(),
+                                                             marathon_config.get_password())
+        deploy_functions['marathon'] = partial(deploy_marathon_instances, client=marathon_client,
+                                               marathon_config=marathon_config, soa_dir=args.soa_dir,
+                                               concurrency=args.concurrency)
+    if 'chronos' in instance_types:
+        chronos_client = chronos_tools.get_chronos_client(chronos_tools.load_chronos_config())
+        deploy_functions['chronos'] = partial(deploy_chronos_instances, client=chronos_client, cluster=cluster,
+                                              soa_dir=args.soa_dir)
+
+    SoaConfigDeployer(
+        watcher=SoaConfigWatcher(cluster, args.soa_dir, instance_types=instance_types),
+        deploy_functions=deploy_functions,
+        debouncer=Debouncer(args.quiet_period, args.max_delay),
+    ).run()
+
+
+if __name__ == "__main__":
+    main()
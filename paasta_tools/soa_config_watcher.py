@@ -0,0 +1,280 @@
+# Copyright 2015-2016 Yelp Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Finds out which marathon and chronos instances of a cluster are affected by changes to soa-configs.
+
+A SoaConfigWatcher maps every changed file under the soa dir to the instances that file configures:
+deployments.json and service.yaml to all the service's instances, smartstack.yaml to its marathon
+instances, and marathon-<cluster>.yaml and chronos-<cluster>.yaml to the instances they list.
+
+Changed files are found with inotify (see InotifyBackend). pyinotify is only installed on Linux; elsewhere,
+or if the soa dir can't be watched, they are found by comparing the mtimes of the files that matter from
+one poll to the next (see PollingBackend).
+"""
+import logging
+import os
+import threading
+import time
+
+from paasta_tools.marathon_tools import get_mtime
+from paasta_tools.utils import DEFAULT_SOA_DIR
+from paasta_tools.utils import get_service_instance_list
+
+try:
+    import pyinotify
+except ImportError:
+    pyinotify = None
+
+log = logging.getLogger(__name__)
+
+INSTANCE_TYPES = ('marathon', 'chronos')
+
+
+def get_watched_filenames(cluster):
+    """The names of the files of a service's soa-configs that decide how its instances in cluster are deployed."""
+    return ['service.yaml', 'smartstack.yaml', 'deployments.json'] + \
+        ['%s-%s.yaml' % (instance_type, cluster) for instance_type in INSTANCE_TYPES]
+
+
+def get_affected_instance_types(filename, cluster):
+    """Returns the types of instance in cluster whose deployment depends on a file of a service's soa-configs."""
+    if filename in ('service.yaml', 'deployments.json'):
+        return INSTANCE_TYPES
+    elif filename == 'smartstack.yaml':
+        return ('marathon',)
+    for instance_type in INSTANCE_TYPES:
+        if filename == '%s-%s.yaml' % (instance_type, cluster):
+            return (instance_type,)
+    return ()
+
+
+class PollingBackend(object):
+    """Finds changed soa-configs by comparing the mtimes of every service's watched files with those
+    of the previous call."""
+
+    def __init__(self, soa_dir, cluster):
+        self.soa_dir = os.path.abspath(soa_dir)
+        self.filenames = get_watched_filenames(cluster)
+        self.mtimes = self.get_mtimes()
+
+    def get_mtimes(self):
+        try:
+            services = os.listdir(self.soa_dir)
+        except OSError as e:
+            log.error("Could not list %s: %s" % (self.soa_dir, e))
+            return {}
+        mtimes = {}
+        for service in services:
+            for filename in self.filenames:
+                path = os.path.join(self.soa_dir, service, filename)
+                mtime = get_mtime(path)
+                if mtime is not None:
+                    mtimes[path] = mtime
+        return mtimes
+
+    def get_changed_paths(self, timeout=0):
+        """Waits for timeout seconds, then returns the paths of the watched files that were written,
+        created or deleted since the last call."""
+        if timeout > 0:
+            time.sleep(timeout)
+        old_mtimes = self.mtimes
+        self.mtimes = self.get_mtimes()
+        return set(path for path in set(old_mtimes) | set(self.mtimes)
+                   if old_mtimes.get(path) != self.mtimes.get(path))
+
+
+class InotifyBackend(object):
+    """Finds changed soa-configs from the inotify events of the soa dir and every directory under it.
+
+    If the kernel drops events because we did not read them fast enough, the soa dir itself is reported
+    as changed, which SoaConfigWatcher takes to mean that anything may have changed."""
+
+    def __init__(self, soa_dir):
+        self.soa_dir = os.path.abspath(soa_dir)
+        self.changed_paths = set()
+        self.watch_manager = pyinotify.WatchManager()
+        self.notifier = pyinotify.Notifier(self.watch_manager, default_proc_fun=self.process_event)
+        # Files written in place are reported when they are closed; files replaced atomically, like
+        # atomic_file_write and rsync do, when they are moved into place.
+        mask = pyinotify.IN_CLOSE_WRITE | pyinotify.IN_MOVED_TO | pyinotify.IN_MOVED_FROM | \
+            pyinotify.IN_CREATE | pyinotify.IN_DELETE
+        watch_descriptors = self.watch_manager.add_watch(self.soa_dir, mask, rec=True, auto_add=True)
+        if not watch_descriptors or any(wd < 0 for wd in watch_descriptors.values()):
+            raise OSError("Could not watch every directory under %s" % self.soa_dir)
+
+    def process_event(self, event):
+        if event.mask & pyinotify.IN_Q_OVERFLOW:
+            log.warning("Missed inotify events for %s" % self.soa_dir)
+            self.changed_paths.add(self.soa_dir)
+        else:
+            self.changed_paths.add(event.pathname)
+
+    def get_changed_paths(self, timeout=0):
+        """Waits up to timeout seconds for inotify events, then returns the paths of the files and
+        directories that were written, created, moved or deleted since the last call."""
+        if self.notifier.check_events(timeout=int(timeout * 1000)):
+            self.notifier.read_events()
+            self.notifier.process_events()
+        changed_paths, self.changed_paths = self.changed_paths, set()
+        return changed_paths
+
+    def close(self):
+        self.notifier.stop()
+
+
+def get_watch_backend(soa_dir, cluster):
+    """Returns an InotifyBackend for soa_dir if pyinotify is installed and can watch it, and a
+    PollingBackend otherwise."""
+    if pyinotify is not None:
+        try:
+            return InotifyBackend(soa_dir)
+        except Exception as e:
+            log.warning("Could not watch %s with inotify, polling it instead: %s" % (soa_dir, e))
+    return PollingBackend(soa_dir, cluster)
+
+
+class SoaConfigWatcher(object):
+    """Finds the instances of a cluster whose soa-configs changed, and keeps track of every instance of
+    the cluster as of the last poll.
+
+    service_configuration_lib remembers every file it reads for the life of the process, and never looks at
+    mtimes, so callers must call service_configuration_lib.disable_yaml_cache() for changes to be read.
+    Polls must come from one thread, but get_service_instances may be called from any.
+
+    :param cluster: The cluster whose instances to watch
+    :param soa_dir: The SOA config directory to watch
+    :param instance_types: The types of instance to watch
+    :param backend: What to find changed files with; by default, get_watch_backend picks one on the first poll
+    """
+
+    def __init__(self, cluster, soa_dir=DEFAULT_SOA_DIR, instance_types=INSTANCE_TYPES, backend=None):
+        self.cluster = cluster
+        self.soa_dir = soa_dir
+        self.instance_types = tuple(instance_types)
+        self.backend = backend
+        self.started = False
+        # {instance_type: {service: [(service, instance)]}}
+        self.instances = dict((instance_type, {}) for instance_type in self.instance_types)
+        self.instances_lock = threading.Lock()
+
+    def list_services(self):
+        try:
+            return set(os.listdir(os.path.abspath(self.soa_dir)))
+        except OSError as e:
+            log.error("Could not list %s: %s" % (self.soa_dir, e))
+            return set()
+
+    def get_changed_services(self, paths):
+        """Maps changed paths under the soa dir to the services whose instances of each type they affect.
+
+        :returns: A dict of {instance_type: set of services}
+        """
+        soa_dir = os.path.abspath(self.soa_dir)
+        changed = dict((instance_type, set()) for instance_type in self.instance_types)
+        for path in paths:
+            parts = os.path.relpath(path, soa_dir).split(os.sep)
+            if parts == ['.']:
+                services = self.list_services() | self.get_known_services()
+                for instance_type in self.instance_types:
+                    changed[instance_type].update(services)
+                continue
+            elif parts[0] == os.pardir or len(parts) > 2:
+                continue
+            # A service directory that appeared or went away affects all of its instances.
+            instance_types = INSTANCE_TYPES if len(parts) == 1 else get_affected_instance_types(parts[1], self.cluster)
+            for instance_type in set(instance_types) & set(self.instance_types):
+                changed[instance_type].add(parts[0])
+        return changed
+
+    def get_known_services(self):
+        """Returns the services that had instances of a watched type as of the last poll."""
+        with self.instances_lock:
+            return set(service for services in self.instances.values() for service in services)
+
+    def refresh(self, changed_services):
+        """Reads the instances of the given services again.
+
+        :param changed_services: A dict of {instance_type: set of services}
+        :returns: A dict of {instance_type: set of the (service, instance) of those services}
+        """
+        refreshed = {}
+        for instance_type, services in changed_services.items():
+            refreshed[instance_type] = set()
+            for service in services:
+                instances = get_service_instance_list(service, cluster=self.cluster, instance_type=instance_type,
+                                                      soa_dir=self.soa_dir)
+                with self.instances_lock:
+                    if instances:
+                        self.instances[instance_type][service] = instances
+                    else:
+                        self.instances[instance_type].pop(service, None)
+                refreshed[instance_type].update(instances)
+        return refreshed
+
+    def poll(self, timeout=0):
+        """Looks for changed soa-configs, waiting up to timeout seconds for some.
+
+        :returns: A dict of {instance_type: set of the (service, instance) whose soa-configs changed since the
+                  last poll}; every instance of the cluster on the first poll
+        """
+        if not self.started:
+            # Start watching before the first full read, so that nothing changes in between unnoticed.
+            if self.backend is None:
+                self.backend = get_watch_backend(self.soa_dir, self.cluster)
+            self.started = True
+            services = self.list_services()
+            return self.refresh(dict((instance_type, services) for instance_type in self.instance_types))
+        return self.refresh(self.get_changed_services(self.backend.get_changed_paths(timeout)))
+
+    def get_service_instances(self, instance_type):
+        """Returns every instance of the given type in the cluster, as of the last poll."""
+        with self.instances_lock:
+            return set(service_instance for instances in self.instances[instance_type].values()
+                       for service_instance in instances)
+
+
+class Debouncer(object):
+    """Gathers changes that come in a burst, like a soa-configs sync touching many files, into one batch.
+    A batch is ready once no change has come for quiet_period seconds, or max_delay seconds after its
+    first change, whichever is sooner."""
+
+    def __init__(self, quiet_period, max_delay):
+        self.quiet_period = quiet_period
+        self.max_delay = max_delay
+        self.pending = set()
+        self.first_change = None
+        self.last_change = None
+
+    def add(self, items, now):
+        items = set(items)
+        if not items:
+            return
+        if not self.pending:
+            self.first_change = now
+        self.last_change = now
+        self.pending.update(items)
+
+    def get_ready_time(self):
+        """Returns when the pending batch is ready, or None if nothing is pending."""
+        if not self.pending:
+            return None
+        return min(self.last_change + self.quiet_period, self.first_change + self.max_delay)
+
+    def take(self, now):
+        """Returns the pending batch and starts a new one if it is ready, and an empty set otherwise."""
+        ready_time = self.get_ready_time()
+        if ready_time is None or now < ready_time:
+            return set()
+        pending, self.pending = self.pending, set()
+        return pending
@@ -28,13 +28,22 @@ import sys
 from paasta_tools import marathon_tools
 
 
-def main():
+def get_synapse_srv_namespaces_fact(service_configurations=None):
+    """Returns the fact as a line of the form synapse_srv_namespaces=<full_name>:<proxy_port>,...
+
+    :param service_configurations: The result of marathon_tools.get_all_service_configurations, to use
+                                   instead of reading the SOA config directory
+    """
     strings = []
-    for full_name, config in marathon_tools.get_all_namespaces():
+    for full_name, config in marathon_tools.get_all_namespaces(service_configurations=service_configurations):
         if 'proxy_port' in config:
             strings.append('%s:%s' % (full_name, config['proxy_port']))
     strings = sorted(strings)
-    print "synapse_srv_namespaces=" + ','.join(strings)
+    return "synapse_srv_namespaces=" + ','.join(strings)
+
+
+def main():
+    print get_synapse_srv_namespaces_fact()
     sys.exit(0)
 
 
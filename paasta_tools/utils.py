@@ -29,10 +29,12 @@ import os
 import pwd
 import re
 import shlex
-import signal
+import socket
 import sys
 import tempfile
 import threading
+import time
+from collections import Mapping
 from fnmatch import fnmatch
 from functools import wraps
 from subprocess import PIPE
@@ -46,6 +48,7 @@ import yaml
 from docker import Client
 from docker.utils import kwargs_from_env
 from kazoo.client import KazooClient
+from kazoo.protocol.states import KazooState
 
 
 # DO NOT CHANGE SPACER, UNLESS YOU'RE PREPARED TO CHANGE ALL INSTANCES
@@ -88,9 +91,13 @@ class InstanceConfig(dict):
         self.service = service
         config_interpolation_keys = ('deploy_group',)
         interpolation_facts = self.__get_interpolation_facts()
+        interpolated = {}
         for key in config_interpolation_keys:
             if key in self.config_dict:
-                self.config_dict[key] = self.config_dict[key].format(**interpolation_facts)
+                interpolated[key] = self.config_dict[key].format(**interpolation_facts)
+        if interpolated:
+            # Layered on top rather than written back, as config_dict may be shared or a read-only LayeredConfig.
+            self.config_dict = LayeredConfig(interpolated, self.config_dict)
 
     def __get_interpolation_facts(self):
         return {
@@ -199,8 +206,8 @@ class InstanceConfig(dict):
                 raise InvalidInstanceConfig('Instance configuration can specify cmd or args, but not both.')
 
     def get_monitoring(self):
-        """Get monitoring overrides defined for the given instance"""
-        return self.config_dict.get('monitoring', {})
+        """Get monitoring overrides defined for the given instance, as a dictionary of the caller's own"""
+        return materialize(self.config_dict.get('monitoring', {}))
 
     def get_deploy_blacklist(self):
         """The deploy blacklist is a list of lists, where the lists indicate
@@ -664,6 +671,148 @@ class FileLogWriter(LogWriter):
                 f.write(to_write)
 
 
+# The active timing sink. Until configure_timing is called, timings go nowhere.
+_timing_sink = None
+# The map of name -> TimingSink subclasses, used by configure_timing.
+_timing_sink_classes = {}
+# Tags (service, instance, ...) attached to every timing emitted from the current thread.
+_timing_context = threading.local()
+
+
+def register_timing_sink(name):
+    """Returns a decorator that registers a TimingSink subclass at a given name
+    so configure_timing can find it."""
+    def outer(sink_class):
+        _timing_sink_classes[name] = sink_class
+        return sink_class
+    return outer
+
+
+def get_timing_sink_class(name):
+    return _timing_sink_classes[name]
+
+
+def list_timing_sinks():
+    return _timing_sink_classes.keys()
+
+
+class TimingSink(object):
+    def emit(self, name, duration, tags):
+        """Record that the phase ``name`` took ``duration`` seconds.
+
+        :param tags: A dictionary describing what was being timed, e.g. service and instance"""
+        raise NotImplementedError()
+
+
+@register_timing_sink('null')
+class NullTimingSink(TimingSink):
+    """A TimingSink that throws everything away. This is what you get if timing was never configured."""
+
+    def __init__(self, **kwargs):
+        pass
+
+    def emit(self, name, duration, tags):
+        pass
+
+
+@register_timing_sink('statsd')
+class StatsdTimingSink(TimingSink):
+    """Sends each timing as a statsd timer over UDP. Plain statsd has no notion of tags, so they are only sent
+    (in the dogstatsd ``|#key:value`` format) if ``dogstatsd`` is set."""
+
+    def __init__(self, host='localhost', port=8125, prefix='paasta', dogstatsd=False, **kwargs):
+        self.address = (host, int(port))
+        self.prefix = prefix
+        self.dogstatsd = dogstatsd
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def format_packet(self, name, duration, tags):
+        packet = '%s.%s:%d|ms' % (self.prefix, name, int(round(duration * 1000)))
+        if self.dogstatsd and tags:
+            packet += '|#%s' % ','.join('%s:%s' % (key, value) for key, value in sorted(tags.items()))
+        return packet
+
+    def emit(self, name, duration, tags):
+        try:
+            self.sock.sendto(self.format_packet(name, duration, tags), self.address)
+        except socket.error as e:
+            log.debug("Could not send timing %s to statsd: %s", name, e)
+
+
+@register_timing_sink('jsonl')
+class JsonlTimingSink(TimingSink):
+    """Appends each timing to a file as a line of JSON. As with the FileLogWriter, every line is a single
+    write() to an O_APPEND file, so concurrent deploys can share a file."""
+
+    def __init__(self, path, **kwargs):
+        self.path = path
+
+    def emit(self, name, duration, tags):
+        line = json.dumps({
+            'timestamp': _now(),
+            'name': name,
+            'duration': duration,
+            'tags': tags,
+        }, sort_keys=True)
+        with io.FileIO(self.path, mode='a') as f:
+            f.write('%s\n' % line)
+
+
+class MultiTimingSink(TimingSink):
+    """Fans every timing out to several sinks."""
+
+    def __init__(self, sinks):
+        self.sinks = sinks
+
+    def emit(self, name, duration, tags):
+        for sink in self.sinks:
+            sink.emit(name, duration, tags)
+
+
+def configure_timing(system_paasta_config=None):
+    """Sets up the timing sinks listed under ``timing_sinks`` in the system paasta config.
+    Entry points that want their phases timed (setup_marathon_job, etc.) call this once at startup."""
+    global _timing_sink
+    if system_paasta_config is None:
+        system_paasta_config = load_system_paasta_config()
+    sinks = []
+    for sink_config in system_paasta_config.get_timing_sinks():
+        SinkClass = get_timing_sink_class(sink_config['driver'])
+        sinks.append(SinkClass(**sink_config.get('options', {})))
+    _timing_sink = MultiTimingSink(sinks)
+    return _timing_sink
+
+
+def get_timing_sink():
+    global _timing_sink
+    if _timing_sink is None:
+        _timing_sink = NullTimingSink()
+    return _timing_sink
+
+
+@contextlib.contextmanager
+def timing_tags(**tags):
+    """Attach tags to every timing emitted from this thread inside the with block."""
+    old_tags = getattr(_timing_context, 'tags', {})
+    _timing_context.tags = dict(old_tags, **tags)
+    try:
+        yield
+    finally:
+        _timing_context.tags = old_tags
+
+
+@contextlib.contextmanager
+def timed(name, **tags):
+    """Time the with block and emit its duration to the configured timing sink as ``name``.
+    The duration is emitted even if the block raises."""
+    all_tags = dict(getattr(_timing_context, 'tags', {}), **tags)
+    start = time.time()
+    try:
+        yield
+    finally:
+        get_timing_sink().emit(name, time.time() - start, all_tags)
+
+
 def _timeout(process):
     """Helper function for _run. It terminates the process.
     Doesn't raise OSError, if we try to terminate a non-existing
@@ -821,6 +970,14 @@ class SystemPaastaConfig(dict):
         """
         return int(self.get('sensu_port', 3030))
 
+    def get_sensu_event_cache_path(self):
+        """Get the file batched sensu events remember what they last sent in.
+
+        :returns: the sensu_event_cache_path string, or paasta_sensu_events.json in the temp directory if not
+                  specified.
+        """
+        return self.get('sensu_event_cache_path', os.path.join(tempfile.gettempdir(), 'paasta_sensu_events.json'))
+
     def get_dockercfg_location(self):
         """Get the location of the dockerfile, as a URI.
 
@@ -850,6 +1007,19 @@ class SystemPaastaConfig(dict):
     def get_cluster_autoscaling_resources(self):
         return self.get('cluster_autoscaling_resources', {})
 
+    def get_timing_sinks(self):
+        """Get the list of sinks that deploy phase timings should be sent to. Each one is a dictionary with a
+        ``driver`` (one of list_timing_sinks()) and the ``options`` to pass to it.
+
+        :returns: A list of timing sink dictionaries, empty if not specified."""
+        return self.get('timing_sinks', [])
+
+    def get_autoscaling_history_dir(self):
+        """Get the directory the autoscaler keeps the history of its decisions for each instance in.
+
+        :returns: the autoscaling_history_dir string, or /var/lib/paasta/autoscaling_history if not specified."""
+        return self.get('autoscaling_history_dir', '/var/lib/paasta/autoscaling_history')
+
     def get_cluster_fqdn_format(self):
         """Get a format string that constructs a DNS name pointing at the paasta masters in a cluster. This format
         string gets one parameter: cluster. Defaults to 'paasta-{cluster:s}.yelp'.
@@ -961,6 +1131,25 @@ def atomic_file_write(target_path):
     os.rename(temp_target_path, target_path)
 
 
+def write_file_if_changed(target_path, contents):
+    """Atomically replaces a file with new contents, unless the content hash of the file shows it
+    already has them. Rewriting a file that did not change would still wake up whatever watches it.
+
+    :param contents: A str of the contents to write
+    :returns: True if the file was written, False if it was left alone
+    """
+    new_digest = hashlib.sha1(contents).hexdigest()
+    try:
+        with open(target_path, 'rb') as f:
+            if hashlib.sha1(f.read()).hexdigest() == new_digest:
+                return False
+    except IOError:
+        pass
+    with atomic_file_write(target_path) as f:
+        f.write(contents)
+    return True
+
+
 class InvalidJobNameError(Exception):
     pass
 
@@ -1210,41 +1399,103 @@ class TimeoutError(Exception):
     pass
 
 
-def timeout(seconds=10, error_message=os.strerror(errno.ETIME)):
-    def decorator(func):
-        def _handle_timeout(signum, frame):
-            raise TimeoutError(error_message)
+_deadlines = threading.local()
 
-        def wrapper(*args, **kwargs):
-            signal.signal(signal.SIGALRM, _handle_timeout)
-            signal.alarm(seconds)
-            try:
-                result = func(*args, **kwargs)
-            finally:
-                signal.alarm(0)
-            return result
-
-        return wraps(func)(wrapper)
 
-    return decorator
+class Deadline(object):
+    """A point in time by which some work has to be done.
 
+    Deadlines replace SIGALRM based timeouts: nothing interrupts the work, instead it is expected to call
+    check_deadline() between steps, and to pass deadline_timeout() as the socket timeout of any HTTP or
+    zookeeper call it makes, so no single call can block past the deadline. Unlike signal.alarm, they work
+    from any thread and can be nested: entering a Deadline only affects the thread (or greenlet, under
+    gevent) that entered it, and the earliest active deadline wins. To carry a deadline into a worker pool,
+    enter the same Deadline object in the worker.
 
-class Timeout:
-    # From http://stackoverflow.com/questions/2281850/timeout-function-if-it-takes-too-long-to-finish
+    :param seconds: How long from now until the deadline
+    :param error_message: The message of the exception raised once the deadline has passed
+    :param exception: The type of exception to raise once the deadline has passed
+    """
 
-    def __init__(self, seconds=1, error_message='Timeout'):
+    def __init__(self, seconds, error_message='Timeout', exception=TimeoutError):
         self.seconds = seconds
+        self.expires_at = time.time() + seconds
         self.error_message = error_message
+        self.exception = exception
 
-    def handle_timeout(self, signum, frame):
-        raise TimeoutError(self.error_message)
+    def remaining(self):
+        return max(0.0, self.expires_at - time.time())
+
+    def expired(self):
+        return time.time() >= self.expires_at
+
+    def check(self):
+        if self.expired():
+            raise self.exception(self.error_message)
 
     def __enter__(self):
-        signal.signal(signal.SIGALRM, self.handle_timeout)
-        signal.alarm(self.seconds)
+        _active_deadlines().append(self)
+        return self
 
     def __exit__(self, type, value, traceback):
-        signal.alarm(0)
+        _active_deadlines().remove(self)
+
+
+def _active_deadlines():
+    if not hasattr(_deadlines, 'stack'):
+        _deadlines.stack = []
+    return _deadlines.stack
+
+
+def current_deadline():
+    """Returns the earliest Deadline active in this thread, or None if there is none."""
+    stack = _active_deadlines()
+    return min(stack, key=lambda deadline: deadline.expires_at) if stack else None
+
+
+def check_deadline():
+    """Raises the current deadline's exception if it has passed."""
+    deadline = current_deadline()
+    if deadline is not None:
+        deadline.check()
+
+
+def deadline_timeout(default=None):
+    """Returns the socket timeout to use for a blocking call made under the current deadline:
+    the time left until the deadline, or default if that is shorter (or there is no deadline).
+    Raises the deadline's exception if it has already passed, rather than returning a zero timeout."""
+    deadline = current_deadline()
+    if deadline is None:
+        return default
+    deadline.check()
+    remaining = deadline.remaining()
+    return remaining if default is None else min(default, remaining)
+
+
+def sleep_within_deadline(seconds):
+    """Like time.sleep, but never sleeps past the current deadline, and raises its exception once it is reached."""
+    check_deadline()
+    time.sleep(deadline_timeout(seconds))
+    check_deadline()
+
+
+def timeout(seconds=10, error_message=os.strerror(errno.ETIME)):
+    """A decorator that runs the function under a Deadline of the given number of seconds."""
+    def decorator(func):
+        def wrapper(*args, **kwargs):
+            with Deadline(seconds, error_message=error_message):
+                return func(*args, **kwargs)
+
+        return wraps(func)(wrapper)
+
+    return decorator
+
+
+class Timeout(Deadline):
+    """A contextmanager that runs its body under a Deadline of the given number of seconds."""
+
+    def __init__(self, seconds=1, error_message='Timeout'):
+        super(Timeout, self).__init__(seconds, error_message=error_message)
 
 
 def print_with_indent(line, indent=2):
@@ -1432,6 +1683,66 @@ def format_table(rows, min_spacing=2):
     return [(' ' * min_spacing).join(r) for r in expanded_rows]
 
 
+class LayeredConfig(Mapping):
+    """A read-only view of several dictionaries layered on top of each other, which resolves keys the way
+    deep_merge_dictionaries merges them, without copying any of them.
+
+    The first layer takes precedence. Where a key holds a dictionary, it is merged with the dictionaries
+    the layers below hold under the same key (down to the first layer where that key holds something
+    else), and returned as another LayeredConfig. Use materialize() to get a plain dict, e.g. to send
+    to Marathon or Chronos.
+
+    :param layers: The dictionaries to layer, most specific first
+    """
+
+    def __init__(self, *layers):
+        self.layers = layers
+
+    def __getitem__(self, key):
+        nested_layers = []
+        for layer in self.layers:
+            if key in layer:
+                value = layer[key]
+                if not isinstance(value, Mapping):
+                    if not nested_layers:
+                        return value
+                    break
+                nested_layers.append(value)
+        if not nested_layers:
+            raise KeyError(key)
+        return LayeredConfig(*nested_layers)
+
+    def __contains__(self, key):
+        return any(key in layer for layer in self.layers)
+
+    def __iter__(self):
+        seen = set()
+        for layer in self.layers:
+            for key in layer:
+                if key not in seen:
+                    seen.add(key)
+                    yield key
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __repr__(self):
+        return 'LayeredConfig(%r)' % self.materialize()
+
+    def materialize(self):
+        """Returns the merged dictionaries as a plain dict, with any nested LayeredConfigs materialized too."""
+        return dict((key, materialize(value)) for key, value in self.iteritems())
+
+
+def materialize(value):
+    """Returns a plain dict for a LayeredConfig (or any other mapping), and value itself otherwise."""
+    if isinstance(value, LayeredConfig):
+        return value.materialize()
+    elif isinstance(value, Mapping):
+        return dict((key, materialize(nested)) for key, nested in value.iteritems())
+    return value
+
+
 def deep_merge_dictionaries(overrides, defaults):
     """
     Merges two dictionaries.
@@ -1449,28 +1760,103 @@ def deep_merge_dictionaries(overrides, defaults):
     return result
 
 
+ZK_SESSION_TIMEOUT_S = 10.0  # seconds zookeeper keeps a session alive while its client is disconnected
+
+_zookeeper_sessions = {}
+_zookeeper_sessions_lock = threading.Lock()
+
+
+class ZookeeperSession(object):
+    """One KazooClient shared by everything in the process that talks to the same zookeeper hosts.
+
+    Callers borrow the client with lease(). The first lease starts the client and the last one to be released
+    stops it, so a lease held around a batch of work (a deploy run, an autoscaling pass, a cleanup) lets every
+    lock and read inside it reuse one TCP connection and one zookeeper session. Leases may be taken and
+    released from any thread.
+
+    Kazoo reconnects on its own after a connection drops; the session only notes when zookeeper expired it,
+    since every lock and ephemeral node taken through it is gone at that point.
+
+    :param read_only: Whether the client may connect to a zookeeper server in read-only mode, which lets reads
+                      go on while the ensemble has lost its quorum
+    """
+
+    def __init__(self, hosts, timeout=ZK_SESSION_TIMEOUT_S, read_only=False):
+        self.hosts = hosts
+        self.timeout = timeout
+        self.read_only = read_only
+        self.zk = None
+        self.leases = 0
+        self.expirations = 0
+        self.lock = threading.Lock()
+
+    def _on_state_change(self, state):
+        if state == KazooState.LOST:
+            self.expirations += 1
+            log.warning("Zookeeper session to %s expired; any locks held through it were released" % self.hosts)
+        elif state == KazooState.SUSPENDED:
+            log.warning("Lost connection to zookeeper at %s, reconnecting" % self.hosts)
+
+    def acquire(self):
+        """Takes a lease on the session, starting its client if nobody else holds one.
+
+        :returns: A started KazooClient"""
+        with self.lock:
+            if self.zk is None:
+                zk = KazooClient(hosts=self.hosts, timeout=self.timeout, read_only=self.read_only)
+                zk.add_listener(self._on_state_change)
+                with timed('zookeeper.connect'):
+                    zk.start()
+                self.zk = zk
+            self.leases += 1
+            return self.zk
+
+    def release(self):
+        """Gives back a lease taken with acquire(), stopping the client once the last one is returned."""
+        with self.lock:
+            self.leases -= 1
+            if self.leases == 0:
+                self.zk.stop()
+                self.zk.close()
+                self.zk = None
+
+    @contextlib.contextmanager
+    def lease(self):
+        zk = self.acquire()
+        try:
+            yield zk
+        finally:
+            self.release()
+
+
+def get_zookeeper_session(hosts=None, read_only=False):
+    """Returns the process-wide ZookeeperSession for the given zookeeper hosts.
+
+    :param hosts: A zookeeper connection string; defaults to the cluster's zookeeper from the system paasta config
+    :param read_only: Whether the session may connect to read-only servers; see ZookeeperSession
+    """
+    if hosts is None:
+        hosts = load_system_paasta_config().get_zk_hosts()
+    with _zookeeper_sessions_lock:
+        if (hosts, read_only) not in _zookeeper_sessions:
+            _zookeeper_sessions[(hosts, read_only)] = ZookeeperSession(hosts, read_only=read_only)
+        return _zookeeper_sessions[(hosts, read_only)]
+
+
 class ZookeeperPool(object):
     """
-    A context manager that shares the same KazooClient with its children. The first nested contest manager
-    creates and deletes the client and shares it with any of its children. This allows to place a context
-    manager over a large number of zookeeper calls without opening and closing a connection each time.
-    GIL makes this 'safe'.
+    A context manager that leases the cluster's shared read-only ZookeeperSession. Nested (or concurrent) pools share
+    the same KazooClient, which is only started by the first and stopped by the last. This allows to place
+    a context manager over a large number of zookeeper calls without opening and closing a connection each time.
     """
-    counter = 0
-    zk = None
-
-    @classmethod
-    def __enter__(cls):
-        if cls.zk is None:
-            cls.zk = KazooClient(hosts=load_system_paasta_config().get_zk_hosts(), read_only=True)
-            cls.zk.start()
-        cls.counter = cls.counter + 1
-        return cls.zk
-
-    @classmethod
-    def __exit__(cls, *args, **kwargs):
-        cls.counter = cls.counter - 1
-        if cls.counter == 0:
-            cls.zk.stop()
-            cls.zk.close()
-            cls.zk = None
+
+    def __init__(self):
+        self.session = None
+
+    def __enter__(self):
+        self.session = get_zookeeper_session(read_only=True)
+        return self.session.acquire()
+
+    def __exit__(self, *args, **kwargs):
+        self.session.release()
+        self.session = None
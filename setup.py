@@ -40,6 +40,7 @@ setup(
         # the Docker version deployed on PaaSTA servers
         'docker-py == 1.2.3',
         'dulwich == 0.10.0',
+        'futures >= 3.0.1',
         'humanize >= 0.5.1',
         'httplib2 >= 0.9, <= 1.0',
         'isodate >= 0.5.0',
@@ -49,6 +50,8 @@ setup(
         'mesos.cli == 0.1.5',
         'ordereddict >= 1.1',
         'path.py >= 8.1',
+        # The soa-configs watcher polls instead where inotify is not available.
+        'pyinotify >= 0.9.6; sys_platform == "linux2"',
         'pysensu-yelp >= 0.2.2',
         'pytimeparse >= 1.1.0',
         'python-dateutil >= 2.4.0',
@@ -62,6 +65,7 @@ setup(
     ],
     scripts=[
         'paasta_tools/am_i_mesos_leader.py',
+        'paasta_tools/api_recorder.py',
         'paasta_tools/autoscale_all_services.py',
         'paasta_tools/check_marathon_services_replication.py',
         'paasta_tools/check_mesos_resource_utilization.py',
@@ -73,14 +77,17 @@ setup(
         'paasta_tools/generate_services_file.py',
         'paasta_tools/generate_services_yaml.py',
         'paasta_tools/list_marathon_service_instances.py',
+        'paasta_tools/marathon_deployer.py',
         'paasta_tools/monitoring/check_classic_service_replication.py',
         'paasta_tools/monitoring/check_synapse_replication.py',
         'paasta_tools/cli/paasta_tabcomplete.sh',
+        'paasta_tools/paasta_capacity.py',
         'paasta_tools/paasta_execute_docker_command.py',
         'paasta_tools/paasta_maintenance.py',
         'paasta_tools/paasta_metastatus.py',
         'paasta_tools/paasta_serviceinit.py',
         'paasta_tools/setup_marathon_job.py',
+        'paasta_tools/soa_config_deployer.py',
         'paasta_tools/synapse_srv_namespaces_fact.py',
     ] + glob.glob('paasta_tools/contrib/*'),
     package_data={'': ['cli/fsm/template/*/*', 'cli/schemas/*.json']},
@@ -0,0 +1,83 @@
+# Copyright 2015-2016 Yelp Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import array
+import contextlib
+
+import mock
+
+from paasta_tools.autoscaling_history import HistoryColumns
+from paasta_tools.autoscaling_simulator import SimulationResult
+from paasta_tools.cli.cmds import autoscale_sim
+from paasta_tools.marathon_tools import MarathonServiceConfig
+
+
+def make_args(**kwargs):
+    args = dict(service='fake_service', instance='main', cluster='fake_cluster', history_file=None,
+                policies=None, slo_utilization=0.9, days=None, yelpsoa_config_root='/fake/soa')
+    args.update(kwargs)
+    return mock.Mock(**args)
+
+
+def make_history(count):
+    return HistoryColumns(
+        timestamp=array.array('L', range(0, 300 * count, 300)),
+        utilization=array.array('d', [0.5] * count),
+        error=array.array('d', [0.0] * count),
+        instances=array.array('H', [2] * count),
+        decision=array.array('h', [0] * count),
+    )
+
+
+def test_format_results():
+    lines = autoscale_sim.format_results([SimulationResult('recorded', 10.0, 2.25, 5.0, 3)])
+    assert lines[0].split() == ['Policy', 'Instance-hours', 'Over-provisioned', 'instance-hours', 'SLO-violation',
+                                'minutes', 'Scaling', 'actions']
+    assert lines[1].split() == ['recorded', '10.0', '2.2', '5.0', '3']
+
+
+def test_paasta_autoscale_sim(capsys):
+    service_config = MarathonServiceConfig('fake_service', 'fake_cluster', 'main',
+                                           {'min_instances': 1, 'max_instances': 5}, {})
+    with contextlib.nested(
+        mock.patch('paasta_tools.cli.cmds.autoscale_sim.figure_out_service_name', autospec=True,
+                   return_value='fake_service'),
+        mock.patch('paasta_tools.cli.cmds.autoscale_sim.load_marathon_service_config', autospec=True,
+                   return_value=service_config),
+        mock.patch('paasta_tools.cli.cmds.autoscale_sim.load_system_paasta_config', autospec=True),
+        mock.patch('paasta_tools.cli.cmds.autoscale_sim.AutoscalingHistory', autospec=True),
+        mock.patch('paasta_tools.cli.cmds.autoscale_sim.simulate', autospec=True,
+                   return_value=[SimulationResult('recorded', 1.0, 0.0, 0.0, 0)]),
+    ) as (
+        _,
+        _,
+        mock_load_system_paasta_config,
+        mock_history,
+        mock_simulate,
+    ):
+        mock_load_system_paasta_config.return_value.get_autoscaling_history_dir.return_value = '/fake/history'
+        mock_history.return_value.read.return_value = make_history(3)
+        assert autoscale_sim.paasta_autoscale_sim(make_args(policies=['threshold'])) == 0
+        mock_history.assert_called_once_with('/fake/history/fake_service.main.history')
+        mock_history.return_value.read.assert_called_once_with(since=None)
+        assert mock_simulate.call_args[0][1].keys() == ['threshold']
+        assert mock_simulate.call_args[1]['min_instances'] == 1
+        assert mock_simulate.call_args[1]['max_instances'] == 5
+        assert 'Replayed 3 autoscaling decisions for fake_service.main' in capsys.readouterr()[0]
+
+        mock_history.reset_mock()
+        mock_history.return_value.read.return_value = make_history(1)
+        assert autoscale_sim.paasta_autoscale_sim(make_args(history_file='/copy.history', days=1)) == 1
+        mock_history.assert_called_once_with('/copy.history')
+        assert mock_history.return_value.read.call_args[1]['since'] is not None
+        assert 'Not enough autoscaling history' in capsys.readouterr()[0]
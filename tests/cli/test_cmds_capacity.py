@@ -0,0 +1,56 @@
+# Copyright 2015-2016 Yelp Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import argparse
+import contextlib
+from StringIO import StringIO
+
+import mock
+
+from paasta_tools.cli.cmds import capacity
+
+
+def make_args(clusters=None, scale=1.0, instance_counts=()):
+    return argparse.Namespace(clusters=clusters, scale=scale, instance_counts=list(instance_counts),
+                              soa_dir='fake_soa_dir')
+
+
+def test_paasta_capacity():
+    with contextlib.nested(
+        mock.patch('paasta_tools.cli.cmds.capacity.load_system_paasta_config', autospec=True),
+        mock.patch('paasta_tools.cli.cmds.capacity.list_clusters', autospec=True,
+                   return_value=['cluster1', 'cluster2']),
+        mock.patch('paasta_tools.cli.cmds.capacity.execute_paasta_capacity_on_remote_master', autospec=True,
+                   return_value='Pool default: 1 hosts'),
+        mock.patch('sys.stdout', new_callable=StringIO),
+    ) as (mock_load_system_paasta_config, mock_list_clusters, mock_execute, mock_stdout):
+        assert capacity.paasta_capacity(make_args(scale=2.0, instance_counts=['svc.main=3'])) == 0
+        mock_list_clusters.assert_called_once_with(soa_dir='fake_soa_dir')
+        assert mock_execute.call_args_list == [
+            mock.call(cluster, mock_load_system_paasta_config.return_value, scale=2.0,
+                      instance_counts=['svc.main=3'])
+            for cluster in ('cluster1', 'cluster2')
+        ]
+        assert 'Cluster: cluster2\nPool default: 1 hosts' in mock_stdout.getvalue()
+
+
+def test_paasta_capacity_with_an_unknown_cluster():
+    with contextlib.nested(
+        mock.patch('paasta_tools.cli.cmds.capacity.load_system_paasta_config', autospec=True),
+        mock.patch('paasta_tools.cli.cmds.capacity.list_clusters', autospec=True, return_value=['cluster1']),
+        mock.patch('paasta_tools.cli.cmds.capacity.execute_paasta_capacity_on_remote_master', autospec=True),
+        mock.patch('sys.stdout', new_callable=StringIO),
+    ) as (_, __, mock_execute, mock_stdout):
+        assert capacity.paasta_capacity(make_args(clusters='cluster1,nope')) == 1
+        assert [call[0][0] for call in mock_execute.call_args_list] == ['cluster1']
+        assert "Cluster nope doesn't look like a valid cluster?" in mock_stdout.getvalue()
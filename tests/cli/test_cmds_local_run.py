@@ -106,29 +106,33 @@ def test_perform_tcp_healthcheck_failure(mock_socket_connect):
     assert '10 seconds' in actual[1]
 
 
-@mock.patch('requests.head')
-def test_perform_http_healthcheck_success(mock_http_conn):
+@mock.patch('paasta_tools.cli.cmds.local_run.get_http_client', autospec=True)
+def test_perform_http_healthcheck_success(mock_get_http_client):
+    mock_http_conn = mock_get_http_client.return_value.head
     fake_http_url = "http://fakehost:1234/fake_status_path"
     fake_timeout = 10
 
     mock_http_conn.return_value = mock.Mock(status_code=200, headers={})
     assert perform_http_healthcheck(fake_http_url, fake_timeout)
-    mock_http_conn.assert_called_once_with(fake_http_url)
+    mock_http_conn.assert_called_once_with(fake_http_url, timeout=fake_timeout, endpoint='local_run.healthcheck')
 
 
-@mock.patch('requests.head')
-def test_perform_http_healthcheck_failure(mock_http_conn):
+@mock.patch('paasta_tools.cli.cmds.local_run.get_http_client', autospec=True)
+def test_perform_http_healthcheck_failure(mock_get_http_client):
+    mock_http_conn = mock_get_http_client.return_value.head
     fake_http_url = "http://fakehost:1234/fake_status_path"
     fake_timeout = 10
 
     mock_http_conn.return_value = mock.Mock(status_code=400, headers={})
     result, reason = perform_http_healthcheck(fake_http_url, fake_timeout)
     assert result is False
-    mock_http_conn.assert_called_once_with(fake_http_url)
+    mock_http_conn.assert_called_once_with(fake_http_url, timeout=fake_timeout, endpoint='local_run.healthcheck')
 
 
-@mock.patch('requests.head', side_effect=TimeoutError)
-def test_perform_http_healthcheck_timeout(mock_http_conn):
+@mock.patch('paasta_tools.cli.cmds.local_run.get_http_client', autospec=True)
+def test_perform_http_healthcheck_timeout(mock_get_http_client):
+    mock_http_conn = mock_get_http_client.return_value.head
+    mock_http_conn.side_effect = TimeoutError
     fake_http_url = "http://fakehost:1234/fake_status_path"
     fake_timeout = 10
 
@@ -136,11 +140,12 @@ def test_perform_http_healthcheck_timeout(mock_http_conn):
     assert actual[0] is False
     assert "10" in actual[1]
     assert "timed out" in actual[1]
-    mock_http_conn.assert_called_once_with(fake_http_url)
+    mock_http_conn.assert_called_once_with(fake_http_url, timeout=fake_timeout, endpoint='local_run.healthcheck')
 
 
-@mock.patch('requests.head')
-def test_perform_http_healthcheck_failure_with_multiple_content_type(mock_http_conn):
+@mock.patch('paasta_tools.cli.cmds.local_run.get_http_client', autospec=True)
+def test_perform_http_healthcheck_failure_with_multiple_content_type(mock_get_http_client):
+    mock_http_conn = mock_get_http_client.return_value.head
     fake_http_url = "http://fakehost:1234/fake_status_path"
     fake_timeout = 10
 
@@ -149,7 +154,7 @@ def test_perform_http_healthcheck_failure_with_multiple_content_type(mock_http_c
     actual = perform_http_healthcheck(fake_http_url, fake_timeout)
     assert actual[0] is False
     assert "200" in actual[1]
-    mock_http_conn.assert_called_once_with(fake_http_url)
+    mock_http_conn.assert_called_once_with(fake_http_url, timeout=fake_timeout, endpoint='local_run.healthcheck')
 
 
 @mock.patch('paasta_tools.cli.cmds.local_run.perform_http_healthcheck')
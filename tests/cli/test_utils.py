@@ -334,6 +334,66 @@ def test_execute_paasta_metastatus_on_remote_no_connectable_master(
     assert "fake_err_msg" in actual
 
 
+@patch('paasta_tools.cli.utils._run', autospec=True)
+def test_run_paasta_capacity(mock_run):
+    mock_run.return_value = ('unused', 'fake_output')
+    actual = utils.run_paasta_capacity('fake_master')
+    mock_run.assert_called_once_with('ssh -A -n fake_master sudo paasta_capacity', timeout=120)
+    assert actual == 'fake_output'
+
+
+@patch('paasta_tools.cli.utils._run', autospec=True)
+def test_run_paasta_capacity_what_if(mock_run):
+    mock_run.return_value = ('unused', 'fake_output')
+    utils.run_paasta_capacity('fake_master', scale=1.5, instance_counts=['svc.main=3', 'svc.canary=1; rm'])
+    mock_run.assert_called_once_with(
+        "ssh -A -n fake_master sudo paasta_capacity --scale 1.5 --instances svc.main=3 "
+        "--instances 'svc.canary=1; rm'",
+        timeout=120,
+    )
+
+
+@patch('paasta_tools.cli.utils.calculate_remote_masters', autospec=True)
+@patch('paasta_tools.cli.utils.find_connectable_master', autospec=True)
+@patch('paasta_tools.cli.utils.run_paasta_capacity', autospec=True)
+def test_execute_paasta_capacity_on_remote_master(
+    mock_run_paasta_capacity,
+    mock_find_connectable_master,
+    mock_calculate_remote_masters,
+):
+    mock_calculate_remote_masters.return_value = (['fake_master1', 'fake_master2'], None)
+    mock_find_connectable_master.return_value = ('fake_connectable_master', None)
+    fake_system_paasta_config = SystemPaastaConfig({}, '/fake/config')
+
+    actual = utils.execute_paasta_capacity_on_remote_master('fake_cluster_name', fake_system_paasta_config,
+                                                            scale=2.0, instance_counts=['svc.main=3'])
+    mock_calculate_remote_masters.assert_called_once_with('fake_cluster_name', fake_system_paasta_config)
+    mock_find_connectable_master.assert_called_once_with(['fake_master1', 'fake_master2'])
+    mock_run_paasta_capacity.assert_called_once_with('fake_connectable_master', 2.0, ['svc.main=3'])
+    assert actual == mock_run_paasta_capacity.return_value
+
+
+@patch('paasta_tools.cli.utils.calculate_remote_masters', autospec=True)
+@patch('paasta_tools.cli.utils.find_connectable_master', autospec=True)
+@patch('paasta_tools.cli.utils.run_paasta_capacity', autospec=True)
+def test_execute_paasta_capacity_on_remote_master_errors(
+    mock_run_paasta_capacity,
+    mock_find_connectable_master,
+    mock_calculate_remote_masters,
+):
+    fake_system_paasta_config = SystemPaastaConfig({}, '/fake/config')
+    mock_calculate_remote_masters.return_value = ([], 'fake_dns_error')
+    assert utils.execute_paasta_capacity_on_remote_master('fake_cluster_name', fake_system_paasta_config) == \
+        'ERROR: fake_dns_error'
+
+    mock_calculate_remote_masters.return_value = (['fake_master'], None)
+    mock_find_connectable_master.return_value = (None, 'fake_err_msg')
+    actual = utils.execute_paasta_capacity_on_remote_master('fake_cluster_name', fake_system_paasta_config)
+    assert 'ERROR: could not find connectable master in cluster fake_cluster_name' in actual
+    assert 'fake_err_msg' in actual
+    assert mock_run_paasta_capacity.call_count == 0
+
+
 @mark.parametrize('test_case', [
     [
         (['fake_master1', 'fake_master2'], None),  # OK
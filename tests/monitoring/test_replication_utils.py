@@ -14,7 +14,6 @@
 import os
 
 import mock
-import requests
 
 from paasta_tools.monitoring.replication_utils import backend_is_up
 from paasta_tools.monitoring.replication_utils import get_registered_marathon_tasks
@@ -32,9 +31,8 @@ def test_get_replication_for_service():
 
     mock_response = mock.Mock()
     mock_response.text = mock_haproxy_data
-    mock_get = mock.Mock(return_value=(mock_response))
-
-    with mock.patch.object(requests.Session, 'get', mock_get):
+    with mock.patch('paasta_tools.smartstack_tools.get_http_client', autospec=True) as mock_get_http_client:
+        mock_get_http_client.return_value.get.return_value = mock_response
         replication_result = get_replication_for_services(
             'fake_host',
             6666,
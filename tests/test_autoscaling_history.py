@@ -0,0 +1,88 @@
+# Copyright 2015-2016 Yelp Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import os
+
+import mock
+
+from paasta_tools import autoscaling_history
+from paasta_tools.autoscaling_history import AutoscalingHistory
+from paasta_tools.autoscaling_history import HistoryRecord
+
+
+def make_record(timestamp, instances=3, decision=0):
+    return HistoryRecord(timestamp=timestamp, utilization=0.5, error=-0.25, instances=instances, decision=decision)
+
+
+def test_encode_and_decode_records():
+    data = ''.join(autoscaling_history.encode_record(make_record(ts, instances=ts - 99)) for ts in (100, 200))
+    assert len(data) == 2 * autoscaling_history.RECORD_SIZE
+    columns = autoscaling_history.decode_records(data)
+    assert columns.records() == [
+        HistoryRecord(timestamp=100, utilization=0.5, error=-0.25, instances=1, decision=0),
+        HistoryRecord(timestamp=200, utilization=0.5, error=-0.25, instances=101, decision=0),
+    ]
+    assert list(columns.instances) == [1, 101]
+
+
+def test_decode_records_ignores_a_torn_record():
+    data = autoscaling_history.encode_record(make_record(100))
+    assert len(autoscaling_history.decode_records(data + data[:5])) == 1
+    assert len(autoscaling_history.decode_records(data[:5])) == 0
+
+
+def test_encode_record_clamps_counts():
+    record = HistoryRecord(timestamp=1, utilization=1.0, error=0.0, instances=-1, decision=100000)
+    decoded = autoscaling_history.decode_records(autoscaling_history.encode_record(record)).records()[0]
+    assert decoded.instances == 0
+    assert decoded.decision == 0x7fff
+
+
+def test_get_history_path():
+    assert autoscaling_history.get_history_path('fake_service', 'main', '/fake/dir') == \
+        '/fake/dir/fake_service.main.history'
+
+
+def test_history_append_and_read(tmpdir):
+    history = AutoscalingHistory(str(tmpdir.join('nested', 'svc.main.history')))
+    assert len(history.read()) == 0
+    for ts in (100, 200, 300):
+        history.append(make_record(ts, decision=1))
+    assert [record.timestamp for record in history.read().records()] == [100, 200, 300]
+    assert list(history.read(since=200).timestamp) == [200, 300]
+    assert list(history.read(since=301).timestamp) == []
+
+
+def test_find_first_record_since(tmpdir):
+    history = AutoscalingHistory(str(tmpdir.join('svc.main.history')))
+    for ts in range(100, 1100, 100):
+        history.append(make_record(ts))
+    with open(history.path, 'rb') as f:
+        assert autoscaling_history.find_first_record_since(f, 0) == 0
+        assert autoscaling_history.find_first_record_since(f, 100) == 0
+        assert autoscaling_history.find_first_record_since(f, 101) == 1
+        assert autoscaling_history.find_first_record_since(f, 1000) == 9
+        assert autoscaling_history.find_first_record_since(f, 1001) == 10
+
+
+def test_history_compacts_once_past_the_slack(tmpdir):
+    history = AutoscalingHistory(str(tmpdir.join('svc.main.history')), max_records=10)
+    with mock.patch.object(AutoscalingHistory, 'compact', autospec=True,
+                           side_effect=AutoscalingHistory.compact) as mock_compact:
+        for ts in range(11):
+            history.append(make_record(ts))
+        assert mock_compact.call_count == 0
+        history.append(make_record(11))
+        assert mock_compact.call_count == 1
+    assert list(history.read().timestamp) == list(range(2, 12))
+    assert os.path.getsize(history.path) == 10 * autoscaling_history.RECORD_SIZE
@@ -11,6 +11,7 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+import array
 import contextlib
 from datetime import datetime
 from datetime import timedelta
@@ -21,6 +22,9 @@ from pytest import raises
 
 from paasta_tools import autoscaling_lib
 from paasta_tools import marathon_tools
+from paasta_tools.autoscaling_history import AutoscalingHistory
+from paasta_tools.autoscaling_history import get_history_path
+from paasta_tools.autoscaling_history import HistoryColumns
 
 
 def test_get_zookeeper_instances():
@@ -151,6 +155,10 @@ def test_get_decision_policy():
     assert autoscaling_lib.get_decision_policy('pid') == autoscaling_lib.pid_decision_policy
 
 
+def test_get_decision_policy_names():
+    assert autoscaling_lib.get_decision_policy_names() == ['pid', 'predictive', 'threshold']
+
+
 def test_pid_decision_policy():
     current_time = datetime.now()
 
@@ -184,6 +192,119 @@ def test_pid_decision_policy():
         ], any_order=True)
 
 
+def test_pid_decision_policy_with_policy_state():
+    policy_state = autoscaling_lib.InMemoryPolicyState()
+    assert autoscaling_lib.pid_decision_policy(None, 10, 1, 100, 0.0, policy_state=policy_state,
+                                               current_time=1000) == 0
+    assert policy_state.values == {'pid_iterm': 0.0, 'pid_last_error': 0.0, 'pid_last_time': 1000}
+    assert autoscaling_lib.pid_decision_policy(None, 10, 1, 100, 0.2, policy_state=policy_state,
+                                               current_time=1600) == 1
+    assert policy_state.values['pid_last_error'] == 0.2
+    assert policy_state.values['pid_last_time'] == 1600
+
+
+def test_in_memory_policy_state():
+    policy_state = autoscaling_lib.InMemoryPolicyState()
+    assert policy_state.load(['a', 'b']) == {'a': 0.0, 'b': 0.0}
+    policy_state.save({'a': 1.5})
+    assert policy_state.load(['a', 'b']) == {'a': 0.0, 'b': 0.0}
+    policy_state.save({'b': 2.5})
+    assert policy_state.load(['a', 'b']) == {'a': 1.5, 'b': 2.5}
+
+
+def make_history(points):
+    """Builds HistoryColumns from (timestamp, utilization, instances) tuples."""
+    timestamps, utilizations, instances = zip(*points) if points else ((), (), ())
+    return HistoryColumns(
+        timestamp=array.array('L', timestamps),
+        utilization=array.array('d', utilizations),
+        error=array.array('d', [0.0] * len(points)),
+        instances=array.array('H', instances),
+        decision=array.array('h', [0] * len(points)),
+    )
+
+
+def test_get_needed_instances():
+    assert autoscaling_lib.get_needed_instances(4.0, 0.8) == 5
+    assert autoscaling_lib.get_needed_instances(8.0 * 0.8, 0.8) == 8
+    assert autoscaling_lib.get_needed_instances(0.1, 0.8, 3) == 3
+
+
+def test_get_loads_between():
+    history = make_history([(100, 0.5, 4), (200, 0.25, 4), (300, 1.0, 2)])
+    timestamps, loads = autoscaling_lib.get_loads_between(history, 150, 300)
+    assert list(timestamps) == [200]
+    assert loads == [1.0]
+
+
+def test_get_load_at():
+    history = make_history([(1000, 0.5, 4), (2000, 0.25, 4)])
+    assert autoscaling_lib.get_load_at(history, 1100) == 2.0
+    assert autoscaling_lib.get_load_at(history, 1900) == 1.0
+    assert autoscaling_lib.get_load_at(history, 1500) is None
+    assert autoscaling_lib.get_load_at(history, 500) is None
+    assert autoscaling_lib.get_load_at(make_history([]), 1000) is None
+
+
+def test_forecast_load_from_trend():
+    # Load grows by one instance's worth every five minutes.
+    assert autoscaling_lib.forecast_load_from_trend([400, 700], [2.0, 3.0], 1000, 4.0, 600) == 6.0
+    assert autoscaling_lib.forecast_load_from_trend([700], [3.0], 1000, 4.0, 600) is None
+    assert autoscaling_lib.forecast_load_from_trend([400, 700], [6.0, 3.0], 1000, 0.0, 600) == 0.0
+
+
+def test_forecast_load_from_seasonality():
+    day = 24 * 60 * 60
+    now = 10 * day
+    # Yesterday, load went from 2 to 3 over the next ten minutes; two days ago from 2 to 5.
+    history = make_history([
+        (now - 2 * day, 1.0, 2), (now - 2 * day + 600, 1.0, 5),
+        (now - day, 1.0, 2), (now - day + 600, 1.0, 3),
+    ])
+    assert autoscaling_lib.forecast_load_from_seasonality(history, now, 4.0, 600, 7) == 8.0
+    assert autoscaling_lib.forecast_load_from_seasonality(history, now, 4.0, 600, 1) == 6.0
+    assert autoscaling_lib.forecast_load_from_seasonality(make_history([]), now, 4.0, 600, 7) is None
+
+
+def test_predictive_decision_policy_without_history():
+    # A load of 4 instances' worth needs 8 instances at 0.5.
+    assert autoscaling_lib.predictive_decision_policy(
+        current_instances=4, min_instances=1, max_instances=100, utilization=1.0, setpoint=0.5,
+        current_time=1000) == 1
+    assert autoscaling_lib.predictive_decision_policy(
+        current_instances=4, min_instances=1, max_instances=100, utilization=1.0, setpoint=0.5,
+        current_time=1000, max_step=10) == 4
+    assert autoscaling_lib.predictive_decision_policy(
+        current_instances=4, min_instances=1, max_instances=6, utilization=1.0, setpoint=0.5,
+        current_time=1000, max_step=10) == 2
+    assert autoscaling_lib.predictive_decision_policy(
+        current_instances=10, min_instances=1, max_instances=100, utilization=0.2, setpoint=0.5,
+        current_time=1000, max_step=10) == -6
+    assert autoscaling_lib.predictive_decision_policy(
+        current_instances=4, min_instances=1, max_instances=100, utilization=0.5, setpoint=0.5,
+        current_time=1000) == 0
+
+
+def test_predictive_decision_policy_scales_ahead_of_the_trend():
+    # Load is 4 instances' worth now, right at the setpoint, but has grown by one every five minutes.
+    history = make_history([(100, 1.0, 1), (400, 1.0, 2), (700, 1.0, 3)])
+    assert autoscaling_lib.predictive_decision_policy(
+        current_instances=8, min_instances=1, max_instances=100, utilization=0.5, setpoint=0.5,
+        current_time=1000, history=history, max_step=10) == 4
+    # The trend never drives a scale down.
+    history = make_history([(100, 1.0, 7), (400, 1.0, 6), (700, 1.0, 5)])
+    assert autoscaling_lib.predictive_decision_policy(
+        current_instances=8, min_instances=1, max_instances=100, utilization=0.5, setpoint=0.5,
+        current_time=1000, history=history, max_step=10) == 0
+
+
+def test_predictive_decision_policy_ignores_history_after_current_time():
+    history = make_history([(1300, 1.0, 5), (1600, 1.0, 6), (1900, 1.0, 7)])
+    assert autoscaling_lib.predictive_decision_policy(
+        current_instances=8, min_instances=1, max_instances=100, utilization=0.5, setpoint=0.5,
+        current_time=1000, history=history, max_step=10) == 0
+
+
 def test_threshold_decision_policy():
     decision_policy_args = {
         'threshold': 0.1,
@@ -235,7 +356,9 @@ def test_mesos_cpu_metrics_provider():
             autoscaling_lib.mesos_cpu_metrics_provider(
                 fake_marathon_service_config, fake_marathon_tasks, (fake_mesos_task,))
         mock_zk_client.return_value.set.assert_has_calls([
-            mock.call('/autoscaling/fake-service/fake-instance/cpu_data', '480.0:fake-service.fake-instance'),
+            mock.call('/autoscaling/fake-service/fake-instance/cpu_data', autoscaling_lib.encode_cpu_data({
+                autoscaling_lib.get_task_id_hash('fake-service.fake-instance'): 480.0,
+            })),
         ], any_order=True)
 
 
@@ -282,10 +405,129 @@ def test_mesos_cpu_metrics_provider_no_previous_cpu_data():
             fake_marathon_service_config, fake_marathon_tasks, (fake_mesos_task,)) == 0.8
         mock_zk_client.return_value.set.assert_has_calls([
             mock.call('/autoscaling/fake-service/fake-instance/cpu_last_time', current_time.strftime('%s')),
-            mock.call('/autoscaling/fake-service/fake-instance/cpu_data', '480.0:fake-service.fake-instance'),
+            mock.call('/autoscaling/fake-service/fake-instance/cpu_data', autoscaling_lib.encode_cpu_data({
+                autoscaling_lib.get_task_id_hash('fake-service.fake-instance'): 480.0,
+            })),
         ], any_order=True)
 
 
+def test_mesos_cpu_metrics_provider_reads_encoded_cpu_data():
+    fake_marathon_service_config = marathon_tools.MarathonServiceConfig(
+        service='fake-service',
+        instance='fake-instance',
+        cluster='fake-cluster',
+        config_dict={},
+        branch_dict={},
+    )
+    fake_mesos_tasks = []
+    for task_id, cpu_seconds in (('fake-service.fake-instance.1', 240), ('fake-service.fake-instance.2', 480)):
+        fake_mesos_task = mock.MagicMock(stats={'cpus_limit': 1.1, 'cpus_user_time_secs': cpu_seconds})
+        fake_mesos_task.__getitem__.return_value = task_id
+        fake_mesos_tasks.append(fake_mesos_task)
+    current_time = datetime.now()
+    zookeeper_get_payload = {
+        'cpu_last_time': (current_time - timedelta(seconds=600)).strftime('%s'),
+        # Only the first task ran last time.
+        'cpu_data': autoscaling_lib.encode_cpu_data({
+            autoscaling_lib.get_task_id_hash('fake-service.fake-instance.1'): 60.0,
+            autoscaling_lib.get_task_id_hash('fake-service.fake-instance.gone'): 0.0,
+        }),
+    }
+    with contextlib.nested(
+            mock.patch('paasta_tools.utils.KazooClient', autospec=True,
+                       return_value=mock.Mock(get=mock.Mock(
+                           side_effect=lambda x: (zookeeper_get_payload[x.split('/')[-1]], None)))),
+            mock.patch('paasta_tools.autoscaling_lib.datetime', autospec=True),
+            mock.patch('paasta_tools.utils.load_system_paasta_config', autospec=True,
+                       return_value=mock.Mock(get_zk_hosts=mock.Mock())),
+    ) as (
+        _,
+        mock_datetime,
+        __,
+    ):
+        mock_datetime.now.return_value = current_time
+        assert autoscaling_lib.mesos_cpu_metrics_provider(
+            fake_marathon_service_config, [], fake_mesos_tasks) == (240.0 - 60.0) / 600
+
+
+def test_mesos_cpu_metrics_provider_ignores_corrupt_cpu_data():
+    fake_marathon_service_config = marathon_tools.MarathonServiceConfig(
+        service='fake-service',
+        instance='fake-instance',
+        cluster='fake-cluster',
+        config_dict={},
+        branch_dict={},
+    )
+    fake_mesos_task = mock.MagicMock(stats={'cpus_limit': 1.1, 'cpus_user_time_secs': 240})
+    fake_mesos_task.__getitem__.return_value = 'fake-service.fake-instance'
+    zookeeper_get_payload = {
+        'cpu_last_time': '0',
+        'cpu_data': '\x01\x00\x05\x00\x00\x00',
+    }
+    with contextlib.nested(
+            mock.patch('paasta_tools.utils.KazooClient', autospec=True,
+                       return_value=mock.Mock(get=mock.Mock(
+                           side_effect=lambda x: (zookeeper_get_payload[x.split('/')[-1]], None)))),
+            mock.patch('paasta_tools.utils.load_system_paasta_config', autospec=True,
+                       return_value=mock.Mock(get_zk_hosts=mock.Mock())),
+            mock.patch('paasta_tools.autoscaling_lib.log', autospec=True),
+    ) as (
+        _,
+        __,
+        mock_log,
+    ):
+        with raises(autoscaling_lib.MetricsProviderNoDataError):
+            autoscaling_lib.mesos_cpu_metrics_provider(fake_marathon_service_config, [], [fake_mesos_task])
+        assert mock_log.warning.call_count == 1
+
+
+def test_encode_cpu_data_round_trips():
+    cpu_data = dict((autoscaling_lib.get_task_id_hash('fake-service.fake-instance.%d' % index), index * 1.5)
+                    for index in range(1000))
+    for compress in (True, False):
+        assert autoscaling_lib.decode_cpu_data(autoscaling_lib.encode_cpu_data(cpu_data, compress=compress)) == \
+            cpu_data
+    assert autoscaling_lib.decode_cpu_data(autoscaling_lib.encode_cpu_data({})) == {}
+
+
+def test_encode_cpu_data_is_compact():
+    cpu_data = dict((autoscaling_lib.get_task_id_hash('fake-service.fake-instance.%d' % index), 123456.789)
+                    for index in range(1000))
+    uncompressed = autoscaling_lib.encode_cpu_data(cpu_data, compress=False)
+    assert len(uncompressed) == autoscaling_lib.CPU_DATA_HEADER.size + 16 * 1000
+    compressed = autoscaling_lib.encode_cpu_data(cpu_data)
+    assert len(compressed) < len(uncompressed)
+    assert autoscaling_lib.CPU_DATA_HEADER.unpack(compressed[:autoscaling_lib.CPU_DATA_HEADER.size]) == (
+        autoscaling_lib.CPU_DATA_VERSION, autoscaling_lib.CPU_DATA_COMPRESSED, 1000)
+
+
+def test_encode_cpu_data_only_compresses_when_it_helps():
+    encoded = autoscaling_lib.encode_cpu_data({autoscaling_lib.get_task_id_hash('fake-service.fake-instance'): 0.1})
+    assert autoscaling_lib.CPU_DATA_HEADER.unpack(encoded[:autoscaling_lib.CPU_DATA_HEADER.size]) == (
+        autoscaling_lib.CPU_DATA_VERSION, 0, 1)
+
+
+def test_decode_cpu_data_reads_csv():
+    assert autoscaling_lib.decode_cpu_data('480.0:fake-service.fake-instance.1,0:fake-service.fake-instance.2,') == {
+        autoscaling_lib.get_task_id_hash('fake-service.fake-instance.1'): 480.0,
+        autoscaling_lib.get_task_id_hash('fake-service.fake-instance.2'): 0.0,
+    }
+    assert autoscaling_lib.decode_cpu_data('') == {}
+
+
+def test_decode_cpu_data_rejects_bad_data():
+    valid = autoscaling_lib.encode_cpu_data({1: 2.0, 3: 4.0}, compress=False)
+    for data in (
+        '\x01\x00',  # a truncated header
+        '\x02' + valid[1:],  # an unknown version
+        valid[:-1],  # a truncated body
+        valid[:1] + chr(autoscaling_lib.CPU_DATA_COMPRESSED) + valid[2:],  # a body that is not compressed
+        'not csv',
+    ):
+        with raises(ValueError):
+            autoscaling_lib.decode_cpu_data(data)
+
+
 def test_http_metrics_provider():
     fake_marathon_service_config = marathon_tools.MarathonServiceConfig(
         service='fake-service',
@@ -296,9 +538,12 @@ def test_http_metrics_provider():
     )
     fake_marathon_tasks = [mock.Mock(id='fake-service.fake-instance', host='fake_host', ports=[30101])]
     mock_request_result = mock.Mock(json=mock.Mock(return_value={'utilization': '0.5'}))
-    with mock.patch('paasta_tools.autoscaling_lib.requests.get', autospec=True, return_value=mock_request_result):
+    with mock.patch('paasta_tools.autoscaling_lib.get_http_client', autospec=True) as mock_get_http_client:
+        mock_get_http_client.return_value.get.return_value = mock_request_result
         assert autoscaling_lib.http_metrics_provider(
             fake_marathon_service_config, fake_marathon_tasks, mock.Mock()) == 0.5
+        mock_get_http_client.return_value.get.assert_called_once_with(
+            'http://fake_host:30101/status', endpoint='autoscaling.http_metrics')
 
 
 def test_http_metrics_provider_no_data():
@@ -311,7 +556,8 @@ def test_http_metrics_provider_no_data():
     )
     fake_marathon_tasks = [mock.Mock(id='fake-service.fake-instance', host='fake_host', ports=[30101])]
     mock_request_result = mock.Mock(json=mock.Mock(return_value='malformed_result'))
-    with mock.patch('paasta_tools.autoscaling_lib.requests.get', autospec=True, return_value=mock_request_result):
+    with mock.patch('paasta_tools.autoscaling_lib.get_http_client', autospec=True) as mock_get_http_client:
+        mock_get_http_client.return_value.get.return_value = mock_request_result
         with raises(autoscaling_lib.MetricsProviderNoDataError):
             autoscaling_lib.http_metrics_provider(fake_marathon_service_config, fake_marathon_tasks, mock.Mock()) == 0.5
 
@@ -370,6 +616,65 @@ def test_autoscale_marathon_instance():
             service='fake-service', instance='fake-instance', instance_count=2)
 
 
+def test_autoscale_marathon_instance_records_history(tmpdir):
+    fake_marathon_service_config = marathon_tools.MarathonServiceConfig(
+        service='fake-service',
+        instance='fake-instance',
+        cluster='fake-cluster',
+        config_dict={'min_instances': 1, 'max_instances': 10},
+        branch_dict={},
+    )
+    history_dir = str(tmpdir.join('history'))
+    with contextlib.nested(
+        mock.patch('paasta_tools.autoscaling_lib.set_instances_for_marathon_service', autospec=True),
+        mock.patch('paasta_tools.autoscaling_lib.get_service_metrics_provider', autospec=True,
+                   return_value=mock.Mock(return_value=0.9)),
+        mock.patch('paasta_tools.autoscaling_lib.get_decision_policy', autospec=True,
+                   return_value=mock.Mock(return_value=20)),
+        mock.patch.object(marathon_tools.MarathonServiceConfig, 'get_instances', autospec=True, return_value=4),
+        mock.patch('paasta_tools.autoscaling_lib._log', autospec=True),
+    ) as (
+        _,
+        _,
+        mock_get_decision_policy,
+        _,
+        _,
+    ):
+        autoscaling_lib.autoscale_marathon_instance(fake_marathon_service_config, [mock.Mock()] * 4, [mock.Mock()],
+                                                    history_dir=history_dir)
+        policy_kwargs = mock_get_decision_policy.return_value.call_args[1]
+        assert len(policy_kwargs['history']) == 0
+        assert policy_kwargs['utilization'] == 0.9
+        assert policy_kwargs['setpoint'] == 0.8
+    history = AutoscalingHistory(get_history_path('fake-service', 'fake-instance', history_dir)).read()
+    assert len(history) == 1
+    record = history.records()[0]
+    assert record.instances == 4
+    assert record.decision == 6
+    assert abs(record.utilization - 0.9) < 1e-6
+    assert abs(record.error - 0.1) < 1e-6
+
+
+def test_record_autoscaling_decision_survives_io_errors():
+    fake_marathon_service_config = marathon_tools.MarathonServiceConfig(
+        service='fake-service',
+        instance='fake-instance',
+        cluster='fake-cluster',
+        config_dict={},
+        branch_dict={},
+    )
+    with contextlib.nested(
+        mock.patch('paasta_tools.autoscaling_lib.AutoscalingHistory.append', autospec=True,
+                   side_effect=IOError('disk full')),
+        mock.patch('paasta_tools.autoscaling_lib.log', autospec=True),
+    ) as (
+        _,
+        mock_log,
+    ):
+        autoscaling_lib.record_autoscaling_decision(fake_marathon_service_config, '/fake/history', 0.5, 0.3, 3, 4)
+        assert mock_log.warning.call_count == 1
+
+
 def test_autoscale_marathon_instance_aborts_when_task_deploying():
     fake_marathon_service_config = marathon_tools.MarathonServiceConfig(
         service='fake-service',
@@ -413,7 +718,8 @@ def test_autoscale_services():
         mock.patch('paasta_tools.autoscaling_lib.get_running_tasks_from_active_frameworks', autospec=True,
                    return_value=mock_mesos_tasks),
         mock.patch('paasta_tools.autoscaling_lib.load_system_paasta_config', autospec=True,
-                   return_value=mock.Mock(get_cluster=mock.Mock())),
+                   return_value=mock.Mock(get_cluster=mock.Mock(),
+                                          get_autoscaling_history_dir=mock.Mock(return_value='/fake/history'))),
         mock.patch('paasta_tools.utils.load_system_paasta_config', autospec=True,
                    return_value=mock.Mock(get_zk_hosts=mock.Mock())),
         mock.patch('paasta_tools.autoscaling_lib.get_services_for_cluster', autospec=True,
@@ -437,7 +743,7 @@ def test_autoscale_services():
     ):
         autoscaling_lib.autoscale_services()
         mock_autoscale_marathon_instance.assert_called_once_with(
-            fake_marathon_service_config, mock_marathon_tasks, mock_mesos_tasks)
+            fake_marathon_service_config, mock_marathon_tasks, mock_mesos_tasks, history_dir='/fake/history')
 
 
 def test_autoscale_services_bespoke_doesnt_autoscale():
@@ -497,3 +803,266 @@ def test_humanize_error_below():
 def test_humanize_error_equal():
     actual = autoscaling_lib.humanize_error(0.0)
     assert actual == "utilization within thresholds"
+
+
+class FakeEC2Client(object):
+    """Stands in for the boto3 EC2 client of a spot fleet request whose instances have the given private ips."""
+
+    def __init__(self, sfr_id, instance_ips, target_capacity=None, state='active'):
+        self.sfr_id = sfr_id
+        self.instance_ips = dict(instance_ips)
+        self.target_capacity = len(instance_ips) if target_capacity is None else target_capacity
+        self.state = state
+        self.calls = []
+
+    def describe_spot_fleet_requests(self, SpotFleetRequestIds):
+        assert SpotFleetRequestIds == [self.sfr_id]
+        return {'SpotFleetRequestConfigs': [{
+            'SpotFleetRequestState': self.state,
+            'SpotFleetRequestConfig': {'TargetCapacity': self.target_capacity},
+        }]}
+
+    def describe_spot_fleet_instances(self, SpotFleetRequestId):
+        assert SpotFleetRequestId == self.sfr_id
+        return {'ActiveInstances': [{'InstanceId': instance_id} for instance_id in sorted(self.instance_ips)]}
+
+    def describe_instances(self, InstanceIds):
+        return {'Reservations': [{'Instances': [
+            {'InstanceId': instance_id, 'PrivateIpAddress': self.instance_ips[instance_id]}
+            for instance_id in InstanceIds
+        ]}]}
+
+    def modify_spot_fleet_request(self, SpotFleetRequestId, TargetCapacity, ExcessCapacityTerminationPolicy):
+        self.calls.append(('modify', TargetCapacity, ExcessCapacityTerminationPolicy))
+        self.target_capacity = TargetCapacity
+
+    def terminate_instances(self, InstanceIds):
+        self.calls.append(('terminate', InstanceIds))
+        for instance_id in InstanceIds:
+            del self.instance_ips[instance_id]
+
+
+def make_slave(number, pool='default'):
+    return {
+        'id': 'slave%d' % number,
+        'hostname': 'host%d' % number,
+        'pid': 'slave(1)@10.0.0.%d:5051' % number,
+        'attributes': {'pool': pool},
+        'resources': {'cpus': 10, 'mem': 1000, 'disk': 1000, 'ports': '[31000-32000]'},
+    }
+
+
+def make_task(slave_number, cpus=1, mem=100):
+    return {'slave_id': 'slave%d' % slave_number, 'resources': {'cpus': cpus, 'mem': mem, 'disk': 0}}
+
+
+def make_mesos_state(slaves, tasks):
+    return {'slaves': slaves, 'frameworks': [{'tasks': tasks}]}
+
+
+def test_get_spot_fleet_slaves():
+    ec2_client = FakeEC2Client('sfr-1', {'i-1': '10.0.0.1', 'i-2': '10.0.0.2', 'i-3': '10.0.0.3'})
+    mesos_state = make_mesos_state([make_slave(1), make_slave(2, pool='other'), make_slave(4)], [])
+    slaves = autoscaling_lib.get_spot_fleet_slaves(autoscaling_lib.get_spot_fleet_instances('sfr-1', ec2_client),
+                                                   mesos_state, 'default', ec2_client)
+    assert slaves == {'i-1': make_slave(1)}
+    assert autoscaling_lib.get_spot_fleet_slaves([], mesos_state, 'default', ec2_client) == {}
+
+
+def test_spotfleet_metrics_provider():
+    ec2_client = FakeEC2Client('sfr-1', {'i-1': '10.0.0.1', 'i-2': '10.0.0.2'})
+    mesos_state = make_mesos_state([make_slave(1), make_slave(2)], [make_task(1, cpus=5), make_task(3, cpus=5)])
+    with mock.patch('paasta_tools.autoscaling_lib.boto3.client', autospec=True, return_value=ec2_client):
+        assert autoscaling_lib.spotfleet_metrics_provider('sfr-1', mesos_state, 'default') == 0.25
+
+
+def test_spotfleet_metrics_provider_refuses_with_missing_slaves():
+    ec2_client = FakeEC2Client('sfr-1', {'i-1': '10.0.0.1', 'i-2': '10.0.0.2'})
+    with mock.patch('paasta_tools.autoscaling_lib.boto3.client', autospec=True, return_value=ec2_client):
+        with raises(autoscaling_lib.ClusterAutoscalingError):
+            autoscaling_lib.spotfleet_metrics_provider('sfr-1', make_mesos_state([make_slave(1)], []), 'default')
+
+
+def test_sort_slaves_by_allocation():
+    slaves = [make_slave(1), make_slave(2), make_slave(3), make_slave(4)]
+    tasks = [
+        make_task(1, cpus=1, mem=900),
+        make_task(2, cpus=2), make_task(2, cpus=2),
+        make_task(3, cpus=4),
+    ]
+    # slave4 is empty, slave2 and slave3 both have 40% of their cpus allocated but slave3 runs fewer tasks, and
+    # slave1 has 90% of its memory allocated.
+    assert [slave['id'] for slave in autoscaling_lib.sort_slaves_by_allocation(slaves, tasks)] == [
+        'slave4', 'slave3', 'slave2', 'slave1']
+
+
+def test_get_slave_machine_id():
+    assert autoscaling_lib.get_slave_machine_id(make_slave(3)) == 'host3|10.0.0.3'
+
+
+def test_spot_fleet_drain_state():
+    drain_state = autoscaling_lib.SpotFleetDrainState('sfr-1')
+    with mock.patch('paasta_tools.autoscaling_lib.ZookeeperPool', autospec=True) as mock_zookeeper_pool:
+        mock_zk = mock_zookeeper_pool.return_value.__enter__.return_value
+        mock_zk.get.side_effect = NoNodeError
+        assert drain_state.load() == {}
+
+        drain_state.save({'i-1': {'slave_id': 'slave1', 'machine_id': 'host1|10.0.0.1', 'started': 30}})
+        mock_zk.ensure_path.assert_called_once_with('/autoscaling/cluster/sfr-1/draining')
+        path, data = mock_zk.set.call_args[0]
+        assert path == '/autoscaling/cluster/sfr-1/draining'
+
+        mock_zk.get.side_effect = None
+        mock_zk.get.return_value = (data, None)
+        assert drain_state.load() == {'i-1': {'slave_id': 'slave1', 'machine_id': 'host1|10.0.0.1', 'started': 30}}
+
+
+class FakeDrainStore(object):
+    """Stands in for the SpotFleetDrainState of every spot fleet request."""
+
+    def __init__(self, **draining):
+        self.draining = draining
+
+    def __call__(self, spotfleet_request_id):
+        store = self
+
+        class FakeSpotFleetDrainState(object):
+            def load(self):
+                return store.draining.get(spotfleet_request_id, {})
+
+            def save(self, draining):
+                store.draining[spotfleet_request_id] = draining
+
+        return FakeSpotFleetDrainState()
+
+
+class TestSpotfleetScaler:
+
+    resource = {'id': 'sfr-1', 'pool': 'default', 'min_instances': 1, 'max_instances': 100}
+
+    def run_scaler(self, ec2_client, mesos_state, error, drain_store, now=0):
+        with contextlib.nested(
+            mock.patch('paasta_tools.autoscaling_lib.boto3.client', autospec=True, return_value=ec2_client),
+            mock.patch('paasta_tools.autoscaling_lib.SpotFleetDrainState', side_effect=drain_store),
+            mock.patch('paasta_tools.autoscaling_lib.time.time', autospec=True, return_value=now),
+            mock.patch('paasta_tools.paasta_maintenance.drain', autospec=True),
+            mock.patch('paasta_tools.paasta_maintenance.undrain', autospec=True),
+        ) as (
+            _,
+            _,
+            _,
+            mock_drain,
+            mock_undrain,
+        ):
+            autoscaling_lib.spotfleet_scaler(self.resource, error, mesos_state)
+            return mock_drain, mock_undrain
+
+    def make_cluster(self):
+        ec2_client = FakeEC2Client('sfr-1', dict(('i-%d' % n, '10.0.0.%d' % n) for n in range(1, 21)))
+        # slave n runs n - 1 tasks, so slave1 and slave2 are the emptiest.
+        tasks = [make_task(n, cpus=0.5) for n in range(1, 21) for _ in range(n - 1)]
+        return ec2_client, make_mesos_state([make_slave(n) for n in range(1, 21)], tasks)
+
+    def make_drains(self, *numbers, **kwargs):
+        return dict(('i-%d' % n, {
+            'slave_id': 'slave%d' % n,
+            'machine_id': 'host%d|10.0.0.%d' % (n, n),
+            'started': kwargs.get('started', 0),
+        }) for n in numbers)
+
+    def test_scales_up(self):
+        ec2_client, mesos_state = self.make_cluster()
+        mock_drain, _ = self.run_scaler(ec2_client, mesos_state, 0.05, FakeDrainStore())
+        assert ec2_client.calls == [('modify', 21, 'default')]
+        assert not mock_drain.called
+
+    def test_scales_down_by_draining_the_emptiest_hosts(self):
+        ec2_client, mesos_state = self.make_cluster()
+        drain_store = FakeDrainStore()
+        mock_drain, mock_undrain = self.run_scaler(ec2_client, mesos_state, -0.5, drain_store, now=30)
+        assert mock_drain.call_args[0][0] == ['host1|10.0.0.1', 'host2|10.0.0.2']
+        assert not mock_undrain.called
+        # Nothing is terminated until a later run sees the hosts empty.
+        assert ec2_client.calls == []
+        assert drain_store.draining == {'sfr-1': self.make_drains(1, 2, started=30)}
+
+    def test_terminates_the_drained_hosts_in_a_later_run(self):
+        ec2_client, mesos_state = self.make_cluster()
+        tasks = mesos_state['frameworks'][0]['tasks']
+        drained_state = make_mesos_state(mesos_state['slaves'],
+                                         [task for task in tasks if task['slave_id'] != 'slave2'])
+        drain_store = FakeDrainStore(**{'sfr-1': self.make_drains(1, 2)})
+        mock_drain, mock_undrain = self.run_scaler(ec2_client, drained_state, -0.5, drain_store, now=60)
+        assert not mock_drain.called
+        assert ec2_client.calls == [('modify', 18, 'noTermination'), ('terminate', ['i-1', 'i-2'])]
+        assert mock_undrain.call_args[0][0] == ['host1|10.0.0.1', 'host2|10.0.0.2']
+        assert drain_store.draining == {'sfr-1': {}}
+
+    def test_keeps_waiting_for_busy_hosts(self):
+        ec2_client, mesos_state = self.make_cluster()
+        drain_store = FakeDrainStore(**{'sfr-1': self.make_drains(1, 2)})
+        _, mock_undrain = self.run_scaler(ec2_client, mesos_state, -0.5, drain_store, now=60)
+        assert ec2_client.calls == [('modify', 19, 'noTermination'), ('terminate', ['i-1'])]
+        assert mock_undrain.call_args[0][0] == ['host1|10.0.0.1']
+        assert drain_store.draining == {'sfr-1': self.make_drains(2)}
+
+    def test_gives_up_on_hosts_that_did_not_drain_in_time(self):
+        ec2_client, mesos_state = self.make_cluster()
+        drain_store = FakeDrainStore(**{'sfr-1': self.make_drains(2)})
+        _, mock_undrain = self.run_scaler(ec2_client, mesos_state, -0.5, drain_store,
+                                          now=autoscaling_lib.CLUSTER_DRAIN_TIMEOUT_S)
+        assert ec2_client.calls == []
+        assert mock_undrain.call_args[0][0] == ['host2|10.0.0.2']
+        assert drain_store.draining == {'sfr-1': {}}
+
+    def test_cancels_drains_when_capacity_is_needed_again(self):
+        ec2_client, mesos_state = self.make_cluster()
+        drain_store = FakeDrainStore(**{'sfr-1': self.make_drains(1, 2)})
+        _, mock_undrain = self.run_scaler(ec2_client, mesos_state, 0.05, drain_store, now=60)
+        assert mock_undrain.call_args[0][0] == ['host1|10.0.0.1', 'host2|10.0.0.2']
+        assert ec2_client.calls == [('modify', 21, 'default')]
+        assert drain_store.draining == {'sfr-1': {}}
+
+    def test_forgets_and_undrains_hosts_when_termination_fails(self):
+        ec2_client, _ = self.make_cluster()
+        ec2_client.terminate_instances = mock.Mock(side_effect=Exception('boom'))
+        drain_store = FakeDrainStore()
+        with contextlib.nested(
+            mock.patch('paasta_tools.autoscaling_lib.SpotFleetDrainState', side_effect=drain_store),
+            mock.patch('paasta_tools.paasta_maintenance.undrain', autospec=True),
+        ) as (
+            _,
+            mock_undrain,
+        ):
+            with raises(Exception):
+                autoscaling_lib.finish_draining_spot_fleet_request(self.resource, 20, self.make_drains(1, 2),
+                                                                   make_mesos_state([], []), ec2_client)
+            assert mock_undrain.call_args[0][0] == ['host1|10.0.0.1', 'host2|10.0.0.2']
+            assert drain_store.draining == {'sfr-1': {}}
+
+
+def test_autoscale_local_cluster_fetches_the_mesos_state_for_every_resource():
+    resources = {
+        'sfr-1': {'id': 'sfr-1', 'type': 'aws_spot_fleet_request', 'pool': 'default'},
+        'sfr-2': {'id': 'sfr-2', 'type': 'aws_spot_fleet_request', 'pool': 'batch'},
+    }
+    states = [mock.sentinel.first_state, mock.sentinel.second_state]
+    with contextlib.nested(
+        mock.patch('paasta_tools.autoscaling_lib.load_system_paasta_config', autospec=True),
+        mock.patch('paasta_tools.autoscaling_lib.get_mesos_state_from_leader', autospec=True, side_effect=states),
+        mock.patch('paasta_tools.autoscaling_lib.get_cluster_metrics_provider', autospec=True),
+        mock.patch('paasta_tools.autoscaling_lib.get_scaler', autospec=True),
+    ) as (
+        mock_load_system_paasta_config,
+        _,
+        mock_get_cluster_metrics_provider,
+        mock_get_scaler,
+    ):
+        mock_load_system_paasta_config.return_value.get_cluster_autoscaling_resources.return_value = resources
+        mock_get_cluster_metrics_provider.return_value.return_value = 0.5
+        autoscaling_lib.autoscale_local_cluster()
+        measured = dict((call[0][0], call[0][1])
+                        for call in mock_get_cluster_metrics_provider.return_value.call_args_list)
+        scaled = dict((call[0][0]['id'], call[0][2]) for call in mock_get_scaler.return_value.call_args_list)
+        assert set(scaled.values()) == set(states)
+        assert measured == scaled
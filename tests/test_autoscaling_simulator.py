@@ -0,0 +1,145 @@
+# Copyright 2015-2016 Yelp Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import array
+
+import mock
+
+from paasta_tools import autoscaling_simulator
+from paasta_tools.autoscaling_history import HistoryColumns
+from paasta_tools.autoscaling_lib import pid_decision_policy
+from paasta_tools.autoscaling_lib import predictive_decision_policy
+from paasta_tools.autoscaling_lib import threshold_decision_policy
+
+
+def make_history(points):
+    """Builds HistoryColumns from (timestamp, utilization, instances, decision) tuples."""
+    timestamps, utilizations, instances, decisions = zip(*points)
+    return HistoryColumns(
+        timestamp=array.array('L', timestamps),
+        utilization=array.array('d', utilizations),
+        error=array.array('d', [0.0] * len(points)),
+        instances=array.array('H', instances),
+        decision=array.array('h', decisions),
+    )
+
+
+AUTOSCALING_PARAMS = {'metrics_provider': 'mesos_cpu', 'decision_policy': 'pid', 'setpoint': 0.5}
+
+
+def test_get_increasing_points():
+    history = make_history([(100, 0, 1, 0), (100, 0, 1, 0), (50, 0, 1, 0), (200, 0, 1, 0)])
+    assert autoscaling_simulator.get_increasing_points(history) == [0, 3]
+
+
+def test_get_policy_params():
+    assert autoscaling_simulator.get_policy_params(dict(AUTOSCALING_PARAMS, threshold=0.1)) == {'threshold': 0.1}
+
+
+def test_score_recorded_decisions():
+    # 4 instances at 0.5 need 4 at the setpoint; scaling to 6 over-provisions 2 for five minutes, and
+    # shrinking to 2 under a load of 2 puts utilization at 1.0, over the SLO, for five minutes.
+    history = make_history([(0, 0.5, 4, 2), (300, 2.0 / 6, 6, -4), (600, 1.0, 2, 0)])
+    result = autoscaling_simulator.score_recorded_decisions(history, min_instances=1, setpoint=0.5)
+    assert result.policy == 'recorded'
+    assert result.instance_hours == (6 + 2) * 300 / 3600.0
+    assert result.overprovisioned_instance_hours == 2 * 300 / 3600.0
+    assert result.slo_violation_minutes == 5
+    assert result.scaling_actions == 2
+
+
+def test_score_recorded_decisions_caps_gaps():
+    history = make_history([(0, 0.5, 4, 0), (100000, 0.5, 4, 0)])
+    result = autoscaling_simulator.score_recorded_decisions(history, min_instances=1, setpoint=0.5)
+    assert result.instance_hours == 4 * autoscaling_simulator.MAX_INTERVAL_S / 3600.0
+
+
+def test_simulate_policy_feeds_the_policy_simulated_utilization():
+    history = make_history([(0, 1.0, 4, 0), (300, 1.0, 4, 0), (600, 1.0, 4, 0)])
+    decision_policy = mock.Mock(side_effect=[4, 0])
+    result = autoscaling_simulator.simulate_policy(history, 'fake', decision_policy, 1, 10,
+                                                   dict(AUTOSCALING_PARAMS, threshold=0.1))
+    first_call, second_call = decision_policy.call_args_list
+    assert first_call[1]['current_instances'] == 4
+    assert first_call[1]['error'] == 0.5
+    assert first_call[1]['current_time'] == 0
+    assert first_call[1]['threshold'] == 0.1
+    assert first_call[1]['setpoint'] == 0.5
+    assert first_call[1]['utilization'] == 1.0
+    assert first_call[1]['history'] is history
+    # A load of 4 on the 8 instances the policy scaled to is right at the setpoint.
+    assert second_call[1]['current_instances'] == 8
+    assert second_call[1]['error'] == 0.0
+    assert second_call[1]['policy_state'] is first_call[1]['policy_state']
+    assert result.scaling_actions == 1
+    assert result.slo_violation_minutes == 0
+    assert result.overprovisioned_instance_hours == 0
+    assert result.instance_hours == 8 * 600 / 3600.0
+
+
+def test_simulate_policy_clamps_to_min_and_max():
+    history = make_history([(0, 1.0, 4, 0), (300, 1.0, 4, 0), (600, 0.0, 4, 0)])
+    decision_policy = mock.Mock(side_effect=[100, -100])
+    result = autoscaling_simulator.simulate_policy(history, 'fake', decision_policy, 2, 6, AUTOSCALING_PARAMS)
+    assert decision_policy.call_args_list[1][1]['current_instances'] == 6
+    assert result.instance_hours == (6 + 2) * 300 / 3600.0
+    assert result.overprovisioned_instance_hours == 0
+
+
+def test_simulate_policy_empty_history():
+    result = autoscaling_simulator.simulate_policy(make_history([(0, 0.5, 1, 0)]), 'fake', mock.Mock(), 1, 10,
+                                                   AUTOSCALING_PARAMS)
+    assert result == autoscaling_simulator.SimulationResult('fake', 0.0, 0.0, 0.0, 0)
+
+
+def test_simulate_with_registered_policies():
+    # Load doubles halfway through a day and a half of history.
+    start = 1470000000
+    points = [(ts, 0.5 if ts < start + 64800 else 1.0, 4, 0) for ts in range(start, start + 129600, 300)]
+    results = autoscaling_simulator.simulate(
+        make_history(points),
+        {'threshold': threshold_decision_policy, 'pid': pid_decision_policy,
+         'predictive': predictive_decision_policy},
+        min_instances=1,
+        max_instances=20,
+        autoscaling_params=AUTOSCALING_PARAMS,
+    )
+    assert [result.policy for result in results] == ['recorded', 'pid', 'predictive', 'threshold']
+    recorded, pid, predictive, threshold = results
+    assert recorded.slo_violation_minutes > 0
+    assert pid.slo_violation_minutes < recorded.slo_violation_minutes
+    assert threshold.slo_violation_minutes < recorded.slo_violation_minutes
+    assert predictive.slo_violation_minutes < recorded.slo_violation_minutes
+    assert pid.scaling_actions > 0
+
+
+def test_predictive_policy_scales_ahead_of_a_daily_ramp():
+    # Every day, load ramps from 4 to 12 instances' worth between 08:00 and 09:00.
+    start = 1470009600  # a midnight
+    day = 24 * 60 * 60
+
+    def load(ts):
+        seconds = (ts - start) % day
+        return 4.0 + 8.0 * min(max(seconds - 8 * 3600, 0) / 3600.0, 1.0) if seconds < 20 * 3600 else 4.0
+
+    # The history's recorded decisions always kept 8 instances.
+    points = [(ts, load(ts) / 8, 8, 0) for ts in range(start, start + 8 * day, 300)]
+    history = make_history(points)
+    params = {'setpoint': 0.5, 'max_step': 20}
+    results = [autoscaling_simulator.simulate_policy(history, name, decision_policy, 1, 40, params,
+                                                     slo_utilization=0.55)
+               for name, decision_policy in [('threshold', threshold_decision_policy),
+                                             ('predictive', predictive_decision_policy)]]
+    reactive, predictive = results
+    assert predictive.slo_violation_minutes < reactive.slo_violation_minutes
+    assert predictive.overprovisioned_instance_hours < reactive.overprovisioned_instance_hours
@@ -16,9 +16,12 @@ import datetime
 
 import marathon
 import mock
+import requests
+from pytest import raises
 
 from paasta_tools import bounce_lib
 from paasta_tools import utils
+from paasta_tools.smartstack_tools import HaproxySnapshot
 
 
 class TestBounceLib:
@@ -53,9 +56,9 @@ class TestBounceLib:
         fake_zk = mock.MagicMock(Lock=mock.Mock(return_value=fake_lock))
         fake_zk_hosts = 'awjti42ior'
         with contextlib.nested(
-            mock.patch('paasta_tools.bounce_lib.KazooClient', return_value=fake_zk, autospec=True),
+            mock.patch('paasta_tools.utils.KazooClient', return_value=fake_zk, autospec=True),
             mock.patch(
-                'paasta_tools.bounce_lib.load_system_paasta_config',
+                'paasta_tools.utils.load_system_paasta_config',
                 return_value=mock.Mock(
                     get_zk_hosts=lambda: fake_zk_hosts
                 ),
@@ -68,14 +71,34 @@ class TestBounceLib:
             with bounce_lib.bounce_lock_zookeeper(lock_name):
                 pass
             hosts_patch.assert_called_once_with()
-            client_patch.assert_called_once_with(hosts=fake_zk_hosts,
-                                                 timeout=bounce_lib.ZK_LOCK_CONNECT_TIMEOUT_S)
+            client_patch.assert_called_once_with(hosts=fake_zk_hosts, timeout=utils.ZK_SESSION_TIMEOUT_S,
+                                                 read_only=False)
             fake_zk.start.assert_called_once_with()
             fake_zk.Lock.assert_called_once_with('%s/%s' % (bounce_lib.ZK_LOCK_PATH, lock_name))
             fake_lock.acquire.assert_called_once_with(timeout=1)
             fake_lock.release.assert_called_once_with()
             fake_zk.stop.assert_called_once_with()
 
+    def test_bounce_lock_zookeeper_shared_client(self):
+        fake_lock = mock.Mock()
+        fake_zk = mock.Mock(Lock=mock.Mock(return_value=fake_lock))
+        with mock.patch('paasta_tools.utils.KazooClient', autospec=True) as client_patch:
+            with bounce_lib.bounce_lock_zookeeper('watermelon', zk=fake_zk):
+                pass
+            assert client_patch.call_count == 0
+        fake_lock.acquire.assert_called_once_with(timeout=1)
+        fake_lock.release.assert_called_once_with()
+        assert fake_zk.start.call_count == 0
+        assert fake_zk.stop.call_count == 0
+
+    def test_bounce_lock_zookeeper_held(self):
+        fake_lock = mock.Mock()
+        fake_lock.acquire.side_effect = bounce_lib.LockTimeout
+        fake_zk = mock.Mock(Lock=mock.Mock(return_value=fake_lock))
+        with raises(bounce_lib.LockHeldException):
+            with bounce_lib.bounce_lock_zookeeper('watermelon', zk=fake_zk):
+                pass
+
     def test_create_marathon_app(self):
         marathon_client_mock = mock.create_autospec(marathon.MarathonClient)
         fake_client = marathon_client_mock
@@ -111,8 +134,8 @@ class TestBounceLib:
             fake_client.scale_app.assert_called_once_with(fake_id, instances=0, force=True)
             fake_client.delete_app.assert_called_once_with(fake_id, force=True)
             sleep_patch.assert_called_once_with(1)
-            wait_patch.assert_called_once_with(fake_id, fake_client)
-            assert lock_patch.called
+            wait_patch.assert_called_once_with(fake_id, fake_client, timeout_s=bounce_lib.WAIT_DELETE_TIMEOUT_S)
+            lock_patch.assert_called_once_with(zk=None)
 
     def test_kill_old_ids(self):
         old_ids = ['mmm.whatcha.say', 'that.you', 'only.meant.well']
@@ -139,6 +162,20 @@ class TestBounceLib:
         assert sleep_patch.call_count == 2
         assert is_app_id_running_patch.call_count == 3
 
+    def test_wait_for_create_under_expired_time_limit(self):
+        with contextlib.nested(
+            mock.patch('paasta_tools.marathon_tools.is_app_id_running', return_value=False),
+            mock.patch('time.sleep'),
+        ) as (
+            is_app_id_running_patch,
+            sleep_patch,
+        ):
+            with raises(bounce_lib.TimeoutException):
+                with bounce_lib.time_limit(0):
+                    bounce_lib.wait_for_create('my_created', mock.Mock())
+        assert sleep_patch.call_count == 0
+        assert is_app_id_running_patch.call_count == 1
+
     def test_wait_for_create_fast(self):
         fake_id = 'my_created'
         fake_client = mock.Mock(spec='paasta_tools.setup_marathon_job.MarathonClient')
@@ -187,6 +224,29 @@ class TestBounceLib:
         assert sleep_patch.call_count == 0
         assert is_app_id_running_patch.call_count == 1
 
+    def test_wait_for_delete_under_expired_time_limit(self):
+        with contextlib.nested(
+            mock.patch('paasta_tools.marathon_tools.is_app_id_running', return_value=True),
+            mock.patch('time.sleep'),
+        ) as (
+            is_app_id_running_patch,
+            sleep_patch,
+        ):
+            with raises(bounce_lib.TimeoutException):
+                with bounce_lib.time_limit(0):
+                    bounce_lib.wait_for_delete('my_deleted', mock.Mock())
+        assert sleep_patch.call_count == 0
+        assert is_app_id_running_patch.call_count == 1
+
+    def test_wait_for_delete_times_out(self):
+        with contextlib.nested(
+            mock.patch('paasta_tools.marathon_tools.is_app_id_running', return_value=True),
+            mock.patch('time.sleep'),
+            mock.patch('time.time', side_effect=[0, 5, 11]),
+        ):
+            with raises(bounce_lib.TimeoutException):
+                bounce_lib.wait_for_delete('my_deleted', mock.Mock(), timeout_s=10)
+
     def test_get_bounce_method_func(self):
         actual = bounce_lib.get_bounce_method_func('brutal')
         expected = bounce_lib.brutal_bounce
@@ -283,6 +343,27 @@ class TestBounceLib:
             expected = tasks[2:]
             assert actual == expected
 
+    def test_get_happy_tasks_check_haproxy_goes_by_the_callers_snapshot(self):
+        tasks = [mock.Mock(health_check_results=[mock.Mock(alive=True)]) for i in xrange(5)]
+        fake_app = mock.Mock(tasks=tasks, health_checks=[])
+        snapshots = []
+
+        def get_registered_marathon_tasks(*args):
+            snapshots.append(HaproxySnapshot.current())
+            return tasks
+
+        with contextlib.nested(
+            mock.patch('paasta_tools.bounce_lib.get_registered_marathon_tasks', autospec=True,
+                       side_effect=get_registered_marathon_tasks),
+            mock.patch('paasta_tools.mesos_tools.get_mesos_slaves_grouped_by_attribute',
+                       return_value={'fake_region': ['fake_host1'], 'fake_other_region': ['fake_host2']},
+                       autospec=True),
+            HaproxySnapshot(),
+        ) as (_, __, snapshot):
+            bounce_lib.get_happy_tasks(fake_app, 'service', 'namespace', self.fake_system_paasta_config(),
+                                       check_haproxy=True)
+        assert snapshots == [snapshot, snapshot]
+
     def test_get_happy_tasks_check_haproxy_when_unhealthy(self):
         """If we specify that a task should be in haproxy, don't call it happy unless it's in haproxy."""
 
@@ -309,7 +390,8 @@ class TestBounceLib:
         with contextlib.nested(
             mock.patch(
                 'paasta_tools.bounce_lib.get_registered_marathon_tasks',
-                side_effect=[tasks[2:3], tasks[3:]], autospec=True,
+                side_effect=lambda host, *args: {'fake_host1': tasks[2:3], 'fake_host2': tasks[3:]}[host],
+                autospec=True,
             ),
             mock.patch('paasta_tools.mesos_tools.get_mesos_slaves_grouped_by_attribute', autospec=True),
         ) as (
@@ -323,7 +405,7 @@ class TestBounceLib:
             actual = bounce_lib.get_happy_tasks(fake_app, 'service', 'namespace', self.fake_system_paasta_config(),
                                                 check_haproxy=True)
             expected = tasks[2:]
-            assert actual == expected
+            assert sorted(actual) == sorted(expected)
 
             get_registered_marathon_tasks_patch.assert_any_call(
                 'fake_host1',
@@ -340,6 +422,30 @@ class TestBounceLib:
                 tasks,
             )
 
+    def test_get_registered_tasks_in_location_falls_back_to_next_host(self):
+        fake_tasks = [mock.Mock()]
+        with mock.patch(
+            'paasta_tools.bounce_lib.get_registered_marathon_tasks',
+            side_effect=[requests.exceptions.ConnectionError(), fake_tasks],
+            autospec=True,
+        ) as get_registered_marathon_tasks_patch:
+            actual = bounce_lib.get_registered_tasks_in_location(
+                ['fake_host1', 'fake_host2', 'fake_host3'], 123456, 'fake_format', 'service.namespace', fake_tasks)
+            assert actual == fake_tasks
+            assert [c[0][0] for c in get_registered_marathon_tasks_patch.call_args_list] == \
+                ['fake_host1', 'fake_host2']
+
+    def test_get_registered_tasks_in_location_raises_when_every_host_fails(self):
+        with mock.patch(
+            'paasta_tools.bounce_lib.get_registered_marathon_tasks',
+            side_effect=requests.exceptions.ConnectionError(),
+            autospec=True,
+        ) as get_registered_marathon_tasks_patch:
+            with raises(requests.exceptions.ConnectionError):
+                bounce_lib.get_registered_tasks_in_location(
+                    ['fake_host1', 'fake_host2'], 123456, 'fake_format', 'service.namespace', [])
+            assert get_registered_marathon_tasks_patch.call_count == 2
+
     def test_flatten_tasks(self):
         """Simple check of flatten_tasks."""
         all_tasks = [mock.Mock(task_id='id_%d' % i) for i in range(10)]
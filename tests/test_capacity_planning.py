@@ -0,0 +1,307 @@
+# Copyright 2015-2016 Yelp Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from collections import Counter
+
+import mock
+
+from paasta_tools import capacity_planning
+from paasta_tools.capacity_planning import Host
+from paasta_tools.capacity_planning import Packer
+from paasta_tools.capacity_planning import Resources
+from paasta_tools.capacity_planning import TaskGroup
+
+
+def make_host(hostname, cpus=10.0, mem=1000.0, disk=1000.0, **attributes):
+    return Host(hostname, attributes, Resources(cpus, mem, disk))
+
+
+def make_group(name, count, cpus=1.0, mem=100.0, disk=10.0, pool='default', constraints=()):
+    return TaskGroup(name, count, Resources(cpus, mem, disk), pool, constraints)
+
+
+def test_host_how_many_fit():
+    host = make_host('host1', cpus=4.0, mem=1000.0, disk=100.0)
+    assert host.how_many_fit(Resources(1.0, 100.0, 10.0)) == 4
+    assert host.how_many_fit(Resources(0.5, 400.0, 10.0)) == 2
+    assert host.how_many_fit(Resources(0.1, 1.0, 0.0)) == 40
+    assert host.how_many_fit(Resources(5.0, 1.0, 1.0)) == 0
+    assert host.how_many_fit(Resources(0.0, 0.0, 0.0)) == capacity_planning.MAX_FIT
+
+
+def test_host_how_many_fit_allows_for_rounding():
+    host = make_host('host1', cpus=1.0)
+    for _ in range(10):
+        host.allocate(Resources(0.1, 0.0, 0.0))
+    assert host.how_many_fit(Resources(0.0, 1.0, 1.0)) == 1000
+    host.allocate(Resources(0.1, 0.0, 0.0))
+    assert host.how_many_fit(Resources(0.0, 1.0, 1.0)) == 0
+
+
+def test_host_allocate_and_clone():
+    host = make_host('host1', region='r1')
+    host.allocate(Resources(1.0, 100.0, 10.0), count=3)
+    assert host.get_free() == Resources(7.0, 700.0, 970.0)
+    assert host.task_count == 3
+    clone = host.clone('host2')
+    assert clone.get_free() == host.total
+    assert clone.task_count == 0
+    assert clone.get_attribute('region') == 'r1'
+    assert clone.get_attribute('hostname') == 'host2'
+
+
+def test_get_hosts_from_mesos_state():
+    mesos_state = {
+        'slaves': [
+            {'id': 's2', 'hostname': 'host2', 'resources': {'cpus': 4, 'mem': 1024, 'disk': 100, 'ports': '[1-2]'},
+             'attributes': {'pool': 'batch'}},
+            {'id': 's1', 'hostname': 'host1', 'resources': {'cpus': 8, 'mem': 2048, 'disk': 200}},
+            {'id': 's3', 'hostname': 'host3', 'resources': {'cpus': 8, 'mem': 2048, 'disk': 200}, 'active': False},
+        ],
+        'frameworks': [
+            {'name': 'marathon', 'tasks': [{'slave_id': 's1', 'resources': {'cpus': 1, 'mem': 1, 'disk': 1}}]},
+            {'name': 'chronos', 'tasks': [
+                {'slave_id': 's1', 'resources': {'cpus': 2, 'mem': 512, 'disk': 0}},
+                {'slave_id': 's3', 'resources': {'cpus': 2, 'mem': 512, 'disk': 0}},
+            ]},
+        ],
+    }
+    hosts = capacity_planning.get_hosts_from_mesos_state(mesos_state)
+    assert [host.hostname for host in hosts] == ['host1', 'host2']
+    assert [host.pool for host in hosts] == ['default', 'batch']
+    assert hosts[0].total == Resources(8.0, 2048.0, 200.0)
+    assert hosts[0].get_free() == Resources(6.0, 1536.0, 200.0)
+    assert hosts[1].get_free() == Resources(4.0, 1024.0, 100.0)
+
+
+def test_host_passes_constraint():
+    host = make_host('host1', region='uswest1', habitat='uswest1a')
+    assert capacity_planning.host_passes_constraint(host, ['region', 'LIKE', 'uswest1'])
+    assert capacity_planning.host_passes_constraint(host, ['region', 'LIKE', 'uswest.*'])
+    assert not capacity_planning.host_passes_constraint(host, ['region', 'LIKE', 'uswest'])
+    assert not capacity_planning.host_passes_constraint(host, ['ecosystem', 'LIKE', '.*'])
+    assert not capacity_planning.host_passes_constraint(host, ['hostname', 'UNLIKE', 'host1|host2'])
+    assert capacity_planning.host_passes_constraint(host, ['hostname', 'UNLIKE', 'host2'])
+    assert capacity_planning.host_passes_constraint(host, ['habitat', 'CLUSTER', 'uswest1a'])
+    assert not capacity_planning.host_passes_constraint(host, ['habitat', 'CLUSTER', 'uswest1b'])
+    assert capacity_planning.host_passes_constraint(host, ['region', 'GROUP_BY', '2'])
+
+
+def test_get_spread_limits():
+    hosts = [make_host('host%d' % index, region='r%d' % (index % 3)) for index in range(6)]
+    group = make_group('svc.main', 10, constraints=[
+        ['region', 'GROUP_BY'],
+        ['habitat', 'GROUP_BY', '4'],
+        ['hostname', 'UNIQUE'],
+        ['rack', 'MAX_PER', '2'],
+        ['pool', 'LIKE', 'default'],
+    ])
+    assert capacity_planning.get_spread_limits(group, hosts) == [
+        ('region', 4),
+        ('habitat', 3),
+        ('hostname', 1),
+        ('rack', 2),
+    ]
+
+
+def test_get_spread_limits_warns_about_unknown_operators():
+    with mock.patch('paasta_tools.capacity_planning.log', autospec=True) as mock_log:
+        assert capacity_planning.get_spread_limits(make_group('svc.main', 1, constraints=[['a', 'FOO']]), []) == []
+        assert mock_log.warning.call_count == 1
+
+
+class TestPacker:
+
+    def test_pack_places_the_biggest_tasks_first(self):
+        hosts = [make_host('host1', cpus=4.0), make_host('host2', cpus=4.0)]
+        small = make_group('small', 2, cpus=1.0)
+        big = make_group('big', 2, cpus=3.0)
+        placements = Packer(hosts).pack([small, big])
+        assert [placement.group.name for placement in placements] == ['big', 'small']
+        assert not any(placement.remaining for placement in placements)
+        assert [host.task_count for host in hosts] == [2, 2]
+
+    def test_pack_fills_hosts_in_order(self):
+        hosts = [make_host('host%d' % index, cpus=4.0) for index in range(3)]
+        Packer(hosts).pack([make_group('svc.main', 6, cpus=1.0)])
+        assert [host.task_count for host in hosts] == [4, 2, 0]
+
+    def test_pack_reports_what_does_not_fit(self):
+        hosts = [make_host('host1', cpus=4.0)]
+        packer = Packer(hosts)
+        packer.pack([make_group('svc.main', 6, cpus=1.0), make_group('svc.huge', 1, cpus=5.0)])
+        assert sorted((placement.group.name, placement.remaining) for placement in packer.get_unplaced()) == [
+            ('svc.huge', 1),
+            ('svc.main', 2),
+        ]
+
+    def test_pack_respects_host_constraints(self):
+        hosts = [make_host('host1', pool='default'), make_host('host2', pool='batch')]
+        Packer(hosts).pack([make_group('svc.batch', 3, pool='batch', constraints=[['pool', 'LIKE', 'batch']])])
+        assert [host.task_count for host in hosts] == [0, 3]
+
+    def test_pack_spreads_group_by(self):
+        hosts = [make_host('host%d' % index, region='r%d' % (index % 2)) for index in range(4)]
+        Packer(hosts).pack([make_group('svc.main', 6, constraints=[['region', 'GROUP_BY', '2']])])
+        per_region = Counter()
+        for host in hosts:
+            per_region[host.get_attribute('region')] += host.task_count
+        assert per_region == Counter({'r0': 3, 'r1': 3})
+
+    def test_pack_respects_unique(self):
+        hosts = [make_host('host%d' % index) for index in range(3)]
+        packer = Packer(hosts)
+        packer.pack([make_group('svc.main', 4, constraints=[['hostname', 'UNIQUE']])])
+        assert [host.task_count for host in hosts] == [1, 1, 1]
+        assert packer.get_unplaced()[0].remaining == 1
+
+    def test_pack_skips_full_hosts_for_later_groups_of_the_same_size(self):
+        hosts = [make_host('host%d' % index, cpus=2.0) for index in range(3)]
+        packer = Packer(hosts)
+        how_many_fit = Host.how_many_fit
+        with mock.patch.object(Host, 'how_many_fit', autospec=True, side_effect=how_many_fit) as mock_fit:
+            packer.pack([make_group('a', 3), make_group('b', 1), make_group('c', 1)])
+            # b starts at host1, which a left room on, and c at host2, as b filled host1.
+            assert [call[0][0].hostname for call in mock_fit.call_args_list] == ['host0', 'host1', 'host1', 'host2']
+        assert [host.task_count for host in hosts] == [2, 2, 1]
+
+    def test_add_hosts_places_what_did_not_fit(self):
+        packer = Packer([make_host('host1', cpus=2.0, pool='batch')])
+        packer.pack([make_group('svc.main', 3), make_group('svc.other', 1, constraints=[['pool', 'LIKE', 'batch']])])
+        new_host = make_host('host2', cpus=2.0, pool='default')
+        packer.add_hosts([new_host])
+        assert [(placement.group.name, placement.remaining) for placement in packer.get_unplaced()] == [
+            ('svc.other', 1),
+        ]
+        assert new_host.task_count == 1
+
+
+def test_get_stranded_resources():
+    cpu_bound = make_host('host1', cpus=1.0, mem=1000.0, disk=1000.0)
+    cpu_bound.allocate(Resources(1.0, 100.0, 100.0))
+    roomy = make_host('host2')
+    full = make_host('host3', cpus=1.0, mem=100.0, disk=100.0)
+    full.allocate(Resources(1.0, 100.0, 100.0))
+    groups = [make_group('svc.main', 1, cpus=1.0, mem=100.0, disk=100.0), make_group('svc.none', 0, cpus=0.0)]
+    assert capacity_planning.get_stranded_resources([cpu_bound, roomy, full], groups) == (
+        Resources(0.0, 900.0, 900.0), 1)
+
+
+def test_count_hosts_to_add():
+    hosts = [make_host('host%d' % index, cpus=4.0) for index in range(2)]
+    packer = Packer(hosts)
+    packer.pack([make_group('svc.main', 17, cpus=1.0)])
+    assert capacity_planning.count_hosts_to_add(packer, 'default', hosts, max_new_hosts=4) == 3
+    assert not packer.get_unplaced()
+    assert [host.task_count for host in hosts] == [4, 4]
+
+
+def test_count_hosts_to_add_gives_up():
+    hosts = [make_host('host1', cpus=4.0)]
+    packer = Packer(hosts)
+    packer.pack([make_group('svc.main', 17, cpus=1.0)])
+    assert capacity_planning.count_hosts_to_add(packer, 'default', hosts, max_new_hosts=2) is None
+
+    packer = Packer(hosts)
+    packer.pack([make_group('svc.huge', 1, cpus=8.0)])
+    assert capacity_planning.count_hosts_to_add(packer, 'default', hosts, max_new_hosts=100) is None
+    assert capacity_planning.count_hosts_to_add(packer, 'default', [], max_new_hosts=100) is None
+
+
+def test_plan_capacity():
+    hosts = [
+        make_host('host1', cpus=4.0, mem=1000.0, disk=100.0, pool='default'),
+        make_host('host2', cpus=4.0, mem=1000.0, disk=100.0, pool='default'),
+        make_host('host3', cpus=8.0, mem=1000.0, disk=100.0, pool='batch'),
+    ]
+    groups = [
+        make_group('svc.main', 10, cpus=1.0, mem=100.0, disk=0.0, constraints=[['pool', 'LIKE', 'default']]),
+        make_group('svc.batch', 2, cpus=2.0, mem=100.0, disk=0.0, pool='batch',
+                   constraints=[['pool', 'LIKE', 'batch']]),
+    ]
+    batch, default = capacity_planning.plan_capacity(hosts, groups)
+    assert batch == capacity_planning.PoolReport(
+        pool='batch',
+        hosts=1,
+        hosts_used=1,
+        total=Resources(8.0, 1000.0, 100.0),
+        requested=Resources(4.0, 200.0, 0.0),
+        headroom=Resources(4.0, 800.0, 100.0),
+        stranded=Resources(0.0, 0.0, 0.0),
+        stranded_hosts=0,
+        unplaced=[],
+        hosts_to_add=0,
+    )
+    assert default.hosts_used == 2
+    assert default.headroom == Resources(0.0, 1200.0, 200.0)
+    assert default.stranded == Resources(0.0, 1200.0, 200.0)
+    assert default.stranded_hosts == 2
+    assert default.unplaced == [('svc.main', 2, 10)]
+    assert default.hosts_to_add == 1
+    # The hosts planned for are not reported as hosts of the pool.
+    assert [host.task_count for host in hosts] == [4, 4, 2]
+
+
+def test_plan_capacity_with_a_pool_without_hosts():
+    reports = capacity_planning.plan_capacity([make_host('host1')], [make_group('svc.main', 1, pool='nowhere',
+                                                                                constraints=[['pool', 'LIKE', 'x']])])
+    assert [(report.pool, report.hosts, report.unplaced, report.hosts_to_add) for report in reports] == [
+        ('default', 1, [], 0),
+        ('nowhere', 0, [('svc.main', 1, 1)], None),
+    ]
+
+
+def test_plan_capacity_packs_50k_tasks():
+    hosts = [make_host('host%04d' % index, cpus=32.0, mem=131072.0, disk=500000.0,
+                       pool='batch' if index % 4 == 0 else 'default', region='r%d' % (index % 3))
+             for index in range(2000)]
+    shapes = [(0.1, 512.0), (0.25, 1024.0), (0.5, 1024.0), (1.0, 2048.0), (2.0, 4096.0)]
+    groups = []
+    for index in range(2500):
+        pool = 'batch' if index % 5 == 0 else 'default'
+        cpus, mem = shapes[index % len(shapes)]
+        groups.append(make_group('svc%d.main' % index, 20, cpus=cpus, mem=mem, disk=1024.0, pool=pool,
+                                 constraints=[['region', 'GROUP_BY', '3'], ['pool', 'LIKE', pool]]))
+    reports = capacity_planning.plan_capacity(hosts, groups)
+    assert sum(group.count for group in groups) == 50000
+    assert [(report.pool, report.unplaced) for report in reports] == [('batch', []), ('default', [])]
+    assert sum(host.task_count for host in hosts) == 50000
+    assert all(value >= -capacity_planning.EPSILON for host in hosts for value in host.get_free())
+
+
+def test_format_pool_report():
+    report = capacity_planning.PoolReport(
+        pool='default',
+        hosts=2,
+        hosts_used=1,
+        total=Resources(8.0, 2000.0, 0.0),
+        requested=Resources(12.0, 100.0, 0.0),
+        headroom=Resources(2.0, 1000.0, 0.0),
+        stranded=Resources(0.0, 500.0, 0.0),
+        stranded_hosts=1,
+        unplaced=[('svc.main', 4, 10)],
+        hosts_to_add=None,
+    )
+    assert capacity_planning.format_pool_report(report) == [
+        "Pool default: 2 hosts, 1 used by the packing",
+        "  Total:     cpus 8.0, mem 2000.0 MB, disk 0.0 MB",
+        "  Requested: cpus 12.0, mem 100.0 MB, disk 0.0 MB",
+        "  Headroom:  cpus 2.0 (25.0%), mem 1000.0 MB (50.0%), disk 0.0 MB (0.0%)",
+        "  Stranded:  cpus 0.0 (0.0%), mem 500.0 MB (25.0%), disk 0.0 MB (0.0%) on 1 hosts",
+        "  Could not place:",
+        "    svc.main: 4 of 10 tasks",
+        "  Adding hosts like those of the pool would not place everything",
+    ]
+    assert capacity_planning.format_pool_report(report._replace(hosts_to_add=3))[-1] == \
+        "  Placing everything needs 3 more hosts like those of the pool"
+    assert len(capacity_planning.format_pool_report(report._replace(unplaced=[]))) == 5
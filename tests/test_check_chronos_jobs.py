@@ -100,47 +100,52 @@ def test_sensu_event_for_last_run_state_invalid():
         check_chronos_jobs.sensu_event_for_last_run_state(100)
 
 
-@patch('paasta_tools.check_chronos_jobs.chronos_tools.lookup_chronos_jobs', autospec=True)
-@patch('paasta_tools.check_chronos_jobs.chronos_tools.filter_enabled_jobs', autospec=True)
 @patch('paasta_tools.check_chronos_jobs.chronos_tools.get_status_last_run', autospec=True)
-def test_build_service_job_mapping(mock_last_run_state, mock_filter_enabled_jobs, mock_lookup_chronos_jobs):
-    # iter() is a workaround
-    # (http://lists.idyll.org/pipermail/testing-in-python/2013-April/005527.html)
-    # for a bug in mock (http://bugs.python.org/issue17826)
-    fake_jobs = [[
-        {
-            'name': 'foo'
-        },
-        {
-            'name': 'foo'
-        },
-        {
-            'name': 'foo'
-        }
-    ] for x in range(0, 3)]
-    mock_lookup_chronos_jobs.side_effect = iter(fake_jobs)
-    mock_filter_enabled_jobs.side_effect = iter([[{}, {}, {}] for x in range(0, 3)])
-    mock_last_run_state.side_effect = iter([
-        ('faketimestamp', chronos_tools.LastRunState.Success),
-        ('faketimestamp', chronos_tools.LastRunState.Fail),
-        ('faketimestamp', chronos_tools.LastRunState.NotRun),
-    ] * 3)
+def test_build_service_job_mapping(mock_last_run_state):
+    fake_jobs = [
+        {'name': 'service1 main', 'lastSuccess': '1'},
+        {'name': 'service2 main', 'lastSuccess': '2'},
+        {'name': '%s service2 main' % chronos_tools.TMP_JOB_IDENTIFIER},
+        {'name': 'service2 main', 'lastSuccess': '3'},
+        {'name': 'not-configured main'},
+    ]
+    mock_last_run_state.side_effect = lambda job: ('faketimestamp', {
+        '1': chronos_tools.LastRunState.Success,
+        '2': chronos_tools.LastRunState.Fail,
+        '3': chronos_tools.LastRunState.NotRun,
+    }[job['lastSuccess']])
 
     fake_configured_jobs = [('service1', 'main'), ('service2', 'main'), ('service3', 'main')]
-    fake_client = Mock(list=Mock(return_value=[('service1', 'main'), ('service2', 'main'), ('service3', 'main')]))
-
-    expected_job_states = [
-        ({'name': 'foo'}, chronos_tools.LastRunState.Success),
-        ({'name': 'foo'}, chronos_tools.LastRunState.Fail),
-        ({'name': 'foo'}, chronos_tools.LastRunState.NotRun),
-    ]
+    fake_client = Mock(list=Mock(return_value=fake_jobs))
 
     expected = {
-        ('service1', 'main'): expected_job_states,
-        ('service2', 'main'): expected_job_states,
-        ('service3', 'main'): expected_job_states,
+        ('service1', 'main'): [
+            ({'name': 'service1 main', 'lastSuccess': '1'}, chronos_tools.LastRunState.Success),
+        ],
+        ('service2', 'main'): [
+            ({'name': 'service2 main', 'lastSuccess': '2'}, chronos_tools.LastRunState.Fail),
+            ({'name': 'service2 main', 'lastSuccess': '3'}, chronos_tools.LastRunState.NotRun),
+        ],
+        ('service3', 'main'): [],
     }
     assert check_chronos_jobs.build_service_job_mapping(fake_client, fake_configured_jobs) == expected
+    fake_client.list.assert_called_once_with()
+    assert mock_last_run_state.call_count == 3
+
+
+@patch('paasta_tools.check_chronos_jobs.chronos_tools.load_chronos_job_configs_for_service', autospec=True)
+def test_load_chronos_job_configs(mock_load_configs_for_service):
+    mock_load_configs_for_service.side_effect = lambda service, instances, cluster, soa_dir: dict(
+        (instance, '%s-%s' % (service, instance)) for instance in instances
+    )
+    actual = check_chronos_jobs.load_chronos_job_configs(
+        [('service1', 'main'), ('service1', 'canary'), ('service2', 'main')], 'mycluster', 'soa_dir')
+    assert actual == {
+        ('service1', 'main'): 'service1-main',
+        ('service1', 'canary'): 'service1-canary',
+        ('service2', 'main'): 'service2-main',
+    }
+    assert mock_load_configs_for_service.call_count == 2
 
 
 def test_message_for_status_fail():
@@ -202,7 +207,7 @@ def test_sensu_message_status_fail(mock_message_for_status):
 
 def test_sensu_message_status_no_run():
     fake_job_state_pairs = []
-    with patch('paasta_tools.check_chronos_jobs.load_chronos_job_config', autospec=True,
+    with patch('paasta_tools.check_chronos_jobs.chronos_tools.load_chronos_job_config', autospec=True,
                return_value=Mock(get_disabled=Mock(return_value=False))):
         output, status = check_chronos_jobs.sensu_message_status_for_jobs(
             Mock(get_disabled=Mock(return_value=False)), 'myservice', 'myinstance', 'mycluster', fake_job_state_pairs)
@@ -213,7 +218,7 @@ def test_sensu_message_status_no_run():
 
 def test_sensu_message_status_no_run_disabled():
     fake_job_state_pairs = []
-    with patch('paasta_tools.check_chronos_jobs.load_chronos_job_config', autospec=True,
+    with patch('paasta_tools.check_chronos_jobs.chronos_tools.load_chronos_job_config', autospec=True,
                return_value=Mock(get_disabled=Mock(return_value=True))):
         output, status = check_chronos_jobs.sensu_message_status_for_jobs(
             Mock(), 'myservice', 'myinstance', 'mycluster', fake_job_state_pairs)
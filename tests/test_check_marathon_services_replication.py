@@ -897,13 +897,16 @@ def test_main():
                    autospec=True),
         mock.patch('paasta_tools.check_marathon_services_replication.load_system_paasta_config',
                    autospec=True),
-        mock.patch('paasta_tools.check_marathon_services_replication.marathon_tools.load_marathon_config')
+        mock.patch('paasta_tools.check_marathon_services_replication.marathon_tools.load_marathon_config'),
+        mock.patch('paasta_tools.check_marathon_services_replication.monitoring_tools.batched_sensu_events',
+                   autospec=True),
     ) as (
         mock_parse_args,
         mock_get_services_for_cluster,
         mock_check_service_replication,
         mock_load_system_paasta_config,
         mock_load_marathon_config,
+        mock_batched_sensu_events,
     ):
         mock_config = mock.Mock()
         mock_load_marathon_config.return_value = mock_config
@@ -912,6 +915,8 @@ def test_main():
         mock_parse_args.assert_called_once_with()
         mock_get_services_for_cluster.assert_called_once_with(
             cluster='fake_cluster', instance_type='marathon', soa_dir=soa_dir)
+        mock_batched_sensu_events.assert_called_once_with(mock_load_system_paasta_config.return_value)
+        assert mock_check_service_replication.call_count == 3
 
 
 def test_load_smartstack_info_for_service():
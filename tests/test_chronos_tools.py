@@ -991,6 +991,19 @@ class TestChronosTools:
                 include_disabled=False,
             )
 
+    def test_lookup_chronos_jobs_uses_snapshot(self):
+        fake_client = mock.Mock()
+        fake_client.list.return_value = [{'name': 'fake_service fake_instance', 'disabled': False}]
+        with chronos_tools.ChronosJobsSnapshot():
+            with chronos_tools.ChronosJobsSnapshot():
+                chronos_tools.lookup_chronos_jobs(client=fake_client, service='fake_service')
+            actual = chronos_tools.lookup_chronos_jobs(client=fake_client, service='fake_service')
+            assert actual == fake_client.list.return_value
+            assert fake_client.list.call_count == 1
+        chronos_tools.lookup_chronos_jobs(client=fake_client, service='fake_service')
+        assert fake_client.list.call_count == 2
+        assert chronos_tools.ChronosJobsSnapshot.jobs is None
+
     def test_filter_chronos_jobs_with_no_filters(self):
         fake_jobs = [
             {
@@ -1103,6 +1116,49 @@ class TestChronosTools:
         # The main thing here is that InvalidJobNameError is not raised.
         assert actual == []
 
+    def test_index_chronos_jobs(self):
+        fake_jobs = [
+            {'name': 'service1 main'},
+            {'name': 'service1 main'},
+            {'name': 'service1 other'},
+            {'name': '%s service2 main' % chronos_tools.TMP_JOB_IDENTIFIER},
+            {'name': 'some non-paasta job'},
+        ]
+        assert chronos_tools.index_chronos_jobs(fake_jobs) == {
+            ('service1', 'main'): [{'name': 'service1 main'}, {'name': 'service1 main'}],
+            ('service1', 'other'): [{'name': 'service1 other'}],
+            ('service2', 'main'): [{'name': '%s service2 main' % chronos_tools.TMP_JOB_IDENTIFIER}],
+        }
+
+    def test_load_chronos_job_configs_for_service_reads_files_once(self):
+        fake_soa_dir = '/tmp/'
+        fake_config_file = {
+            'main': self.fake_config_dict,
+            'other': self.fake_config_dict,
+        }
+        with contextlib.nested(
+            mock.patch('paasta_tools.chronos_tools.load_deployments_json', autospec=True,),
+            mock.patch('paasta_tools.chronos_tools.read_chronos_jobs_for_service', autospec=True,
+                       return_value=fake_config_file),
+        ) as (
+            mock_load_deployments_json,
+            mock_read_chronos_jobs_for_service,
+        ):
+            mock_load_deployments_json.return_value.get_branch_dict.return_value = self.fake_branch_dict
+            actual = chronos_tools.load_chronos_job_configs_for_service(
+                service=self.fake_service,
+                instances=['main', 'other'],
+                cluster=self.fake_cluster,
+                soa_dir=fake_soa_dir,
+            )
+            mock_load_deployments_json.assert_called_once_with(self.fake_service, soa_dir=fake_soa_dir)
+            mock_read_chronos_jobs_for_service.assert_called_once_with(self.fake_service,
+                                                                       self.fake_cluster,
+                                                                       soa_dir=fake_soa_dir)
+            assert sorted(actual.keys()) == ['main', 'other']
+            assert actual['other'].get_job_name() == 'other'
+            assert actual['other'].branch_dict == self.fake_branch_dict
+
     def test_create_complete_config(self):
         fake_owner = 'test_team'
         fake_config_hash = 'fake_config_hash'
@@ -1386,7 +1442,7 @@ class TestChronosTools:
         # only provide the right response on the third attempt
         client.list = Mock(side_effect=[[], [], [{'name': 'foo'}]])
 
-        with mock.patch('paasta_tools.chronos_tools.sleep') as mock_sleep:
+        with mock.patch('paasta_tools.chronos_tools.sleep_within_deadline') as mock_sleep:
             assert chronos_tools.wait_for_job(client, 'foo')
             assert mock_sleep.call_count == 2
 
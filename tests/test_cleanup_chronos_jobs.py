@@ -44,23 +44,42 @@ def test_format_list_output():
         == "Successfully Removed:\n  foo\n  bar\n  baz"
 
 
-def test_deployed_job_names():
-    mock_client = mock.Mock()
-    mock_client.list.return_value = [{'name': 'foo', 'blah': 'blah'}, {'name': 'bar', 'blah': 'blah'}]
-    assert cleanup_chronos_jobs.deployed_job_names(mock_client) == ['foo', 'bar']
+def test_cleanup_tasks_runs_concurrently_and_keeps_order():
+    chronos_client = mock.Mock()
+    chronos_client.delete_tasks = mock.Mock(side_effect=lambda job: job.upper())
+    result = cleanup_chronos_jobs.cleanup_tasks(chronos_client, ['foo', 'bar', 'baz'], concurrency=2)
+    assert result == [('foo', 'FOO'), ('bar', 'BAR'), ('baz', 'BAZ')]
+    assert cleanup_chronos_jobs.cleanup_tasks(chronos_client, [], concurrency=2) == []
 
 
-@mock.patch('paasta_tools.cleanup_chronos_jobs.chronos_tools.get_temporary_jobs_for_service_instance')
-def test_filter_expired_tmp_jobs(mock_get_temporary_jobs):
+def test_index_tmp_jobs():
     two_days_ago = datetime.datetime.now(dateutil.tz.tzutc()) - datetime.timedelta(days=2)
-    one_hour_ago = datetime.datetime.now(dateutil.tz.tzutc()) - datetime.timedelta(hours=1)
-    mock_get_temporary_jobs.side_effect = [
-                                          [{'name': 'tmp foo bar',
-                                            'lastSuccess': two_days_ago.isoformat()}],
-                                          [{'name': 'tmp anotherservice anotherinstance',
-                                            'lastSuccess': one_hour_ago.isoformat()}]]
-    actual = cleanup_chronos_jobs.filter_expired_tmp_jobs(mock.Mock(), ['foo bar', 'anotherservice anotherinstance'])
-    assert actual == ['foo bar']
+    jobs = [
+        {'name': 'foo bar', 'lastSuccess': two_days_ago.isoformat()},
+        {'name': 'tmp foo bar', 'lastSuccess': two_days_ago.isoformat()},
+        {'name': 'tmp never run', 'lastSuccess': '', 'lastError': ''},
+    ]
+    assert cleanup_chronos_jobs.index_tmp_jobs(jobs) == {
+        ('foo', 'bar'): [(jobs[1], two_days_ago)],
+        ('never', 'run'): [(jobs[2], None)],
+    }
+
+
+def test_filter_expired_tmp_jobs():
+    now = datetime.datetime.now(dateutil.tz.tzutc())
+    two_days_ago = now - datetime.timedelta(days=2)
+    one_hour_ago = now - datetime.timedelta(hours=1)
+    tmp_jobs_by_service_instance = {
+        ('foo', 'bar'): [({'name': 'tmp foo bar'}, two_days_ago)],
+        ('anotherservice', 'anotherinstance'): [({'name': 'tmp anotherservice anotherinstance'}, one_hour_ago)],
+        ('never', 'run'): [({'name': 'tmp never run'}, None)],
+    }
+    actual = cleanup_chronos_jobs.filter_expired_tmp_jobs(
+        ['tmp foo bar', 'tmp anotherservice anotherinstance', 'tmp never run'],
+        tmp_jobs_by_service_instance,
+        now=now,
+    )
+    assert actual == ['tmp foo bar']
 
 
 def test_filter_paasta_jobs():
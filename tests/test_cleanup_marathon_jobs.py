@@ -35,17 +35,20 @@ class TestCleanupMarathonJobs:
 
     def test_main(self):
         soa_dir = 'paasta_maaaachine'
-        fake_args = mock.Mock(verbose=False, soa_dir=soa_dir)
+        fake_args = mock.Mock(verbose=False, soa_dir=soa_dir, dry_run=False, concurrency=3)
         with contextlib.nested(
             mock.patch('paasta_tools.cleanup_marathon_jobs.parse_args', return_value=fake_args),
-            mock.patch('paasta_tools.cleanup_marathon_jobs.cleanup_apps')
+            mock.patch('paasta_tools.cleanup_marathon_jobs.cleanup_apps'),
+            mock.patch('paasta_tools.cleanup_marathon_jobs.batched_sensu_events', autospec=True),
         ) as (
             args_patch,
-            cleanup_patch
+            cleanup_patch,
+            batched_sensu_events_patch,
         ):
             cleanup_marathon_jobs.main()
             args_patch.assert_called_once_with()
-            cleanup_patch.assert_called_once_with(soa_dir)
+            batched_sensu_events_patch.assert_called_once_with()
+            cleanup_patch.assert_called_once_with(soa_dir, dry_run=False, concurrency=3)
 
     def test_cleanup_apps(self):
         soa_dir = 'not_really_a_dir'
@@ -61,12 +64,15 @@ class TestCleanupMarathonJobs:
                        return_value=self.fake_marathon_config),
             mock.patch('paasta_tools.marathon_tools.get_marathon_client', autospec=True,
                        return_value=self.fake_marathon_client),
-            mock.patch('paasta_tools.cleanup_marathon_jobs.delete_app', autospec=True),
+            mock.patch('paasta_tools.cleanup_marathon_jobs.delete_apps', autospec=True,
+                       return_value=([('not-here', 'oh')], [])),
+            mock.patch('paasta_tools.cleanup_marathon_jobs.send_cleanup_events', autospec=True),
         ) as (
             get_services_for_cluster_patch,
             config_patch,
             client_patch,
             delete_patch,
+            send_cleanup_events_patch,
         ):
             cleanup_marathon_jobs.cleanup_apps(soa_dir)
             config_patch.assert_called_once_with()
@@ -75,10 +81,117 @@ class TestCleanupMarathonJobs:
                                                  self.fake_marathon_config.get_username(),
                                                  self.fake_marathon_config.get_password())
             delete_patch.assert_called_once_with(
-                app_id='not-here.oh.no.weirdo',
-                client=self.fake_marathon_client,
-                soa_dir=soa_dir,
+                ['not-here.oh.no.weirdo'],
+                self.fake_marathon_client,
+                cleanup_marathon_jobs.DEFAULT_DELETE_CONCURRENCY,
+            )
+            send_cleanup_events_patch.assert_called_once_with([('not-here', 'oh')], soa_dir)
+
+    def test_cleanup_apps_dry_run(self):
+        expected_apps = [('present', 'away')]
+        fake_app_ids = [mock.Mock(id='present.away.gone.wtf'), mock.Mock(id='not-here.oh.no.weirdo')]
+        self.fake_marathon_client.list_apps = mock.Mock(return_value=fake_app_ids)
+        with contextlib.nested(
+            mock.patch('paasta_tools.cleanup_marathon_jobs.get_services_for_cluster',
+                       return_value=expected_apps, autospec=True),
+            mock.patch('paasta_tools.marathon_tools.load_marathon_config',
+                       autospec=True,
+                       return_value=self.fake_marathon_config),
+            mock.patch('paasta_tools.marathon_tools.get_marathon_client', autospec=True,
+                       return_value=self.fake_marathon_client),
+            mock.patch('paasta_tools.cleanup_marathon_jobs.delete_apps', autospec=True),
+            mock.patch('paasta_tools.cleanup_marathon_jobs.send_cleanup_events', autospec=True),
+        ) as (
+            _,
+            _,
+            _,
+            delete_patch,
+            send_cleanup_events_patch,
+        ):
+            cleanup_marathon_jobs.cleanup_apps('not_really_a_dir', dry_run=True)
+            assert delete_patch.call_count == 0
+            assert send_cleanup_events_patch.call_count == 0
+
+    def test_cleanup_apps_sends_events_then_raises(self):
+        self.fake_marathon_client.list_apps = mock.Mock(return_value=[])
+        with contextlib.nested(
+            mock.patch('paasta_tools.cleanup_marathon_jobs.get_services_for_cluster', return_value=[], autospec=True),
+            mock.patch('paasta_tools.marathon_tools.load_marathon_config', autospec=True),
+            mock.patch('paasta_tools.marathon_tools.get_marathon_client', autospec=True,
+                       return_value=self.fake_marathon_client),
+            mock.patch('paasta_tools.cleanup_marathon_jobs.delete_apps', autospec=True,
+                       return_value=([('fake', 'main')], [ValueError('foo')])),
+            mock.patch('paasta_tools.cleanup_marathon_jobs.send_cleanup_events', autospec=True),
+        ) as (
+            _,
+            _,
+            _,
+            _,
+            send_cleanup_events_patch,
+        ):
+            with raises(ValueError):
+                cleanup_marathon_jobs.cleanup_apps('not_really_a_dir')
+            send_cleanup_events_patch.assert_called_once_with([('fake', 'main')], 'not_really_a_dir')
+
+    def test_get_stale_app_ids(self):
+        valid_services = [('present', 'away'), ('on-app', 'off')]
+        running_app_ids = ['present.away.gone.wtf', 'not-here.oh.no.weirdo', 'non_conforming_app', 'on-app.on.a.b']
+        assert cleanup_marathon_jobs.get_stale_app_ids(running_app_ids, valid_services) == \
+            ['not-here.oh.no.weirdo', 'on-app.on.a.b']
+
+    def test_format_dry_run_summary(self):
+        assert cleanup_marathon_jobs.format_dry_run_summary([]) == "No stale apps to delete."
+        summary = cleanup_marathon_jobs.format_dry_run_summary(
+            ['b.main.git1.config1', 'a.main.git1.config1', 'a.canary.git1.config1'])
+        assert summary.split('\n') == [
+            "Would delete 3 stale apps of 2 services:",
+            "  a:",
+            "    a.canary.git1.config1",
+            "    a.main.git1.config1",
+            "  b:",
+            "    b.main.git1.config1",
+        ]
+
+    def test_delete_apps(self):
+        fake_zk = mock.Mock()
+        fake_lock_client = mock.MagicMock()
+        fake_lock_client.__enter__.return_value = fake_zk
+
+        def fake_delete_app(app_id, client, zk):
+            assert zk is fake_zk
+            if app_id.startswith('bounced'):
+                return False
+            if app_id.startswith('broken'):
+                raise ValueError(app_id)
+            return True
+
+        with contextlib.nested(
+            mock.patch('paasta_tools.bounce_lib.zookeeper_lock_client', return_value=fake_lock_client,
+                       autospec=True),
+            mock.patch('paasta_tools.cleanup_marathon_jobs.delete_app', side_effect=fake_delete_app,
+                       autospec=True),
+        ) as (
+            zookeeper_lock_client_patch,
+            delete_app_patch,
+        ):
+            deleted, errors = cleanup_marathon_jobs.delete_apps(
+                ['fake.main.a.b', 'bounced.main.a.b', 'broken.main.a.b', 'fake.canary.a.b'],
+                self.fake_marathon_client,
+                concurrency=2,
             )
+            assert deleted == [('fake', 'main'), ('fake', 'canary')]
+            assert [str(e) for e in errors] == ['broken.main.a.b']
+            zookeeper_lock_client_patch.assert_called_once_with()
+            assert delete_app_patch.call_count == 4
+
+    def test_send_cleanup_events(self):
+        with mock.patch('paasta_tools.cleanup_marathon_jobs.send_event', autospec=True) as send_event_patch:
+            cleanup_marathon_jobs.send_cleanup_events([('fake', 'main'), ('fake', 'main')], 'fake_soa_dir')
+            assert [c[1]['check_name'] for c in send_event_patch.call_args_list] == [
+                'check_marathon_services_replication.fake.main',
+                'setup_marathon_job.fake.main',
+                'paasta_bounce_progress.fake.main',
+            ]
 
     def test_cleanup_apps_doesnt_delete_unknown_apps(self):
         soa_dir = 'not_really_a_dir'
@@ -94,11 +207,13 @@ class TestCleanupMarathonJobs:
             mock.patch('paasta_tools.marathon_tools.get_marathon_client', autospec=True,
                        return_value=self.fake_marathon_client),
             mock.patch('paasta_tools.cleanup_marathon_jobs.delete_app', autospec=True),
+            mock.patch('paasta_tools.cleanup_marathon_jobs.send_cleanup_events', autospec=True),
         ) as (
             get_services_for_cluster_patch,
             config_patch,
             client_patch,
             delete_patch,
+            _,
         ):
             cleanup_marathon_jobs.cleanup_apps(soa_dir)
             assert delete_patch.call_count == 0
@@ -111,17 +226,16 @@ class TestCleanupMarathonJobs:
             mock.patch('paasta_tools.bounce_lib.bounce_lock_zookeeper', autospec=True),
             mock.patch('paasta_tools.bounce_lib.delete_marathon_app', autospec=True),
             mock.patch('paasta_tools.cleanup_marathon_jobs._log', autospec=True),
-            mock.patch('paasta_tools.cleanup_marathon_jobs.send_event', autospec=True)
         ) as (
             mock_load_system_paasta_config,
             mock_bounce_lock_zookeeper,
             mock_delete_marathon_app,
             mock_log,
-            mock_send_sensu_event,
         ):
             mock_load_system_paasta_config.return_value.get_cluster = mock.Mock(return_value='fake_cluster')
-            cleanup_marathon_jobs.delete_app(app_id, client, 'fake_soa_dir')
-            mock_delete_marathon_app.assert_called_once_with(app_id, client)
+            assert cleanup_marathon_jobs.delete_app(app_id, client) is True
+            mock_bounce_lock_zookeeper.assert_called_once_with('example_service.main', zk=None)
+            mock_delete_marathon_app.assert_called_once_with(app_id, client, zk=None)
             mock_load_system_paasta_config.return_value.get_cluster.assert_called_once_with()
             expected_log_line = (
                 'Deleted stale marathon job that looks lost: ' +
@@ -135,7 +249,21 @@ class TestCleanupMarathonJobs:
                 cluster='fake_cluster',
                 line=expected_log_line,
             )
-            assert mock_send_sensu_event.call_count == 3
+
+    def test_delete_app_skips_apps_being_bounced(self):
+        app_id = 'example--service.main.git93340779.configddb38a65'
+        with contextlib.nested(
+            mock.patch('paasta_tools.cleanup_marathon_jobs.load_system_paasta_config', autospec=True),
+            mock.patch('paasta_tools.bounce_lib.bounce_lock_zookeeper', autospec=True,
+                       side_effect=cleanup_marathon_jobs.bounce_lib.LockHeldException),
+            mock.patch('paasta_tools.bounce_lib.delete_marathon_app', autospec=True),
+        ) as (
+            _,
+            _,
+            mock_delete_marathon_app,
+        ):
+            assert cleanup_marathon_jobs.delete_app(app_id, self.fake_marathon_client) is False
+            assert mock_delete_marathon_app.call_count == 0
 
     def test_delete_app_throws_exception(self):
         app_id = 'example--service.main.git93340779.configddb38a65'
@@ -153,7 +281,7 @@ class TestCleanupMarathonJobs:
             mock_log,
         ):
             with raises(ValueError):
-                cleanup_marathon_jobs.delete_app(app_id, client, 'fake_soa_dir')
+                cleanup_marathon_jobs.delete_app(app_id, client)
             assert 'example_service' in mock_log.mock_calls[0][2]["line"]
             assert 'Traceback' in mock_log.mock_calls[1][2]["line"]
 
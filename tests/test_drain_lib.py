@@ -42,7 +42,8 @@ class TestHacheckDrainMethod(object):
             text="Service service in down state since 1435694078.778886 until 1435694178.780000: Drained by Paasta",
         )
         fake_task = mock.Mock(host="fake_host", ports=[54321])
-        with mock.patch('requests.get', return_value=fake_response):
+        with mock.patch('paasta_tools.drain_lib.get_http_client', autospec=True) as mock_get_http_client:
+            mock_get_http_client.return_value.get.return_value = fake_response
             actual = self.drain_method.get_spool(fake_task)
 
         expected = {
@@ -60,7 +61,8 @@ class TestHacheckDrainMethod(object):
             text="Service service in down state since 1435694078.778886 until 1435694178.780000: Drained by Paasta",
         )
         fake_task = mock.Mock(host="fake_host", ports=[54321])
-        with mock.patch('requests.get', return_value=fake_response):
+        with mock.patch('paasta_tools.drain_lib.get_http_client', autospec=True) as mock_get_http_client:
+            mock_get_http_client.return_value.get.return_value = fake_response
             assert self.drain_method.is_draining(fake_task) is True
 
     def test_is_draining_no(self):
@@ -69,5 +71,6 @@ class TestHacheckDrainMethod(object):
             text="",
         )
         fake_task = mock.Mock(host="fake_host", ports=[54321])
-        with mock.patch('requests.get', return_value=fake_response):
+        with mock.patch('paasta_tools.drain_lib.get_http_client', autospec=True) as mock_get_http_client:
+            mock_get_http_client.return_value.get.return_value = fake_response
             assert self.drain_method.is_draining(fake_task) is False
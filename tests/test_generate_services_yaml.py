@@ -11,7 +11,10 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+import contextlib
+
 import mock
+import yaml
 
 from paasta_tools import generate_services_yaml
 
@@ -39,3 +42,50 @@ def test_generate_configuration():
         actual = generate_services_yaml.generate_configuration()
 
     assert expected == actual
+
+
+def test_generate_outputs_reads_soa_configs_once():
+    service_configurations = [
+        ('bar', {'port': 1000, 'smartstack': {'canary': {'proxy_port': 1025}}}),
+        ('foo', {'smartstack': {'main': {'proxy_port': 1024}, 'other': {}}}),
+    ]
+    args = mock.Mock(output_path='/services.yaml', services_file='/etc/services',
+                     synapse_fact_file='/facts.d/synapse.txt')
+    with mock.patch('service_configuration_lib.read_service_configuration',
+                    autospec=True) as read_service_configuration_patch:
+        outputs = dict(generate_services_yaml.generate_outputs(args, service_configurations))
+        assert read_service_configuration_patch.call_count == 0
+    assert yaml.safe_load(outputs['/services.yaml']) == {
+        'foo.main': {'host': '169.254.255.254', 'port': 1024},
+        'bar.canary': {'host': '169.254.255.254', 'port': 1025},
+    }
+    assert outputs['/etc/services'] == (
+        "bar\t1000/tcp\t# No description\n"
+        "bar.canary\t1025/tcp\t# No description\n"
+        "foo.main\t1024/tcp\t# No description\n"
+    )
+    assert outputs['/facts.d/synapse.txt'] == "synapse_srv_namespaces=bar.canary:1025,foo.main:1024\n"
+
+
+def test_generate_outputs_only_services_yaml():
+    args = mock.Mock(output_path='/services.yaml', services_file=None, synapse_fact_file=None)
+    outputs = generate_services_yaml.generate_outputs(args, [])
+    assert [path for path, _ in outputs] == ['/services.yaml']
+
+
+def test_main_writes_each_output_if_changed():
+    with contextlib.nested(
+        mock.patch('paasta_tools.generate_services_yaml.parse_args', autospec=True),
+        mock.patch('paasta_tools.generate_services_yaml.get_all_service_configurations', autospec=True),
+        mock.patch('paasta_tools.generate_services_yaml.generate_outputs', autospec=True,
+                   return_value=[('/a', 'a'), ('/b', 'b')]),
+        mock.patch('paasta_tools.generate_services_yaml.write_file_if_changed', autospec=True),
+    ) as (
+        _,
+        mock_get_all_service_configurations,
+        _,
+        mock_write_file_if_changed,
+    ):
+        generate_services_yaml.main()
+        assert mock_get_all_service_configurations.call_count == 1
+        assert mock_write_file_if_changed.call_args_list == [mock.call('/a', 'a'), mock.call('/b', 'b')]
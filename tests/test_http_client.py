@@ -0,0 +1,80 @@
+# Copyright 2015-2016 Yelp Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import json
+
+import mock
+from pytest import raises
+
+from paasta_tools import http_client
+from paasta_tools import utils
+from paasta_tools.api_recorder import FixtureReplayServer
+
+
+def test_default_endpoint_name():
+    assert http_client.default_endpoint_name('get', 'http://host:6666/spool/a.b/1/status') == 'GET host:6666'
+
+
+def test_http_client_pools_connections_per_host():
+    client = http_client.HttpClient(retries=2, pool_hosts=7, pool_connections_per_host=3)
+    adapter = client.session.get_adapter('http://somewhere')
+    assert adapter.max_retries.total == 2
+    assert adapter._pool_connections == 7
+    assert adapter._pool_maxsize == 3
+    assert adapter._pool_block is True
+
+
+def test_http_client_request_applies_timeouts():
+    client = http_client.HttpClient(timeout=7)
+    with mock.patch.object(client, 'session', autospec=True) as mock_session:
+        client.get('http://host/a')
+        mock_session.request.assert_called_once_with('GET', 'http://host/a', timeout=7)
+        client.post('http://host/b', timeout=2, data={'a': 1})
+        mock_session.request.assert_called_with('POST', 'http://host/b', timeout=2, data={'a': 1})
+        with utils.Deadline(1):
+            client.head('http://host/c')
+        assert mock_session.request.call_args[1]['timeout'] <= 1
+        with utils.Deadline(-1):
+            with raises(utils.TimeoutError):
+                client.get('http://host/d')
+        assert mock_session.request.call_count == 3
+
+
+def test_http_client_times_requests_per_endpoint():
+    exchanges = [{
+        'method': 'GET',
+        'path': '/state',
+        'status_code': 200,
+        'content_type': 'application/json',
+        'body': json.dumps({'frameworks': []}),
+        'latency': 0,
+        'recorded_at': 1,
+    }]
+    server = FixtureReplayServer(exchanges, speed=0).start()
+    try:
+        client = http_client.HttpClient()
+        with mock.patch('paasta_tools.utils.get_timing_sink', autospec=True) as mock_get_timing_sink:
+            for _ in range(3):
+                assert client.get('%s/state' % server.url, endpoint='mesos_slave.state').json() == {'frameworks': []}
+            assert client.get('%s/nope' % server.url).status_code == 404
+    finally:
+        server.stop()
+    endpoints = [call[0][2]['endpoint'] for call in mock_get_timing_sink.return_value.emit.call_args_list
+                 if call[0][0] == 'http_client.request']
+    assert endpoints == ['mesos_slave.state'] * 3 + ['GET %s:%d' % server.server_address]
+
+
+def test_get_http_client_is_shared():
+    with mock.patch('paasta_tools.http_client._http_client', None):
+        client = http_client.get_http_client()
+        assert http_client.get_http_client() is client
@@ -0,0 +1,391 @@
+# Copyright 2015-2016 Yelp Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import contextlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+from BaseHTTPServer import BaseHTTPRequestHandler
+from BaseHTTPServer import HTTPServer
+from SocketServer import ThreadingMixIn
+
+import mock
+import pytest
+from marathon.models import MarathonApp
+from marathon.models import MarathonTask
+from marathon.models.task import MarathonHealthCheckResult
+
+from paasta_tools import marathon_deployer
+from paasta_tools.marathon_tools import PaastaMarathonClient
+
+
+class StandInMarathonHandler(BaseHTTPRequestHandler):
+    """Serves /v2/apps and streams the server's events on /v2/events, then hangs up."""
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        if self.path.startswith('/v2/events'):
+            self.server.subscriptions.append(self.path)
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/event-stream')
+            self.end_headers()
+            self.wfile.write(': keepalive\r\n\r\n')
+            for event_type, data in self.server.events:
+                self.wfile.write('event: %s\r\ndata: %s\r\n\r\n' % (event_type, json.dumps(data)))
+                self.wfile.flush()
+        elif self.path.startswith('/v2/apps'):
+            body = json.dumps({'apps': self.server.apps})
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        else:
+            self.send_error(404)
+
+
+class StandInMarathonServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, apps, events):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), StandInMarathonHandler)
+        self.apps = apps
+        self.events = events
+        self.subscriptions = []
+
+    @property
+    def url(self):
+        return 'http://%s:%d' % self.server_address
+
+
+@contextlib.contextmanager
+def stand_in_marathon(apps=(), events=()):
+    server = StandInMarathonServer(list(apps), list(events))
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    try:
+        yield server
+    finally:
+        server.shutdown()
+        server.server_close()
+        thread.join()
+
+
+def status_update(app_id, task_id, status):
+    return ('status_update_event', {'appId': app_id, 'taskId': task_id, 'taskStatus': status})
+
+
+@pytest.yield_fixture
+def soa_dir():
+    soa_dir = tempfile.mkdtemp()
+    for service, instances in (('fake_service', ('main', 'canary')), ('other_service', ('main',))):
+        os.mkdir(os.path.join(soa_dir, service))
+        with open(os.path.join(soa_dir, service, 'marathon-fake_cluster.yaml'), 'w') as f:
+            f.write(''.join('%s: {}\n' % instance for instance in instances))
+    try:
+        yield soa_dir
+    finally:
+        shutil.rmtree(soa_dir)
+
+
+def test_iter_stream_lines():
+    chunks = ['a\r', '\nb\rc', '\n', '\r', '\r\n', 'd\r', 'e', '\nunfinished']
+    assert list(marathon_deployer.iter_stream_lines(chunks)) == ['a', 'b', 'c', '', '', 'd', 'e']
+    assert list(marathon_deployer.iter_stream_lines(['a\n\nb\r\n'])) == ['a', '', 'b']
+
+
+def test_iter_stream_lines_with_a_large_line():
+    line = 'data: ' + json.dumps({'plan': ['x' * 100] * 1000})
+    stream = 'event: deployment_info\r\n%s\r\n\r\n' % line
+    # One byte at a time must not cost time in proportion to the square of the line's length.
+    assert list(marathon_deployer.iter_stream_lines(iter(stream))) == ['event: deployment_info', line, '']
+    chunks = [stream[i:i + 1024] for i in range(0, len(stream), 1024)]
+    assert list(marathon_deployer.iter_stream_lines(chunks)) == ['event: deployment_info', line, '']
+
+
+def test_parse_event_stream():
+    lines = [
+        ': a comment',
+        '',
+        'event: status_update_event',
+        'data: {"appId": "/a",',
+        'data:  "taskId": "t"}',
+        '',
+        'event: bogus',
+        'data: not json',
+        '',
+        'data: {"x": 1}',
+        '',
+        'event: not_dispatched',
+        'data: {}',
+    ]
+    assert list(marathon_deployer.parse_event_stream(lines)) == [
+        ('status_update_event', {'appId': '/a', 'taskId': 't'}),
+        ('message', {'x': 1}),
+    ]
+
+
+def test_app_id_to_service_instance():
+    assert marathon_deployer.app_id_to_service_instance('/fake--service.main.gitabc.config123') == \
+        ('fake_service', 'main')
+    assert marathon_deployer.app_id_to_service_instance('/fake_service.main') == ('fake_service', 'main')
+    assert marathon_deployer.app_id_to_service_instance('/not-a-paasta-app') is None
+
+
+def test_get_deployment_app_ids():
+    plan = {'steps': [
+        {'actions': [{'action': 'StartApplication', 'app': '/a'}]},
+        {'actions': [{'action': 'ScaleApplication', 'app': '/b'}, {'action': 'Unknown'}]},
+    ]}
+    assert marathon_deployer.get_deployment_app_ids(plan) == set(['/a', '/b'])
+    assert marathon_deployer.get_deployment_app_ids({}) == set()
+
+
+def test_subscribe_and_read_marathon_events_from_stand_in_server():
+    events = [status_update('/a.main', 't1', 'TASK_RUNNING'), ('app_terminated_event', {'appId': '/a.main'})]
+    with stand_in_marathon(events=events) as server:
+        client = PaastaMarathonClient([server.url], timeout=5)
+        response = marathon_deployer.subscribe_to_marathon_events(client)
+        assert list(marathon_deployer.read_marathon_events(response)) == [
+            (event_type, data) for event_type, data in events]
+    assert 'event_type=status_update_event' in server.subscriptions[0]
+    assert 'event_type=app_terminated_event' in server.subscriptions[0]
+
+
+def test_read_marathon_events_with_a_large_event():
+    events = [('deployment_info', {'plan': {'steps': [{'actions': [{'app': '/a.main'}] * 2000}]}}),
+              ('app_terminated_event', {'appId': '/a.main'})]
+    with stand_in_marathon(events=events) as server:
+        client = PaastaMarathonClient([server.url], timeout=5)
+        response = marathon_deployer.subscribe_to_marathon_events(client)
+        assert list(marathon_deployer.read_marathon_events(response)) == events
+
+
+def test_subscribe_to_marathon_events_tries_every_server():
+    with stand_in_marathon(events=[('app_terminated_event', {'appId': '/a.main'})]) as server:
+        client = PaastaMarathonClient(['http://127.0.0.1:1', server.url], timeout=5)
+        response = marathon_deployer.subscribe_to_marathon_events(client)
+        assert list(marathon_deployer.read_marathon_events(response)) == [
+            ('app_terminated_event', {'appId': '/a.main'})]
+
+
+def test_subscribe_to_marathon_events_raises_when_no_server_answers():
+    client = PaastaMarathonClient(['http://127.0.0.1:1'], timeout=5)
+    with pytest.raises(marathon_deployer.requests.exceptions.ConnectionError):
+        marathon_deployer.subscribe_to_marathon_events(client)
+
+
+def fake_app(app_id, instances, tasks):
+    return MarathonApp(id=app_id, instances=instances, tasks=tasks)
+
+
+def fake_task(task_id, started=True, alive=None):
+    results = [MarathonHealthCheckResult(alive=alive)] if alive is not None else []
+    return MarathonTask(id=task_id, started_at='2016-01-01T00:00:00.000Z' if started else None,
+                        health_check_results=results)
+
+
+class TestMarathonModel:
+
+    def test_load_returns_changed_apps(self):
+        model = marathon_deployer.MarathonModel()
+        assert model.load([fake_app('/a.main', 1, [fake_task('t1')]), fake_app('b.main', 0, [])]) == \
+            set(['/a.main', '/b.main'])
+        assert model.apps['/a.main'] == {'instances': 1, 'tasks': {'t1': {'state': 'TASK_RUNNING', 'healthy': None}}}
+        assert model.load([fake_app('/a.main', 1, [fake_task('t1')]), fake_app('/c.main', 1, [])]) == \
+            set(['/b.main', '/c.main'])
+        assert model.load([fake_app('/a.main', 1, [fake_task('t1', alive=False)]), fake_app('/c.main', 1, [])]) == \
+            set(['/a.main'])
+
+    def test_apply_status_update_event(self):
+        model = marathon_deployer.MarathonModel()
+        assert model.apply_event(*status_update('/a.main', 't1', 'TASK_STAGING')) == set(['/a.main'])
+        assert model.apps['/a.main']['tasks'] == {'t1': {'state': 'TASK_STAGING', 'healthy': None}}
+        model.apply_event(*status_update('/a.main', 't1', 'TASK_RUNNING'))
+        assert model.apps['/a.main']['tasks']['t1']['state'] == 'TASK_RUNNING'
+        model.apply_event(*status_update('/a.main', 't1', 'TASK_KILLED'))
+        assert model.apps['/a.main']['tasks'] == {}
+
+    def test_apply_health_status_changed_event(self):
+        model = marathon_deployer.MarathonModel()
+        model.load([fake_app('/a.main', 1, [fake_task('t1')])])
+        assert model.apply_event('health_status_changed_event', {'appId': '/a.main', 'taskId': 't1', 'alive': True}) \
+            == set(['/a.main'])
+        assert model.apps['/a.main']['tasks']['t1']['healthy'] is True
+        model.apply_event('health_status_changed_event', {'appId': '/a.main', 'instanceId': 't1', 'alive': False})
+        assert model.apps['/a.main']['tasks']['t1']['healthy'] is False
+        model.apply_event('health_status_changed_event', {'appId': '/a.main', 'taskId': 'gone', 'alive': False})
+        assert 'gone' not in model.apps['/a.main']['tasks']
+
+    def test_apply_api_post_and_app_terminated_events(self):
+        model = marathon_deployer.MarathonModel()
+        assert model.apply_event('api_post_event', {'appDefinition': {'id': '/a.main', 'instances': 3}}) == \
+            set(['/a.main'])
+        assert model.apps['/a.main']['instances'] == 3
+        assert model.apply_event('api_post_event', {'uri': '/v2/groups'}) == set()
+        assert model.apply_event('app_terminated_event', {'appId': '/a.main'}) == set(['/a.main'])
+        assert model.apps == {}
+
+    def test_apply_deployment_success_event(self):
+        model = marathon_deployer.MarathonModel()
+        model.load([fake_app('/a.main', 1, []), fake_app('/b.main', 1, [])])
+        plan = {
+            'steps': [{'actions': [{'action': 'ScaleApplication', 'app': '/a.main'}]}],
+            'target': {'apps': [{'id': '/a.main', 'instances': 4}, {'id': '/b.main', 'instances': 7}]},
+        }
+        assert model.apply_event('deployment_success', {'plan': plan}) == set(['/a.main'])
+        assert model.apps['/a.main']['instances'] == 4
+        assert model.apps['/b.main']['instances'] == 1
+        assert model.apply_event('deployment_info', {'plan': plan}) == set(['/a.main'])
+
+    def test_apply_unknown_event(self):
+        model = marathon_deployer.MarathonModel()
+        assert model.apply_event('event_stream_attached', {'remoteAddress': '1.2.3.4'}) == set()
+
+    def test_get_service_instances_with_bounce_in_progress(self):
+        model = marathon_deployer.MarathonModel()
+        model.load([
+            fake_app('/settled.main.git1.config1', 2, [fake_task('t1', alive=True), fake_task('t2')]),
+            fake_app('/two-apps.main.git1.config1', 1, [fake_task('t3')]),
+            fake_app('/two-apps.main.git2.config2', 1, []),
+            fake_app('/staging.main.git1.config1', 1, [fake_task('t4', started=False)]),
+            fake_app('/short.main.git1.config1', 2, [fake_task('t5')]),
+            fake_app('/unhealthy.main.git1.config1', 1, [fake_task('t6', alive=False)]),
+            fake_app('/not-paasta', 2, []),
+        ])
+        assert model.get_service_instances_with_bounce_in_progress() == set([
+            ('two-apps', 'main'),
+            ('staging', 'main'),
+            ('short', 'main'),
+            ('unhealthy', 'main'),
+        ])
+
+
+class TestMarathonDeployer:
+
+    @pytest.fixture
+    def deployer(self, soa_dir):
+        deployer = marathon_deployer.MarathonDeployer(
+            client=mock.Mock(),
+            marathon_config=mock.Mock(),
+            cluster='fake_cluster',
+            soa_dir=soa_dir,
+            bounce_interval=10,
+            soa_poll_interval=5,
+            full_deploy_interval=100,
+        )
+        deployer.soa_config_watcher.poll()
+        return deployer
+
+    @pytest.yield_fixture
+    def mock_deploy_context(self):
+        with contextlib.nested(
+            mock.patch('paasta_tools.marathon_deployer.load_system_paasta_config', autospec=True),
+            mock.patch('paasta_tools.monitoring_tools.batched_sensu_events', autospec=True),
+            mock.patch('paasta_tools.marathon_deployer.MaintenanceSnapshot', autospec=True),
+            mock.patch('paasta_tools.setup_marathon_job.deploy_marathon_service', autospec=True, return_value=0),
+        ) as (_, __, ___, mock_deploy_marathon_service):
+            yield mock_deploy_marathon_service
+
+    def test_mark_dirty_only_keeps_instances_of_the_cluster(self, deployer):
+        deployer.mark_dirty([('fake_service', 'main'), ('fake_service', 'nope'), ('unknown', 'main')])
+        deployer.mark_apps_dirty(['/other--service.main.git1.config1', '/not-paasta'])
+        assert deployer.take_dirty() == set([('fake_service', 'main'), ('other_service', 'main')])
+        assert deployer.take_dirty() == set()
+
+    def test_check_timers(self, deployer):
+        everything = deployer.soa_config_watcher.get_service_instances('marathon')
+        deployer.check_timers(1000)
+        assert deployer.take_dirty() == everything
+        deployer.model.load([fake_app('/fake--service.canary.git1.config1', 1, [])])
+        deployer.check_timers(1001)
+        assert deployer.take_dirty() == set()
+        deployer.check_timers(1010)
+        assert deployer.take_dirty() == set([('fake_service', 'canary')])
+        assert deployer.get_next_deadline() == 1015
+        with mock.patch.object(deployer.soa_config_watcher, 'poll', autospec=True,
+                               return_value={'marathon': set([('other_service', 'main')])}):
+            deployer.check_timers(1015)
+        assert deployer.take_dirty() == set([('other_service', 'main')])
+        deployer.check_timers(1100)
+        assert deployer.take_dirty() == everything
+
+    def test_run_once_deploys_dirty_instances(self, deployer, mock_deploy_context):
+        deployer.check_timers(1000)
+        deployer.take_dirty()
+        mock_deploy_context.side_effect = lambda service, instance, *args: int(instance == 'canary')
+        deployer.mark_dirty([('fake_service', 'main'), ('fake_service', 'canary')])
+        assert deployer.run_once(now=1001) == {('fake_service', 'main'): 0, ('fake_service', 'canary'): 1}
+        assert sorted(call[0][:2] for call in mock_deploy_context.call_args_list) == [
+            ('fake_service', 'canary'), ('fake_service', 'main')]
+        for call in mock_deploy_context.call_args_list:
+            assert call[0][2:] == (deployer.client, deployer.soa_dir, deployer.marathon_config)
+        deployer.client.invalidate_snapshot.assert_called_once_with()
+        assert deployer.run_once(now=1002) == {}
+
+    def test_deploy_counts_exceptions_as_failures(self, deployer, mock_deploy_context):
+        mock_deploy_context.side_effect = Exception('boom')
+        assert deployer.deploy([('fake_service', 'main')]) == {('fake_service', 'main'): 1}
+
+    def test_follow_events_from_stand_in_server(self, deployer):
+        apps = [{'id': '/fake--service.main.git1.config1', 'instances': 1, 'tasks': []}]
+        events = [
+            status_update('/other--service.main.git1.config1', 't1', 'TASK_RUNNING'),
+            status_update('/not-paasta', 't2', 'TASK_RUNNING'),
+        ]
+        with stand_in_marathon(apps=apps, events=events) as server:
+            deployer.client = PaastaMarathonClient([server.url], timeout=5)
+            stop_event = threading.Event()
+            thread = threading.Thread(target=deployer.follow_events, args=(stop_event,))
+            thread.start()
+            try:
+                dirty = set()
+                deadline = time.time() + 10
+                while len(dirty) < 2 and time.time() < deadline:
+                    dirty.update(deployer.take_dirty())
+                    time.sleep(0.01)
+            finally:
+                stop_event.set()
+                thread.join()
+        assert dirty == set([('fake_service', 'main'), ('other_service', 'main')])
+        assert deployer.model.apps['/other--service.main.git1.config1']['tasks']['t1']['state'] == 'TASK_RUNNING'
+
+    def test_follow_events_backs_off_when_marathon_is_down(self, deployer):
+        stop_event = mock.Mock(is_set=mock.Mock(side_effect=[False, False, True]))
+        with mock.patch('paasta_tools.marathon_deployer.subscribe_to_marathon_events', autospec=True,
+                        side_effect=Exception('down')):
+            deployer.follow_events(stop_event)
+        assert stop_event.wait.call_args_list == [mock.call(1), mock.call(2)]
+
+    def test_run_stops(self, deployer, mock_deploy_context):
+        stop_event = threading.Event()
+        stop_event.set()
+        with contextlib.nested(
+            mock.patch('paasta_tools.marathon_deployer.subscribe_to_marathon_events', autospec=True,
+                       side_effect=Exception('down')),
+            mock.patch('paasta_tools.marathon_deployer.ZookeeperPool', autospec=True),
+            mock.patch('paasta_tools.marathon_deployer.get_zookeeper_session', autospec=True),
+        ) as (_, mock_zookeeper_pool, mock_get_zookeeper_session):
+            deployer.run(stop_event)
+            mock_zookeeper_pool.assert_called_once_with()
+            assert mock_zookeeper_pool.return_value.__exit__.call_count == 1
+            mock_get_zookeeper_session.assert_called_once_with()
+            assert mock_get_zookeeper_session.return_value.lease.return_value.__exit__.call_count == 1
+        assert mock_deploy_context.call_count == 0
+        assert len(deployer.take_dirty()) == 3
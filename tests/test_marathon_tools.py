@@ -12,15 +12,21 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 import contextlib
+import json
+import os
+import shutil
+import tempfile
 
 import mock
 from marathon import MarathonHttpError
+from marathon import NotFoundError
 from marathon.models import MarathonApp
 from mock import patch
 from pytest import raises
 
 from paasta_tools import marathon_tools
-from paasta_tools.utils import compose_job_id
+from paasta_tools.api_recorder import FixtureReplayServer
+from paasta_tools.paasta_maintenance import MaintenanceIndex
 from paasta_tools.utils import DeploymentsJson
 from paasta_tools.utils import SystemPaastaConfig
 
@@ -85,13 +91,12 @@ class TestMarathonTools:
             mock.patch('paasta_tools.marathon_tools.load_deployments_json', autospec=True),
             mock.patch('service_configuration_lib.read_service_configuration', autospec=True),
             mock.patch('service_configuration_lib.read_extra_service_information', autospec=True),
-            mock.patch('paasta_tools.marathon_tools.deep_merge_dictionaries', autospec=True),
         ) as (
             mock_load_deployments_json,
             mock_read_service_configuration,
             mock_read_extra_service_information,
-            _,
         ):
+            mock_read_service_configuration.return_value = {}
             mock_read_extra_service_information.return_value = {fake_instance: {}}
             marathon_tools.load_marathon_service_config(
                 fake_name,
@@ -103,6 +108,28 @@ class TestMarathonTools:
             assert mock_read_extra_service_information.call_count == 1
             mock_load_deployments_json.assert_called_once_with(fake_name, soa_dir=fake_dir)
 
+    def test_load_marathon_service_config_layers_instance_over_service_config(self):
+        general_config = {'cpus': 1, 'env': {'A': 'general', 'B': 'general'}, 'monitoring': {'team': 'a'}}
+        instance_config = {'cpus': 2, 'env': {'A': 'instance'}, 'deploy_group': '{cluster}.all'}
+        with contextlib.nested(
+            mock.patch('service_configuration_lib.read_service_configuration', autospec=True,
+                       return_value=general_config),
+            mock.patch('service_configuration_lib.read_extra_service_information', autospec=True,
+                       return_value={'solo': instance_config}),
+        ):
+            config = marathon_tools.load_marathon_service_config(
+                'jazz', 'solo', 'amnesia', load_deployments=False, soa_dir='/nail/home/sanfran')
+        assert config.get_cpus() == 2
+        assert config.get_deploy_group() == 'amnesia.all'
+        assert config.get_env()['A'] == 'instance'
+        assert config.get_env()['B'] == 'general'
+        monitoring = config.get_monitoring()
+        monitoring['team'] = 'b'
+        assert config.get_monitoring() == {'team': 'a'}
+        # Nothing was copied into, or written back to, the files' contents.
+        assert general_config == {'cpus': 1, 'env': {'A': 'general', 'B': 'general'}, 'monitoring': {'team': 'a'}}
+        assert instance_config['deploy_group'] == '{cluster}.all'
+
     def test_load_marathon_service_config_bails_with_no_config(self):
         fake_name = 'jazz'
         fake_instance = 'solo'
@@ -286,28 +313,40 @@ class TestMarathonTools:
 
     def test_get_all_namespaces(self):
         soa_dir = 'carbon'
-        namespaces = [[('aluminum', {'hydrogen': 1}), ('potassium', {'helium': 2})],
-                      [('uranium', {'lithium': 3}), ('gold', {'boron': 5})]]
-        expected = [('uranium', {'lithium': 3}), ('gold', {'boron': 5}),
-                    ('aluminum', {'hydrogen': 1}), ('potassium', {'helium': 2})]
+        service_configurations = {
+            'rid1': {'smartstack': {'aluminum': {'hydrogen': 1}, 'potassium': {'helium': 2}}},
+            'rid2': {'smartstack': {'uranium': {'lithium': 3}}},
+            'rid3': {},
+        }
+        expected = [('rid1.aluminum', {'hydrogen': 1}), ('rid1.potassium', {'helium': 2}),
+                    ('rid2.uranium', {'lithium': 3})]
         with contextlib.nested(
             mock.patch('os.path.abspath', autospec=True, return_value='oxygen'),
-            mock.patch('os.listdir', autospec=True, return_value=['rid1', 'rid2']),
-            mock.patch('paasta_tools.marathon_tools.get_all_namespaces_for_service',
+            mock.patch('os.listdir', autospec=True, return_value=['rid2', 'rid3', 'rid1']),
+            mock.patch('service_configuration_lib.read_service_configuration',
                        autospec=True,
-                       side_effect=lambda a, b: namespaces.pop())
+                       side_effect=lambda service, soa_dir: service_configurations[service])
         ) as (
             abspath_patch,
             listdir_patch,
-            get_namespaces_patch,
+            read_service_configuration_patch,
         ):
             actual = marathon_tools.get_all_namespaces(soa_dir)
-            assert expected == actual
+            assert expected == sorted(actual)
             abspath_patch.assert_called_once_with(soa_dir)
             listdir_patch.assert_called_once_with('oxygen')
-            get_namespaces_patch.assert_any_call('rid1', soa_dir)
-            get_namespaces_patch.assert_any_call('rid2', soa_dir)
-            assert get_namespaces_patch.call_count == 2
+            assert read_service_configuration_patch.call_args_list == [
+                mock.call('rid1', soa_dir), mock.call('rid2', soa_dir), mock.call('rid3', soa_dir),
+            ]
+
+    def test_get_all_namespaces_from_service_configurations(self):
+        with mock.patch('service_configuration_lib.read_service_configuration',
+                        autospec=True) as read_service_configuration_patch:
+            actual = marathon_tools.get_all_namespaces(service_configurations=[
+                ('rid1', {'smartstack': {'main': {'proxy_port': 1}}}),
+            ])
+            assert actual == [('rid1.main', {'proxy_port': 1})]
+            assert read_service_configuration_patch.call_count == 0
 
     def test_get_proxy_port_for_instance(self):
         name = 'thats_no_moon'
@@ -728,17 +767,22 @@ class TestMarathonTools:
             mock.patch(
                 'paasta_tools.marathon_tools.get_all_namespaces_for_service',
                 autospec=True,
-                side_effect=lambda x, y, full_name: [('foo', {})]
-            ),
-            mock.patch(
-                'paasta_tools.marathon_tools._namespaced_get_classic_service_information_for_nerve',
-                autospec=True,
-                side_effect=lambda x, y, _: (compose_job_id(x, y), {})
+                side_effect=lambda x, y, full_name: [('foo', {'proxy_port': 1234}), ('bar', {})] if x != 'c' else []
             ),
+            mock.patch('service_configuration_lib.read_port', autospec=True, return_value=101),
+        ) as (
+            _,
+            _,
+            read_port_patch,
         ):
             assert marathon_tools.get_classic_services_running_here_for_nerve('baz') == [
-                ('a.foo', {}), ('b.foo', {}), ('c.foo', {}),
+                ('a.foo', {'proxy_port': 1234, 'mode': 'http', 'port': 101}),
+                ('a.bar', {'mode': None, 'port': 101}),
+                ('b.foo', {'proxy_port': 1234, 'mode': 'http', 'port': 101}),
+                ('b.bar', {'mode': None, 'port': 101}),
             ]
+            # The port file is read once per service, not once per namespace.
+            assert read_port_patch.call_args_list == [mock.call('baz/a/port'), mock.call('baz/b/port')]
 
     def test_get_services_running_here_for_nerve(self):
         cluster = 'plentea'
@@ -1206,10 +1250,17 @@ class TestMarathonTools:
         fake_url = "nothing_for_me_to_do_but_dance"
         fake_user = "the_boogie"
         fake_passwd = "is_for_real"
-        with mock.patch('paasta_tools.marathon_tools.MarathonClient', autospec=True) as client_patch:
+        with mock.patch('paasta_tools.marathon_tools.PaastaMarathonClient', autospec=True) as client_patch:
             marathon_tools.get_marathon_client(fake_url, fake_user, fake_passwd)
             client_patch.assert_called_once_with(fake_url, fake_user, fake_passwd, timeout=30)
 
+    def test_get_marathon_client_recording(self):
+        with mock.patch.dict('os.environ', {'PAASTA_RECORD_FIXTURES': '/tmp/fake_bundle'}):
+            client = marathon_tools.get_marathon_client('http://fake_host', 'fake_user', 'fake_passwd')
+        assert isinstance(client, marathon_tools.RecordingMarathonClient)
+        assert isinstance(client, marathon_tools.PaastaMarathonClient)
+        assert client.recorder.path == '/tmp/fake_bundle'
+
     def test_list_all_marathon_app_ids(self):
         fakeapp1 = mock.Mock(id='/fake_app1')
         fakeapp2 = mock.Mock(id='/fake_app2')
@@ -1220,40 +1271,25 @@ class TestMarathonTools:
         assert marathon_tools.list_all_marathon_app_ids(fake_client) == expected_apps
 
     def test_is_app_id_running_true(self):
-        fake_id = 'fake_app1'
-        fake_all_marathon_app_ids = ['fake_app1', 'fake_app2']
         fake_client = mock.Mock()
-        with mock.patch(
-            'paasta_tools.marathon_tools.list_all_marathon_app_ids',
-            autospec=True,
-            return_value=fake_all_marathon_app_ids,
-        ) as list_all_marathon_app_ids_patch:
-            assert marathon_tools.is_app_id_running(fake_id, fake_client) is True
-            list_all_marathon_app_ids_patch.assert_called_once_with(fake_client)
+        assert marathon_tools.is_app_id_running('fake_app1', fake_client) is True
+        fake_client.get_app.assert_called_once_with('fake_app1')
 
     def test_is_app_id_running_false(self):
-        fake_id = 'fake_app3'
-        fake_all_marathon_app_ids = ['fake_app1', 'fake_app2']
         fake_client = mock.Mock()
-        with mock.patch(
-            'paasta_tools.marathon_tools.list_all_marathon_app_ids',
-            autospec=True,
-            return_value=fake_all_marathon_app_ids,
-        ) as list_all_marathon_app_ids_patch:
-            assert marathon_tools.is_app_id_running(fake_id, fake_client) is False
-            list_all_marathon_app_ids_patch.assert_called_once_with(fake_client)
+        fake_client.get_app.side_effect = NotFoundError(mock.Mock(json=mock.Mock(return_value={'message': 'no'})))
+        assert marathon_tools.is_app_id_running('fake_app3', fake_client) is False
 
     def test_is_app_id_running_handles_leading_slashes(self):
-        fake_id = '/fake_app1'
-        fake_all_marathon_app_ids = ['fake_app1', 'fake_app2']
         fake_client = mock.Mock()
-        with mock.patch(
-            'paasta_tools.marathon_tools.list_all_marathon_app_ids',
-            autospec=True,
-            return_value=fake_all_marathon_app_ids,
-        ) as list_all_marathon_app_ids_patch:
-            assert marathon_tools.is_app_id_running(fake_id, fake_client) is True
-            list_all_marathon_app_ids_patch.assert_called_once_with(fake_client)
+        assert marathon_tools.is_app_id_running('/fake_app1', fake_client) is True
+        fake_client.get_app.assert_called_once_with('fake_app1')
+
+    def test_get_matching_apps_uses_snapshot(self):
+        fake_client = mock.Mock(spec=marathon_tools.PaastaMarathonClient)
+        fake_client.get_apps_with_prefix.return_value = ['fake_app']
+        assert marathon_tools.get_matching_apps('fake_service', 'fake_instance', fake_client) == ['fake_app']
+        fake_client.get_apps_with_prefix.assert_called_once_with('/fake--service.fake--instance.')
 
     @patch('paasta_tools.marathon_tools.MarathonClient.list_tasks')
     def test_app_has_tasks_exact(self, patch_list_tasks):
@@ -2027,6 +2063,45 @@ def test_format_marathon_app_dict_no_smartstack():
         assert MarathonApp(**actual)
 
 
+def test_format_marathon_app_dict_ignores_maintenance():
+    fake_marathon_service_config = marathon_tools.MarathonServiceConfig(
+        service='service',
+        cluster='clustername',
+        instance='instance',
+        config_dict={},
+        branch_dict={'docker_image': 'abcdef'},
+    )
+    fake_system_paasta_config = SystemPaastaConfig({
+        'volumes': [],
+        'docker_registry': 'fake_docker_registry:443'
+    }, '/fake/dir/')
+    fake_index = MaintenanceIndex({
+        'draining_machines': [{'id': {'hostname': 'fake-host1.example.org', 'ip': '0.0.0.0'}}],
+    })
+
+    with contextlib.nested(
+        mock.patch(
+            'paasta_tools.marathon_tools.load_service_namespace_config',
+            return_value=marathon_tools.ServiceNamespaceConfig(),
+        ),
+        mock.patch('paasta_tools.marathon_tools.load_system_paasta_config', return_value=fake_system_paasta_config),
+        mock.patch('paasta_tools.marathon_tools.get_mesos_slaves_grouped_by_attribute',
+                   autospec=True, return_value={'fake_region': {}}),
+        mock.patch('paasta_tools.paasta_maintenance.MaintenanceSnapshot.get_active_index'),
+    ) as (
+        _,
+        _,
+        _,
+        mock_get_active_index,
+    ):
+        # Hosts go in and out of maintenance all the time, so they must not be frozen into the app.
+        mock_get_active_index.return_value = None
+        without_maintenance = fake_marathon_service_config.format_marathon_app_dict()
+        mock_get_active_index.return_value = fake_index
+        with_maintenance = fake_marathon_service_config.format_marathon_app_dict()
+        assert with_maintenance == without_maintenance
+
+
 def test_format_marathon_app_dict_with_smartstack():
     service = "service"
     instance = "instance"
@@ -2346,7 +2421,7 @@ def wait_for_app_to_launch_tasks():
         return val
     with contextlib.nested(
         mock.patch('paasta_tools.marathon_tools.app_has_tasks', autospec=True, side_effect=get_mock_return_values),
-        mock.patch('paasta_tools.marathon_tools.sleep', autospec=True),
+        mock.patch('paasta_tools.marathon_tools.sleep_within_deadline', autospec=True),
     ) as (
         mock_app_has_tasks,
         mock_sleep,
@@ -2354,3 +2429,156 @@ def wait_for_app_to_launch_tasks():
         marathon_tools.wait_for_app_to_launch_tasks(mock.Mock(), 'app_id', 0)
         assert mock_app_has_tasks.call_count == 3
         assert mock_sleep.call_count == 2
+
+
+def test_app_id_prefix_index():
+    apps = [mock.Mock(id=app_id) for app_id in ['/b.main.1', '/a.main.1', '/a.main.2', '/a.mainly.1', '/c.main.1']]
+    index = marathon_tools.AppIdPrefixIndex(apps, lambda app: app.id)
+    assert len(index) == 5
+    assert [app.id for app in index.with_prefix('/a.main.')] == ['/a.main.1', '/a.main.2']
+    assert [app.id for app in index.with_prefix('a.main')] == ['/a.main.1', '/a.main.2', '/a.mainly.1']
+    assert index.with_prefix('/d.') == []
+
+
+class TestPaastaMarathonClient(object):
+
+    def fake_exchange(self, method, path, body, status_code=200):
+        return {
+            'method': method,
+            'path': path,
+            'status_code': status_code,
+            'content_type': 'application/json',
+            'body': json.dumps(body),
+            'latency': 0,
+            'recorded_at': 1,
+        }
+
+    def test_snapshot_is_fetched_once_and_invalidated_by_writes(self):
+        server = FixtureReplayServer([
+            self.fake_exchange('GET', '/v2/apps?embed=apps.failures', {'apps': [
+                {'id': '/fake--service.main.git1.config1'},
+                {'id': '/fake--service.canary.git1.config1'},
+                {'id': '/other.main.git1.config1'},
+            ]}),
+            self.fake_exchange('GET', '/v2/apps?embed=apps.failures', {'apps': []}),
+            self.fake_exchange('GET', '/v2/tasks', {'tasks': [
+                {'id': 'fake--service.main.git1.config1.1', 'appId': '/fake--service.main.git1.config1'},
+                {'id': 'other.main.git1.config1.1', 'appId': '/other.main.git1.config1'},
+            ]}),
+            self.fake_exchange('DELETE', '/v2/apps/other.main.git1.config1?force=true', {}),
+        ], speed=0).start()
+        try:
+            client = marathon_tools.PaastaMarathonClient(server.url)
+            assert [app.id for app in marathon_tools.get_matching_apps('fake_service', 'main', client)] == \
+                ['/fake--service.main.git1.config1']
+            assert [app.id for app in client.get_apps_with_prefix('/fake--service.')] == \
+                ['/fake--service.canary.git1.config1', '/fake--service.main.git1.config1']
+            assert [task.id for task in client.get_tasks_with_prefix('other.main')] == ['other.main.git1.config1.1']
+            assert [task.id for task in client.get_tasks_with_prefix('other.main')] == ['other.main.git1.config1.1']
+            client.delete_app('other.main.git1.config1', force=True)
+            assert client.get_apps_with_prefix('/fake--service.') == []
+        finally:
+            server.stop()
+
+    def test_list_tasks_for_one_app(self):
+        server = FixtureReplayServer([
+            self.fake_exchange('GET', '/v2/apps/fake--service.main/tasks', {'tasks': [
+                {'id': 'fake--service.main.1', 'appId': '/fake--service.main', 'host': 'host1'},
+                {'id': 'fake--service.main.2', 'appId': '/fake--service.main', 'host': 'host2'},
+            ]}),
+            self.fake_exchange('GET', '/v2/apps/missing/tasks', {'message': 'nope'}, status_code=404),
+        ], speed=0).start()
+        try:
+            client = marathon_tools.PaastaMarathonClient(server.url)
+            assert [task.id for task in client.list_tasks('/fake--service.main', host='host2')] == \
+                ['fake--service.main.2']
+            with raises(NotFoundError):
+                client.list_tasks('missing')
+        finally:
+            server.stop()
+
+
+class TestMarathonNerveCache(object):
+
+    def setup_method(self, method):
+        marathon_tools.MarathonNerveCache.clear()
+        self.soa_dir = tempfile.mkdtemp()
+        for service, proxy_port in (('fake_service', 1234), ('other_service', 5678)):
+            os.mkdir(os.path.join(self.soa_dir, service))
+            self.write(service, 'smartstack.yaml', 'main:\n  proxy_port: %d\n' % proxy_port)
+            self.write(service, 'marathon-fake_cluster.yaml', 'main: {}\ncanary:\n  nerve_ns: main\n')
+
+    def teardown_method(self, method):
+        marathon_tools.MarathonNerveCache.clear()
+        shutil.rmtree(self.soa_dir)
+
+    def write(self, service, filename, contents, mtime=None):
+        path = os.path.join(self.soa_dir, service, filename)
+        with open(path, 'w') as f:
+            f.write(contents)
+        if mtime is not None:
+            os.utime(path, (mtime, mtime))
+
+    def get_nerve_list(self, marathon_services):
+        with mock.patch(
+            'paasta_tools.marathon_tools.marathon_services_running_here',
+            autospec=True,
+            return_value=marathon_services,
+        ):
+            return marathon_tools.get_marathon_services_running_here_for_nerve('fake_cluster', self.soa_dir)
+
+    def test_reads_each_instance_once(self):
+        marathon_services = [('fake_service', 'main', 31000), ('fake_service', 'canary', 31001),
+                             ('other_service', 'main', 31002)]
+        expected = [
+            ('fake_service.main', {'proxy_port': 1234, 'mode': 'http', 'port': 31000}),
+            ('fake_service.main', {'proxy_port': 1234, 'mode': 'http', 'port': 31001}),
+            ('other_service.main', {'proxy_port': 5678, 'mode': 'http', 'port': 31002}),
+        ]
+        with mock.patch(
+            'paasta_tools.marathon_tools.read_nerve_entry',
+            autospec=True,
+            side_effect=marathon_tools.read_nerve_entry,
+        ) as read_nerve_entry_patch:
+            assert self.get_nerve_list(marathon_services) == expected
+            assert read_nerve_entry_patch.call_count == 3
+            actual = self.get_nerve_list(marathon_services)
+            assert actual == expected
+            # A task moving to another port reuses what was read for its instance.
+            assert self.get_nerve_list(marathon_services[:2] + [('other_service', 'main', 31005)])[2] == \
+                ('other_service.main', {'proxy_port': 5678, 'mode': 'http', 'port': 31005})
+            assert read_nerve_entry_patch.call_count == 3
+        # Callers may modify what they get back.
+        actual[0][1]['port'] = 1
+        assert self.get_nerve_list(marathon_services) == expected
+
+    def test_rereads_changed_services_only(self):
+        marathon_services = [('fake_service', 'main', 31000), ('other_service', 'main', 31002)]
+        with mock.patch(
+            'paasta_tools.marathon_tools.read_nerve_entry',
+            autospec=True,
+            side_effect=marathon_tools.read_nerve_entry,
+        ) as read_nerve_entry_patch:
+            self.get_nerve_list(marathon_services)
+            self.write('fake_service', 'smartstack.yaml', 'main:\n  proxy_port: 4321\n', mtime=1)
+            assert self.get_nerve_list(marathon_services) == [
+                ('fake_service.main', {'proxy_port': 4321, 'mode': 'http', 'port': 31000}),
+                ('other_service.main', {'proxy_port': 5678, 'mode': 'http', 'port': 31002}),
+            ]
+            assert read_nerve_entry_patch.call_args_list[2:] == [
+                mock.call('fake_service', 'main', 'fake_cluster', self.soa_dir),
+            ]
+
+    def test_does_not_remember_services_without_marathon_config(self):
+        os.remove(os.path.join(self.soa_dir, 'other_service', 'marathon-fake_cluster.yaml'))
+        marathon_services = [('fake_service', 'main', 31000), ('other_service', 'main', 31002)]
+        with mock.patch(
+            'paasta_tools.marathon_tools.read_nerve_entry',
+            autospec=True,
+            side_effect=marathon_tools.read_nerve_entry,
+        ) as read_nerve_entry_patch:
+            expected = [('fake_service.main', {'proxy_port': 1234, 'mode': 'http', 'port': 31000})]
+            assert self.get_nerve_list(marathon_services) == expected
+            assert self.get_nerve_list(marathon_services) == expected
+            assert [call[0][0] for call in read_nerve_entry_patch.call_args_list] == \
+                ['fake_service', 'other_service', 'other_service']
@@ -15,6 +15,7 @@ import contextlib
 import datetime
 import random
 import socket
+import threading
 
 import docker
 import mesos
@@ -25,7 +26,9 @@ from pytest import raises
 
 import paasta_tools.mesos_tools as mesos_tools
 from paasta_tools.marathon_tools import format_job_id
+from paasta_tools.utils import Deadline
 from paasta_tools.utils import PaastaColors
+from paasta_tools.utils import TimeoutError
 
 
 def test_filter_running_tasks():
@@ -171,6 +174,47 @@ def test_get_mem_usage_divide_by_zero():
     assert actual == "Undef"
 
 
+def test_get_mem_usage_timed_out():
+    fake_task = mock.create_autospec(mesos.cli.task.Task)
+    slave_answered = threading.Event()
+    type(fake_task).rss = mock.PropertyMock(side_effect=lambda: slave_answered.wait(5))
+    fake_task.mem_limit = 1024 * 1024 * 10
+    try:
+        with Deadline(0.01):
+            assert mesos_tools.get_mem_usage(fake_task) == "Timed Out"
+    finally:
+        slave_answered.set()
+
+
+def test_get_cpu_usage_timed_out():
+    fake_task = mock.create_autospec(mesos.cli.task.Task)
+    slave_answered = threading.Event()
+    fake_task.cpu_limit = 1.1
+    type(fake_task).stats = mock.PropertyMock(side_effect=lambda: slave_answered.wait(5))
+    fake_task.__getitem__.return_value = [{
+        'state': 'TASK_RUNNING',
+        'timestamp': int(datetime.datetime.now().strftime('%s')) - 100,
+    }]
+    try:
+        with Deadline(0.01):
+            assert mesos_tools.get_cpu_usage(fake_task) == "Timed Out"
+    finally:
+        slave_answered.set()
+
+
+def test_read_from_slave_timed_out():
+    slave_answered = threading.Event()
+    try:
+        with raises(TimeoutError):
+            mesos_tools.read_from_slave(lambda: slave_answered.wait(5), seconds=0.01)
+        with raises(TimeoutError):
+            with Deadline(0.01):
+                mesos_tools.read_from_slave(lambda: slave_answered.wait(5))
+    finally:
+        slave_answered.set()
+    assert mesos_tools.read_from_slave(lambda: 42) == 42
+
+
 def test_get_zookeeper_config():
     zk_hosts = '1.1.1.1:1111,2.2.2.2:2222,3.3.3.3:3333'
     zk_path = 'fake_path'
@@ -248,7 +292,7 @@ def test_is_mesos_leader_substring(mock_get_mesos_leader):
     mock_get_mesos_leader.assert_called_once_with()
 
 
-@mock.patch('paasta_tools.mesos_tools.KazooClient')
+@mock.patch('paasta_tools.utils.KazooClient')
 def test_get_number_of_mesos_masters(
     mock_kazoo,
 ):
@@ -257,17 +301,20 @@ def test_get_number_of_mesos_masters(
     zk = mock_kazoo.return_value
     zk.get_children.return_value = ['log_11', 'state', 'json.info_1', 'info_2']
     assert mesos_tools.get_number_of_mesos_masters(fake_zk_config) == 2
+    mock_kazoo.assert_called_once_with(hosts='1.1.1.1', timeout=mock.ANY, read_only=True)
+    zk.get_children.assert_called_once_with('fake_path')
+    zk.stop.assert_called_once_with()
 
 
-@mock.patch('requests.get')
+@mock.patch('paasta_tools.mesos_tools.get_http_client', autospec=True)
 @mock.patch('socket.getfqdn')
 def test_get_local_slave_state_connection_error(
     mock_getfqdn,
-    mock_requests_get,
+    mock_get_http_client,
 ):
     fake_request = requests.Request('GET', url='doesnt_matter')
     mock_getfqdn.return_value = 'fake_hostname'
-    mock_requests_get.side_effect = requests.ConnectionError(
+    mock_get_http_client.return_value.get.side_effect = requests.ConnectionError(
         'fake_message',
         request=fake_request,
     )
@@ -611,3 +658,21 @@ def test_format_stdstreams_tail_for_task(test_case):
     with mock.patch('paasta_tools.mesos_tools.mesos.cli.cluster.files', mock_cluster_files):
         result = mesos_tools.format_stdstreams_tail_for_task(fake_task, get_short_task_id)
         assert result == expected
+
+
+def test_format_stdstreams_tail_for_task_with_a_hung_read():
+    slave_answered = threading.Event()
+    fobj = mock.create_autospec(mesos.cli.mesos_file.File)
+    fobj.path = 'stdout'
+    fobj.__reversed__ = mock.MagicMock(side_effect=lambda: iter([slave_answered.wait(5)]))
+    try:
+        with contextlib.nested(
+            mock.patch('paasta_tools.mesos_tools.mesos.cli.cluster.files', autospec=True, return_value=[fobj]),
+            Deadline(0.05),
+        ):
+            assert mesos_tools.format_stdstreams_tail_for_task({'id': 'a_task'}, lambda task_id: task_id) == [
+                PaastaColors.blue("      stdout tail for a_task"),
+                PaastaColors.red("      couldn't read stdout/stderr for a_task (timeout)"),
+            ]
+    finally:
+        slave_answered.set()
@@ -12,8 +12,18 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 import contextlib
+import itertools
+import json
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import time
 
 import mock
+import pysensu_yelp
+from pytest import raises
 
 from paasta_tools import chronos_tools
 from paasta_tools import marathon_tools
@@ -234,6 +244,68 @@ class TestMonitoring_Tools:
             service_configuration_lib_patch.assert_called_once_with(self.service, soa_dir=self.soa_dir)
             read_monitoring_patch.assert_called_once_with(self.service, soa_dir=self.soa_dir)
 
+    def test_get_monitoring_config_value_prefers_overrides(self):
+        with contextlib.nested(
+            mock.patch('service_configuration_lib.read_service_configuration', autospec=True,
+                       return_value=self.fake_general_service_config),
+            mock.patch('paasta_tools.monitoring_tools.read_monitoring_config',
+                       autospec=True, return_value=self.fake_monitor_config),
+        ):
+            actual = monitoring_tools.get_team({'team': 'override_team'}, self.service, self.soa_dir)
+            assert actual == 'override_team'
+
+    def test_monitoring_config_get_uses_monitoring_section_of_service_config(self):
+        config = monitoring_tools.MonitoringConfig(
+            service=self.service,
+            general_config={'team': 'top_level_team', 'monitoring': {'team': 'section_team'}},
+            monitor_config={},
+        )
+        assert config.get('team') == 'section_team'
+        assert config.get('ticket') is False
+        assert config.get('ticket', {'ticket': True}) is True
+
+    def test_monitoring_config_cache_reads_each_service_once(self):
+        with contextlib.nested(
+            mock.patch('service_configuration_lib.read_service_configuration', autospec=True,
+                       return_value=self.fake_general_service_config),
+            mock.patch('paasta_tools.monitoring_tools.read_monitoring_config',
+                       autospec=True, return_value=self.fake_monitor_config),
+        ) as (
+            service_configuration_lib_patch,
+            read_monitoring_patch,
+        ):
+            with monitoring_tools.MonitoringConfigCache():
+                with monitoring_tools.MonitoringConfigCache():
+                    assert monitoring_tools.get_team(self.overrides, self.service, self.soa_dir) == 'monitor_test_team'
+                assert monitoring_tools.get_tip(self.overrides, self.service, self.soa_dir) == 'monitor_test_tip'
+                monitoring_tools.get_team(self.overrides, 'other_service', self.soa_dir)
+            assert service_configuration_lib_patch.call_count == 2
+            assert read_monitoring_patch.call_count == 2
+            assert monitoring_tools.MonitoringConfigCache.configs is None
+
+            monitoring_tools.get_team(self.overrides, self.service, self.soa_dir)
+            assert service_configuration_lib_patch.call_count == 3
+
+    def test_send_event_reads_monitoring_config_once(self):
+        with contextlib.nested(
+            mock.patch('service_configuration_lib.read_service_configuration', autospec=True,
+                       return_value=self.fake_general_service_config),
+            mock.patch('paasta_tools.monitoring_tools.read_monitoring_config',
+                       autospec=True, return_value=self.fake_monitor_config),
+            mock.patch('paasta_tools.monitoring_tools.load_system_paasta_config', autospec=True),
+            mock.patch('pysensu_yelp.send_event', autospec=True),
+        ) as (
+            service_configuration_lib_patch,
+            read_monitoring_patch,
+            load_system_paasta_config_patch,
+            pysensu_yelp_send_event_patch,
+        ):
+            load_system_paasta_config_patch.return_value.get_sensu_host.return_value = 'fake_sensu_host'
+            monitoring_tools.send_event(self.service, 'fake_check', {}, 0, 'output', self.soa_dir)
+            service_configuration_lib_patch.assert_called_once_with(self.service, soa_dir=self.soa_dir)
+            read_monitoring_patch.assert_called_once_with(self.service, soa_dir=self.soa_dir)
+            assert pysensu_yelp_send_event_patch.call_count == 1
+
     def test_get_team_email_address_uses_override_if_specified(self):
         fake_email = 'fake_email'
         with contextlib.nested(
@@ -484,3 +556,307 @@ class TestMonitoring_Tools:
             abspath_patch.assert_called_once_with(fake_soa_dir)
             join_patch.assert_called_once_with(fake_path, fake_name, 'monitoring.yaml')
             read_monitoring_patch.assert_called_once_with(fake_fname)
+
+
+def test_format_sensu_event_matches_pysensu():
+    kwargs = {
+        'page': True,
+        'tip': 'a tip',
+        'check_every': '1m',
+        'alert_after': '5m',
+        'realert_every': -1,
+        'irc_channels': ['#chan'],
+        'source': 'paasta-cluster',
+        'ttl': '1h',
+    }
+    fake_socket = mock.Mock()
+    with mock.patch('pysensu_yelp.socket.socket', return_value=fake_socket, autospec=True):
+        pysensu_yelp.send_event('check.name', 'y/rb', 2, 'broken', 'team', **kwargs)
+    sent = json.loads(fake_socket.sendall.call_args[0][0])
+    assert monitoring_tools.format_sensu_event('check.name', 'y/rb', 2, 'broken', 'team', **kwargs) == sent
+
+
+def test_format_sensu_event_validates_name():
+    with raises(ValueError):
+        monitoring_tools.format_sensu_event('bad name!', 'y/rb', 0, 'ok', 'team')
+    with raises(ValueError):
+        monitoring_tools.format_sensu_event('name', 'y/rb', 0, 'ok', None)
+
+
+def _fake_event(name='check', status=pysensu_yelp.Status.OK, ttl=None):
+    return monitoring_tools.format_sensu_event(name, 'y/rb', status, 'output', 'team', source='paasta-c', ttl=ttl)
+
+
+class TestSensuEventCache:
+
+    def setup_method(self, method):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'cache.json')
+
+    def teardown_method(self, method):
+        shutil.rmtree(self.tmpdir)
+
+    def test_only_skips_repeated_oks(self):
+        cache = monitoring_tools.SensuEventCache(max_age_s=100)
+        ok = _fake_event()
+        assert not cache.is_redundant(ok, now=0)
+        cache.record(ok, now=0)
+        assert cache.is_redundant(ok, now=50)
+        assert not cache.is_redundant(ok, now=150)
+        assert not cache.is_redundant(_fake_event(name='other'), now=50)
+
+        crit = _fake_event(status=pysensu_yelp.Status.CRITICAL)
+        cache.record(crit, now=60)
+        assert not cache.is_redundant(crit, now=70)
+        assert not cache.is_redundant(ok, now=70)
+
+    def test_never_skips_keepalives(self):
+        cache = monitoring_tools.SensuEventCache()
+        keepalive = _fake_event(ttl='1h')
+        cache.record(keepalive, now=0)
+        assert not cache.is_redundant(keepalive, now=1)
+
+    def test_persists_and_merges(self):
+        first = monitoring_tools.SensuEventCache(self.path)
+        first.record(_fake_event(name='a'), now=10)
+        second = monitoring_tools.SensuEventCache(self.path)
+        second.record(_fake_event(name='b'), now=20)
+        first.save()
+        second.save()
+        reloaded = monitoring_tools.SensuEventCache(self.path)
+        assert reloaded.is_redundant(_fake_event(name='a'), now=30)
+        assert reloaded.is_redundant(_fake_event(name='b'), now=30)
+
+    def test_unreadable_cache_is_empty(self):
+        with open(self.path, 'w') as f:
+            f.write('not json')
+        assert monitoring_tools.SensuEventCache(self.path).last_sent == {}
+
+
+class FakeSensuClient(object):
+    """Accepts connections like a sensu client's socket: everything sent on a connection is parsed as one JSON
+    event, which is answered "ok" (or "invalid" if it is not a valid event) before the connection is closed.
+    A connection that has not sent a whole JSON document within the watchdog time is answered "invalid".
+
+    :param rejected_names: The names of the events to answer "invalid" to
+    """
+
+    def __init__(self, rejected_names=(), watchdog_s=0.5):
+        self.server = socket.socket()
+        self.server.bind(('127.0.0.1', 0))
+        self.server.listen(50)
+        self.port = self.server.getsockname()[1]
+        self.rejected_names = set(rejected_names)
+        self.watchdog_s = watchdog_s
+        self.connections = 0
+        self.events = []
+        self.replies = []
+        self.lock = threading.Lock()
+        self.thread = threading.Thread(target=self.serve)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def serve(self):
+        while True:
+            try:
+                conn, _ = self.server.accept()
+            except socket.error:
+                return
+            with self.lock:
+                self.connections += 1
+            handler = threading.Thread(target=self.handle, args=(conn,))
+            handler.daemon = True
+            handler.start()
+
+    def handle(self, conn):
+        conn.settimeout(self.watchdog_s)
+        data = ''
+        reply = 'invalid'
+        try:
+            while True:
+                received = conn.recv(4096)
+                if not received:
+                    break
+                data += received
+                try:
+                    event = json.loads(data)
+                except ValueError:
+                    continue
+                if isinstance(event, dict) and event.get('name') and event['name'] not in self.rejected_names:
+                    with self.lock:
+                        self.events.append(event)
+                    reply = 'ok'
+                break
+        except socket.timeout:
+            pass
+        with self.lock:
+            self.replies.append(reply)
+        conn.sendall(reply)
+        conn.close()
+
+    def stop(self):
+        self.server.close()
+
+
+def test_fake_sensu_client_rejects_concatenated_events():
+    sensu = FakeSensuClient(watchdog_s=0.1)
+    try:
+        sock = socket.create_connection(('127.0.0.1', sensu.port))
+        sock.sendall('%s\n%s\n' % (json.dumps(_fake_event(name='a')), json.dumps(_fake_event(name='b'))))
+        assert sock.recv(64) == 'invalid'
+        sock.close()
+        assert sensu.events == []
+    finally:
+        sensu.stop()
+
+
+class TestSensuEventBatcher:
+
+    def setup_method(self, method):
+        self.sensu = FakeSensuClient(rejected_names=['rejected'])
+
+    def teardown_method(self, method):
+        self.sensu.stop()
+
+    def test_sends_every_event_on_its_own_connection(self):
+        batcher = monitoring_tools.SensuEventBatcher('127.0.0.1', self.sensu.port, batch_size=3)
+        for i in range(5):
+            batcher.add(_fake_event(name='check%d' % i, status=pysensu_yelp.Status.CRITICAL))
+        assert len(batcher.pending) == 2
+        batcher.close()
+        assert sorted(event['name'] for event in self.sensu.events) == ['check%d' % i for i in range(5)]
+        assert self.sensu.connections == 5
+        assert self.sensu.replies == ['ok'] * 5
+        assert batcher.sent == 5
+
+    def test_sends_the_events_of_a_check_in_order(self):
+        batcher = monitoring_tools.SensuEventBatcher('127.0.0.1', self.sensu.port)
+        statuses = [pysensu_yelp.Status.CRITICAL, pysensu_yelp.Status.OK, pysensu_yelp.Status.WARNING]
+        for status in statuses:
+            batcher.add(_fake_event(name='flapping', status=status))
+            batcher.add(_fake_event(name='other%d' % status))
+        batcher.close()
+        assert [event['status'] for event in self.sensu.events if event['name'] == 'flapping'] == statuses
+        assert batcher.sent == 6
+
+    def test_only_caches_accepted_events(self):
+        cache = monitoring_tools.SensuEventCache()
+        batcher = monitoring_tools.SensuEventBatcher('127.0.0.1', self.sensu.port, cache=cache)
+        batcher.add(_fake_event(name='rejected'))
+        batcher.add(_fake_event(name='accepted'))
+        batcher.close()
+        assert [event['name'] for event in self.sensu.events] == ['accepted']
+        assert (batcher.sent, batcher.failed) == (1, 1)
+        assert cache.is_redundant(_fake_event(name='accepted'), now=time.time())
+        assert not cache.is_redundant(_fake_event(name='rejected'), now=time.time())
+
+    def test_skips_redundant_events(self):
+        cache = monitoring_tools.SensuEventCache()
+        cache.record(_fake_event(name='steady'), now=0)
+        with mock.patch('paasta_tools.monitoring_tools.time.time', autospec=True, return_value=1):
+            batcher = monitoring_tools.SensuEventBatcher('127.0.0.1', self.sensu.port, cache=cache)
+            batcher.add(_fake_event(name='steady'))
+            batcher.add(_fake_event(name='new'))
+            batcher.close()
+        assert [event['name'] for event in self.sensu.events] == ['new']
+        assert batcher.skipped == 1
+
+    def test_flushes_old_events(self):
+        batcher = monitoring_tools.SensuEventBatcher('127.0.0.1', self.sensu.port, max_delay_s=10)
+        with mock.patch('paasta_tools.monitoring_tools.time.time', autospec=True,
+                        side_effect=itertools.count(0, 5.5)):
+            batcher.add(_fake_event(name='a'))
+            batcher.add(_fake_event(name='b'))
+            assert len(batcher.pending) == 2
+            batcher.add(_fake_event(name='c'))
+            assert batcher.pending == []
+        assert batcher.sent == 3
+
+    def test_keeps_sending_after_a_failure(self):
+        batcher = monitoring_tools.SensuEventBatcher('127.0.0.1', self.sensu.port)
+        real_send_one = batcher._send_one
+
+        def send_one(event):
+            if event['name'] == 'a':
+                raise socket.error('connection reset')
+            return real_send_one(event)
+
+        with mock.patch.object(batcher, '_send_one', side_effect=send_one):
+            batcher.add(_fake_event(name='a'))
+            batcher.add(_fake_event(name='b'))
+            batcher.close()
+        assert [event['name'] for event in self.sensu.events] == ['b']
+        assert (batcher.sent, batcher.failed) == (1, 1)
+
+    def test_adding_during_a_slow_send(self):
+        batcher = monitoring_tools.SensuEventBatcher('127.0.0.1', self.sensu.port, batch_size=1)
+        real_send_one = batcher._send_one
+        sending = threading.Event()
+        slow_send_done = threading.Event()
+
+        def send_one(event):
+            if event['name'] == 'slow':
+                sending.set()
+                slow_send_done.wait(5)
+            return real_send_one(event)
+
+        def start(target, *args):
+            thread = threading.Thread(target=target, args=args)
+            thread.daemon = True
+            thread.start()
+            return thread
+
+        with mock.patch.object(batcher, '_send_one', side_effect=send_one):
+            threads = [start(batcher.add, _fake_event(name='slow'))]
+            assert sending.wait(5)
+            threads += [start(batcher.add, _fake_event(name='next')), start(batcher.flush)]
+            time.sleep(0.1)
+            slow_send_done.set()
+            for thread in threads:
+                thread.join(5)
+                assert not thread.is_alive()
+        assert [event['name'] for event in self.sensu.events] == ['slow', 'next']
+        assert batcher.sent == 2
+
+    def test_gives_up_when_sensu_is_down(self):
+        unused = socket.socket()
+        unused.bind(('127.0.0.1', 0))
+        port = unused.getsockname()[1]
+        unused.close()
+        cache = monitoring_tools.SensuEventCache()
+        batcher = monitoring_tools.SensuEventBatcher('127.0.0.1', port, cache=cache)
+        batcher.add(_fake_event())
+        batcher.close()
+        assert (batcher.sent, batcher.failed) == (0, 1)
+        assert cache.last_sent == {}
+
+
+def test_batched_sensu_events_batches_send_event():
+    fake_config = mock.Mock(
+        get_sensu_host=mock.Mock(return_value='fake_sensu_host'),
+        get_sensu_port=mock.Mock(return_value=3030),
+        get_sensu_event_cache_path=mock.Mock(return_value=None),
+        get_cluster=mock.Mock(return_value='fake_cluster'),
+    )
+    with contextlib.nested(
+        mock.patch('paasta_tools.monitoring_tools.load_system_paasta_config', autospec=True,
+                   return_value=fake_config),
+        mock.patch('paasta_tools.monitoring_tools.get_team', autospec=True, return_value='fake_team'),
+        mock.patch('paasta_tools.monitoring_tools.pysensu_yelp.send_event', autospec=True),
+        mock.patch('paasta_tools.monitoring_tools.SensuEventBatcher._send', autospec=True),
+    ) as (
+        _,
+        _,
+        mock_send_event,
+        mock_send,
+    ):
+        with monitoring_tools.batched_sensu_events() as batcher:
+            with monitoring_tools.batched_sensu_events() as inner_batcher:
+                assert inner_batcher is batcher
+                monitoring_tools.send_event('fake_service', 'fake_check', {}, 0, 'output', '/fake/soa/dir')
+            assert monitoring_tools.get_sensu_event_batcher() is batcher
+            assert [event['name'] for event in batcher.pending] == ['fake_check']
+        assert monitoring_tools.get_sensu_event_batcher() is None
+        assert mock_send_event.call_count == 0
+        sent_events = [event for call in mock_send.call_args_list for event in call[0][1]]
+        assert [event['name'] for event in sent_events] == ['fake_check']
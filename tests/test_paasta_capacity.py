@@ -0,0 +1,143 @@
+# Copyright 2015-2016 Yelp Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import argparse
+import contextlib
+
+import mock
+from pytest import raises
+
+from paasta_tools import paasta_capacity
+from paasta_tools.capacity_planning import Resources
+from paasta_tools.marathon_tools import MarathonServiceConfig
+from paasta_tools.mesos_tools import MasterNotAvailableException
+from paasta_tools.mesos_tools import NoSlavesAvailable
+from paasta_tools.utils import NoDeploymentsAvailable
+
+
+def test_instance_count():
+    assert paasta_capacity.instance_count('svc.main=3') == (('svc', 'main'), 3)
+    for value in ('svc.main', 'svc=3', 'svc.main=many', 'svc.main=-1'):
+        with raises(argparse.ArgumentTypeError):
+            paasta_capacity.instance_count(value)
+
+
+def make_service_config(instance='main', **config):
+    config.setdefault('cpus', 1)
+    config.setdefault('mem', 512)
+    config.setdefault('instances', 3)
+    return MarathonServiceConfig('svc', 'fake_cluster', instance, config, {'desired_state': 'start'})
+
+
+def test_get_task_group():
+    service_config = make_service_config(disk=2048, pool='batch')
+    with mock.patch('paasta_tools.paasta_capacity.get_constraints', autospec=True,
+                    return_value=[['pool', 'LIKE', 'batch']]) as mock_get_constraints:
+        group = paasta_capacity.get_task_group(service_config, 5, 'fake_soa_dir')
+        mock_get_constraints.assert_called_once_with(service_config, 'fake_soa_dir')
+    assert group.name == 'svc.main'
+    assert group.count == 5
+    assert group.resources == Resources(1.0, 512.0, 2048.0)
+    assert group.pool == 'batch'
+    assert group.constraints == [['pool', 'LIKE', 'batch']]
+
+
+def test_get_constraints():
+    service_config = make_service_config()
+    with contextlib.nested(
+        mock.patch('paasta_tools.paasta_capacity.load_service_namespace_config', autospec=True),
+        mock.patch.object(MarathonServiceConfig, 'get_calculated_constraints', autospec=True,
+                          return_value=[['region', 'GROUP_BY', '2']]),
+    ) as (mock_load_service_namespace_config, mock_get_calculated_constraints):
+        assert paasta_capacity.get_constraints(service_config, 'fake_soa_dir') == [['region', 'GROUP_BY', '2']]
+        mock_load_service_namespace_config.assert_called_once_with('svc', 'main', soa_dir='fake_soa_dir')
+        mock_get_calculated_constraints.assert_called_once_with(
+            service_config, mock_load_service_namespace_config.return_value)
+
+
+def test_get_constraints_without_slaves():
+    with contextlib.nested(
+        mock.patch('paasta_tools.paasta_capacity.load_service_namespace_config', autospec=True),
+        mock.patch.object(MarathonServiceConfig, 'get_calculated_constraints', autospec=True,
+                          side_effect=NoSlavesAvailable),
+    ):
+        assert paasta_capacity.get_constraints(make_service_config(pool='batch'), 'fake_soa_dir') == [
+            ['pool', 'LIKE', 'batch'],
+        ]
+        assert paasta_capacity.get_constraints(make_service_config(constraints=[['a', 'LIKE', 'b']]),
+                                               'fake_soa_dir') == [['a', 'LIKE', 'b']]
+
+
+def test_get_task_groups():
+    service_configs = {
+        'main': make_service_config('main', instances=3),
+        'canary': make_service_config('canary', instances=1),
+    }
+
+    def load_marathon_service_config(service, instance, cluster, load_deployments, soa_dir):
+        if instance == 'undeployed':
+            raise NoDeploymentsAvailable
+        return service_configs[instance]
+
+    with contextlib.nested(
+        mock.patch('paasta_tools.paasta_capacity.get_services_for_cluster', autospec=True,
+                   return_value=[('svc', 'main'), ('svc', 'undeployed'), ('svc', 'canary')]),
+        mock.patch('paasta_tools.paasta_capacity.load_marathon_service_config', autospec=True,
+                   side_effect=load_marathon_service_config),
+        mock.patch('paasta_tools.paasta_capacity.get_constraints', autospec=True, return_value=[]),
+        mock.patch('paasta_tools.paasta_capacity.log', autospec=True),
+    ) as (mock_get_services_for_cluster, _, __, mock_log):
+        groups = paasta_capacity.get_task_groups('fake_cluster', 'fake_soa_dir', scale=1.5, instance_counts={
+            ('svc', 'canary'): 4,
+            ('svc', 'other'): 2,
+        })
+        mock_get_services_for_cluster.assert_called_once_with(
+            cluster='fake_cluster', instance_type='marathon', soa_dir='fake_soa_dir')
+        assert mock_log.warning.call_count == 1
+    assert [(group.name, group.count) for group in groups] == [('svc.canary', 4), ('svc.main', 5)]
+
+
+def test_main():
+    with contextlib.nested(
+        mock.patch('paasta_tools.paasta_capacity.parse_args', autospec=True, return_value=argparse.Namespace(
+            soa_dir='fake_soa_dir', scale=2.0, instance_counts=[(('svc', 'main'), 4)], verbose=False)),
+        mock.patch('paasta_tools.paasta_capacity.load_system_paasta_config', autospec=True),
+        mock.patch('paasta_tools.paasta_capacity.get_mesos_state_from_leader', autospec=True),
+        mock.patch('paasta_tools.paasta_capacity.get_hosts_from_mesos_state', autospec=True),
+        mock.patch('paasta_tools.paasta_capacity.get_task_groups', autospec=True, return_value=[]),
+        mock.patch('paasta_tools.paasta_capacity.plan_capacity', autospec=True, return_value=['report']),
+        mock.patch('paasta_tools.paasta_capacity.format_pool_report', autospec=True, return_value=['Pool x']),
+    ) as (_, mock_load_system_paasta_config, mock_get_mesos_state_from_leader, mock_get_hosts_from_mesos_state,
+          mock_get_task_groups, mock_plan_capacity, mock_format_pool_report):
+        mock_load_system_paasta_config.return_value.get_cluster.return_value = 'fake_cluster'
+        with raises(SystemExit) as excinfo:
+            paasta_capacity.main()
+        assert excinfo.value.code == 0
+        mock_get_hosts_from_mesos_state.assert_called_once_with(mock_get_mesos_state_from_leader.return_value)
+        mock_get_task_groups.assert_called_once_with('fake_cluster', 'fake_soa_dir', scale=2.0,
+                                                     instance_counts={('svc', 'main'): 4})
+        mock_plan_capacity.assert_called_once_with(mock_get_hosts_from_mesos_state.return_value, [])
+        mock_format_pool_report.assert_called_once_with('report')
+
+
+def test_main_without_a_master():
+    with contextlib.nested(
+        mock.patch('paasta_tools.paasta_capacity.parse_args', autospec=True, return_value=argparse.Namespace(
+            soa_dir='fake_soa_dir', scale=1.0, instance_counts=[], verbose=False)),
+        mock.patch('paasta_tools.paasta_capacity.load_system_paasta_config', autospec=True),
+        mock.patch('paasta_tools.paasta_capacity.get_mesos_state_from_leader', autospec=True,
+                   side_effect=MasterNotAvailableException('no master')),
+    ):
+        with raises(SystemExit) as excinfo:
+            paasta_capacity.main()
+        assert excinfo.value.code == 2
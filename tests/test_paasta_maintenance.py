@@ -35,6 +35,8 @@ from paasta_tools.paasta_maintenance import get_maintenance_status
 from paasta_tools.paasta_maintenance import is_host_down
 from paasta_tools.paasta_maintenance import is_host_draining
 from paasta_tools.paasta_maintenance import load_credentials
+from paasta_tools.paasta_maintenance import MaintenanceIndex
+from paasta_tools.paasta_maintenance import MaintenanceSnapshot
 from paasta_tools.paasta_maintenance import parse_timedelta
 from paasta_tools.paasta_maintenance import schedule
 from paasta_tools.paasta_maintenance import seconds_to_nanoseconds
@@ -112,10 +114,12 @@ def test_get_machine_ids_multiple_hosts(
     ip1 = '169.254.121.212'
     ip2 = '169.254.121.213'
     ip3 = '169.254.121.214'
-    mock_gethostbyname.side_effect = [ip1, ip2, ip3]
     hostname1 = 'fqdn1.example.org'
     hostname2 = 'fqdn2.example.org'
     hostname3 = 'fqdn3.example.org'
+    ips = {hostname1: ip1, hostname2: ip2, hostname3: ip3}
+    # The hostnames are resolved concurrently, so they may be looked up in any order.
+    mock_gethostbyname.side_effect = lambda hostname: ips[hostname]
     hostnames = [hostname1, hostname2, hostname3]
     expected = [
         {
@@ -506,7 +510,7 @@ def test_schedule(
 def test_get_hosts_with_state_none(
     mock_get_maintenance_status,
 ):
-    mock_get_maintenance_status.return_value = {}
+    mock_get_maintenance_status.return_value.json.return_value = {}
     assert get_hosts_with_state(state='fake_state') == []
 
 
@@ -530,7 +534,7 @@ def test_get_hosts_with_state_draining(
             }
         ]
     }
-    mock_get_maintenance_status.return_value = fake_status
+    mock_get_maintenance_status.return_value.json.return_value = fake_status
     expected = sorted(['fake-host1.fakesite.something', 'fake-host2.fakesite.something'])
     assert sorted(get_hosts_with_state(state='draining_machines')) == expected
 
@@ -555,7 +559,7 @@ def test_get_hosts_with_state_down(
             }
         ]
     }
-    mock_get_maintenance_status.return_value = fake_status
+    mock_get_maintenance_status.return_value.json.return_value = fake_status
     expected = sorted(['fake-host1.fakesite.something', 'fake-host2.fakesite.something'])
     assert sorted(get_hosts_with_state(state='down_machines')) == expected
 
@@ -580,19 +584,101 @@ def test_get_down_hosts(
     assert mock_get_hosts_with_state.call_args == expected_args
 
 
-@mock.patch('paasta_tools.paasta_maintenance.get_draining_hosts')
+FAKE_MAINTENANCE_STATUS = {
+    "draining_machines": [
+        {"id": {"hostname": "fake-host1.fakesite.something", "ip": "0.0.0.0"}},
+        {"id": {"hostname": "fake-host2.fakesite.something", "ip": "0.0.0.1"}},
+    ],
+    "down_machines": [
+        {"id": {"hostname": "fake-host3.fakesite.something", "ip": "0.0.0.2"}},
+    ],
+}
+
+
+@mock.patch('paasta_tools.paasta_maintenance.get_maintenance_status')
 def test_is_host_draining(
-    mock_get_draining_hosts,
+    mock_get_maintenance_status,
 ):
-    mock_get_draining_hosts.return_value = ['fake-host1.fakesite.something', 'fake-host2.fakesite.something']
+    mock_get_maintenance_status.return_value.json.return_value = FAKE_MAINTENANCE_STATUS
     assert is_host_draining('fake-host1.fakesite.something')
     assert not is_host_draining('fake-host3.fakesite.something')
 
 
-@mock.patch('paasta_tools.paasta_maintenance.get_down_hosts')
+@mock.patch('paasta_tools.paasta_maintenance.get_maintenance_status')
 def test_is_host_down(
-    mock_get_down_hosts,
+    mock_get_maintenance_status,
+):
+    mock_get_maintenance_status.return_value.json.return_value = FAKE_MAINTENANCE_STATUS
+    assert is_host_down('fake-host3.fakesite.something')
+    assert not is_host_down('fake-host1.fakesite.something')
+
+
+@mock.patch('paasta_tools.paasta_maintenance.getfqdn', autospec=True)
+@mock.patch('paasta_tools.paasta_maintenance.get_maintenance_status')
+def test_is_host_draining_defaults_to_current_host(
+    mock_get_maintenance_status,
+    mock_getfqdn,
+):
+    mock_get_maintenance_status.return_value.json.return_value = FAKE_MAINTENANCE_STATUS
+    mock_getfqdn.return_value = 'fake-host2.fakesite.something'
+    assert is_host_draining()
+
+
+def test_maintenance_index():
+    index = MaintenanceIndex(FAKE_MAINTENANCE_STATUS)
+    assert index.is_draining('fake-host1.fakesite.something')
+    assert not index.is_down('fake-host1.fakesite.something')
+    assert index.is_down('fake-host3.fakesite.something')
+    assert index.is_under_maintenance('fake-host3.fakesite.something')
+    assert not index.is_under_maintenance('fake-host4.fakesite.something')
+    assert index.get_hosts_under_maintenance() == set([
+        'fake-host1.fakesite.something',
+        'fake-host2.fakesite.something',
+        'fake-host3.fakesite.something',
+    ])
+    assert index.get_hosts_with_state('fake_state') == set()
+
+
+def test_maintenance_index_empty_status():
+    index = MaintenanceIndex(None)
+    assert not index.is_under_maintenance('fake-host1.fakesite.something')
+    assert index.get_hosts_under_maintenance() == set()
+
+
+@mock.patch('paasta_tools.paasta_maintenance.get_maintenance_status')
+def test_maintenance_snapshot_fetches_once(
+    mock_get_maintenance_status,
 ):
-    mock_get_down_hosts.return_value = ['fake-host1.fakesite.something', 'fake-host2.fakesite.something']
-    assert is_host_down('fake-host1.fakesite.something')
-    assert not is_host_down('fake-host3.fakesite.something')
+    mock_get_maintenance_status.return_value.json.return_value = FAKE_MAINTENANCE_STATUS
+    with MaintenanceSnapshot():
+        with MaintenanceSnapshot():
+            assert is_host_draining('fake-host1.fakesite.something')
+        assert is_host_down('fake-host3.fakesite.something')
+        assert sorted(get_draining_hosts()) == ['fake-host1.fakesite.something', 'fake-host2.fakesite.something']
+    assert mock_get_maintenance_status.call_count == 1
+    # Outside of the snapshot, every lookup asks the master again.
+    assert is_host_draining('fake-host1.fakesite.something')
+    assert mock_get_maintenance_status.call_count == 2
+
+
+@mock.patch('paasta_tools.paasta_maintenance.get_maintenance_status')
+def test_maintenance_snapshot_get_active_index(
+    mock_get_maintenance_status,
+):
+    mock_get_maintenance_status.return_value.json.return_value = FAKE_MAINTENANCE_STATUS
+    assert MaintenanceSnapshot.get_active_index() is None
+    with MaintenanceSnapshot():
+        assert MaintenanceSnapshot.get_active_index().is_draining('fake-host1.fakesite.something')
+        assert MaintenanceSnapshot.get_active_index().is_down('fake-host3.fakesite.something')
+    assert mock_get_maintenance_status.call_count == 1
+
+
+@mock.patch('paasta_tools.paasta_maintenance.get_maintenance_status')
+def test_maintenance_snapshot_get_active_index_remembers_failures(
+    mock_get_maintenance_status,
+):
+    mock_get_maintenance_status.side_effect = IOError
+    with MaintenanceSnapshot():
+        assert MaintenanceSnapshot.get_active_index().get_hosts_under_maintenance() == set()
+        assert MaintenanceSnapshot.get_active_index().get_hosts_under_maintenance() == set()
+    assert mock_get_maintenance_status.call_count == 1
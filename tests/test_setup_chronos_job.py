@@ -65,6 +65,7 @@ class TestSetupChronosJob:
         service_instance=compose_job_id(fake_service, fake_instance),
         soa_dir='no_more',
         verbose=False,
+        all=False,
     )
 
     def test_main_success(self):
@@ -193,6 +194,63 @@ class TestSetupChronosJob:
                 output=expected_error_msg
             )
 
+    def test_deploy_chronos_job_sends_setup_result(self):
+        with contextlib.nested(
+            mock.patch('paasta_tools.setup_chronos_job.load_complete_job_config', autospec=True,
+                       return_value=({'foo': 'bar'}, None)),
+            mock.patch('paasta_tools.setup_chronos_job.setup_job', autospec=True, return_value=(1, 'broken')),
+            mock.patch('paasta_tools.setup_chronos_job.send_event', autospec=True),
+        ) as (
+            load_complete_job_config_patch,
+            setup_job_patch,
+            send_event_patch,
+        ):
+            assert setup_chronos_job.deploy_chronos_job(
+                self.fake_service, self.fake_instance, self.fake_client, self.fake_cluster, 'fake_soa_dir') == 1
+            load_complete_job_config_patch.assert_called_once_with(
+                self.fake_service, self.fake_instance, self.fake_cluster, 'fake_soa_dir')
+            setup_job_patch.assert_called_once_with(
+                service=self.fake_service,
+                instance=self.fake_instance,
+                cluster=self.fake_cluster,
+                complete_job_config={'foo': 'bar'},
+                client=self.fake_client,
+            )
+            send_event_patch.assert_called_once_with(
+                service=self.fake_service,
+                instance=self.fake_instance,
+                soa_dir='fake_soa_dir',
+                status=Status.CRITICAL,
+                output='broken',
+            )
+
+    def test_deploy_chronos_job_without_config(self):
+        with contextlib.nested(
+            mock.patch('paasta_tools.setup_chronos_job.load_complete_job_config', autospec=True),
+            mock.patch('paasta_tools.setup_chronos_job.setup_job', autospec=True),
+            mock.patch('paasta_tools.setup_chronos_job.send_event', autospec=True),
+        ) as (
+            load_complete_job_config_patch,
+            setup_job_patch,
+            send_event_patch,
+        ):
+            load_complete_job_config_patch.return_value = (None, None)
+            assert setup_chronos_job.deploy_chronos_job(
+                self.fake_service, self.fake_instance, self.fake_client, self.fake_cluster, 'fake_soa_dir') == 0
+            assert send_event_patch.call_count == 0
+
+            load_complete_job_config_patch.return_value = (None, 'no deployments')
+            assert setup_chronos_job.deploy_chronos_job(
+                self.fake_service, self.fake_instance, self.fake_client, self.fake_cluster, 'fake_soa_dir') == 1
+            send_event_patch.assert_called_once_with(
+                service=self.fake_service,
+                instance=self.fake_instance,
+                soa_dir='fake_soa_dir',
+                status=Status.CRITICAL,
+                output='no deployments',
+            )
+            assert setup_job_patch.call_count == 0
+
     def test_setup_job_new_app_with_no_previous_jobs(self):
         fake_existing_jobs = []
         with contextlib.nested(
@@ -413,3 +471,142 @@ class TestSetupChronosJob:
             )
             assert not mock_log.called
             assert not mock_update_job.called
+
+    def test_plan_job_changes(self):
+        desired_jobs = {
+            ('svc', 'new'): {'name': 'svc new', 'description': 'hash1', 'disabled': False},
+            ('svc', 'same'): {'name': 'svc same', 'description': 'hash2', 'disabled': False},
+            ('svc', 'changed'): {'name': 'svc changed', 'description': 'hash3', 'disabled': False},
+            ('svc', 'stopped'): {'name': 'svc stopped', 'description': 'hash4', 'disabled': True},
+        }
+        existing_jobs = [
+            {'name': 'svc same', 'description': 'hash2', 'disabled': False},
+            {'name': 'svc changed', 'description': 'old', 'disabled': False},
+            {'name': 'svc stopped', 'description': 'old', 'disabled': False},
+            {'name': '%s svc new' % chronos_tools.TMP_JOB_IDENTIFIER, 'description': 'hash1', 'disabled': False},
+        ]
+        changes, unchanged = setup_chronos_job.plan_job_changes(desired_jobs, existing_jobs)
+        assert changes == [
+            ('update', 'svc', 'changed', desired_jobs[('svc', 'changed')]),
+            ('create', 'svc', 'new', desired_jobs[('svc', 'new')]),
+            ('disable', 'svc', 'stopped', desired_jobs[('svc', 'stopped')]),
+        ]
+        assert unchanged == [('svc', 'same')]
+
+    def test_apply_job_changes_keeps_going_after_a_failure(self):
+        def fake_bounce(service, instance, cluster, job_to_update, client):
+            if instance == 'bad':
+                raise Exception('chronos said no')
+            return (0, 'ok')
+
+        changes = [
+            ('create', 'svc', 'bad', {'name': 'svc bad'}),
+            ('update', 'svc', 'good', {'name': 'svc good'}),
+        ]
+        with mock.patch('paasta_tools.setup_chronos_job.bounce_chronos_job', autospec=True,
+                        side_effect=fake_bounce) as mock_bounce:
+            results = setup_chronos_job.apply_job_changes(changes, self.fake_client, self.fake_cluster, 2)
+            assert mock_bounce.call_count == 2
+        assert results == {
+            ('svc', 'bad'): (1, 'Failed to update the chronos job: chronos said no'),
+            ('svc', 'good'): (0, 'ok'),
+        }
+
+    def test_reconcile_jobs_lists_chronos_jobs_once(self):
+        fake_client = mock.Mock()
+        fake_client.list.return_value = [
+            {'name': 'svc same', 'description': 'hash', 'disabled': False},
+        ]
+
+        def fake_create_complete_config(service, job_name, soa_dir):
+            if job_name == 'missing':
+                raise NoDeploymentsAvailable
+            # Dependent jobs look up their parents while their config is built.
+            chronos_tools.lookup_chronos_jobs(fake_client, service='svc', instance='same')
+            return {'name': 'svc %s' % job_name, 'description': 'hash', 'disabled': False}
+
+        with contextlib.nested(
+            mock.patch('paasta_tools.chronos_tools.get_chronos_jobs_for_cluster', autospec=True,
+                       return_value=[('svc', 'same'), ('svc', 'new'), ('svc', 'missing')]),
+            mock.patch('paasta_tools.chronos_tools.create_complete_config', autospec=True,
+                       side_effect=fake_create_complete_config),
+            mock.patch('paasta_tools.setup_chronos_job.bounce_chronos_job', autospec=True,
+                       return_value=(0, 'ok')),
+        ) as (
+            mock_get_jobs_for_cluster,
+            mock_create_complete_config,
+            mock_bounce,
+        ):
+            reconciled = setup_chronos_job.reconcile_jobs(fake_client, self.fake_cluster, 'soa_dir')
+        fake_client.list.assert_called_once_with()
+        mock_bounce.assert_called_once_with(
+            service='svc',
+            instance='new',
+            cluster=self.fake_cluster,
+            job_to_update={'name': 'svc new', 'description': 'hash', 'disabled': False},
+            client=fake_client,
+        )
+        assert [change[:3] for change in reconciled['changes']] == [('create', 'svc', 'new')]
+        assert reconciled['unchanged'] == [('svc', 'same')]
+        assert reconciled['results'][('svc', 'new')] == (0, 'ok')
+        assert reconciled['results'][('svc', 'missing')][0] == 1
+        assert [step for step, seconds in reconciled['timings']] == ['list', 'build', 'diff', 'apply']
+
+    def test_format_reconcile_summary(self):
+        reconciled = {
+            'changes': [('create', 'svc', 'new', {}), ('disable', 'svc', 'stopped', {})],
+            'unchanged': [('svc', 'same')],
+            'results': {
+                ('svc', 'new'): (0, 'ok'),
+                ('svc', 'stopped'): (1, 'failed'),
+                ('svc', 'same'): (0, 'ok'),
+            },
+            'timings': [('list', 0.5), ('apply', 1.25)],
+        }
+        assert setup_chronos_job.format_reconcile_summary(reconciled) == (
+            "1 created, 0 updated, 1 disabled, 1 unchanged, 1 failed\n"
+            "  create svc.new\n"
+            "  disable svc.stopped\n"
+            "  failed svc.stopped\n"
+            "Timings: list 0.50s, apply 1.25s"
+        )
+
+    def test_main_all_reconciles_and_sends_events(self):
+        fake_args = mock.MagicMock(soa_dir='no_more', verbose=False, all=True, concurrency=3)
+        reconciled = {
+            'changes': [],
+            'unchanged': [],
+            'results': {('svc', 'good'): (0, 'ok'), ('svc', 'bad'): (1, 'broken')},
+            'timings': [],
+        }
+        with contextlib.nested(
+            mock.patch('paasta_tools.setup_chronos_job.parse_args', return_value=fake_args, autospec=True),
+            mock.patch('paasta_tools.chronos_tools.load_chronos_config', autospec=True),
+            mock.patch('paasta_tools.chronos_tools.get_chronos_client', return_value=self.fake_client,
+                       autospec=True),
+            mock.patch('paasta_tools.setup_chronos_job.load_system_paasta_config', autospec=True),
+            mock.patch('paasta_tools.setup_chronos_job.reconcile_jobs', autospec=True, return_value=reconciled),
+            mock.patch('paasta_tools.monitoring_tools.batched_sensu_events', autospec=True),
+            mock.patch('paasta_tools.setup_chronos_job.send_event', autospec=True),
+            mock.patch('paasta_tools.setup_chronos_job.setup_job', autospec=True),
+        ) as (
+            parse_args_patch,
+            load_chronos_config_patch,
+            get_client_patch,
+            load_system_paasta_config_patch,
+            reconcile_jobs_patch,
+            batched_sensu_events_patch,
+            send_event_patch,
+            setup_job_patch,
+        ):
+            load_system_paasta_config_patch.return_value.get_cluster.return_value = self.fake_cluster
+            with raises(SystemExit) as excinfo:
+                setup_chronos_job.main()
+            assert excinfo.value.code == 0
+            reconcile_jobs_patch.assert_called_once_with(self.fake_client, self.fake_cluster, 'no_more',
+                                                         concurrency=3)
+            send_event_patch.assert_any_call(service='svc', instance='bad', soa_dir='no_more',
+                                             status=Status.CRITICAL, output='broken')
+            send_event_patch.assert_any_call(service='svc', instance='good', soa_dir='no_more',
+                                             status=Status.OK, output='ok')
+            assert not setup_job_patch.called
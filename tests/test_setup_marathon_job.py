@@ -23,6 +23,8 @@ from paasta_tools import marathon_tools
 from paasta_tools import setup_marathon_job
 from paasta_tools import utils
 from paasta_tools.bounce_lib import list_bounce_methods
+from paasta_tools.mesos_tools import MasterNotAvailableException
+from paasta_tools.paasta_maintenance import MaintenanceIndex
 from paasta_tools.utils import compose_job_id
 from paasta_tools.utils import decompose_job_id
 from paasta_tools.utils import NoDeploymentsAvailable
@@ -92,6 +94,7 @@ class TestSetupMarathonJob:
             ),
             mock.patch('paasta_tools.setup_marathon_job.load_system_paasta_config', autospec=True),
             mock.patch('paasta_tools.setup_marathon_job.send_event', autospec=True),
+            mock.patch('paasta_tools.setup_marathon_job.monitoring_tools.batched_sensu_events', autospec=True),
             mock.patch('sys.exit', autospec=True),
         ) as (
             parse_args_patch,
@@ -101,6 +104,7 @@ class TestSetupMarathonJob:
             setup_service_patch,
             load_system_paasta_config_patch,
             sensu_patch,
+            batched_sensu_events_patch,
             sys_exit_patch,
         ):
             load_system_paasta_config_patch.return_value.get_cluster = mock.Mock(return_value=self.fake_cluster)
@@ -158,6 +162,7 @@ class TestSetupMarathonJob:
             ),
             mock.patch('paasta_tools.setup_marathon_job.load_system_paasta_config', autospec=True),
             mock.patch('paasta_tools.setup_marathon_job.send_event', autospec=True),
+            mock.patch('paasta_tools.setup_marathon_job.monitoring_tools.batched_sensu_events', autospec=True),
             mock.patch('sys.exit', autospec=True),
         ) as (
             parse_args_patch,
@@ -167,6 +172,7 @@ class TestSetupMarathonJob:
             setup_service_patch,
             load_system_paasta_config_patch,
             sensu_patch,
+            batched_sensu_events_patch,
             sys_exit_patch,
         ):
             load_system_paasta_config_patch.return_value.get_cluster = mock.Mock(return_value=self.fake_cluster)
@@ -221,6 +227,7 @@ class TestSetupMarathonJob:
                 autospec=True,
             ),
             mock.patch('paasta_tools.setup_marathon_job.load_system_paasta_config', autospec=True),
+            mock.patch('paasta_tools.setup_marathon_job.monitoring_tools.batched_sensu_events', autospec=True),
         ) as (
             parse_args_patch,
             get_main_conf_patch,
@@ -228,6 +235,7 @@ class TestSetupMarathonJob:
             read_service_conf_patch,
             setup_service_patch,
             load_system_paasta_config_patch,
+            batched_sensu_events_patch,
         ):
             load_system_paasta_config_patch.return_value.get_cluster = mock.Mock(return_value=self.fake_cluster)
             with raises(SystemExit) as exc_info:
@@ -765,6 +773,327 @@ class TestSetupMarathonJob:
                 force=True,
             )
 
+    def test_is_converged(self):
+        config = {'id': 'some_id', 'instances': 3}
+        new_app = mock.Mock(id='/some_id', instances=3)
+        assert setup_marathon_job.is_converged([new_app], [], config)
+        assert not setup_marathon_job.is_converged([], [], config)
+        assert not setup_marathon_job.is_converged([new_app], [mock.Mock(id='/old_id', instances=3)], config)
+        assert not setup_marathon_job.is_converged([mock.Mock(id='/some_id', instances=2)], [], config)
+
+    def test_is_converged_with_tasks_under_maintenance(self):
+        config = {'id': 'some_id', 'instances': 2}
+        fake_index = MaintenanceIndex({
+            'draining_machines': [{'id': {'hostname': 'draining-host', 'ip': '0.0.0.0'}}],
+        })
+        fine_app = mock.Mock(id='/some_id', instances=2, tasks=[mock.Mock(host='fine-host')] * 2)
+        doomed_app = mock.Mock(id='/some_id', instances=2,
+                               tasks=[mock.Mock(host='fine-host'), mock.Mock(host='draining-host')])
+        assert setup_marathon_job.is_converged([fine_app], [], config, fake_index)
+        assert not setup_marathon_job.is_converged([doomed_app], [], config, fake_index)
+        assert setup_marathon_job.is_converged([doomed_app], [], config, None)
+
+    def test_has_room_off_maintenance(self):
+        fake_index = MaintenanceIndex({
+            'draining_machines': [{'id': {'hostname': 'draining-host', 'ip': '0.0.0.0'}}],
+        })
+        config = {'id': 'some_id', 'cpus': 1, 'mem': 1024, 'disk': 0, 'constraints': [['pool', 'LIKE', 'default']]}
+
+        def make_slave(hostname, used_cpus, active=True, pool='default'):
+            return {
+                'hostname': hostname,
+                'active': active,
+                'attributes': {'pool': pool},
+                'resources': {'cpus': 4, 'mem': 4096, 'disk': 1000},
+                'used_resources': {'cpus': used_cpus, 'mem': 0, 'disk': 0},
+            }
+
+        with mock.patch('paasta_tools.setup_marathon_job.get_mesos_state_from_leader',
+                        autospec=True) as mock_get_mesos_state_from_leader:
+            mock_get_mesos_state_from_leader.return_value = {'slaves': [
+                make_slave('draining-host', 0),
+                make_slave('full-host', 3.5),
+                make_slave('inactive-host', 0, active=False),
+                make_slave('batch-host', 0, pool='batch'),
+            ]}
+            assert not setup_marathon_job.has_room_off_maintenance(config, fake_index)
+            mock_get_mesos_state_from_leader.return_value['slaves'].append(make_slave('roomy-host', 3))
+            assert setup_marathon_job.has_room_off_maintenance(config, fake_index)
+
+    def test_get_maintenance_index_for_deploy(self):
+        config = {'id': 'some_id', 'instances': 2}
+        fake_index = MaintenanceIndex({
+            'draining_machines': [{'id': {'hostname': 'draining-host', 'ip': '0.0.0.0'}}],
+        })
+        fine_app = mock.Mock(id='/some_id', instances=2, tasks=[mock.Mock(host='fine-host')] * 2)
+        doomed_app = mock.Mock(id='/some_id', instances=2,
+                               tasks=[mock.Mock(host='fine-host'), mock.Mock(host='draining-host')])
+        with contextlib.nested(
+            mock.patch('paasta_tools.setup_marathon_job.MaintenanceSnapshot.get_active_index'),
+            mock.patch('paasta_tools.setup_marathon_job.has_room_off_maintenance', autospec=True),
+        ) as (mock_get_active_index, mock_has_room_off_maintenance):
+            mock_get_active_index.return_value = None
+            assert setup_marathon_job.get_maintenance_index_for_deploy([doomed_app], config) is None
+            mock_get_active_index.return_value = fake_index
+            assert setup_marathon_job.get_maintenance_index_for_deploy([], config) is fake_index
+            assert setup_marathon_job.get_maintenance_index_for_deploy([fine_app], config) is fake_index
+            assert not mock_has_room_off_maintenance.called
+
+            mock_has_room_off_maintenance.return_value = True
+            assert setup_marathon_job.get_maintenance_index_for_deploy([doomed_app], config) is fake_index
+            mock_has_room_off_maintenance.assert_called_once_with(config, fake_index)
+            mock_has_room_off_maintenance.return_value = False
+            assert setup_marathon_job.get_maintenance_index_for_deploy([doomed_app], config) is None
+            mock_has_room_off_maintenance.side_effect = MasterNotAvailableException('no master')
+            assert setup_marathon_job.get_maintenance_index_for_deploy([doomed_app], config) is fake_index
+
+    def test_deploy_service_converged_skips_bounce(self):
+        fake_config = {
+            'id': 'some_id',
+            'instances': 3,
+        }
+        fake_client = mock.MagicMock()
+        with contextlib.nested(
+            mock.patch('paasta_tools.setup_marathon_job._log', autospec=True),
+            mock.patch('paasta_tools.setup_marathon_job.load_system_paasta_config', autospec=True),
+            mock.patch('paasta_tools.setup_marathon_job.marathon_tools.get_matching_apps', autospec=True),
+            mock.patch('paasta_tools.setup_marathon_job.bounce_lib.get_happy_tasks', autospec=True),
+            mock.patch('paasta_tools.setup_marathon_job.drain_lib.get_drain_method', autospec=True),
+            mock.patch('paasta_tools.setup_marathon_job.bounce_lib.bounce_lock_zookeeper', autospec=True),
+            mock.patch('paasta_tools.setup_marathon_job.send_sensu_bounce_keepalive', autospec=True),
+        ) as (
+            mock_log,
+            mock_load_system_paasta_config,
+            mock_get_matching_apps,
+            mock_get_happy_tasks,
+            mock_get_drain_method,
+            mock_bounce_lock_zookeeper,
+            mock_send_sensu_bounce_keepalive,
+        ):
+            mock_load_system_paasta_config.return_value.get_cluster.return_value = 'fake_cluster'
+            mock_get_matching_apps.return_value = [mock.Mock(id='/some_id', instances=3, tasks=[])]
+            result = setup_marathon_job.deploy_service(
+                service='fake_service',
+                instance='fake_instance',
+                marathon_jobid='some_id',
+                config=fake_config,
+                client=fake_client,
+                bounce_method='bounce',
+                drain_method_name='drain',
+                drain_method_params={},
+                nerve_ns='nerve',
+                bounce_health_params={},
+                soa_dir='/soa/dir',
+            )
+            assert result == (0, 'Service deployed.')
+            mock_send_sensu_bounce_keepalive.assert_called_once_with(
+                service='fake_service',
+                instance='fake_instance',
+                cluster='fake_cluster',
+                soa_dir='/soa/dir',
+            )
+            assert not mock_get_happy_tasks.called
+            assert not mock_get_drain_method.called
+            assert not mock_bounce_lock_zookeeper.called
+            assert not fake_client.scale_app.called
+
+    def test_get_tasks_under_maintenance(self):
+        fake_index = MaintenanceIndex({
+            'draining_machines': [{'id': {'hostname': 'draining-host', 'ip': '0.0.0.0'}}],
+            'down_machines': [{'id': {'hostname': 'down-host', 'ip': '0.0.0.1'}}],
+        })
+        happy_task = mock.Mock(host='draining-host')
+        unhappy_task = mock.Mock(host='down-host')
+        draining_task = mock.Mock(host='draining-host')
+        fine_task = mock.Mock(host='fine-host')
+        fake_drain_method = mock.Mock(is_draining=lambda task: task is draining_task)
+        assert setup_marathon_job.get_tasks_under_maintenance(
+            [happy_task, unhappy_task, draining_task, fine_task],
+            [happy_task, fine_task],
+            fake_drain_method,
+            fake_index,
+        ) == {
+            'happy': set([happy_task]),
+            'unhappy': set([unhappy_task]),
+            'draining': set([draining_task]),
+        }
+
+    def test_deploy_service_treats_tasks_under_maintenance_as_old(self):
+        fake_config = {
+            'id': 'some_id',
+            'instances': 3,
+        }
+        fake_client = mock.MagicMock()
+        fake_index = MaintenanceIndex({
+            'draining_machines': [{'id': {'hostname': 'draining-host', 'ip': '0.0.0.0'}}],
+        })
+        fine_tasks = [mock.Mock(host='fine-host') for _ in range(2)]
+        doomed_task = mock.Mock(host='draining-host')
+        draining_doomed_task = mock.Mock(host='draining-host')
+        with contextlib.nested(
+            mock.patch('paasta_tools.setup_marathon_job._log', autospec=True),
+            mock.patch('paasta_tools.setup_marathon_job.load_system_paasta_config', autospec=True),
+            mock.patch('paasta_tools.setup_marathon_job.marathon_tools.get_matching_apps', autospec=True),
+            mock.patch('paasta_tools.setup_marathon_job.bounce_lib.get_happy_tasks', autospec=True),
+            mock.patch('paasta_tools.setup_marathon_job.drain_lib.get_drain_method', autospec=True),
+            mock.patch('paasta_tools.setup_marathon_job.bounce_lib.get_bounce_method_func', autospec=True),
+            mock.patch('paasta_tools.setup_marathon_job.bounce_lib.bounce_lock_zookeeper', autospec=True),
+            mock.patch('paasta_tools.setup_marathon_job.do_bounce', autospec=True),
+            mock.patch('paasta_tools.setup_marathon_job.MaintenanceSnapshot.get_active_index'),
+            mock.patch('paasta_tools.setup_marathon_job.has_room_off_maintenance', autospec=True,
+                       return_value=True),
+        ) as (
+            mock_log,
+            mock_load_system_paasta_config,
+            mock_get_matching_apps,
+            mock_get_happy_tasks,
+            mock_get_drain_method,
+            mock_get_bounce_method_func,
+            mock_bounce_lock_zookeeper,
+            mock_do_bounce,
+            mock_get_active_index,
+            _,
+        ):
+            mock_load_system_paasta_config.return_value.get_cluster.return_value = 'fake_cluster'
+            new_app = mock.Mock(id='/some_id', instances=4, tasks=fine_tasks + [doomed_task, draining_doomed_task])
+            mock_get_matching_apps.return_value = [new_app, mock.Mock(id='/old_id', instances=1, tasks=[])]
+            mock_get_happy_tasks.return_value = fine_tasks + [doomed_task]
+            mock_drain_method = mock.Mock(is_draining=lambda task: task is draining_doomed_task)
+            mock_get_drain_method.return_value = mock_drain_method
+            mock_get_active_index.return_value = fake_index
+            setup_marathon_job.deploy_service(
+                service='fake_service',
+                instance='fake_instance',
+                marathon_jobid='some_id',
+                config=fake_config,
+                client=fake_client,
+                bounce_method='bounce',
+                drain_method_name='drain',
+                drain_method_params={},
+                nerve_ns='nerve',
+                bounce_health_params={},
+                soa_dir='/soa/dir',
+            )
+            bounce_kwargs = mock_do_bounce.call_args[1]
+            assert sorted(bounce_kwargs['happy_new_tasks']) == sorted(fine_tasks)
+            assert bounce_kwargs['old_app_live_happy_tasks']['/some_id'] == set([doomed_task])
+            assert bounce_kwargs['old_app_draining_tasks']['/some_id'] == set([draining_doomed_task])
+            # The task under maintenance that is already draining must stay drained.
+            assert mock.call(draining_doomed_task) not in mock_drain_method.stop_draining.call_args_list
+            assert mock.call(draining_doomed_task) in mock_drain_method.drain.call_args_list
+
+    def test_deploy_service_converged_with_a_draining_host_bounces(self):
+        fake_config = {
+            'id': 'some_id',
+            'instances': 3,
+        }
+        fake_client = mock.MagicMock()
+        fake_index = MaintenanceIndex({
+            'draining_machines': [{'id': {'hostname': 'draining-host', 'ip': '0.0.0.0'}}],
+        })
+        fine_tasks = [mock.Mock(host='fine-host') for _ in range(2)]
+        doomed_task = mock.Mock(host='draining-host')
+        with contextlib.nested(
+            mock.patch('paasta_tools.setup_marathon_job._log', autospec=True),
+            mock.patch('paasta_tools.setup_marathon_job.load_system_paasta_config', autospec=True),
+            mock.patch('paasta_tools.setup_marathon_job.marathon_tools.get_matching_apps', autospec=True),
+            mock.patch('paasta_tools.setup_marathon_job.bounce_lib.get_happy_tasks', autospec=True),
+            mock.patch('paasta_tools.setup_marathon_job.drain_lib.get_drain_method', autospec=True),
+            mock.patch('paasta_tools.setup_marathon_job.bounce_lib.get_bounce_method_func', autospec=True),
+            mock.patch('paasta_tools.setup_marathon_job.bounce_lib.bounce_lock_zookeeper', autospec=True),
+            mock.patch('paasta_tools.setup_marathon_job.do_bounce', autospec=True),
+            mock.patch('paasta_tools.setup_marathon_job.send_sensu_bounce_keepalive', autospec=True),
+            mock.patch('paasta_tools.setup_marathon_job.MaintenanceSnapshot.get_active_index'),
+            mock.patch('paasta_tools.setup_marathon_job.has_room_off_maintenance', autospec=True,
+                       return_value=True),
+        ) as (
+            mock_log,
+            mock_load_system_paasta_config,
+            mock_get_matching_apps,
+            mock_get_happy_tasks,
+            mock_get_drain_method,
+            mock_get_bounce_method_func,
+            mock_bounce_lock_zookeeper,
+            mock_do_bounce,
+            mock_send_sensu_bounce_keepalive,
+            mock_get_active_index,
+            _,
+        ):
+            mock_load_system_paasta_config.return_value.get_cluster.return_value = 'fake_cluster'
+            mock_get_matching_apps.return_value = [
+                mock.Mock(id='/some_id', instances=3, tasks=fine_tasks + [doomed_task]),
+            ]
+            mock_get_happy_tasks.return_value = fine_tasks + [doomed_task]
+            mock_get_drain_method.return_value = mock.Mock(is_draining=lambda task: False)
+            mock_get_active_index.return_value = fake_index
+            result = setup_marathon_job.deploy_service(
+                service='fake_service',
+                instance='fake_instance',
+                marathon_jobid='some_id',
+                config=fake_config,
+                client=fake_client,
+                bounce_method='bounce',
+                drain_method_name='drain',
+                drain_method_params={},
+                nerve_ns='nerve',
+                bounce_health_params={},
+                soa_dir='/soa/dir',
+            )
+            assert result == (0, 'Service deployed.')
+            assert not mock_send_sensu_bounce_keepalive.called
+            bounce_kwargs = mock_do_bounce.call_args[1]
+            assert sorted(bounce_kwargs['happy_new_tasks']) == sorted(fine_tasks)
+            assert bounce_kwargs['old_app_live_happy_tasks']['/some_id'] == set([doomed_task])
+
+    def test_deploy_service_with_nowhere_else_to_go_leaves_tasks_under_maintenance_alone(self):
+        fake_config = {
+            'id': 'some_id',
+            'instances': 3,
+        }
+        fake_index = MaintenanceIndex({
+            'draining_machines': [{'id': {'hostname': 'draining-host', 'ip': '0.0.0.0'}}],
+        })
+        with contextlib.nested(
+            mock.patch('paasta_tools.setup_marathon_job._log', autospec=True),
+            mock.patch('paasta_tools.setup_marathon_job.load_system_paasta_config', autospec=True),
+            mock.patch('paasta_tools.setup_marathon_job.marathon_tools.get_matching_apps', autospec=True),
+            mock.patch('paasta_tools.setup_marathon_job.do_bounce', autospec=True),
+            mock.patch('paasta_tools.setup_marathon_job.send_sensu_bounce_keepalive', autospec=True),
+            mock.patch('paasta_tools.setup_marathon_job.MaintenanceSnapshot.get_active_index',
+                       return_value=fake_index),
+            mock.patch('paasta_tools.setup_marathon_job.has_room_off_maintenance', autospec=True,
+                       return_value=False),
+        ) as (
+            mock_log,
+            mock_load_system_paasta_config,
+            mock_get_matching_apps,
+            mock_do_bounce,
+            mock_send_sensu_bounce_keepalive,
+            _,
+            mock_has_room_off_maintenance,
+        ):
+            mock_get_matching_apps.return_value = [
+                mock.Mock(id='/some_id', instances=3, tasks=[mock.Mock(host='fine-host'),
+                                                             mock.Mock(host='draining-host')]),
+            ]
+            result = setup_marathon_job.deploy_service(
+                service='fake_service',
+                instance='fake_instance',
+                marathon_jobid='some_id',
+                config=fake_config,
+                client=mock.MagicMock(),
+                bounce_method='bounce',
+                drain_method_name='drain',
+                drain_method_params={},
+                nerve_ns='nerve',
+                bounce_health_params={},
+                soa_dir='/soa/dir',
+            )
+            assert result == (0, 'Service deployed.')
+            mock_has_room_off_maintenance.assert_called_once_with(fake_config, fake_index)
+            assert mock_send_sensu_bounce_keepalive.called
+            assert not mock_do_bounce.called
+
     def test_deploy_service_scale_down(self):
         fake_service = 'fake_service'
         fake_instance = 'fake_instance'
@@ -0,0 +1,96 @@
+# Copyright 2015-2016 Yelp Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import contextlib
+import itertools
+import threading
+
+import mock
+
+from paasta_tools import smartstack_tools
+
+
+FAKE_HAPROXY_CSV = [
+    '# pxname,svname,status,',
+    'service.main,FRONTEND,OPEN,',
+    'service.main,10.0.0.1:31000_host1,UP,',
+    'service.main,BACKEND,UP,',
+    'other.main,10.0.0.2:31001_host2,DOWN,',
+]
+
+
+def test_get_multiple_backends():
+    with mock.patch(
+        'paasta_tools.smartstack_tools.retrieve_haproxy_csv',
+        side_effect=lambda *args, **kwargs: smartstack_tools.csv.DictReader(FAKE_HAPROXY_CSV),
+        autospec=True,
+    ):
+        backends = smartstack_tools.get_multiple_backends(['service.main'], 'fake_host', 3212, 'fake_format')
+        assert [(b['pxname'], b['svname']) for b in backends] == [('service.main', '10.0.0.1:31000_host1')]
+        backends = smartstack_tools.get_multiple_backends(None, 'fake_host', 3212, 'fake_format')
+        assert [b['pxname'] for b in backends] == ['service.main', 'other.main']
+
+
+def test_haproxy_snapshot_fetches_each_host_once():
+    with mock.patch(
+        'paasta_tools.smartstack_tools.retrieve_haproxy_csv',
+        side_effect=lambda *args, **kwargs: smartstack_tools.csv.DictReader(FAKE_HAPROXY_CSV),
+        autospec=True,
+    ) as retrieve_haproxy_csv_patch:
+        with smartstack_tools.HaproxySnapshot():
+            with smartstack_tools.HaproxySnapshot():
+                smartstack_tools.get_multiple_backends(['service.main'], 'fake_host1', 3212, 'fake_format')
+            smartstack_tools.get_multiple_backends(['other.main'], 'fake_host1', 3212, 'fake_format')
+            smartstack_tools.get_multiple_backends(['other.main'], 'fake_host2', 3212, 'fake_format')
+            assert retrieve_haproxy_csv_patch.call_count == 2
+        assert smartstack_tools.HaproxySnapshot.current() is None
+        smartstack_tools.get_multiple_backends(['other.main'], 'fake_host1', 3212, 'fake_format')
+        assert retrieve_haproxy_csv_patch.call_count == 3
+
+
+def test_haproxy_snapshot_refetches_old_answers():
+    with contextlib.nested(
+        mock.patch(
+            'paasta_tools.smartstack_tools.retrieve_haproxy_csv',
+            side_effect=lambda *args, **kwargs: smartstack_tools.csv.DictReader(FAKE_HAPROXY_CSV),
+            autospec=True,
+        ),
+        mock.patch('paasta_tools.smartstack_tools.time.time', autospec=True, side_effect=itertools.count(0, 4)),
+    ) as (retrieve_haproxy_csv_patch, _):
+        with smartstack_tools.HaproxySnapshot(max_age_s=10):
+            for _ in range(4):
+                smartstack_tools.get_multiple_backends(['service.main'], 'fake_host1', 3212, 'fake_format')
+        assert retrieve_haproxy_csv_patch.call_count == 2
+
+
+def test_haproxy_snapshot_is_per_thread():
+    with mock.patch(
+        'paasta_tools.smartstack_tools.retrieve_haproxy_csv',
+        side_effect=lambda *args, **kwargs: smartstack_tools.csv.DictReader(FAKE_HAPROXY_CSV),
+        autospec=True,
+    ) as retrieve_haproxy_csv_patch:
+        snapshots = []
+
+        def deploy():
+            with smartstack_tools.HaproxySnapshot() as snapshot:
+                snapshots.append(snapshot)
+                smartstack_tools.get_multiple_backends(['service.main'], 'fake_host1', 3212, 'fake_format')
+
+        with smartstack_tools.HaproxySnapshot() as outer_snapshot:
+            smartstack_tools.get_multiple_backends(['service.main'], 'fake_host1', 3212, 'fake_format')
+            thread = threading.Thread(target=deploy)
+            thread.start()
+            thread.join()
+            assert smartstack_tools.HaproxySnapshot.current() is outer_snapshot
+        assert snapshots[0] is not outer_snapshot
+        assert retrieve_haproxy_csv_patch.call_count == 2
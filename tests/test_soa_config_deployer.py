@@ -0,0 +1,83 @@
+# Copyright 2015-2016 Yelp Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import contextlib
+
+import mock
+
+from paasta_tools import soa_config_deployer
+from paasta_tools.soa_config_watcher import Debouncer
+
+
+def test_deploy_chronos_instances():
+    with contextlib.nested(
+        mock.patch('paasta_tools.soa_config_deployer.load_system_paasta_config', autospec=True),
+        mock.patch('paasta_tools.monitoring_tools.batched_sensu_events', autospec=True),
+        mock.patch('paasta_tools.chronos_tools.ChronosJobsSnapshot', autospec=True),
+        mock.patch('paasta_tools.setup_chronos_job.deploy_chronos_job', autospec=True,
+                   side_effect=[0, Exception('boom')]),
+    ) as (_, __, mock_snapshot, mock_deploy_chronos_job):
+        assert soa_config_deployer.deploy_chronos_instances(
+            set([('svc', 'b'), ('svc', 'a')]), 'fake_client', 'fake_cluster', 'fake_soa_dir') == {
+            ('svc', 'a'): 0,
+            ('svc', 'b'): 1,
+        }
+        assert mock_deploy_chronos_job.call_args_list == [
+            mock.call('svc', 'a', 'fake_client', 'fake_cluster', 'fake_soa_dir'),
+            mock.call('svc', 'b', 'fake_client', 'fake_cluster', 'fake_soa_dir'),
+        ]
+        assert mock_snapshot.call_count == 1
+        assert soa_config_deployer.deploy_chronos_instances(set(), 'fake_client', 'fake_cluster', 'soa') == {}
+
+
+class TestSoaConfigDeployer:
+
+    def make_deployer(self, changes):
+        watcher = mock.Mock(poll=mock.Mock(side_effect=changes))
+        deploy_functions = {
+            'marathon': mock.Mock(side_effect=lambda service_instances: dict.fromkeys(service_instances, 0)),
+            'chronos': mock.Mock(side_effect=lambda service_instances: dict.fromkeys(service_instances, 1)),
+        }
+        return soa_config_deployer.SoaConfigDeployer(watcher, deploy_functions, Debouncer(2, 30))
+
+    def test_start_ignores_the_first_poll(self):
+        deployer = self.make_deployer([{'marathon': set([('svc', 'main')]), 'chronos': set()}])
+        deployer.start()
+        assert deployer.debouncer.get_ready_time() is None
+
+    def test_run_once_deploys_bursts(self):
+        deployer = self.make_deployer([
+            {'marathon': set([('svc', 'main')]), 'chronos': set()},
+            {'marathon': set([('svc', 'canary')]), 'chronos': set([('svc', 'job')])},
+            {'marathon': set(), 'chronos': set()},
+            {'marathon': set(), 'chronos': set()},
+        ])
+        with mock.patch('paasta_tools.soa_config_deployer.time.time', autospec=True, return_value=100):
+            assert deployer.run_once(now=100) == {}
+            assert deployer.watcher.poll.call_args == mock.call(timeout=soa_config_deployer.IDLE_POLL_INTERVAL_S)
+            assert deployer.run_once(now=101) == {}
+            assert deployer.watcher.poll.call_args == mock.call(timeout=2)
+            assert deployer.run_once(now=102) == {}
+            assert deployer.run_once(now=103) == {
+                'marathon': {('svc', 'main'): 0, ('svc', 'canary'): 0},
+                'chronos': {('svc', 'job'): 1},
+            }
+        deployer.deploy_functions['marathon'].assert_called_once_with(set([('svc', 'main'), ('svc', 'canary')]))
+        deployer.deploy_functions['chronos'].assert_called_once_with(set([('svc', 'job')]))
+
+    def test_run_once_skips_types_it_does_not_deploy(self):
+        deployer = self.make_deployer([{'chronos': set([('svc', 'job')])}, {'chronos': set()}])
+        del deployer.deploy_functions['chronos']
+        assert deployer.run_once(now=100) == {}
+        assert deployer.run_once(now=102) == {}
+        assert deployer.debouncer.get_ready_time() is None
@@ -0,0 +1,261 @@
+# Copyright 2015-2016 Yelp Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import os
+import shutil
+import tempfile
+import time
+
+import mock
+import pytest
+import service_configuration_lib
+
+from paasta_tools import soa_config_watcher
+
+
+requires_pyinotify = pytest.mark.skipif(soa_config_watcher.pyinotify is None, reason="pyinotify is Linux-only")
+
+
+def write_file(path, contents, mtime_offset=0):
+    with open(path, 'w') as f:
+        f.write(contents)
+    # Make sure the mtime changes, however coarse the filesystem's timestamps are.
+    mtime = time.time() + mtime_offset
+    os.utime(path, (mtime, mtime))
+
+
+@pytest.yield_fixture
+def soa_dir():
+    soa_dir = tempfile.mkdtemp()
+    os.mkdir(os.path.join(soa_dir, 'fake_service'))
+    write_file(os.path.join(soa_dir, 'fake_service', 'marathon-fake_cluster.yaml'), 'main: {}\ncanary: {}\n')
+    write_file(os.path.join(soa_dir, 'fake_service', 'chronos-fake_cluster.yaml'), 'job: {}\n')
+    os.mkdir(os.path.join(soa_dir, 'other_service'))
+    write_file(os.path.join(soa_dir, 'other_service', 'marathon-fake_cluster.yaml'), 'main: {}\n')
+    # Like the daemons that use SoaConfigWatcher.
+    service_configuration_lib.disable_yaml_cache()
+    try:
+        yield soa_dir
+    finally:
+        service_configuration_lib.enable_yaml_cache()
+        shutil.rmtree(soa_dir)
+
+
+def test_get_affected_instance_types():
+    assert soa_config_watcher.get_affected_instance_types('deployments.json', 'c1') == ('marathon', 'chronos')
+    assert soa_config_watcher.get_affected_instance_types('service.yaml', 'c1') == ('marathon', 'chronos')
+    assert soa_config_watcher.get_affected_instance_types('smartstack.yaml', 'c1') == ('marathon',)
+    assert soa_config_watcher.get_affected_instance_types('marathon-c1.yaml', 'c1') == ('marathon',)
+    assert soa_config_watcher.get_affected_instance_types('chronos-c1.yaml', 'c1') == ('chronos',)
+    assert soa_config_watcher.get_affected_instance_types('marathon-c2.yaml', 'c1') == ()
+    assert soa_config_watcher.get_affected_instance_types('monitoring.yaml', 'c1') == ()
+    assert soa_config_watcher.get_affected_instance_types('.deployments.json.tmp', 'c1') == ()
+
+
+def test_polling_backend(soa_dir):
+    backend = soa_config_watcher.PollingBackend(soa_dir, 'fake_cluster')
+    assert backend.get_changed_paths() == set()
+
+    deployments_path = os.path.join(soa_dir, 'fake_service', 'deployments.json')
+    write_file(deployments_path, '{}')
+    write_file(os.path.join(soa_dir, 'fake_service', 'unrelated.txt'), '')
+    assert backend.get_changed_paths() == set([deployments_path])
+
+    write_file(deployments_path, '{"v1": {}}', mtime_offset=10)
+    os.remove(os.path.join(soa_dir, 'other_service', 'marathon-fake_cluster.yaml'))
+    assert backend.get_changed_paths() == set([
+        deployments_path, os.path.join(soa_dir, 'other_service', 'marathon-fake_cluster.yaml')])
+    assert backend.get_changed_paths() == set()
+
+
+def test_polling_backend_missing_soa_dir():
+    backend = soa_config_watcher.PollingBackend('/nonexistent/soa/dir', 'fake_cluster')
+    assert backend.get_changed_paths() == set()
+
+
+def test_get_watch_backend_without_pyinotify():
+    with mock.patch('paasta_tools.soa_config_watcher.pyinotify', None):
+        backend = soa_config_watcher.get_watch_backend('/nonexistent/soa/dir', 'fake_cluster')
+    assert isinstance(backend, soa_config_watcher.PollingBackend)
+
+
+def test_get_watch_backend_falls_back_to_polling():
+    with mock.patch('paasta_tools.soa_config_watcher.pyinotify') as mock_pyinotify:
+        mock_pyinotify.WatchManager.return_value.add_watch.return_value = {'/nail/etc/services': -1}
+        backend = soa_config_watcher.get_watch_backend('/nail/etc/services', 'fake_cluster')
+    assert isinstance(backend, soa_config_watcher.PollingBackend)
+
+
+def test_inotify_backend():
+    with mock.patch('paasta_tools.soa_config_watcher.pyinotify') as mock_pyinotify:
+        mock_pyinotify.IN_Q_OVERFLOW = 0x4000
+        mock_watch_manager = mock_pyinotify.WatchManager.return_value
+        mock_watch_manager.add_watch.return_value = {'/soa': 1, '/soa/fake_service': 2}
+        mock_notifier = mock_pyinotify.Notifier.return_value
+        backend = soa_config_watcher.get_watch_backend('/soa', 'fake_cluster')
+        assert isinstance(backend, soa_config_watcher.InotifyBackend)
+        assert mock_watch_manager.add_watch.call_args[1] == {'rec': True, 'auto_add': True}
+        assert mock_pyinotify.Notifier.call_args[1]['default_proc_fun'] == backend.process_event
+
+        def process_events():
+            backend.process_event(mock.Mock(mask=0x2, pathname='/soa/fake_service/deployments.json'))
+            backend.process_event(mock.Mock(mask=0x4000, pathname=None))
+        mock_notifier.check_events.return_value = True
+        mock_notifier.process_events.side_effect = process_events
+        assert backend.get_changed_paths(timeout=1.5) == set(['/soa/fake_service/deployments.json', '/soa'])
+        mock_notifier.check_events.assert_called_once_with(timeout=1500)
+
+        mock_notifier.check_events.return_value = False
+        assert backend.get_changed_paths() == set()
+
+
+@requires_pyinotify
+def test_inotify_backend_watches_the_soa_dir(soa_dir):
+    backend = soa_config_watcher.get_watch_backend(soa_dir, 'fake_cluster')
+    try:
+        assert isinstance(backend, soa_config_watcher.InotifyBackend)
+        assert backend.get_changed_paths() == set()
+
+        marathon_path = os.path.join(soa_dir, 'fake_service', 'marathon-fake_cluster.yaml')
+        write_file(marathon_path, 'main: {}\n')
+        deployments_path = os.path.join(soa_dir, 'other_service', 'deployments.json')
+        write_file(deployments_path + '.tmp', '{}')
+        os.rename(deployments_path + '.tmp', deployments_path)
+        assert set([marathon_path, deployments_path]) <= backend.get_changed_paths(timeout=1)
+
+        new_service_dir = os.path.join(soa_dir, 'new_service')
+        os.mkdir(new_service_dir)
+        assert new_service_dir in backend.get_changed_paths(timeout=1)
+        new_service_path = os.path.join(new_service_dir, 'marathon-fake_cluster.yaml')
+        write_file(new_service_path, 'main: {}\n')
+        os.remove(marathon_path)
+        assert set([new_service_path, marathon_path]) <= backend.get_changed_paths(timeout=1)
+        assert backend.get_changed_paths() == set()
+    finally:
+        backend.close()
+
+
+class FakeBackend(object):
+
+    def __init__(self):
+        self.changed_paths = set()
+        self.timeouts = []
+
+    def get_changed_paths(self, timeout=0):
+        self.timeouts.append(timeout)
+        changed_paths, self.changed_paths = self.changed_paths, set()
+        return changed_paths
+
+
+class TestSoaConfigWatcher:
+
+    def test_first_poll_reports_everything(self, soa_dir):
+        watcher = soa_config_watcher.SoaConfigWatcher('fake_cluster', soa_dir, backend=FakeBackend())
+        assert watcher.poll() == {
+            'marathon': set([('fake_service', 'main'), ('fake_service', 'canary'), ('other_service', 'main')]),
+            'chronos': set([('fake_service', 'job')]),
+        }
+        assert watcher.poll(timeout=3) == {'marathon': set(), 'chronos': set()}
+        assert watcher.backend.timeouts == [3]
+        assert watcher.get_service_instances('chronos') == set([('fake_service', 'job')])
+
+    def test_maps_changed_files_to_instances(self, soa_dir):
+        watcher = soa_config_watcher.SoaConfigWatcher('fake_cluster', soa_dir, backend=FakeBackend())
+        watcher.poll()
+        path = lambda service, filename: os.path.join(soa_dir, service, filename)
+
+        watcher.backend.changed_paths = set([path('fake_service', 'deployments.json')])
+        assert watcher.poll() == {
+            'marathon': set([('fake_service', 'main'), ('fake_service', 'canary')]),
+            'chronos': set([('fake_service', 'job')]),
+        }
+
+        watcher.backend.changed_paths = set([
+            path('other_service', 'smartstack.yaml'),
+            path('other_service', 'marathon-other_cluster.yaml'),
+            path('other_service', '.deployments.json.XXXXXX'),
+            os.path.join(soa_dir, 'not_a_service_file'),
+            os.path.join(soa_dir, 'other_service', 'nested', 'deployments.json'),
+            '/somewhere/else/fake_service/deployments.json',
+        ])
+        assert watcher.poll() == {'marathon': set([('other_service', 'main')]), 'chronos': set()}
+
+    def test_rereads_changed_instance_lists(self, soa_dir):
+        watcher = soa_config_watcher.SoaConfigWatcher('fake_cluster', soa_dir, backend=FakeBackend())
+        watcher.poll()
+        marathon_path = os.path.join(soa_dir, 'fake_service', 'marathon-fake_cluster.yaml')
+        write_file(marathon_path, 'main: {}\n')
+        watcher.backend.changed_paths = set([marathon_path])
+        assert watcher.poll() == {'marathon': set([('fake_service', 'main')]), 'chronos': set()}
+        assert watcher.get_service_instances('marathon') == set([('fake_service', 'main'), ('other_service', 'main')])
+
+        shutil.rmtree(os.path.join(soa_dir, 'other_service'))
+        watcher.backend.changed_paths = set([os.path.join(soa_dir, 'other_service')])
+        assert watcher.poll() == {'marathon': set(), 'chronos': set()}
+        assert watcher.get_service_instances('marathon') == set([('fake_service', 'main')])
+
+    def test_soa_dir_itself_means_everything_changed(self, soa_dir):
+        watcher = soa_config_watcher.SoaConfigWatcher('fake_cluster', soa_dir, instance_types=['marathon'],
+                                                      backend=FakeBackend())
+        assert watcher.poll() == {
+            'marathon': set([('fake_service', 'main'), ('fake_service', 'canary'), ('other_service', 'main')])}
+        shutil.rmtree(os.path.join(soa_dir, 'other_service'))
+        watcher.backend.changed_paths = set([soa_dir])
+        assert watcher.poll() == {'marathon': set([('fake_service', 'main'), ('fake_service', 'canary')])}
+        assert watcher.get_service_instances('marathon') == set([('fake_service', 'main'), ('fake_service', 'canary')])
+
+    def test_with_polling_backend(self, soa_dir):
+        watcher = soa_config_watcher.SoaConfigWatcher('fake_cluster', soa_dir, instance_types=['chronos'])
+        with mock.patch('paasta_tools.soa_config_watcher.pyinotify', None):
+            assert watcher.poll() == {'chronos': set([('fake_service', 'job')])}
+        assert isinstance(watcher.backend, soa_config_watcher.PollingBackend)
+        write_file(os.path.join(soa_dir, 'fake_service', 'chronos-fake_cluster.yaml'), 'job: {}\nother: {}\n',
+                   mtime_offset=10)
+        assert watcher.poll() == {'chronos': set([('fake_service', 'job'), ('fake_service', 'other')])}
+
+    @requires_pyinotify
+    def test_with_inotify_backend(self, soa_dir):
+        watcher = soa_config_watcher.SoaConfigWatcher('fake_cluster', soa_dir, instance_types=['marathon'])
+        assert watcher.poll() == {
+            'marathon': set([('fake_service', 'main'), ('fake_service', 'canary'), ('other_service', 'main')])}
+        try:
+            assert isinstance(watcher.backend, soa_config_watcher.InotifyBackend)
+            write_file(os.path.join(soa_dir, 'other_service', 'marathon-fake_cluster.yaml'), 'main: {}\nnew: {}\n')
+            assert watcher.poll(timeout=1) == {'marathon': set([('other_service', 'main'), ('other_service', 'new')])}
+            assert watcher.poll() == {'marathon': set()}
+        finally:
+            watcher.backend.close()
+
+
+class TestDebouncer:
+
+    def test_ready_after_quiet_period(self):
+        debouncer = soa_config_watcher.Debouncer(quiet_period=2, max_delay=30)
+        assert debouncer.get_ready_time() is None
+        assert debouncer.take(100) == set()
+        debouncer.add(['a'], 100)
+        debouncer.add([], 101)
+        assert debouncer.get_ready_time() == 102
+        debouncer.add(['b', 'a'], 101.5)
+        assert debouncer.take(103) == set()
+        assert debouncer.take(103.5) == set(['a', 'b'])
+        assert debouncer.get_ready_time() is None
+
+    def test_ready_after_max_delay(self):
+        debouncer = soa_config_watcher.Debouncer(quiet_period=2, max_delay=5)
+        for now in range(100, 106):
+            debouncer.add([now], now)
+        assert debouncer.get_ready_time() == 105
+        assert debouncer.take(105) == set(range(100, 106))
+        debouncer.add(['c'], 106)
+        assert debouncer.get_ready_time() == 108
@@ -18,6 +18,7 @@ import os
 import shutil
 import stat
 import tempfile
+import threading
 
 import mock
 from pytest import raises
@@ -359,6 +360,20 @@ def test_SystemPaastaConfig_get_sensu_port():
     assert actual == expected
 
 
+def test_SystemPaastaConfig_get_autoscaling_history_dir_default():
+    fake_config = utils.SystemPaastaConfig({}, '/some/fake/dir')
+    actual = fake_config.get_autoscaling_history_dir()
+    expected = '/var/lib/paasta/autoscaling_history'
+    assert actual == expected
+
+
+def test_SystemPaastaConfig_get_autoscaling_history_dir():
+    fake_config = utils.SystemPaastaConfig({"autoscaling_history_dir": "/fake/history"}, '/some/fake/dir')
+    actual = fake_config.get_autoscaling_history_dir()
+    expected = '/fake/history'
+    assert actual == expected
+
+
 def test_SystemPaastaConfig_get_cluster_fqdn_format_default():
     fake_config = utils.SystemPaastaConfig({}, '/some/fake/dir')
     actual = fake_config.get_cluster_fqdn_format()
@@ -426,6 +441,22 @@ def test_atomic_file_write_itest():
         shutil.rmtree(tempdir)
 
 
+def test_write_file_if_changed():
+    tempdir = tempfile.mkdtemp()
+    target_file_name = os.path.join(tempdir, 'services.yaml')
+
+    try:
+        assert utils.write_file_if_changed(target_file_name, 'content')
+        with mock.patch('paasta_tools.utils.atomic_file_write', autospec=True) as mock_atomic_file_write:
+            assert not utils.write_file_if_changed(target_file_name, 'content')
+            assert mock_atomic_file_write.call_count == 0
+        assert utils.write_file_if_changed(target_file_name, 'new content')
+        with open(target_file_name) as f:
+            assert f.read() == 'new content'
+    finally:
+        shutil.rmtree(tempdir)
+
+
 def test_configure_log():
     fake_log_writer_config = {'driver': 'fake', 'options': {'fake_arg': 'something'}}
     with mock.patch('paasta_tools.utils.load_system_paasta_config') as mock_load_system_paasta_config:
@@ -1367,6 +1398,75 @@ class TestFileLogWriter:
             fake_file.write.assert_called_once_with("%s\n" % fake_line)
 
 
+def test_statsd_timing_sink_format_packet():
+    sink = utils.StatsdTimingSink(prefix='paasta')
+    assert sink.format_packet('setup_marathon_job.total', 1.2345, {'service': 'foo'}) == \
+        'paasta.setup_marathon_job.total:1235|ms'
+    sink = utils.StatsdTimingSink(prefix='paasta', dogstatsd=True)
+    assert sink.format_packet('setup_marathon_job.total', 0.5, {'service': 'foo', 'instance': 'main'}) == \
+        'paasta.setup_marathon_job.total:500|ms|#instance:main,service:foo'
+
+
+def test_statsd_timing_sink_emit_swallows_socket_errors():
+    sink = utils.StatsdTimingSink(host='fake_host', port='1234')
+    sink.sock = mock.Mock()
+    sink.sock.sendto.side_effect = utils.socket.error
+    sink.emit('fake_phase', 1, {})
+    sink.sock.sendto.assert_called_once_with('paasta.fake_phase:1000|ms', ('fake_host', 1234))
+
+
+def test_jsonl_timing_sink():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmpdir, 'timings.jsonl')
+        sink = utils.JsonlTimingSink(path=path)
+        sink.emit('fake_phase', 1.5, {'service': 'foo'})
+        sink.emit('other_phase', 2, {})
+        with open(path) as f:
+            lines = [json.loads(line) for line in f]
+        assert [(line['name'], line['duration'], line['tags']) for line in lines] == [
+            ('fake_phase', 1.5, {'service': 'foo'}),
+            ('other_phase', 2, {}),
+        ]
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def test_configure_timing():
+    fake_config = utils.SystemPaastaConfig({
+        'timing_sinks': [
+            {'driver': 'null'},
+            {'driver': 'jsonl', 'options': {'path': '/dev/null'}},
+        ],
+    }, '/fake/dir')
+    with mock.patch('paasta_tools.utils._timing_sink', None):
+        assert isinstance(utils.get_timing_sink(), utils.NullTimingSink)
+        sink = utils.configure_timing(fake_config)
+        assert utils.get_timing_sink() is sink
+        assert [type(s) for s in sink.sinks] == [utils.NullTimingSink, utils.JsonlTimingSink]
+
+
+def test_timed_emits_tags_and_duration_even_on_error():
+    fake_sink = mock.Mock()
+    with contextlib.nested(
+        mock.patch('paasta_tools.utils._timing_sink', fake_sink),
+        mock.patch('paasta_tools.utils.time.time', side_effect=[10, 12.5, 20, 21, 30, 30]),
+    ):
+        with utils.timing_tags(service='foo', instance='main'):
+            with utils.timed('fake_phase', extra='tag'):
+                pass
+            with raises(ValueError):
+                with utils.timed('failing_phase'):
+                    raise ValueError()
+        assert fake_sink.emit.call_args_list == [
+            mock.call('fake_phase', 2.5, {'service': 'foo', 'instance': 'main', 'extra': 'tag'}),
+            mock.call('failing_phase', 1, {'service': 'foo', 'instance': 'main'}),
+        ]
+        with utils.timed('untagged_phase'):
+            pass
+        fake_sink.emit.assert_called_with('untagged_phase', 0, {})
+
+
 def test_deep_merge_dictionaries():
     overrides = {
         'common_key': 'value',
@@ -1409,3 +1509,243 @@ def test_deep_merge_dictionaries():
         'overwriting_dict': {'test': 'value'},
     }
     assert utils.deep_merge_dictionaries(overrides, defaults) == expected
+
+
+def test_layered_config_resolves_like_deep_merge_dictionaries():
+    overrides = {
+        'common_key': 'value',
+        'common_dict': {'subkey1': 1, 'nested': {'a': 1}},
+        'overwriting_key': {'test': 'value'},
+        'overwriting_dict': 'value',
+    }
+    defaults = {
+        'common_key': 'overwritten_value',
+        'common_dict': {'subkey1': 'overwritten_value', 'subkey2': 2, 'nested': {'b': 2}},
+        'just_in_defaults': 'value',
+        'overwriting_key': 'value',
+        'overwriting_dict': {'test': 'value'},
+    }
+    layered = utils.LayeredConfig(overrides, defaults)
+    assert layered == utils.deep_merge_dictionaries(overrides, defaults)
+    assert layered.materialize() == utils.deep_merge_dictionaries(overrides, defaults)
+    assert type(layered.materialize()['common_dict']['nested']) is dict
+    assert layered['common_dict']['nested'] == {'a': 1, 'b': 2}
+    assert sorted(layered) == ['common_dict', 'common_key', 'just_in_defaults', 'overwriting_dict', 'overwriting_key']
+    assert len(layered) == 5
+    assert 'just_in_defaults' in layered
+    assert 'missing' not in layered
+    assert layered.get('missing', 'default') == 'default'
+    with raises(KeyError):
+        layered['missing']
+
+
+def test_layered_config_does_not_copy_or_write_through():
+    shared = {'cpus': 1, 'env': {'A': 'a'}}
+    layered = utils.LayeredConfig({'cpus': 2}, shared)
+    with raises(TypeError):
+        layered['cpus'] = 3
+    with raises(TypeError):
+        layered['env']['A'] = 'b'
+    assert layered['env'].layers[0] is shared['env']
+    assert shared == {'cpus': 1, 'env': {'A': 'a'}}
+
+
+def test_materialize_leaves_non_mappings_alone():
+    value = [1, 2]
+    assert utils.materialize(value) is value
+    assert utils.materialize(utils.LayeredConfig({'a': {'b': 1}})) == {'a': {'b': 1}}
+
+
+def test_instance_config_interpolates_deploy_group_without_mutating_config_dict():
+    config_dict = {'deploy_group': '{cluster}.{instance}'}
+    config = utils.InstanceConfig(
+        cluster='fake_cluster',
+        instance='fake_instance',
+        service='fake_service',
+        config_dict=config_dict,
+        branch_dict={},
+    )
+    assert config.get_deploy_group() == 'fake_cluster.fake_instance'
+    assert config_dict == {'deploy_group': '{cluster}.{instance}'}
+
+
+def test_zookeeper_session_shares_one_client_across_threads():
+    with mock.patch('paasta_tools.utils.KazooClient', autospec=True) as mock_kazoo:
+        session = utils.ZookeeperSession('fake_hosts')
+        leased = [threading.Event() for _ in range(8)]
+        done = threading.Event()
+        seen = []
+
+        def worker(event):
+            with session.lease() as zk:
+                seen.append(zk)
+                event.set()
+                done.wait()
+
+        threads = [threading.Thread(target=worker, args=(event,)) for event in leased]
+        for thread in threads:
+            thread.start()
+        for event in leased:
+            event.wait()
+        assert session.leases == 8
+        done.set()
+        for thread in threads:
+            thread.join()
+
+        mock_kazoo.assert_called_once_with(hosts='fake_hosts', timeout=utils.ZK_SESSION_TIMEOUT_S, read_only=False)
+        assert all(zk is mock_kazoo.return_value for zk in seen)
+        mock_kazoo.return_value.start.assert_called_once_with()
+        mock_kazoo.return_value.stop.assert_called_once_with()
+        assert session.zk is None
+        assert session.leases == 0
+
+
+def test_zookeeper_session_restarts_after_last_lease():
+    with mock.patch('paasta_tools.utils.KazooClient', autospec=True) as mock_kazoo:
+        session = utils.ZookeeperSession('fake_hosts')
+        with session.lease():
+            pass
+        with session.lease():
+            pass
+        assert mock_kazoo.call_count == 2
+
+
+def test_zookeeper_session_failed_start_takes_no_lease():
+    with mock.patch('paasta_tools.utils.KazooClient', autospec=True) as mock_kazoo:
+        mock_kazoo.return_value.start.side_effect = utils.TimeoutError
+        session = utils.ZookeeperSession('fake_hosts')
+        with raises(utils.TimeoutError):
+            session.acquire()
+        assert session.zk is None
+        assert session.leases == 0
+
+
+def test_zookeeper_session_counts_expirations():
+    with mock.patch('paasta_tools.utils.KazooClient', autospec=True) as mock_kazoo:
+        session = utils.ZookeeperSession('fake_hosts')
+        with session.lease():
+            listener = mock_kazoo.return_value.add_listener.call_args[0][0]
+            listener(utils.KazooState.SUSPENDED)
+            listener(utils.KazooState.CONNECTED)
+            assert session.expirations == 0
+            listener(utils.KazooState.LOST)
+            assert session.expirations == 1
+
+
+def test_get_zookeeper_session_is_per_hosts():
+    with mock.patch('paasta_tools.utils.load_system_paasta_config', autospec=True) as mock_load_config:
+        mock_load_config.return_value.get_zk_hosts.return_value = 'cluster_zk'
+        session = utils.get_zookeeper_session()
+        assert session.hosts == 'cluster_zk'
+        assert utils.get_zookeeper_session() is session
+        assert utils.get_zookeeper_session('cluster_zk') is session
+        assert utils.get_zookeeper_session('mesos_zk') is not session
+        read_only_session = utils.get_zookeeper_session(read_only=True)
+        assert read_only_session is not session
+        assert read_only_session.read_only
+        assert utils.get_zookeeper_session('cluster_zk', read_only=True) is read_only_session
+
+
+def test_zookeeper_pool_is_read_only():
+    with contextlib.nested(
+        mock.patch('paasta_tools.utils.load_system_paasta_config', autospec=True),
+        mock.patch('paasta_tools.utils.KazooClient', autospec=True),
+    ) as (mock_load_config, mock_kazoo):
+        mock_load_config.return_value.get_zk_hosts.return_value = 'pool_zk'
+        with utils.ZookeeperPool() as zk:
+            assert zk is mock_kazoo.return_value
+        mock_kazoo.assert_called_once_with(hosts='pool_zk', timeout=utils.ZK_SESSION_TIMEOUT_S, read_only=True)
+
+
+def test_deadline_timeout_without_deadline():
+    assert utils.current_deadline() is None
+    assert utils.deadline_timeout() is None
+    assert utils.deadline_timeout(5) == 5
+    utils.check_deadline()
+
+
+def test_nested_deadlines_use_the_earliest():
+    with utils.Deadline(60) as outer:
+        assert utils.current_deadline() is outer
+        with utils.Deadline(10) as inner:
+            assert utils.current_deadline() is inner
+            assert 0 < utils.deadline_timeout() <= 10
+            assert utils.deadline_timeout(1) == 1
+            with utils.Deadline(100):
+                assert utils.current_deadline() is inner
+        assert utils.current_deadline() is outer
+    assert utils.current_deadline() is None
+
+
+def test_expired_deadline_raises():
+    with utils.Deadline(-1, error_message='too slow'):
+        with raises(utils.TimeoutError) as excinfo:
+            utils.deadline_timeout(5)
+        assert str(excinfo.value) == 'too slow'
+        with raises(utils.TimeoutError):
+            utils.check_deadline()
+
+
+def test_deadline_custom_exception():
+    class FakeException(Exception):
+        pass
+
+    with utils.Deadline(-1, exception=FakeException):
+        with raises(FakeException):
+            utils.check_deadline()
+
+
+def test_deadlines_are_per_thread():
+    seen = []
+
+    def worker():
+        seen.append(utils.current_deadline())
+
+    with utils.Deadline(10) as deadline:
+        thread = threading.Thread(target=worker)
+        thread.start()
+        thread.join()
+        assert seen == [None]
+
+        def shared_worker():
+            with deadline:
+                seen.append(utils.current_deadline())
+        thread = threading.Thread(target=shared_worker)
+        thread.start()
+        thread.join()
+        assert seen == [None, deadline]
+        assert utils.current_deadline() is deadline
+
+
+def test_sleep_within_deadline_stops_at_the_deadline():
+    with contextlib.nested(
+        mock.patch('paasta_tools.utils.time.sleep', autospec=True),
+        mock.patch('paasta_tools.utils.time.time', autospec=True, side_effect=[0, 0, 0, 0, 2, 2]),
+    ) as (
+        mock_sleep,
+        _,
+    ):
+        with utils.Deadline(1):
+            with raises(utils.TimeoutError):
+                utils.sleep_within_deadline(30)
+        mock_sleep.assert_called_once_with(1)
+
+
+def test_timeout_decorator_works_outside_the_main_thread():
+    results = []
+
+    @utils.timeout(seconds=-1, error_message='expired')
+    def slow():
+        utils.check_deadline()
+
+    def worker():
+        try:
+            slow()
+        except utils.TimeoutError as e:
+            results.append(str(e))
+
+    thread = threading.Thread(target=worker)
+    thread.start()
+    thread.join()
+    assert results == ['expired']
+    assert utils.current_deadline() is None